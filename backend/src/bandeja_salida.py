@@ -0,0 +1,446 @@
+import asyncio
+import os
+import random
+import sqlite3
+import time
+import traceback
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
+from cliente_whatsapp import whatsapp_client
+
+# ============================================================================
+# 📤 BANDEJA DE SALIDA (OUTBOX) DE MENSAJES DE WHATSAPP
+# ============================================================================
+
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", "messages.db")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BASE_BACKOFF = float(os.getenv("OUTBOX_BASE_BACKOFF", "2"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "300"))
+# Separación mínima (s) entre mensajes a un mismo número y tope global por segundo
+OUTBOX_PER_NUMBER_INTERVAL = float(os.getenv("OUTBOX_PER_NUMBER_INTERVAL", "1"))
+OUTBOX_MAX_PER_SECOND = float(os.getenv("OUTBOX_MAX_PER_SECOND", "50"))
+OUTBOX_POLL_INTERVAL = 1.0
+# Segundos que stop() espera a los envíos en curso antes de cancelarlos
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "15"))
+
+# Código de la Graph API para el límite de throughput de la cuenta (afecta a todos los números)
+GRAPH_THROUGHPUT_LIMIT_CODE = 130429
+
+STATUS_QUEUED = "queued"
+STATUS_SENDING = "sending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+
+class OutboxStore:
+    """Tabla outbox en SQLite (junto a messages.db): los envíos pendientes sobreviven a reinicios"""
+
+    def __init__(self, db_path: str = OUTBOX_DB_PATH):
+        self.db_path = db_path
+        self.lock = Lock()
+        self._init_database()
+
+    def _init_database(self):
+        """Crear la tabla outbox si no existe"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phone_number TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    conversation_id TEXT,
+                    message_id TEXT,
+                    status TEXT DEFAULT 'queued',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    last_error TEXT,
+                    whatsapp_message_id TEXT,
+                    created_at REAL,
+                    sent_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_phone ON outbox(status, phone_number, id)")
+            conn.commit()
+
+    def add(self, phone_number: str, body: str, conversation_id: str = None, message_id: str = None) -> int:
+        """Encola un envío y retorna su id"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute(
+                    """INSERT INTO outbox (phone_number, body, conversation_id, message_id, created_at)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (phone_number, body, conversation_id, message_id, time.time())
+                )
+                conn.commit()
+                return cursor.lastrowid
+
+    def queued(self, limit: int = 200) -> List[Dict[str, Any]]:
+        """Envíos pendientes en orden de llegada"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM outbox WHERE status = 'queued' ORDER BY id ASC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def due_heads(self, now: float, limit: int = 200) -> List[Dict[str, Any]]:
+        """
+        Primer envío pendiente de cada número, si ya le toca salir. Un número con
+        muchos mensajes retenidos (backoff, 429) ocupa una sola fila y no tapa a los demás.
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                """SELECT o.* FROM outbox o
+                   JOIN (SELECT MIN(id) AS id FROM outbox WHERE status = 'queued' GROUP BY phone_number) heads
+                     ON o.id = heads.id
+                   WHERE o.next_attempt_at <= ?
+                   ORDER BY o.id ASC LIMIT ?""",
+                (now, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark_sent(self, entry_id: int, whatsapp_message_id: str = None):
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(
+                    """UPDATE outbox SET status = 'sent', attempts = attempts + 1,
+                       whatsapp_message_id = ?, sent_at = ?, last_error = NULL WHERE id = ?""",
+                    (whatsapp_message_id, time.time(), entry_id)
+                )
+                conn.commit()
+
+    def mark_sending(self, entry_id: int):
+        """El POST a la Graph API está por salir: si el proceso muere, el resultado es desconocido"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("UPDATE outbox SET status = 'sending' WHERE id = ?", (entry_id,))
+                conn.commit()
+
+    def reconcile_interrupted(self) -> List[Dict[str, Any]]:
+        """
+        Envíos que quedaron en 'sending' (apagado o caída durante el POST). Pudieron
+        llegar al usuario, así que no se reenvían: se marcan fallidos para revisión.
+        """
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                rows = [dict(row) for row in conn.execute("SELECT * FROM outbox WHERE status = 'sending'")]
+                conn.execute(
+                    """UPDATE outbox SET status = 'failed',
+                       last_error = 'Envío interrumpido: no se sabe si llegó, no se reenvía' WHERE status = 'sending'"""
+                )
+                conn.commit()
+        return rows
+
+    def reschedule(self, entry_id: int, next_attempt_at: float, error: str):
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(
+                    """UPDATE outbox SET status = 'queued', attempts = attempts + 1, next_attempt_at = ?,
+                       last_error = ? WHERE id = ?""",
+                    (next_attempt_at, error, entry_id)
+                )
+                conn.commit()
+
+    def mark_failed(self, entry_id: int, error: str):
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(
+                    "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                    (error, entry_id)
+                )
+                conn.commit()
+
+    def count_by_status(self) -> Dict[str, int]:
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Segundos indicados en la cabecera Retry-After (None si no viene o no es numérica)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class OutboxSender:
+    """
+    Vacía la bandeja de salida en segundo plano.
+
+    Los mensajes de un mismo número salen en orden y con una separación mínima;
+    los errores transitorios (red, 5xx, 429) se reintentan con backoff
+    exponencial respetando Retry-After, y los 4xx restantes fallan de inmediato.
+    """
+
+    def __init__(self, store: OutboxStore = None, client=None, workers: int = OUTBOX_WORKERS,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS, per_number_interval: float = OUTBOX_PER_NUMBER_INTERVAL,
+                 max_per_second: float = OUTBOX_MAX_PER_SECOND, on_status: Callable[[Dict[str, Any], str], None] = None):
+        self.store = store or OutboxStore()
+        self.client = client or whatsapp_client
+        self.num_workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.per_number_interval = per_number_interval
+        self.min_global_interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self.on_status = on_status
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._tasks: set = set()
+        self._in_flight_numbers: set = set()
+        self._next_allowed: Dict[str, float] = {}
+        self._global_next_allowed = 0.0
+        self.stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "total_send_latency": 0.0,
+            "total_queue_delay": 0.0
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._loop_task is not None and not self._loop_task.done()
+
+    async def enqueue(self, phone_number: str, body: str, conversation_id: str = None, message_id: str = None) -> int:
+        """Guarda el envío en la outbox y despierta al sender. No espera a la Graph API"""
+        # SQLite fuera del event loop: el webhook no se bloquea mientras se escribe
+        entry_id = await asyncio.to_thread(self.store.add, phone_number, body, conversation_id, message_id)
+        self.stats["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return entry_id
+
+    async def start(self):
+        """Arranca el bucle del sender; los envíos pendientes de ejecuciones anteriores se reanudan"""
+        if self.running:
+            return
+        self._semaphore = asyncio.Semaphore(self.num_workers)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        for entry in await asyncio.to_thread(self.store.reconcile_interrupted):
+            self.stats["failed"] += 1
+            print(f"⚠️ Envío #{entry['id']} a {entry['phone_number']} interrumpido en la ejecución anterior: no se reenvía")
+            await self._notify(entry, STATUS_FAILED)
+        self._loop_task = asyncio.create_task(self._run())
+        print(f"✅ Outbox de WhatsApp iniciada ({self.num_workers} envíos en paralelo)")
+
+    async def stop(self, drain_timeout: float = None):
+        """
+        Detiene el sender. Los envíos en curso terminan (hasta `drain_timeout`) para no
+        cortar un POST que ya salió; lo que no se envió sigue en la outbox.
+        """
+        # El bucle también revisa esta bandera: wait_for puede absorber la cancelación
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+
+        drain_timeout = OUTBOX_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        tasks = list(self._tasks)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._loop_task = None
+        self._tasks.clear()
+        self._in_flight_numbers.clear()
+        print("✅ Outbox de WhatsApp detenida")
+
+    async def flush(self, timeout: float = 10.0):
+        """Espera a que no queden envíos pendientes (incluidos reintentos) en la outbox"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self._tasks and not await asyncio.to_thread(self.store.queued, 1):
+                return
+            await asyncio.sleep(0.01)
+
+    async def _due_entries(self, now: float) -> List[Dict[str, Any]]:
+        """Primer envío pendiente de cada número libre, si ya le toca salir"""
+        heads = await asyncio.to_thread(self.store.due_heads, now)
+        # Mantener el orden: el siguiente mensaje de un número espera al anterior
+        return [entry for entry in heads if entry["phone_number"] not in self._in_flight_numbers]
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                self._wakeup.clear()
+                now = time.time()
+                monotonic_now = time.monotonic()
+                for entry in await self._due_entries(now):
+                    phone = entry["phone_number"]
+                    if self._next_allowed.get(phone, 0.0) > monotonic_now:
+                        continue
+                    self._in_flight_numbers.add(phone)
+                    task = asyncio.create_task(self._deliver(entry))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._task_done)
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_wakeup_delay())
+            except asyncio.TimeoutError:
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Error en el bucle de la outbox: {str(e)}")
+                traceback.print_exc()
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    def _next_wakeup_delay(self) -> float:
+        """Hasta cuándo dormir: el próximo número que queda libre o el intervalo de sondeo"""
+        now = time.monotonic()
+        pending = [t - now for t in self._next_allowed.values() if t > now]
+        return min([OUTBOX_POLL_INTERVAL] + pending)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _deliver(self, entry: Dict[str, Any]):
+        """Envía una entrada de la outbox y registra el resultado"""
+        phone = entry["phone_number"]
+        try:
+            async with self._semaphore:
+                await self._respect_global_rate()
+                await asyncio.to_thread(self.store.mark_sending, entry["id"])
+                self.stats["total_queue_delay"] += max(0.0, time.time() - entry["created_at"])
+                start = time.perf_counter()
+                try:
+                    response = await self.client.send_text(phone, entry["body"])
+                except Exception as e:
+                    await self._retry_or_fail(entry, f"{type(e).__name__}: {str(e)}")
+                    return
+                finally:
+                    self.stats["total_send_latency"] += time.perf_counter() - start
+                    self._next_allowed[phone] = time.monotonic() + self.per_number_interval
+                await self._handle_response(entry, response)
+        finally:
+            self._in_flight_numbers.discard(phone)
+            self._prune_next_allowed()
+
+    async def _respect_global_rate(self):
+        """Reparte los envíos en el tiempo para no superar el tope global por segundo"""
+        now = time.monotonic()
+        slot = max(now, self._global_next_allowed)
+        self._global_next_allowed = slot + self.min_global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _handle_response(self, entry: Dict[str, Any], response):
+        status_code = response.status_code
+        if status_code < 400:
+            whatsapp_message_id = None
+            try:
+                whatsapp_message_id = response.json().get("messages", [{}])[0].get("id")
+            except Exception:
+                pass
+            await asyncio.to_thread(self.store.mark_sent, entry["id"], whatsapp_message_id)
+            self.stats["sent"] += 1
+            await self._notify(entry, STATUS_SENT)
+            return
+
+        error = f"HTTP {status_code}: {response.text[:500]}"
+        if status_code == 429:
+            self.stats["rate_limited"] += 1
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                self._next_allowed[entry["phone_number"]] = time.monotonic() + retry_after
+            if self._graph_error_code(response) == GRAPH_THROUGHPUT_LIMIT_CODE:
+                # Límite de la cuenta: frenar todos los envíos, no solo este número
+                pause = retry_after if retry_after is not None else self._backoff(entry["attempts"] + 1)
+                self._global_next_allowed = max(self._global_next_allowed, time.monotonic() + pause)
+            await self._retry_or_fail(entry, error, retry_after)
+        elif status_code >= 500:
+            await self._retry_or_fail(entry, error)
+        else:
+            # 4xx distintos de 429 (número inválido, token, payload): reintentar no sirve
+            await self._fail(entry, error)
+
+    @staticmethod
+    def _graph_error_code(response) -> Optional[int]:
+        try:
+            return response.json().get("error", {}).get("code")
+        except Exception:
+            return None
+
+    def _backoff(self, attempt: int) -> float:
+        """Backoff exponencial con jitter: base * 2^(intento-1), acotado"""
+        delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * (2 ** max(0, attempt - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _retry_or_fail(self, entry: Dict[str, Any], error: str, retry_after: float = None):
+        attempt = entry["attempts"] + 1
+        if attempt >= self.max_attempts:
+            await self._fail(entry, error)
+            return
+        delay = retry_after if retry_after is not None else self._backoff(attempt)
+        await asyncio.to_thread(self.store.reschedule, entry["id"], time.time() + delay, error)
+        self.stats["retries"] += 1
+        print(f"⚠️ Envío a {entry['phone_number']} reprogramado en {delay:.1f}s "
+              f"(intento {attempt}/{self.max_attempts}): {error[:200]}")
+
+    async def _fail(self, entry: Dict[str, Any], error: str):
+        await asyncio.to_thread(self.store.mark_failed, entry["id"], error)
+        self.stats["failed"] += 1
+        print(f"❌ Envío a {entry['phone_number']} fallido definitivamente: {error[:200]}")
+        await self._notify(entry, STATUS_FAILED)
+
+    async def _notify(self, entry: Dict[str, Any], status: str):
+        """on_status escribe el estado en la conversación (SQLite): también fuera del event loop"""
+        if self.on_status is None:
+            return
+        try:
+            await asyncio.to_thread(self.on_status, entry, status)
+        except Exception as e:
+            print(f"❌ Error actualizando estado del mensaje {entry.get('message_id')}: {str(e)}")
+
+    def _prune_next_allowed(self):
+        if len(self._next_allowed) > 1024:
+            now = time.monotonic()
+            for phone in [p for p, t in self._next_allowed.items() if t <= now]:
+                del self._next_allowed[phone]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de la outbox"""
+        delivered = self.stats["sent"] + self.stats["failed"]
+        attempts = delivered + self.stats["retries"]
+        by_status = self.store.count_by_status()
+        return {
+            "enqueued": self.stats["enqueued"],
+            "sent": self.stats["sent"],
+            "failed": self.stats["failed"],
+            "retries": self.stats["retries"],
+            "rate_limited": self.stats["rate_limited"],
+            "running": self.running,
+            "in_flight": len(self._tasks),
+            "depth": by_status.get(STATUS_QUEUED, 0),
+            "by_status": by_status,
+            "avg_send_latency_ms": round(self.stats["total_send_latency"] / attempts * 1000, 2) if attempts else 0.0,
+            "avg_queue_delay_ms": round(self.stats["total_queue_delay"] / attempts * 1000, 2) if attempts else 0.0
+        }
+
+
+# Instancia global compartida por main.py y web_api.py
+outbox_sender = OutboxSender()
+
+
+async def send_whatsapp_message(phone_number: str, response_data: dict,
+                                conversation_id: str = None, message_id: str = None) -> int:
+    """Encola un mensaje de WhatsApp en la outbox; el sender lo entrega en segundo plano"""
+    entry_id = await outbox_sender.enqueue(phone_number, response_data["response"], conversation_id, message_id)
+    print(f"📤 Mensaje para {phone_number} encolado en la outbox (#{entry_id})")
+    return entry_id
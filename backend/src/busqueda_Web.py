@@ -1,3 +1,4 @@
+import asyncio
 import traceback
 from bs4 import BeautifulSoup
 import aiohttp
@@ -41,8 +42,9 @@ class WebSearchAgent:
                 "hl": "es"   # Idioma español
             }
             
+            # SerpAPI es bloqueante: se ejecuta fuera del event loop
             search = GoogleSearch(params)
-            results = search.get_dict()
+            results = await asyncio.to_thread(search.get_dict)
             
             # 2. Procesar resultados - priorizar documentos y contenido relevante
             web_results = []
@@ -77,7 +79,7 @@ class WebSearchAgent:
             # 3. Extraer contenido de PDFs (máximo 3 para más información)
             for url in pdf_urls[:3]:
                 try:
-                    content = self.extract_pdf_content(url)
+                    content = await asyncio.to_thread(self.extract_pdf_content, url)
                     if content and len(content) > 100:
                         pdf_contents[url] = content
                         print(f"✅ PDF procesado: {len(content)} caracteres")
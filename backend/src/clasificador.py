@@ -0,0 +1,580 @@
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from corrector import normalize_text, strip_accents
+from utilidades import LRUTTLCache
+
+# ============================================================================
+# 🏷️ CLASIFICADOR LABORAL / NO LABORAL
+# ============================================================================
+
+LABORAL = "LABORAL"
+NO_LABORAL = "NO_LABORAL"
+
+CLASSIFIER_CONFIDENCE_THRESHOLD = float(os.getenv("CLASSIFIER_CONFIDENCE_THRESHOLD", "0.8"))
+# Junto a la memoria local (memory_data/); la base se abre en el primer uso, no al importar
+CLASSIFIER_DB_PATH = os.getenv("CLASSIFIER_DB_PATH", os.path.join("memory_data", "classifier.db"))
+CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH", "classifier_model.json")
+CLASSIFIER_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", "5000"))
+CLASSIFIER_CACHE_TTL = int(os.getenv("CLASSIFIER_CACHE_TTL", "86400"))
+# Nivel persistente en SQLite, compartido entre procesos/workers (opcional)
+CLASSIFIER_CACHE_PERSISTENT = os.getenv("CLASSIFIER_CACHE_PERSISTENT", "false").lower() == "true"
+CLASSIFIER_CACHE_MAX_ROWS = int(os.getenv("CLASSIFIER_CACHE_MAX_ROWS", "50000"))
+
+LLM_CLASSIFICATION_PROMPT = """Eres un clasificador especializado en determinar si una consulta es LABORAL(saludos tambien son laborales) o NO LABORAL.
+
+CONSULTAS LABORALES (RESPONDER "LABORAL"):
+✅ Temas de trabajo, empleo, contratos, sueldos, horarios
+✅ Saludos, bienvenidas, despedidas, etc.
+✅ Vacaciones, permisos, licencias, días festivos
+✅ Beneficios laborales, bonificaciones, compensaciones
+✅ Seguridad social, salud ocupacional, riesgos laborales
+✅ Capacitación, desarrollo profesional, cursos laborales
+✅ Políticas de empresa, reglamentos internos, procedimientos
+✅ Relaciones laborales, conflictos, mediación
+✅ Terminación laboral, renuncias, despidos
+✅ Jornada de trabajo, horas extras, descansos
+✅ Condiciones de trabajo, ambiente laboral
+✅ Derechos y obligaciones del trabajador
+✅ Normativas laborales, leyes de trabajo
+✅ Evaluaciones de desempeño, ascensos
+✅ Herramientas de trabajo, equipos, recursos
+✅ Comunicación interna, reuniones, reportes
+
+CONSULTAS NO LABORALES (RESPONDER "NO_LABORAL"):
+❌ Chistes, memes, entretenimiento
+❌ Deportes, noticias generales, política
+❌ Cocina, recetas, restaurantes
+❌ Viajes, turismo, hoteles
+❌ Música, películas, series
+❌ Salud personal (no ocupacional)
+❌ Educación general (no capacitación laboral)
+❌ Compras personales, moda, tecnología
+❌ Familia, relaciones personales
+❌ Hobbies, pasatiempos, juegos
+❌ Religión, espiritualidad
+❌ Consultas técnicas generales (no relacionadas al trabajo)
+❌ Consultas sobre otros empleos o empresas
+❌ Temas personales no relacionados al trabajo actual
+
+REGLAS IMPORTANTES:
+1. Si hay AMBIGÜEDAD, clasifica como "LABORAL" para dar beneficio de la duda
+2. Considera el CONTEXTO de una empresa/ambiente laboral
+3. Si la consulta puede interpretarse como laboral, es LABORAL
+4. Solo clasifica como NO_LABORAL si es claramente no relacionado al trabajo
+
+RESPUESTA OBLIGATORIA:
+Responde ÚNICAMENTE con "LABORAL" o "NO_LABORAL" sin explicaciones adicionales.
+
+CONSULTA A CLASIFICAR: {query}"""
+
+# Reglas derivadas de las categorías del prompt. Se evalúan sobre texto en
+# minúsculas y sin tildes, así "capacitación" y "capacitacion" coinciden.
+GREETING_PATTERN = re.compile(
+    r"^(hola+|ola|buen[oa]s?( dias| tardes| noches)?|saludos|hey|que tal|gracias|muchas gracias|"
+    r"mil gracias|ok|okey|okay|vale|perfecto|genial|listo|chau|chao|adios|hasta luego|bye|"
+    r"nos vemos|bienvenid[oa]|si|no|entendido|de acuerdo)"
+    r"([\s,]+(tony|amigo|bot|gracias|a todos|por favor|igualmente))*[\s!.,?¡¿]*$"
+)
+
+LABORAL_PATTERNS = [
+    r"trabaj\w*", r"mis? (empleo|empleador|empresa)\w*", r"(nuestra|esta) empresa", r"contrat\w*", r"sueldo\w*", r"salari\w*", r"remunera\w*",
+    r"pago\w*", r"planilla\w*", r"boleta\w*", r"horari\w*", r"jornada\w*", r"turno\w*",
+    r"vacacion\w*", r"permiso\w*", r"licencia\w*", r"feriado\w*", r"dias? festivos?", r"descanso\w*",
+    r"beneficio\w*", r"bonifica\w*", r"bono\w*", r"gratificacion\w*", r"compensacion\w*", r"cts",
+    r"utilidades", r"asignacion familiar", r"seguro\w*", r"essalud", r"afp", r"onp", r"pension\w*",
+    r"salud ocupacional", r"riesgos? laboral\w*", r"accidente de trabajo", r"epp",
+    r"capacita\w*", r"curso\w*", r"taller\w*", r"certifica\w*", r"induccion", r"inscri\w*",
+    r"politica\w* de (la )?empresa", r"reglamento\w*", r"procedimiento\w*", r"norma\w* intern\w*",
+    r"renuncia\w*", r"despid\w*", r"liquidacion\w*", r"cese\w*", r"finiquito\w*",
+    r"horas? extras?", r"sobretiempo", r"tardanza\w*", r"falt\w*", r"asistencia\w*", r"marcacion\w*",
+    r"derechos? (del|de los) trabajador\w*", r"ley\w* laboral\w*", r"laboral\w*",
+    r"evaluacion\w* de desempeno", r"desempeno", r"ascenso\w*", r"promocion\w* interna\w*",
+    r"jefe\w*", r"supervisor\w*", r"gerente\w*", r"recursos humanos", r"rrhh", r"oficina\w*",
+    r"compan\w+ donde trabajo", r"reunion\w*", r"reporte\w*", r"memorandum\w*",
+    r"maternidad", r"paternidad", r"lactancia", r"descanso medico", r"subsidio\w*",
+    r"uniforme\w*", r"fotocheck", r"credencial\w*", r"equipo\w* de trabajo", r"herramienta\w* de trabajo",
+]
+
+NO_LABORAL_PATTERNS = [
+    r"chiste\w*", r"meme\w*", r"broma\w*", r"adivinanza\w*",
+    r"futbol\w*", r"partido\w*", r"mundial", r"champions", r"gol(es)?", r"equipo favorito",
+    r"noticia\w*", r"eleccion\w*", r"president[ea]\w*", r"congreso", r"politica nacional",
+    r"receta\w*", r"cocin\w*", r"restaurante\w*", r"ceviche", r"pizza\w*", r"postre\w*",
+    r"viaj\w*", r"turismo", r"hotel\w*", r"vuelo\w*", r"playa\w*",
+    r"musica", r"cancion\w*", r"pelicula\w*", r"serie\w* de (tv|television|netflix)", r"netflix", r"cantante\w*",
+    r"horoscopo\w*", r"signo zodiacal", r"religion\w*", r"iglesia\w*", r"rezar",
+    r"novi[oa]\w*", r"enamora\w*", r"cita romantica", r"mi pareja",
+    r"videojuego\w*", r"juego\w* de (mesa|video)", r"hobby\w*", r"pasatiempo\w*",
+    r"moda", r"ropa de moda", r"celular\w* (nuevo|barato)", r"iphone", r"playstation",
+    r"tarea\w* (de|del) colegio", r"ecuacion\w*", r"capital de", r"clima (de|en)",
+    r"loteria", r"apuesta\w*", r"casino\w*",
+]
+
+# Pueden referirse al trabajo actual o a otro ("empleos", "una empresa"): solas no bastan
+AMBIGUOUS_LABORAL_PATTERNS = [r"emple\w*", r"empresa\w*", r"compan\w+"]
+
+# "Consultas sobre otros empleos o empresas" son NO_LABORAL según el prompt
+OTHER_EMPLOYER_PATTERNS = [
+    r"otr[oa]s? (empleo|empresa|trabajo|compan\w+)\w*", r"ofertas? de (empleo|trabajo)\w*",
+    r"(busco|buscar|buscando|conseguir|consigo) (un |otro |nuevo )*(empleo|trabajo|chamba)\w*",
+    r"(empresa|trabajo|empleo)\w* de mi (amig[oa]|prim[oa]|herman[oa]|papa|mama|espos[oa])\w*",
+]
+
+_LABORAL_RE = re.compile(r"\b(" + "|".join(LABORAL_PATTERNS) + r")\b")
+_AMBIGUOUS_LABORAL_RE = re.compile(r"\b(" + "|".join(AMBIGUOUS_LABORAL_PATTERNS) + r")\b")
+_OTHER_EMPLOYER_RE = re.compile(r"\b(" + "|".join(OTHER_EMPLOYER_PATTERNS) + r")\b")
+_NO_LABORAL_RE = re.compile(r"\b(" + "|".join(NO_LABORAL_PATTERNS) + r")\b")
+
+
+def normalize_query(query: str) -> str:
+    """Texto de la consulta en minúsculas, sin tildes ni espacios repetidos"""
+    return strip_accents(normalize_text(query)).replace("ñ", "n")
+
+
+@dataclass
+class ClassificationResult:
+    label: str
+    confidence: float
+    source: str
+
+    @property
+    def is_laboral(self) -> bool:
+        return self.label == LABORAL
+
+
+# ============================================================================
+# 📏 REGLAS
+# ============================================================================
+
+class RuleClassifier:
+    """Reglas por palabras clave: saludos y temas de trabajo vs. temas claramente ajenos"""
+
+    def classify(self, query: str) -> ClassificationResult:
+        text = normalize_query(query)
+        if not text or GREETING_PATTERN.match(text):
+            return ClassificationResult(LABORAL, 0.99, "rules")
+
+        laboral_hits = len(_LABORAL_RE.findall(text))
+        ambiguous_hits = len(_AMBIGUOUS_LABORAL_RE.findall(text))
+        no_laboral_hits = len(_NO_LABORAL_RE.findall(text)) + len(_OTHER_EMPLOYER_RE.findall(text))
+
+        if laboral_hits and not no_laboral_hits:
+            return ClassificationResult(LABORAL, min(0.99, 0.9 + 0.03 * laboral_hits), "rules")
+        if no_laboral_hits and not laboral_hits and (not ambiguous_hits or _OTHER_EMPLOYER_RE.search(text)):
+            return ClassificationResult(NO_LABORAL, min(0.97, 0.85 + 0.05 * no_laboral_hits), "rules")
+        if laboral_hits or ambiguous_hits:
+            # Mezcla (ej. "viaje de trabajo") o solo "empresa"/"empleo": ante la duda, laboral,
+            # pero sin certeza para que decida el LLM
+            return ClassificationResult(LABORAL, 0.6, "rules")
+        return ClassificationResult(LABORAL, 0.5, "rules")
+
+
+# ============================================================================
+# 🔤 MODELO LINEAL SOBRE N-GRAMAS DE CARACTERES
+# ============================================================================
+
+class NgramClassifier:
+    """
+    Regresión logística sobre n-gramas de caracteres con hashing.
+    Se entrena con las clasificaciones registradas (ver ClassificationLog).
+    """
+
+    def __init__(self, dim: int = 2 ** 18, ngram_range: Tuple[int, int] = (2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.bias = 0.0
+        self.weights: Dict[int, float] = {}
+
+    def _features(self, query: str) -> Dict[int, float]:
+        text = f" {normalize_query(query)} "
+        counts: Dict[int, float] = {}
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                index = zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim
+                counts[index] = counts.get(index, 0.0) + 1.0
+        norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+        return {k: v / norm for k, v in counts.items()}
+
+    def predict_proba(self, query: str) -> float:
+        """Probabilidad de que la consulta sea LABORAL"""
+        z = self.bias + sum(self.weights.get(k, 0.0) * v for k, v in self._features(query).items())
+        z = max(-30.0, min(30.0, z))
+        return 1.0 / (1.0 + math.exp(-z))
+
+    def classify(self, query: str) -> ClassificationResult:
+        p = self.predict_proba(query)
+        if p >= 0.5:
+            return ClassificationResult(LABORAL, p, "model")
+        return ClassificationResult(NO_LABORAL, 1.0 - p, "model")
+
+    def fit(self, samples: List[Tuple[str, str]], epochs: int = 15, learning_rate: float = 0.5,
+            l2: float = 1e-5, seed: int = 42) -> "NgramClassifier":
+        """Entrena con SGD sobre pares (consulta, etiqueta)"""
+        data = [(self._features(q), 1.0 if label == LABORAL else 0.0) for q, label in samples]
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(data)
+            for features, target in data:
+                z = self.bias + sum(self.weights.get(k, 0.0) * v for k, v in features.items())
+                z = max(-30.0, min(30.0, z))
+                error = 1.0 / (1.0 + math.exp(-z)) - target
+                self.bias -= learning_rate * error
+                for k, v in features.items():
+                    w = self.weights.get(k, 0.0)
+                    self.weights[k] = w - learning_rate * (error * v + l2 * w)
+        self.weights = {k: w for k, w in self.weights.items() if abs(w) > 1e-6}
+        return self
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "dim": self.dim,
+                "ngram_range": list(self.ngram_range),
+                "bias": self.bias,
+                "weights": {str(k): round(w, 6) for k, w in self.weights.items()}
+            }, f)
+
+    @classmethod
+    def load(cls, path: str) -> "NgramClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        model = cls(dim=data["dim"], ngram_range=tuple(data["ngram_range"]))
+        model.bias = data["bias"]
+        model.weights = {int(k): w for k, w in data["weights"].items()}
+        return model
+
+
+# ============================================================================
+# 💾 REGISTRO DE CLASIFICACIONES (DATOS DE ENTRENAMIENTO)
+# ============================================================================
+
+def _ensure_parent_dir(db_path: str):
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+class ClassificationLog:
+    """Guarda las clasificaciones del LLM en SQLite para reentrenar el modelo local"""
+
+    def __init__(self, db_path: str = CLASSIFIER_DB_PATH):
+        self.db_path = db_path
+        self.lock = Lock()
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Abre la base, creando el directorio y la tabla la primera vez"""
+        if not self._ready:
+            with self.lock:
+                if not self._ready:
+                    _ensure_parent_dir(self.db_path)
+                    with sqlite3.connect(self.db_path) as conn:
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS classification_log (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                query TEXT NOT NULL,
+                                label TEXT NOT NULL,
+                                source TEXT NOT NULL,
+                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                            )
+                        """)
+                        conn.commit()
+                    self._ready = True
+        return sqlite3.connect(self.db_path)
+
+    def record(self, query: str, label: str, source: str):
+        with self._connect() as conn, self.lock:
+            conn.execute(
+                "INSERT INTO classification_log (query, label, source) VALUES (?, ?, ?)",
+                (query, label, source)
+            )
+            conn.commit()
+
+    def samples(self, source: str = "llm") -> List[Tuple[str, str]]:
+        """Pares (consulta, etiqueta) registrados por la fuente indicada"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT query, label FROM classification_log WHERE source = ? ORDER BY id",
+                (source,)
+            ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+
+# ============================================================================
+# ⚡ CACHÉ DE CLASIFICACIONES
+# ============================================================================
+
+class ClassificationCache:
+    """
+    Caché de clasificaciones por consulta normalizada: LRU+TTL en memoria y,
+    opcionalmente, una tabla SQLite compartida entre workers como segundo nivel.
+    """
+
+    def __init__(self, maxsize: int = CLASSIFIER_CACHE_SIZE, ttl: float = CLASSIFIER_CACHE_TTL,
+                 db_path: str = None, max_rows: int = CLASSIFIER_CACHE_MAX_ROWS):
+        self.ttl = ttl
+        self.memory = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.lock = Lock()
+        self._writes = 0
+        self.stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "writes": 0}
+        self._ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Abre el nivel persistente, creando el directorio y la tabla la primera vez"""
+        if not self._ready:
+            with self.lock:
+                if not self._ready:
+                    _ensure_parent_dir(self.db_path)
+                    with sqlite3.connect(self.db_path) as conn:
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS classification_cache (
+                                query_key TEXT PRIMARY KEY,
+                                label TEXT NOT NULL,
+                                confidence REAL NOT NULL,
+                                source TEXT NOT NULL,
+                                expires_at REAL NOT NULL
+                            )
+                        """)
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_classification_cache_expires ON classification_cache(expires_at)")
+                        conn.commit()
+                    self._ready = True
+        return sqlite3.connect(self.db_path)
+
+    def get(self, query: str) -> Optional[ClassificationResult]:
+        key = normalize_query(query)
+        result = self.memory.get(key)
+        if result is not None:
+            self.stats["memory_hits"] += 1
+            return result
+
+        if self.db_path:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT label, confidence, source, expires_at FROM classification_cache "
+                    "WHERE query_key = ? AND expires_at > ?",
+                    (key, time.time())
+                ).fetchone()
+            if row:
+                result = ClassificationResult(row[0], row[1], row[2])
+                # Promover al nivel en memoria con el TTL que le queda
+                self.memory.set(key, result, ttl=row[3] - time.time())
+                self.stats["persistent_hits"] += 1
+                return result
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, query: str, result: ClassificationResult):
+        key = normalize_query(query)
+        self.memory.set(key, result)
+        self.stats["writes"] += 1
+        if not self.db_path:
+            return
+        with self._connect() as conn, self.lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO classification_cache (query_key, label, confidence, source, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, result.label, result.confidence, result.source, time.time() + self.ttl)
+            )
+            self._writes += 1
+            if self._writes % 500 == 0:
+                self._prune(conn)
+            conn.commit()
+
+    def _prune(self, conn: sqlite3.Connection):
+        """Borra filas expiradas y, si se supera el máximo, las más próximas a expirar"""
+        conn.execute("DELETE FROM classification_cache WHERE expires_at <= ?", (time.time(),))
+        conn.execute("""
+            DELETE FROM classification_cache WHERE query_key IN (
+                SELECT query_key FROM classification_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_rows,))
+
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.stats["memory_hits"] + self.stats["persistent_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "persistent": bool(self.db_path),
+            "memory": self.memory.get_stats()
+        }
+
+
+# ============================================================================
+# 🎯 CLASIFICADOR ESCALONADO
+# ============================================================================
+
+class LaboralClassifier:
+    """
+    Clasificador en niveles: reglas → modelo de n-gramas (si hay uno entrenado)
+    → caché → LLM. Solo se llama al LLM cuando ningún nivel local supera el
+    umbral de confianza y la consulta no está en caché; sus respuestas se
+    cachean y se registran para reentrenar el modelo.
+    """
+
+    def __init__(self, threshold: float = None, model: NgramClassifier = None,
+                 log: ClassificationLog = None, model_path: str = CLASSIFIER_MODEL_PATH,
+                 cache: ClassificationCache = None):
+        self.threshold = threshold if threshold is not None else CLASSIFIER_CONFIDENCE_THRESHOLD
+        self.rules = RuleClassifier()
+        self.model = model
+        if self.model is None and model_path and os.path.exists(model_path):
+            try:
+                self.model = NgramClassifier.load(model_path)
+                print(f"✅ Modelo de clasificación laboral cargado desde {model_path}")
+            except Exception as e:
+                print(f"⚠️ No se pudo cargar el modelo de clasificación: {str(e)}")
+        self.log = log
+        self.cache = cache
+        self.stats = {
+            "total": 0,
+            "rules": 0,
+            "model": 0,
+            "cache": 0,
+            "llm": 0,
+            "llm_errors": 0,
+            "local_time": 0.0,
+            "llm_time": 0.0
+        }
+
+    def classify_local(self, query: str) -> Tuple[ClassificationResult, bool]:
+        """Clasifica sin red. Retorna (resultado, es_confiable)"""
+        result = self.rules.classify(query)
+        if result.confidence >= self.threshold:
+            return result, True
+        if self.model is not None:
+            model_result = self.model.classify(query)
+            if model_result.confidence >= self.threshold:
+                return model_result, True
+        return result, False
+
+    async def classify(self, query: str, llm=None) -> ClassificationResult:
+        """Clasifica la consulta; usa el LLM (async) solo para los casos ambiguos"""
+        self.stats["total"] += 1
+        start = time.perf_counter()
+        result, confident = self.classify_local(query)
+        self.stats["local_time"] += time.perf_counter() - start
+
+        if confident or llm is None:
+            self.stats[result.source] += 1
+            return result
+
+        if self.cache is not None:
+            cached = self.cache.get(query)
+            if cached is not None:
+                self.stats["cache"] += 1
+                return cached
+
+        start = time.perf_counter()
+        try:
+            response = await llm.ainvoke(LLM_CLASSIFICATION_PROMPT.format(query=query))
+            classification = response.content.strip().upper()
+            if classification not in (LABORAL, NO_LABORAL):
+                print(f"⚠️ Clasificación inesperada: {classification}, asumiendo LABORAL")
+                classification = LABORAL
+            result = ClassificationResult(classification, 1.0, "llm")
+            self.stats["llm"] += 1
+            if self.cache is not None:
+                self.cache.set(query, result)
+            if self.log is not None:
+                self.log.record(query, classification, "llm")
+        except Exception as e:
+            print(f"❌ Error en clasificación laboral: {str(e)}")
+            self.stats["llm_errors"] += 1
+            # Por defecto, asumir laboral en caso de error
+            result = ClassificationResult(LABORAL, 0.0, "fallback")
+        finally:
+            self.stats["llm_time"] += time.perf_counter() - start
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.stats["total"]
+        local = self.stats["rules"] + self.stats["model"] + self.stats["cache"]
+        llm_total = self.stats["llm"] + self.stats["llm_errors"]
+        return {
+            "total": total,
+            "rules": self.stats["rules"],
+            "model": self.stats["model"],
+            "cache": self.stats["cache"],
+            "llm": self.stats["llm"],
+            "llm_errors": self.stats["llm_errors"],
+            "threshold": self.threshold,
+            "model_loaded": self.model is not None,
+            "local_ratio": round(local / total, 3) if total else 0.0,
+            "avg_local_us": round(self.stats["local_time"] / total * 1e6, 1) if total else 0.0,
+            "avg_llm_ms": round(self.stats["llm_time"] / llm_total * 1000, 1) if llm_total else 0.0,
+            "cache_stats": self.cache.get_stats() if self.cache is not None else None
+        }
+
+
+def evaluate(classifier: LaboralClassifier, samples: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+    """
+    Mide el nivel local contra un conjunto etiquetado: cobertura (casos resueltos
+    sin LLM), exactitud sobre esos casos y latencia por consulta.
+    """
+    total = correct = covered = covered_correct = 0
+    latencies = []
+    for query, label in samples:
+        start = time.perf_counter()
+        result, confident = classifier.classify_local(query)
+        latencies.append(time.perf_counter() - start)
+        total += 1
+        correct += result.label == label
+        if confident:
+            covered += 1
+            covered_correct += result.label == label
+    latencies.sort()
+    return {
+        "samples": total,
+        "accuracy": round(correct / total, 3) if total else 0.0,
+        "coverage": round(covered / total, 3) if total else 0.0,
+        "covered_accuracy": round(covered_correct / covered, 3) if covered else 0.0,
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1) if latencies else 0.0,
+        "p95_us": round(latencies[int(len(latencies) * 0.95)] * 1e6, 1) if latencies else 0.0
+    }
+
+
+def load_labelled_samples(path: str) -> List[Tuple[str, str]]:
+    """Lee un JSON con [{"query": ..., "label": "LABORAL" | "NO_LABORAL"}, ...]"""
+    with open(path, encoding="utf-8") as f:
+        return [(item["query"], item["label"]) for item in json.load(f)]
+
+
+# Instancia global compartida por todos los orquestadores
+laboral_classifier = LaboralClassifier(
+    log=ClassificationLog(),
+    cache=ClassificationCache(db_path=CLASSIFIER_DB_PATH if CLASSIFIER_CACHE_PERSISTENT else None)
+)
+
+
+if __name__ == "__main__":
+    # python clasificador.py train            → entrena el modelo con las clasificaciones del LLM registradas
+    # python clasificador.py evaluate <json>  → exactitud y latencia del nivel local
+    command = sys.argv[1] if len(sys.argv) > 1 else "evaluate"
+    if command == "train":
+        samples = ClassificationLog().samples()
+        if not samples:
+            print("⚠️ No hay clasificaciones registradas para entrenar")
+            sys.exit(1)
+        NgramClassifier().fit(samples).save(CLASSIFIER_MODEL_PATH)
+        print(f"✅ Modelo entrenado con {len(samples)} ejemplos y guardado en {CLASSIFIER_MODEL_PATH}")
+    elif command == "evaluate" and len(sys.argv) > 2:
+        report = evaluate(laboral_classifier, load_labelled_samples(sys.argv[2]))
+        print(json.dumps(report, indent=2))
+    else:
+        print("Uso: python clasificador.py [train | evaluate <archivo.json>]")
@@ -0,0 +1,305 @@
+import os
+import time
+import random
+import asyncio
+from threading import Lock
+from typing import Any, Dict, Optional
+import httpx
+from utilidades import SUPABASE_URL, SUPABASE_KEY
+
+# Configuración del cliente (timeouts en segundos)
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "3"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+SUPABASE_MAX_RETRIES = int(os.getenv("SUPABASE_MAX_RETRIES", "2"))
+SUPABASE_RETRY_BACKOFF = float(os.getenv("SUPABASE_RETRY_BACKOFF", "0.2"))
+# Fallos consecutivos que abren el circuito y segundos que permanece abierto
+SUPABASE_BREAKER_THRESHOLD = int(os.getenv("SUPABASE_BREAKER_THRESHOLD", "5"))
+SUPABASE_BREAKER_COOLDOWN = float(os.getenv("SUPABASE_BREAKER_COOLDOWN", "30"))
+
+# Respuestas transitorias que vale la pena reintentar
+RETRY_STATUS = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"}
+# Errores en los que la petición nunca llegó a Supabase
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class SupabaseUnavailable(Exception):
+    """Supabase no responde o el circuito está abierto: usar el respaldo local"""
+
+    def __init__(self, message: str, maybe_sent: bool = False):
+        super().__init__(message)
+        # True si la petición pudo haberse aplicado (timeout de lectura, conexión cortada)
+        self.maybe_sent = maybe_sent
+
+
+class CircuitBreaker:
+    """
+    Circuito de tres estados (cerrado → abierto → semiabierto).
+    Tras `failure_threshold` fallos seguidos rechaza las llamadas durante `reset_timeout`
+    segundos; después deja pasar una sola de prueba que decide si se cierra o reabre.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = SUPABASE_BREAKER_THRESHOLD,
+                 reset_timeout: float = SUPABASE_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        """True si la llamada puede salir a la red"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    print(f"⚡ Circuito de Supabase abierto ({self.failures} fallos seguidos), usando respaldo local")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Libera la llamada de prueba sin veredicto (p. ej. si se canceló a mitad)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class SupabaseClient:
+    """
+    Cliente PostgREST compartido: pool de conexiones httpx, timeouts, reintentos con
+    jitter y circuit breaker. La API principal es asíncrona (`request`); `request_sync`
+    es el atajo para el código síncrono que aún queda (memoria, scripts).
+    """
+
+    def __init__(self, base_url: str = None, key: str = None,
+                 timeout: float = SUPABASE_TIMEOUT, connect_timeout: float = SUPABASE_CONNECT_TIMEOUT,
+                 max_connections: int = SUPABASE_MAX_CONNECTIONS, max_retries: int = SUPABASE_MAX_RETRIES,
+                 retry_backoff: float = SUPABASE_RETRY_BACKOFF, breaker: CircuitBreaker = None,
+                 transport: httpx.BaseTransport = None):
+        self.base_url = base_url or SUPABASE_URL
+        self.key = key or SUPABASE_KEY
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_connections)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.transport = transport
+
+        # El cliente asíncrono pertenece al event loop que lo creó
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sync_client: Optional[httpx.Client] = None
+        self._sync_lock = Lock()
+
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "errors": 0,
+            "short_circuited": 0,
+            "total_latency": 0.0
+        }
+
+    # ------------------------------------------------------------------
+    # Clientes HTTP
+    # ------------------------------------------------------------------
+
+    def _client_options(self) -> Dict[str, Any]:
+        options = {"timeout": self.timeout, "limits": self.limits}
+        if self.transport is not None:
+            options["transport"] = self.transport
+        return options
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client.is_closed or self._async_loop is not loop:
+            self._async_client = httpx.AsyncClient(**self._client_options())
+            self._async_loop = loop
+        return self._async_client
+
+    def _get_sync_client(self) -> httpx.Client:
+        with self._sync_lock:
+            if self._sync_client is None or self._sync_client.is_closed:
+                self._sync_client = httpx.Client(**self._client_options())
+            return self._sync_client
+
+    async def close(self):
+        """Cierra las conexiones de ambos clientes"""
+        if self._async_client is not None:
+            if self._async_loop is asyncio.get_running_loop():
+                await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
+        with self._sync_lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+    # ------------------------------------------------------------------
+    # Peticiones
+    # ------------------------------------------------------------------
+
+    def _build_request(self, method: str, endpoint: str, data: Any, params: Dict,
+                       headers: Dict) -> Dict[str, Any]:
+        request_headers = {
+            "Content-Type": "application/json",
+            "apikey": self.key or "",
+            "Authorization": f"Bearer {self.key}"
+        }
+        if headers:
+            request_headers.update(headers)
+        return {
+            "method": method,
+            "url": f"{self.base_url}/rest/v1/{endpoint}",
+            "headers": request_headers,
+            "json": data,
+            "params": params
+        }
+
+    def _should_retry(self, attempt: int, idempotent: bool, response: httpx.Response = None,
+                      error: Exception = None) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            # Un POST solo se repite si nunca llegó a enviarse
+            return idempotent or isinstance(error, NOT_SENT_ERRORS)
+        return response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS)
+
+    def _backoff(self, attempt: int) -> float:
+        """Backoff exponencial con jitter completo"""
+        return random.uniform(0, self.retry_backoff * (2 ** attempt))
+
+    def _check_circuit(self) -> None:
+        self.stats["requests"] += 1
+        if not self.breaker.allow():
+            self.stats["short_circuited"] += 1
+            raise SupabaseUnavailable("Circuito de Supabase abierto")
+
+    def _record(self, start: float, response: Optional[httpx.Response], error: Optional[Exception]) -> None:
+        self.stats["total_latency"] += time.perf_counter() - start
+        if error is not None or response.status_code >= 500:
+            self.stats["errors"] += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    async def request(self, method: str, endpoint: str, data: Any = None, params: Dict = None,
+                      headers: Dict = None, idempotent: bool = None) -> httpx.Response:
+        """
+        Petición asíncrona a PostgREST. Lanza SupabaseUnavailable si el circuito está
+        abierto o si tras los reintentos no hubo respuesta.
+        """
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        self._check_circuit()
+        request = self._build_request(method, endpoint, data, params, headers)
+
+        start = time.perf_counter()
+        attempt = 0
+        try:
+            while True:
+                response, error = None, None
+                try:
+                    response = await self._get_async_client().request(**request)
+                except httpx.TransportError as e:
+                    error = e
+                if not self._should_retry(attempt, idempotent, response, error):
+                    break
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+        except Exception as e:
+            # Error inesperado: cuenta como fallo para no dejar el circuito semiabierto
+            self._record(start, None, e)
+            raise
+        except BaseException:
+            # Cancelación: no hay veredicto, solo se libera la llamada de prueba
+            self.breaker.release_probe()
+            raise
+
+        self._record(start, response, error)
+        if error is not None:
+            raise SupabaseUnavailable(f"Supabase no disponible: {error!r}",
+                                      maybe_sent=not isinstance(error, NOT_SENT_ERRORS)) from error
+        return response
+
+    def request_sync(self, method: str, endpoint: str, data: Any = None, params: Dict = None,
+                     headers: Dict = None, idempotent: bool = None) -> httpx.Response:
+        """Versión síncrona de `request` (mismo circuito, mismos reintentos)"""
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        self._check_circuit()
+        request = self._build_request(method, endpoint, data, params, headers)
+
+        start = time.perf_counter()
+        attempt = 0
+        try:
+            while True:
+                response, error = None, None
+                try:
+                    response = self._get_sync_client().request(**request)
+                except httpx.TransportError as e:
+                    error = e
+                if not self._should_retry(attempt, idempotent, response, error):
+                    break
+                self.stats["retries"] += 1
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+        except Exception as e:
+            # Error inesperado: cuenta como fallo para no dejar el circuito semiabierto
+            self._record(start, None, e)
+            raise
+        except BaseException:
+            # Cancelación: no hay veredicto, solo se libera la llamada de prueba
+            self.breaker.release_probe()
+            raise
+
+        self._record(start, response, error)
+        if error is not None:
+            raise SupabaseUnavailable(f"Supabase no disponible: {error!r}",
+                                      maybe_sent=not isinstance(error, NOT_SENT_ERRORS)) from error
+        return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de peticiones, reintentos y estado del circuito"""
+        sent = self.stats["requests"] - self.stats["short_circuited"]
+        return {
+            "requests": self.stats["requests"],
+            "retries": self.stats["retries"],
+            "errors": self.stats["errors"],
+            "short_circuited": self.stats["short_circuited"],
+            "circuit_state": self.breaker.state,
+            "circuit_opened": self.breaker.times_opened,
+            "avg_latency_ms": round(self.stats["total_latency"] / sent * 1000, 2) if sent else 0.0
+        }
+
+
+# Instancia global compartida (memoria, indexador, búsqueda de documentos)
+supabase_client = SupabaseClient()
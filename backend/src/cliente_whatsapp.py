@@ -0,0 +1,127 @@
+import os
+import time
+from typing import Any, Dict, Optional
+import httpx
+
+# HTTP/2 requiere el paquete opcional h2 (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+GRAPH_API_URL = "https://graph.facebook.com/v17.0"
+
+
+class WhatsAppClient:
+    """
+    Cliente HTTP compartido para la Graph API de WhatsApp.
+
+    Se crea una sola vez en el lifespan de la aplicación y lo usan todos los
+    caminos de envío, reutilizando las conexiones TCP/TLS (keep-alive).
+    """
+
+    def __init__(self, max_connections: int = None, max_keepalive_connections: int = None,
+                 keepalive_expiry: float = None, timeout: float = None, base_url: str = GRAPH_API_URL):
+        self.base_url = base_url
+        self.max_connections = max_connections or int(os.getenv("WHATSAPP_MAX_CONNECTIONS", "20"))
+        self.max_keepalive_connections = max_keepalive_connections or int(os.getenv("WHATSAPP_MAX_KEEPALIVE", "10"))
+        self.keepalive_expiry = keepalive_expiry or float(os.getenv("WHATSAPP_KEEPALIVE_EXPIRY", "60"))
+        self.timeout = timeout or float(os.getenv("WHATSAPP_TIMEOUT", "15"))
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = {
+            "requests": 0,
+            "connections_opened": 0,
+            "errors": 0,
+            "http2_responses": 0,
+            "total_latency": 0.0
+        }
+
+    @property
+    def is_started(self) -> bool:
+        return self._client is not None and not self._client.is_closed
+
+    async def start(self):
+        """Crea el cliente con el pool de conexiones"""
+        if self.is_started:
+            return
+        self._client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            timeout=httpx.Timeout(self.timeout)
+        )
+        print(f"✅ Cliente WhatsApp iniciado (HTTP/2: {HTTP2_AVAILABLE}, "
+              f"máx. {self.max_connections} conexiones)")
+
+    async def close(self):
+        """Cierra el cliente y sus conexiones"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            print("✅ Cliente WhatsApp cerrado")
+
+    async def _trace(self, event_name: str, info: Dict[str, Any]):
+        """Hook de httpcore: cuenta las conexiones TCP nuevas para medir la reutilización"""
+        if event_name == "connection.connect_tcp.complete":
+            self.stats["connections_opened"] += 1
+
+    async def send_text(self, phone_number: str, body: str) -> httpx.Response:
+        """Envía un mensaje de texto y retorna la respuesta HTTP de la Graph API"""
+        if not self.is_started:
+            # Envíos fuera del lifespan (scripts, tests): crear el cliente bajo demanda
+            await self.start()
+
+        url = f"{self.base_url}/{os.getenv('WHATSAPP_PHONE_ID', '508244739043826')}/messages"
+        headers = {
+            "Authorization": f"Bearer {os.getenv('WHATSAPP_TOKEN')}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "messaging_product": "whatsapp",
+            "to": phone_number,
+            "type": "text",
+            "text": {"body": body}
+        }
+
+        start = time.perf_counter()
+        self.stats["requests"] += 1
+        try:
+            response = await self._client.post(
+                url, headers=headers, json=data, extensions={"trace": self._trace}
+            )
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["total_latency"] += time.perf_counter() - start
+
+        if response.http_version == "HTTP/2":
+            self.stats["http2_responses"] += 1
+        if response.status_code >= 400:
+            self.stats["errors"] += 1
+        return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de uso y reutilización de conexiones"""
+        requests_count = self.stats["requests"]
+        reused = max(0, requests_count - self.stats["connections_opened"])
+        return {
+            "started": self.is_started,
+            "http2_enabled": HTTP2_AVAILABLE,
+            "requests": requests_count,
+            "connections_opened": self.stats["connections_opened"],
+            "connections_reused": reused,
+            "reuse_ratio": round(reused / requests_count, 3) if requests_count else 0.0,
+            "http2_responses": self.stats["http2_responses"],
+            "errors": self.stats["errors"],
+            "avg_latency_ms": round(self.stats["total_latency"] / requests_count * 1000, 2) if requests_count else 0.0
+        }
+
+
+# Instancia global compartida por la outbox (bandeja_salida.py)
+whatsapp_client = WhatsAppClient()
+
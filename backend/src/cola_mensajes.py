@@ -0,0 +1,333 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import traceback
+from collections import deque
+from threading import Lock
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from utilidades import LRUTTLCache
+
+# Ventana de deduplicación por message_id (WhatsApp reintenta el webhook durante horas)
+INGESTION_DEDUPE_SIZE = int(os.getenv("INGESTION_DEDUPE_SIZE", "100000"))
+INGESTION_DEDUPE_TTL = int(os.getenv("INGESTION_DEDUPE_TTL", "86400"))
+# Cada cuántos acks se borran de SQLite los mensajes procesados más viejos que la ventana
+INGESTION_PRUNE_EVERY = 500
+
+# ============================================================================
+# 💾 BACKENDS DE PERSISTENCIA DE LA COLA
+# ============================================================================
+
+class MemoryQueueBackend:
+    """Backend en memoria: rápido pero los mensajes pendientes se pierden al reiniciar"""
+
+    def __init__(self, dedupe_size: int = INGESTION_DEDUPE_SIZE, dedupe_ttl: float = INGESTION_DEDUPE_TTL):
+        self._items: Dict[int, Dict[str, Any]] = {}
+        self._seen_ids = LRUTTLCache(maxsize=dedupe_size, ttl=dedupe_ttl)
+        self._next_id = 1
+        self.lock = Lock()
+
+    def push(self, item: Dict[str, Any]) -> Optional[int]:
+        """Guarda un mensaje pendiente. Retorna None si ya fue encolado antes"""
+        with self.lock:
+            message_id = item.get("message_id")
+            if self._seen_ids.get(message_id) is not None:
+                return None
+            self._seen_ids.set(message_id, True)
+            item_id = self._next_id
+            self._next_id += 1
+            self._items[item_id] = item
+            return item_id
+
+    def ack(self, item_id: int) -> None:
+        """Marca un mensaje como procesado"""
+        with self.lock:
+            self._items.pop(item_id, None)
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        """Mensajes encolados que aún no se han procesado"""
+        with self.lock:
+            return sorted(self._items.items())
+
+
+class SQLiteQueueBackend:
+    """Backend durable en SQLite (junto a messages.db): sobrevive a reinicios del servidor"""
+
+    def __init__(self, db_path: str = "messages.db", retention: float = INGESTION_DEDUPE_TTL):
+        self.db_path = db_path
+        self.retention = retention
+        self.lock = Lock()
+        self._acks = 0
+        self._init_database()
+
+    def _init_database(self):
+        """Crear la tabla de la cola si no existe"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ingestion_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT UNIQUE,
+                    payload TEXT NOT NULL,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    processed_at TIMESTAMP
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ingestion_status ON ingestion_queue(status)")
+            conn.commit()
+
+    def push(self, item: Dict[str, Any]) -> Optional[int]:
+        """Guarda un mensaje pendiente. Retorna None si ya fue encolado antes"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO ingestion_queue (message_id, payload) VALUES (?, ?)",
+                    (item.get("message_id"), json.dumps(item))
+                )
+                conn.commit()
+                if cursor.rowcount == 0:
+                    return None
+                return cursor.lastrowid
+
+    def ack(self, item_id: int) -> None:
+        """Marca un mensaje como procesado"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute(
+                    "UPDATE ingestion_queue SET status = 'done', processed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (item_id,)
+                )
+                self._acks += 1
+                if self._acks % INGESTION_PRUNE_EVERY == 0:
+                    self._prune(conn)
+                conn.commit()
+
+    def prune(self) -> int:
+        """Borra los mensajes procesados fuera de la ventana de deduplicación"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                deleted = self._prune(conn)
+                conn.commit()
+                return deleted
+
+    def _prune(self, conn: sqlite3.Connection) -> int:
+        return conn.execute(
+            "DELETE FROM ingestion_queue WHERE status = 'done' AND processed_at < datetime('now', ?)",
+            (f"-{int(self.retention)} seconds",)
+        ).rowcount
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        """Mensajes encolados que aún no se han procesado"""
+        with sqlite3.connect(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT id, payload FROM ingestion_queue WHERE status = 'pending' ORDER BY id ASC"
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+
+def create_queue_backend(backend_name: str = None):
+    """Crea el backend configurado en INGESTION_BACKEND (sqlite | memory)"""
+    backend_name = (backend_name or os.getenv("INGESTION_BACKEND", "sqlite")).lower()
+    if backend_name == "memory":
+        return MemoryQueueBackend()
+    backend = SQLiteQueueBackend(os.getenv("INGESTION_DB_PATH", "messages.db"))
+    backend.prune()
+    return backend
+
+# ============================================================================
+# 📥 COLA DE INGESTA ASÍNCRONA CON SHARDS POR TELÉFONO
+# ============================================================================
+
+# Tiempo (segundos) que se conservan las estadísticas de un shard sin actividad
+SHARD_IDLE_TTL = 600
+
+
+class PhoneShard:
+    """Cola FIFO de un número de teléfono: sus mensajes se procesan de uno en uno"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.items: deque = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_active = time.time()
+
+    @property
+    def busy(self) -> bool:
+        return self.task is not None or bool(self.items)
+
+    def record_wait(self, wait: float):
+        """Registra el tiempo que esperó un mensaje antes de empezar a procesarse"""
+        self.processed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.last_active = time.time()
+
+    def get_stats(self) -> Dict[str, Any]:
+        avg_wait = self.total_wait / self.processed if self.processed else 0.0
+        return {
+            "depth": len(self.items),
+            "running": self.task is not None,
+            "processed": self.processed,
+            "avg_wait_ms": round(avg_wait * 1000, 2),
+            "max_wait_ms": round(self.max_wait * 1000, 2)
+        }
+
+
+class IngestionQueue:
+    """
+    Cola de ingesta de mensajes entrantes.
+
+    El webhook solo valida, deduplica y encola. Los mensajes se reparten en
+    shards por número de teléfono: cada usuario se atiende estrictamente en
+    orden (un mensaje a la vez) mientras que usuarios distintos se procesan
+    en paralelo hasta el límite global de concurrencia (workers).
+    """
+
+    def __init__(self, backend=None, workers: int = 4):
+        self.backend = backend or MemoryQueueBackend()
+        self.num_workers = max(1, workers)
+        self._handler: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._shards: Dict[str, PhoneShard] = {}
+        self._outstanding = 0
+        self._idle: Optional[asyncio.Event] = None
+        self._running = False
+        self._dispatches = 0
+        self.stats = {
+            "enqueued": 0,
+            "duplicates": 0,
+            "processed": 0,
+            "failed": 0,
+            "recovered": 0
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def enqueue(self, item: Dict[str, Any]) -> bool:
+        """Encola un mensaje. Retorna False si es un duplicado"""
+        item.setdefault("received_at", time.time())
+        return self._accept(item, self.backend.push(item))
+
+    async def enqueue_async(self, item: Dict[str, Any]) -> bool:
+        """Como enqueue(), pero el INSERT en el backend (commit en SQLite) corre en un hilo"""
+        item.setdefault("received_at", time.time())
+        return self._accept(item, await asyncio.to_thread(self.backend.push, item))
+
+    def _accept(self, item: Dict[str, Any], item_id: Optional[int]) -> bool:
+        """Registra el resultado del push y despacha el mensaje si es nuevo"""
+        if item_id is None:
+            self.stats["duplicates"] += 1
+            return False
+
+        self.stats["enqueued"] += 1
+        # Si el scheduler aún no arrancó, el mensaje queda en el backend
+        # y se recupera en start()
+        if self._running:
+            self._dispatch(item_id, item)
+        return True
+
+    async def start(self, handler: Callable[[Dict[str, Any]], Awaitable[None]]):
+        """Arranca el scheduler y recupera los mensajes pendientes del backend"""
+        if self._running:
+            return
+
+        self._handler = handler
+        self._semaphore = asyncio.Semaphore(self.num_workers)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._running = True
+
+        for item_id, item in self.backend.pending():
+            self._dispatch(item_id, item)
+            self.stats["recovered"] += 1
+
+        print(f"✅ Cola de ingesta iniciada con concurrencia máxima {self.num_workers} "
+              f"({self.stats['recovered']} mensajes pendientes recuperados)")
+
+    async def stop(self):
+        """Detiene el scheduler. Lo que quede pendiente sigue en el backend"""
+        self._running = False
+        tasks = [shard.task for shard in self._shards.values() if shard.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._shards.clear()
+        self._outstanding = 0
+        print("✅ Cola de ingesta detenida")
+
+    async def join(self):
+        """Espera a que se procesen todos los mensajes encolados"""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    def _dispatch(self, item_id: int, item: Dict[str, Any]):
+        """Asigna el mensaje al shard de su teléfono y lo pone en marcha si está libre"""
+        key = item.get("phone_number") or "unknown"
+        shard = self._shards.get(key)
+        if shard is None:
+            shard = self._shards[key] = PhoneShard(key)
+
+        shard.items.append((item_id, item, time.monotonic()))
+        self._outstanding += 1
+        self._idle.clear()
+
+        if shard.task is None:
+            shard.task = asyncio.create_task(self._drain(shard))
+
+        self._dispatches += 1
+        if self._dispatches % 256 == 0:
+            self._prune_idle_shards()
+
+    async def _drain(self, shard: PhoneShard):
+        """Procesa en orden los mensajes de un shard respetando el límite global"""
+        try:
+            while shard.items:
+                item_id, item, enqueued_at = shard.items.popleft()
+                try:
+                    async with self._semaphore:
+                        shard.record_wait(time.monotonic() - enqueued_at)
+                        await self._handler(item)
+                    self.stats["processed"] += 1
+                except asyncio.CancelledError:
+                    # Apagado: el mensaje sigue pendiente en el backend
+                    raise
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"❌ Shard {shard.key}: error procesando mensaje {item.get('message_id')}: {str(e)}")
+                    traceback.print_exc()
+                await asyncio.to_thread(self.backend.ack, item_id)
+                self._outstanding -= 1
+                if self._outstanding <= 0:
+                    self._outstanding = 0
+                    self._idle.set()
+        finally:
+            shard.task = None
+
+    def _prune_idle_shards(self):
+        """Descarta las estadísticas de shards sin actividad reciente"""
+        cutoff = time.time() - SHARD_IDLE_TTL
+        for key in [k for k, shard in self._shards.items() if not shard.busy and shard.last_active < cutoff]:
+            del self._shards[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas globales y por shard de la cola"""
+        self._prune_idle_shards()
+        in_flight = sum(1 for shard in self._shards.values() if shard.task is not None)
+        depth = sum(len(shard.items) for shard in self._shards.values())
+        if not self._running:
+            depth = len(self.backend.pending())
+
+        return {
+            **self.stats,
+            "workers": self.num_workers,
+            "running": self._running,
+            "depth": depth,
+            "in_flight": in_flight,
+            "shards": {key: shard.get_stats() for key, shard in self._shards.items()}
+        }
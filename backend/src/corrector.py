@@ -0,0 +1,186 @@
+import os
+import re
+from typing import Dict, List, Set, Tuple
+
+# ============================================================================
+# 📝 CORRECTOR ORTOGRÁFICO LOCAL (ESPAÑOL)
+# ============================================================================
+
+# Vocabulario base: palabras frecuentes en español y del dominio de RRHH.
+# Se puede ampliar con un archivo (una palabra por línea) en SPELLCHECK_WORDLIST.
+BASE_VOCABULARY = """
+a al algo alguien algún alguna alguno algunos algunas ahora ahí allí aquí así aún aunque ante antes
+apenas año años abril agosto ayer ayuda ayudar ayudame ayúdame adiós acá además adelante
+bien buen bueno buena buenos buenas buenísimo bajo bastante
+cada casi como cómo con contra cual cuál cuales cuáles cuando cuándo cuanto cuánto cuanta cuánta
+cuantos cuántos cuantas cuántas cosa cosas caso casos cerca claro
+de del desde donde dónde dos durante después debe deben debo decir dice dicen dije día días
+diciembre domingo dato datos
+e el él ella ellas ellos en entre era eres es esa esas ese eso esos esta está estas estás este esto
+estos estoy estar están estaba estado estamos enero entonces
+fue fueron favor febrero fecha fin forma
+gracias gran grande general gusto
+ha había haber hace hacer hacia hago hasta hay hoy hola hora horas
+igual incluso
+ja jueves julio junio junto
+la las le les lo los luego lunes
+mal mañana mas más me mi mí mis mismo misma mucho mucha muchos muchas muy marzo mayo martes
+miércoles mes meses menos mejor mientras momento
+nada nadie ni ninguno ninguna no nos nosotros nuestro nuestra nuevo nueva noviembre nunca número
+o octubre otro otra otros otras ok okay
+para pero poco poca pocos pocas por porque porqué pregunta preguntas primero pues puede pueden
+puedo podría podrías problema problemas pronto
+que qué quien quién quienes quiero quiere quieren quisiera quisiéramos
+sabe sé se sea según ser si sí sido siempre sin sobre solo sólo son soy su sus sábado semana
+semanas septiembre sigue siguiente también tampoco tan tanto te tener tengo tiene tienen todo toda
+todos todas tu tú tus tuyo
+un una uno unos unas usted ustedes
+va vamos van varios varias vez veces viernes vía ver voy
+y ya yo
+necesito necesita necesitamos información info consulta consultar saber conocer
+dudas duda explicar explicación entender entiendo ayudarme
+curso cursos capacitación capacitaciones inscrito inscrita inscribirme inscripción inscripciones
+taller talleres programa programas certificado certificados módulo módulos clase clases
+plataforma portal acceso contraseña usuario correo
+trabajo trabajar trabajador trabajadora trabajadores empleado empleada empleados empleador empresa
+laboral laborales contrato contratos despido despidos renuncia liquidación
+vacaciones vacacional permiso permisos licencia licencias maternidad paternidad descanso feriado
+feriados sueldo sueldos salario salarios remuneración pago pagos planilla boleta boletas
+gratificación gratificaciones bono bonos cts aguinaldo utilidades asignación familiar
+horario horarios jornada turno turnos extra extras tardanza tardanzas falta faltas asistencia
+seguro salud essalud afp onp pensión jubilación beneficio beneficios derecho derechos
+jefe jefa supervisor gerente área recursos humanos rrhh oficina sede
+ley leyes norma normas reglamento política políticas procedimiento documento documentos
+solicitud solicitudes solicitar trámite trámites requisito requisitos
+hábiles calendario periodo período vencimiento
+""".split()
+
+# Errores frecuentes que se corrigen sin consultar al LLM. Solo formas que no son
+# palabras válidas: "ola", "q" o "inscripto" se dejan como están
+COMMON_TYPOS: Dict[str, str] = {
+    "kiero": "quiero",
+    "kieres": "quieres",
+    "qiero": "quiero",
+    "nesecito": "necesito",
+    "nesesito": "necesito",
+    "nececito": "necesito",
+    "grasias": "gracias",
+    "porfa": "por favor",
+    "xfa": "por favor",
+    "xq": "porque",
+    "pq": "porque",
+    "tmb": "también",
+    "tb": "también",
+    "vacasiones": "vacaciones",
+    "bacaciones": "vacaciones",
+    "capasitacion": "capacitación",
+    "capacitasion": "capacitación",
+    "incrito": "inscrito",
+}
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+ACCENTS = str.maketrans("áéíóúüÁÉÍÓÚÜ", "aeiouuAEIOUU")
+
+
+def strip_accents(text: str) -> str:
+    """Quita tildes y diéresis (la ñ se conserva)"""
+    return text.translate(ACCENTS)
+
+
+def normalize_text(text: str) -> str:
+    """Clave normalizada de un mensaje: minúsculas y espacios colapsados"""
+    return " ".join(text.lower().split())
+
+
+def edit_distance(a: str, b: str, max_distance: int = 2) -> int:
+    """Distancia de Levenshtein con corte temprano (retorna max_distance + 1 si la supera)"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            current.append(cost)
+            row_min = min(row_min, cost)
+        if row_min > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class SpanishSpellChecker:
+    """
+    Corrector local: arregla errores frecuentes y tildes sin llamar al LLM,
+    y detecta por distancia de edición las palabras que parecen mal escritas.
+    """
+
+    def __init__(self, vocabulary: List[str] = None, typos: Dict[str, str] = None):
+        words = list(vocabulary or BASE_VOCABULARY)
+        wordlist_path = os.getenv("SPELLCHECK_WORDLIST")
+        if wordlist_path and os.path.exists(wordlist_path):
+            with open(wordlist_path, encoding="utf-8") as f:
+                words.extend(line.strip() for line in f if line.strip())
+
+        self.vocabulary: Set[str] = {w.lower() for w in words}
+        self.typos = typos or COMMON_TYPOS
+        # Forma sin tilde → forma con tilde, solo si la forma sin tilde no es palabra válida
+        # (así "que"/"qué" o "si"/"sí" nunca se tocan)
+        self.accent_restore: Dict[str, str] = {}
+        for word in self.vocabulary:
+            plain = strip_accents(word)
+            if plain != word and plain not in self.vocabulary:
+                self.accent_restore[plain] = word
+        self._by_length: Dict[int, List[str]] = {}
+        for word in self.vocabulary:
+            self._by_length.setdefault(len(word), []).append(word)
+
+    def is_known(self, word: str) -> bool:
+        """Palabra del vocabulario, considerando plurales simples"""
+        word = word.lower()
+        if word in self.vocabulary or word.isdigit():
+            return True
+        for suffix in ("es", "s"):
+            if word.endswith(suffix) and word[:-len(suffix)] in self.vocabulary:
+                return True
+        return False
+
+    def correct_locally(self, text: str) -> Tuple[str, int]:
+        """Aplica correcciones seguras (errores frecuentes y tildes). Retorna (texto, cambios)"""
+        changes = 0
+
+        def replace(match: re.Match) -> str:
+            nonlocal changes
+            original = match.group(0)
+            lower = original.lower()
+            replacement = self.typos.get(lower) or self.accent_restore.get(lower)
+            if not replacement:
+                return original
+            changes += 1
+            if original[0].isupper():
+                replacement = replacement[0].upper() + replacement[1:]
+            return replacement
+
+        return WORD_RE.sub(replace, text), changes
+
+    def suspected_typos(self, text: str) -> List[str]:
+        """Palabras desconocidas muy parecidas a una conocida: probablemente mal escritas"""
+        suspects = []
+        for word in WORD_RE.findall(text.lower()):
+            if len(word) < 4 or self.is_known(word):
+                continue
+            # Las palabras desconocidas sin parecido (nombres, siglas) no se consideran errores
+            max_distance = 2 if len(word) >= 8 else 1
+            if self._has_close_match(word, max_distance):
+                suspects.append(word)
+        return suspects
+
+    def _has_close_match(self, word: str, max_distance: int) -> bool:
+        for length in range(len(word) - max_distance, len(word) + max_distance + 1):
+            for candidate in self._by_length.get(length, ()):
+                if edit_distance(word, candidate, max_distance) <= max_distance:
+                    return True
+        return False
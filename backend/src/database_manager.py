@@ -93,7 +93,7 @@ class MessageDatabase:
         return conversation_id
     
     def save_message(self, conversation_id: str, content: str, sender_type: str, 
-                    whatsapp_message_id: str = None) -> str:
+                    whatsapp_message_id: str = None, status: str = "sent") -> str:
         """Guardar un mensaje en la base de datos"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
@@ -102,9 +102,9 @@ class MessageDatabase:
         
         cursor.execute(
             """INSERT INTO messages 
-               (id, conversation_id, whatsapp_message_id, sender_type, content) 
-               VALUES (?, ?, ?, ?, ?)""",
-            (message_id, conversation_id, whatsapp_message_id, sender_type, content)
+               (id, conversation_id, whatsapp_message_id, sender_type, content, status) 
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (message_id, conversation_id, whatsapp_message_id, sender_type, content, status)
         )
         
         # Actualizar timestamp de la conversación
@@ -202,6 +202,19 @@ class MessageDatabase:
         conn.commit()
         conn.close()
     
+    def update_message_status(self, message_id: str, status: str):
+        """Actualizar el estado de envío de un mensaje (queued, sent, failed)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            "UPDATE messages SET status = ? WHERE id = ? OR whatsapp_message_id = ?",
+            (status, message_id, message_id)
+        )
+        
+        conn.commit()
+        conn.close()
+    
     def mark_messages_as_read(self, conversation_id: str):
         """Marcar todos los mensajes de una conversación como leídos"""
         conn = sqlite3.connect(self.db_path)
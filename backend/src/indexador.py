@@ -5,25 +5,310 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 import requests
 from utilidades import *
-from typing import Dict, List
+from cliente_supabase import supabase_client, SupabaseUnavailable
+from typing import Dict, List, Optional
+import sys
+import uuid
+import hashlib
+import sqlite3
+import threading
+from threading import Lock
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import traceback
+import time
 import numpy as np
 from datetime import datetime
 import asyncio
-import aiohttp
-import concurrent.futures
 from markitdown import MarkItDown
 from pathlib import Path
 
 # Importes completados - indexador tradicional optimizado
 
+# Embeddings por lotes: textos y tokens (estimados) máximos por petición a OpenAI
+INDEXER_EMBED_BATCH_SIZE = int(os.getenv("INDEXER_EMBED_BATCH_SIZE", "100"))
+INDEXER_EMBED_MAX_TOKENS = int(os.getenv("INDEXER_EMBED_MAX_TOKENS", "30000"))
+# Peticiones de embeddings simultáneas para toda la indexación (todos los archivos)
+INDEXER_EMBED_CONCURRENCY = int(os.getenv("INDEXER_EMBED_CONCURRENCY", "4"))
+# Estimación conservadora de caracteres por token (texto legal en español)
+CHARS_PER_TOKEN = 3
+# Caché persistente de embeddings por hash del chunk (vacío: desactivada)
+INDEXER_EMBED_CACHE_PATH = os.getenv("INDEXER_EMBED_CACHE_PATH", "embedding_cache.db")
+INDEXER_EMBED_CACHE_MAX_ROWS = int(os.getenv("INDEXER_EMBED_CACHE_MAX_ROWS", "50000"))
+
+# Inserciones en tfinal: filas por petición (array JSON) y reintentos de un tramo fallido
+INDEXER_INSERT_ROWS = int(os.getenv("INDEXER_INSERT_ROWS", "100"))
+INDEXER_INSERT_RETRIES = int(os.getenv("INDEXER_INSERT_RETRIES", "3"))
+INDEXER_INSERT_BACKOFF = float(os.getenv("INDEXER_INSERT_BACKOFF", "0.5"))
+# Rechazos por filas inválidas o en conflicto: se divide el tramo para aislarlas
+INSERT_BISECT_STATUS = {400, 409, 422}
+# Respuestas tras las que el POST no se aplicó y repetirlo no duplica filas
+INSERT_RETRY_STATUS = {429, 500, 502, 503}
+# Etapas del pipeline de indexación, en orden
+PIPELINE_STAGES = ("download", "extract", "split", "embed", "upload")
+# Pool de extracción y split: "process" (MarkItDown y el splitter retienen el GIL) o "thread"
+INDEXER_CPU_EXECUTOR = os.getenv("INDEXER_CPU_EXECUTOR", "process")
+# Filas por página al recorrer tfinal e ids por petición DELETE en la limpieza
+INDEXER_CLEANUP_PAGE = int(os.getenv("INDEXER_CLEANUP_PAGE", "1000"))
+INDEXER_DELETE_IDS = 200
+
+
+class EmbeddingCache:
+    """
+    Embeddings ya calculados en SQLite, clave SHA-256(modelo + texto del chunk), como
+    float32. Al superar `max_rows` se descartan los menos usados recientemente.
+    """
+
+    def __init__(self, db_path: str = INDEXER_EMBED_CACHE_PATH, max_rows: int = INDEXER_EMBED_CACHE_MAX_ROWS):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.lock = Lock()
+        self._ready = False
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._ready:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_used ON embedding_cache(last_used)")
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def get_many(self, texts: List[str], model: str) -> Dict[str, List[float]]:
+        """Embeddings cacheados de `texts`, por texto"""
+        keys = {self.key(text, model): text for text in set(texts)}
+        found: Dict[str, List[float]] = {}
+        with self.lock:
+            with self._connect() as conn:
+                key_list = list(keys)
+                for i in range(0, len(key_list), 500):
+                    part = key_list[i:i+500]
+                    rows = conn.execute(
+                        f"SELECT cache_key, vector FROM embedding_cache WHERE cache_key IN ({','.join('?' * len(part))})",
+                        part
+                    ).fetchall()
+                    for cache_key, vector in rows:
+                        found[keys[cache_key]] = np.frombuffer(vector, dtype=np.float32).tolist()
+                if found:
+                    now = time.time()
+                    conn.executemany("UPDATE embedding_cache SET last_used = ? WHERE cache_key = ?",
+                                     [(now, self.key(text, model)) for text in found])
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: List[tuple], model: str) -> None:
+        """Guarda pares (texto, embedding) y aplica el tope de filas"""
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (cache_key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                    [(self.key(text, model), model, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                     for text, vector in items]
+                )
+                self.stats["writes"] += len(items)
+                evicted = conn.execute("""
+                    DELETE FROM embedding_cache WHERE cache_key IN (
+                        SELECT cache_key FROM embedding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                """, (self.max_rows,)).rowcount
+                self.stats["evicted"] += max(evicted, 0)
+
+    def size(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def get_stats(self) -> Dict[str, float]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0}
+
+
+class ChunkEmbedder:
+    """
+    Genera embeddings de chunks en lotes con `aembed_documents`: cada petición lleva hasta
+    `batch_size` textos sin superar `max_tokens`, y un semáforo compartido limita las
+    peticiones en vuelo de todos los archivos. Con `cache` solo se piden a OpenAI los
+    chunks nuevos o modificados, y los textos repetidos se piden una sola vez.
+    """
+
+    def __init__(self, embeddings, batch_size: int = INDEXER_EMBED_BATCH_SIZE,
+                 max_tokens: int = INDEXER_EMBED_MAX_TOKENS, max_concurrency: int = INDEXER_EMBED_CONCURRENCY,
+                 cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", "")
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        # El semáforo pertenece al event loop que lo creó
+        self._semaphore = None
+        self._semaphore_loop = None
+        self.reset_stats()
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // CHARS_PER_TOKEN + 1
+
+    def make_batches(self, texts: List[str]) -> List[List[int]]:
+        """Agrupa los índices de `texts` en lotes acotados por cantidad y por tokens"""
+        batches, current, current_tokens = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if current and (len(current) >= self.batch_size or current_tokens + tokens > self.max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        async with self._get_semaphore():
+            vectors = await self.embeddings.aembed_documents(texts)
+        self.stats["requests"] += 1
+        self.stats["chunks"] += len(texts)
+        self.stats["tokens"] += sum(self.estimate_tokens(text) for text in texts)
+        return vectors
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embeddings de `texts` en el mismo orden"""
+        if not texts:
+            return []
+        start = time.perf_counter()
+        try:
+            known = await asyncio.to_thread(self.cache.get_many, texts, self.model) if self.cache else {}
+            pending = [text for text in dict.fromkeys(texts) if text not in known]
+            self.stats["cached"] += sum(1 for text in texts if text in known)
+
+            batches = self.make_batches(pending)
+            results = await asyncio.gather(*(self._embed_batch([pending[i] for i in batch]) for batch in batches))
+            fresh = [(pending[i], vector) for batch, batch_vectors in zip(batches, results)
+                     for i, vector in zip(batch, batch_vectors)]
+            if self.cache:
+                await asyncio.to_thread(self.cache.put_many, fresh, self.model)
+        finally:
+            self.stats["seconds"] += time.perf_counter() - start
+
+        known.update(fresh)
+        return [known[text] for text in texts]
+
+    def reset_stats(self) -> None:
+        self.stats = {"chunks": 0, "tokens": 0, "requests": 0, "cached": 0, "seconds": 0.0}
+
+    def get_stats(self) -> Dict[str, float]:
+        seconds = self.stats["seconds"]
+        return {
+            **self.stats,
+            "seconds": round(seconds, 2),
+            "chunks_per_sec": round(self.stats["chunks"] / seconds, 1) if seconds else 0.0,
+            "tokens_per_sec": round(self.stats["tokens"] / seconds, 1) if seconds else 0.0
+        }
+
+
+# MarkItDown de cada proceso del pool de extracción (se crea en el primer archivo)
+_process_markitdown = None
+
+
+def convert_file_to_text(temp_file: str, markitdown: Optional[MarkItDown] = None) -> str:
+    """
+    Convierte un archivo descargado a Markdown con MarkItDown y borra el temporal.
+    Función de módulo para poder ejecutarse en el pool de procesos.
+    
+    Args:
+        temp_file: Ruta devuelta por download_file_from_drive
+        markitdown: Conversor a usar (por defecto, el del proceso actual)
+        
+    Returns:
+        str: Texto extraído del archivo (lanza excepción si no se pudo extraer)
+    """
+    global _process_markitdown
+    if markitdown is None:
+        if _process_markitdown is None:
+            _process_markitdown = MarkItDown()
+        markitdown = _process_markitdown
+    try:
+        # Convertir a Markdown usando MarkItDown
+        print(f"🔄 Convirtiendo archivo a Markdown...")
+        # Crear URI del archivo
+        file_uri = Path(temp_file).absolute().as_uri()
+        # Convertir usando MarkItDown
+        result = markitdown.convert_uri(file_uri)
+        markdown_text = result.markdown
+        
+        if not markdown_text or markdown_text.strip() == "":
+            raise ValueError("No se pudo extraer texto del archivo")
+            
+        print(f"✅ Texto extraído exitosamente ({len(markdown_text)} caracteres)")
+        return markdown_text
+        
+    except Exception as e:
+        print(f"❌ Error convirtiendo a Markdown: {str(e)}")
+        # Si falla la conversión a Markdown, intentar leer el archivo directamente
+        try:
+            with open(temp_file, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except Exception:
+            raise e
+        if not text or not text.strip():
+            raise e
+        print("✅ Texto extraído directamente del archivo")
+        return text
+        
+    finally:
+        # Limpiar: eliminar el archivo temporal
+        try:
+            os.remove(temp_file)
+            print(f"🧹 Archivo temporal eliminado: {temp_file}")
+        except Exception as e:
+            print(f"⚠️ No se pudo eliminar el archivo temporal: {str(e)}")
+
+
+def split_into_chunks(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Divide el texto en chunks (función de módulo para el pool de procesos)"""
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+    return text_splitter.split_text(text)
+
+
 class DocumentIndexer:
     """Clase para indexar documentos de Google Drive en Supabase"""
     
-    def __init__(self, max_hilos=10, lote=5):
+    def __init__(self, max_hilos=10, lote=5, cpu_executor=INDEXER_CPU_EXECUTOR):
         """Inicializa el indexador con los servicios necesarios"""
-        self.drive_service = get_google_drive_service()
-        self.embeddings_model = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
+        self.drive_credentials = get_google_drive_credentials()
+        self.drive_service = get_google_drive_service(self.drive_credentials)
+        # Servicio de Drive propio de cada hilo de descarga (httplib2 no es thread-safe)
+        self._drive_local = threading.local()
+        self.embeddings_model = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY, chunk_size=INDEXER_EMBED_BATCH_SIZE)
+        self.chunk_embedder = ChunkEmbedder(
+            self.embeddings_model,
+            cache=EmbeddingCache(INDEXER_EMBED_CACHE_PATH) if INDEXER_EMBED_CACHE_PATH else None
+        )
         self.markitdown = MarkItDown()
         
         # Configuración de chunks
@@ -31,8 +316,21 @@ class DocumentIndexer:
         self.chunk_overlap = 300
         
         # Configuración de optimización
-        self.max_hilos = max_hilos  # Número máximo de hilos
-        self.batch_size = lote    # Número de chunks por lote
+        self.max_hilos = max_hilos  # Workers por etapa de red del pipeline
+        self.batch_size = lote    # Archivos en espera entre etapas del pipeline
+        self.cpu_executor = cpu_executor  # "process" o "thread" para extracción y split
+        self._executors = {}
+        self.insert_rows = INDEXER_INSERT_ROWS  # Filas por inserción masiva en tfinal
+        self.insert_stats = {"rows": 0, "requests": 0, "retries": 0, "failed_rows": 0}
+        self.stage_stats = {stage: {"files": 0, "seconds": 0.0} for stage in PIPELINE_STAGES}
+
+    def thread_drive_service(self):
+        """Servicio de Drive del hilo actual, creado la primera vez que el hilo descarga"""
+        service = getattr(self._drive_local, "service", None)
+        if service is None:
+            service = get_google_drive_service(self.drive_credentials)
+            self._drive_local.service = service
+        return service
 
     def download_file_from_drive(self, file_id: str, mime_type: str) -> str:
         """
@@ -46,15 +344,16 @@ class DocumentIndexer:
             str: Ruta al archivo temporal descargado
         """
         try:
+            drive_service = self.thread_drive_service()
             # Para archivos de Google Docs/Sheets, necesitamos exportarlos
             if 'google-apps' in mime_type:
                 if 'document' in mime_type:
-                    request = self.drive_service.files().export_media(
+                    request = drive_service.files().export_media(
                         fileId=file_id,
                         mimeType='application/pdf'
                     )
                 elif 'spreadsheet' in mime_type:
-                    request = self.drive_service.files().export_media(
+                    request = drive_service.files().export_media(
                         fileId=file_id,
                         mimeType='application/pdf'
                     )
@@ -62,7 +361,7 @@ class DocumentIndexer:
                     raise ValueError(f"Formato de Google Apps no soportado: {mime_type}")
             else:
                 # Para otros tipos de archivos, usar get_media
-                request = self.drive_service.files().get_media(fileId=file_id)
+                request = drive_service.files().get_media(fileId=file_id)
 
             # Crear archivo temporal con la extensión correcta
             extension = self._get_file_extension(mime_type)
@@ -94,6 +393,10 @@ class DocumentIndexer:
         }
         return mime_to_ext.get(mime_type, '.tmp')
 
+    def convert_to_text(self, temp_file: str) -> str:
+        """Convierte un archivo descargado a Markdown y borra el temporal (ver convert_file_to_text)"""
+        return convert_file_to_text(temp_file, self.markitdown)
+    
     def extract_text(self, file_id: str, mime_type: str) -> str:
         """
         Extrae texto de un archivo usando MarkItDown
@@ -106,45 +409,9 @@ class DocumentIndexer:
             str: Texto extraído del archivo
         """
         try:
-            # 1. Descargar el archivo a un archivo temporal
             temp_file = self.download_file_from_drive(file_id, mime_type)
             print(f"📥 Archivo descargado temporalmente en: {temp_file}")
-            
-            try:
-                # 2. Convertir a Markdown usando MarkItDown
-                print(f"🔄 Convirtiendo archivo a Markdown...")
-                # Crear URI del archivo
-                file_uri = Path(temp_file).absolute().as_uri()
-                # Convertir usando MarkItDown
-                result = self.markitdown.convert_uri(file_uri)
-                markdown_text = result.markdown
-                
-                if not markdown_text or markdown_text.strip() == "":
-                    raise ValueError("No se pudo extraer texto del archivo")
-                    
-                print(f"✅ Texto extraído exitosamente ({len(markdown_text)} caracteres)")
-                return markdown_text
-                
-            except Exception as e:
-                print(f"❌ Error convirtiendo a Markdown: {str(e)}")
-                # Si falla la conversión a Markdown, intentar leer el archivo directamente
-                try:
-                    with open(temp_file, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                        if text and text.strip():
-                            print("✅ Texto extraído directamente del archivo")
-                            return text
-                except:
-                    raise e
-                
-            finally:
-                # 3. Limpiar: eliminar el archivo temporal
-                try:
-                    os.remove(temp_file)
-                    print(f"🧹 Archivo temporal eliminado: {temp_file}")
-                except Exception as e:
-                    print(f"⚠️ No se pudo eliminar el archivo temporal: {str(e)}")
-                
+            return self.convert_to_text(temp_file)
         except Exception as e:
             error_msg = f"Error: {str(e)}"
             print(f"❌ {error_msg}")
@@ -152,26 +419,19 @@ class DocumentIndexer:
     
     def split_text(self, text):
         """Divide el texto en chunks"""
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
-        )
-        return text_splitter.split_text(text)
+        return split_into_chunks(text, self.chunk_size, self.chunk_overlap)
     
     async def index_documents(self):
-        """Indexa documentos utilizando procesamiento optimizado con async y multihilo"""
+        """Indexa documentos con el pipeline por etapas (descarga → extracción → split → embeddings → subida)"""
         print("🚀 Iniciando indexación optimizada de documentos...")
+        self.chunk_embedder.reset_stats()
+        self.insert_stats = {"rows": 0, "requests": 0, "retries": 0, "failed_rows": 0}
         
         # Obtener ID de la carpeta desde variables de entorno
         folder_id = GOOGLE_DRIVE_FOLDER_ID
 
         try:
             # 1. Listar archivos en la carpeta
-            files = self.drive_service.files().list(
-                q=f"'{folder_id}' in parents",
-                fields="files(id, name, mimeType, modifiedTime)"
-            ).execute().get('files', [])
-
             query = (
                 f"'{folder_id}' in parents "
                 "and mimeType!='application/vnd.google-apps.folder' "
@@ -185,134 +445,262 @@ class DocumentIndexer:
             
             print(f"📂 Encontrados {len(files)} archivos en Drive")
             
-            # Procesar cada archivo
-            for file in files:
-                file_id = file['id']
-                file_name = file['name']
-                
-                # 2.1 Verificar si el archivo existe en Supabase usando helper
-                response = make_supabase_request(
-                    method="GET",
-                    endpoint="tfinal",
-                    params={
-                        "select": "metadata",
-                        "metadata->>file_id": f"eq.{file_id}",
-                        "limit": "1"
-                    }
-                )
-                
-                file_exists_in_supabase = False
-                needs_update = True
-                
-                if response.status_code == 200 and response.json():
-                    file_exists_in_supabase = True
-                    # Verificar si el documento ha cambiado (comparando timestamps)
-                    supabase_file = response.json()[0]
-                    supabase_modified_time = supabase_file.get('metadata', {}).get('modifiedTime', '')
-                    drive_modified_time = file.get('modifiedTime', '')
-                    
-                    if supabase_modified_time == drive_modified_time:
-                        needs_update = False
-                        print(f"⏭️ Sin cambios: {file_name}")
-                    else:
-                        print(f"🔄 Cambios detectados: {file_name}, actualizando...")
-                else:
-                    print(f"📄 Nuevo documento: {file_name}")
-                
-                # 2.2 Si no existe en Supabase o necesita actualización, procesarlo
-                if not file_exists_in_supabase or needs_update:
-                    await self._process_file_async(file)
-                else:
-                    # Verificar si hay contenido en Supabase usando helper
-                    count_response = make_supabase_request(
-                        method="GET",
-                        endpoint="tfinal",
-                        params={
-                            "select": "count",
-                            "metadata->>file_id": f"eq.{file_id}"
-                        }
-                    )
-                    
-                    if count_response.status_code == 200:
-                        count_data = count_response.json()
-                        if count_data and not count_data[0].get('count', 0) > 0:
-                            print(f"⚠️ Archivo {file_name} está registrado pero sin contenido en Supabase. Reindexando...")
-                            await self._process_file_async(file)
-                        else:
-                            print(f"✅ Archivo {file_name} ya indexado con {count_data[0].get('count', 0)} chunks")
+            # 2. Verificar y procesar los archivos con etapas solapadas
+            start = time.perf_counter()
+            indexed = await self.run_pipeline(files)
+            elapsed = time.perf_counter() - start
             
-            print("✅ Proceso de indexación completado")
+            print(f"✅ Proceso de indexación completado: {indexed} archivos indexados en {elapsed:.1f}s")
+            timings = ", ".join(f"{stage} {stats['seconds']:.1f}s/{stats['files']}"
+                                for stage, stats in self.stage_stats.items())
+            print(f"⏱️ Etapas (tiempo acumulado/archivos): {timings}")
+            stats = self.chunk_embedder.get_stats()
+            print(f"📊 Embeddings: {stats['chunks']} chunks en {stats['requests']} peticiones, "
+                  f"{stats['chunks_per_sec']} chunks/s, ~{stats['tokens_per_sec']} tokens/s")
+            if self.chunk_embedder.cache:
+                cache_stats = self.chunk_embedder.cache.get_stats()
+                print(f"📊 Caché de embeddings: {stats['cached']} chunks reutilizados, "
+                      f"hit rate {cache_stats['hit_rate']:.0%}, {cache_stats['evicted']} descartados")
+            inserts = self.insert_stats
+            print(f"📊 Inserciones: {inserts['rows']} filas en {inserts['requests']} peticiones "
+                  f"({inserts['retries']} reintentos, {inserts['failed_rows']} filas fallidas)")
             
         except Exception as e:
             print(f"❌ Error en indexación: {str(e)}")
             traceback.print_exc()
     
-    async def process_file_async(self, file):
-        """Procesa un archivo de forma asíncrona"""
+    async def needs_indexing(self, file) -> bool:
+        """Compara el archivo de Drive con lo guardado en tfinal (modifiedTime y chunks presentes)"""
+        file_id = file['id']
+        file_name = file['name']
+        
+        # Verificar si el archivo existe en Supabase
+        response = await supabase_client.request(
+            method="GET",
+            endpoint="tfinal",
+            params={
+                "select": "metadata",
+                "metadata->>file_id": f"eq.{file_id}",
+                "order": "id.desc",   # la fila más reciente: puede quedar otra generación sin limpiar
+                "limit": "1"
+            }
+        )
+        
+        if response.status_code != 200 or not response.json():
+            print(f"📄 Nuevo documento: {file_name}")
+            return True
+        
+        # Verificar si el documento ha cambiado (comparando timestamps)
+        supabase_file = response.json()[0]
+        supabase_modified_time = supabase_file.get('metadata', {}).get('modifiedTime', '')
+        if supabase_modified_time != file.get('modifiedTime', ''):
+            print(f"🔄 Cambios detectados: {file_name}, actualizando...")
+            return True
+        
+        # Verificar si hay contenido en Supabase
+        count_response = await supabase_client.request(
+            method="GET",
+            endpoint="tfinal",
+            params={
+                "select": "count",
+                "metadata->>file_id": f"eq.{file_id}"
+            }
+        )
+        
+        if count_response.status_code == 200:
+            count_data = count_response.json()
+            if count_data and not count_data[0].get('count', 0) > 0:
+                print(f"⚠️ Archivo {file_name} está registrado pero sin contenido en Supabase. Reindexando...")
+                return True
+            print(f"✅ Archivo {file_name} ya indexado con {count_data[0].get('count', 0)} chunks")
+        else:
+            print(f"⏭️ Sin cambios: {file_name}")
+        return False
+    
+    def stage_workers(self) -> Dict[str, int]:
+        """Workers por etapa: red con `max_hilos`, CPU (MarkItDown, split) acotada a los núcleos"""
+        network = max(1, self.max_hilos)
+        cpu = max(1, min(self.max_hilos, os.cpu_count() or 1))
+        return {"download": network, "extract": cpu, "split": cpu, "embed": network, "upload": network}
+    
+    async def run_pipeline(self, files: List[Dict], check: bool = True) -> int:
+        """
+        Procesa los archivos por etapas conectadas con colas acotadas (`lote` archivos
+        por cola), de modo que la descarga de un archivo se solapa con la conversión,
+        los embeddings y la subida de otros. Devuelve los archivos indexados.
+        """
+        workers = self.stage_workers()
+        queues = {stage: asyncio.Queue(maxsize=max(1, self.batch_size)) for stage in PIPELINE_STAGES}
+        self.stage_stats = {stage: {"files": 0, "seconds": 0.0} for stage in PIPELINE_STAGES}
+        indexed = 0
+        
+        async def worker(stage: str, next_stage: Optional[str]):
+            nonlocal indexed
+            while True:
+                job = await queues[stage].get()
+                if job is None:
+                    return
+                job = await self._run_stage(stage, job)
+                if job is None:
+                    continue
+                if next_stage:
+                    await queues[next_stage].put(job)
+                else:
+                    indexed += 1
+        
+        async def run_stage(stage: str, next_stage: Optional[str]):
+            await asyncio.gather(*(worker(stage, next_stage) for _ in range(workers[stage])))
+            # Etapa terminada: avisar a los workers de la siguiente
+            if next_stage:
+                for _ in range(workers[next_stage]):
+                    await queues[next_stage].put(None)
+        
+        async def produce():
+            for file in files:
+                await queues[PIPELINE_STAGES[0]].put({"file": file, "check": check})
+            for _ in range(workers[PIPELINE_STAGES[0]]):
+                await queues[PIPELINE_STAGES[0]].put(None)
+        
+        next_stages = list(PIPELINE_STAGES[1:]) + [None]
+        self._executors = self._create_executors(workers)
         try:
-            print(f"\n📄 Procesando: {file['name']}")
-            
-            # Verificar si el archivo ya está indexado (opcional)
-            # Código de verificación aquí si es necesario
-            
-            # Extraer texto (esto es sincrónico porque usa la API de Drive)
-            loop = asyncio.get_running_loop()
-            text = await loop.run_in_executor(
-                None, 
-                lambda: self.extract_text(file['id'], file['mimeType'])
-            )
-            
-            if not text or text.startswith("Error:"):
-                print(f"❌ {text if text else 'No se pudo extraer texto'}")
-                return
-                
-            # Dividir en chunks
-            chunks = await loop.run_in_executor(
-                None,
-                lambda: self.split_text(text)
-            )
-            
-            total_chunks = len(chunks)
-            print(f"📦 Total chunks: {total_chunks}")
-            
-            # Procesar chunks en lotes para reducir llamadas a API
-            tasks = []
-            for i in range(0, total_chunks, self.batch_size):
-                batch = chunks[i:i+self.batch_size]
+            await asyncio.gather(produce(), *(run_stage(stage, next_stage)
+                                              for stage, next_stage in zip(PIPELINE_STAGES, next_stages)))
+        finally:
+            executors, self._executors = self._executors, {}
+            for executor in executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+        return indexed
+    
+    def _create_executors(self, workers: Dict[str, int]) -> Dict[str, object]:
+        """
+        Pools propios del pipeline: las descargas no compiten con los hilos por defecto
+        (caché de embeddings, SQLite) y la extracción y el split van a procesos aparte.
+        """
+        executors = {"download": ThreadPoolExecutor(max_workers=workers["download"],
+                                                    thread_name_prefix="indexer-download")}
+        cpu_workers = max(workers["extract"], workers["split"])
+        if self.cpu_executor == "process":
+            # spawn: no se hereda por fork el estado de los hilos del servidor
+            executors["cpu"] = ProcessPoolExecutor(max_workers=cpu_workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executors["cpu"] = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="indexer-cpu")
+        return executors
+    
+    async def _run_in(self, pool: str, func, *args):
+        """Ejecuta `func` en el pool indicado del pipeline (o en el por defecto fuera de él)"""
+        return await asyncio.get_running_loop().run_in_executor(self._executors.get(pool), func, *args)
+    
+    async def _run_stage(self, stage: str, job: Dict) -> Optional[Dict]:
+        """Ejecuta una etapa sobre un archivo; None si el archivo no sigue (sin cambios o error)"""
+        start = time.perf_counter()
+        try:
+            return await getattr(self, f"_stage_{stage}")(job)
+        except Exception as e:
+            print(f"❌ Error en etapa {stage} de {job['file']['name']}: {str(e)}")
+            if job.get("temp_file") and os.path.exists(job["temp_file"]):
+                os.remove(job["temp_file"])
+            return None
+        finally:
+            self.stage_stats[stage]["files"] += 1
+            self.stage_stats[stage]["seconds"] += time.perf_counter() - start
+    
+    async def _stage_download(self, job: Dict) -> Optional[Dict]:
+        file = job["file"]
+        if job.get("check") and not await self.needs_indexing(file):
+            return None
+        print(f"\n📄 Procesando: {file['name']}")
+        job["temp_file"] = await self._run_in("download", self.download_file_from_drive, file['id'], file['mimeType'])
+        print(f"📥 Archivo descargado temporalmente en: {job['temp_file']}")
+        return job
+    
+    async def _stage_extract(self, job: Dict) -> Dict:
+        if self.cpu_executor == "process":
+            job["text"] = await self._run_in("cpu", convert_file_to_text, job.pop("temp_file"))
+        else:
+            job["text"] = await self._run_in("cpu", self.convert_to_text, job.pop("temp_file"))
+        return job
+    
+    async def _stage_split(self, job: Dict) -> Dict:
+        if self.cpu_executor == "process":
+            job["chunks"] = await self._run_in("cpu", split_into_chunks, job.pop("text"),
+                                               self.chunk_size, self.chunk_overlap)
+        else:
+            job["chunks"] = await self._run_in("cpu", self.split_text, job.pop("text"))
+        print(f"📦 {job['file']['name']}: {len(job['chunks'])} chunks")
+        return job
+    
+    async def _stage_embed(self, job: Dict) -> Dict:
+        job["embeddings"] = await self.chunk_embedder.embed(job["chunks"])
+        return job
+    
+    async def _stage_upload(self, job: Dict) -> Optional[Dict]:
+        stored = await self.store_chunks(job["file"], job["chunks"], job["embeddings"])
+        return job if stored else None
+    
+    async def process_file_async(self, file) -> bool:
+        """Procesa un solo archivo por todas las etapas. True si se guardaron todos sus chunks"""
+        return await self.run_pipeline([file], check=False) == 1
+    
+    async def store_chunks(self, file, chunks: List[str], embeddings: List[List[float]]) -> bool:
+        """
+        Guarda los chunks de un archivo con una generación propia; las generaciones
+        anteriores del archivo solo se borran cuando la nueva quedó completa.
+        """
+        generation = uuid.uuid4().hex
+        total_chunks = len(chunks)
+        try:
+            # Guardar los chunks con inserciones masivas, un tramo tras otro
+            inserted = 0
+            for i in range(0, total_chunks, self.insert_rows):
+                batch = chunks[i:i+self.insert_rows]
                 batch_indices = list(range(i+1, i+len(batch)+1))
-                tasks.append(self.process_chunk_batch(batch, batch_indices, file, total_chunks))
+                inserted += await self.process_chunk_batch(batch, embeddings[i:i+self.insert_rows],
+                                                           batch_indices, file, total_chunks, generation)
+            if inserted != total_chunks:
+                raise RuntimeError(f"solo se guardaron {inserted} de {total_chunks} chunks")
             
-            # Ejecutar procesamiento de lotes en paralelo
-            await asyncio.gather(*tasks)
+            # Generación completa: reemplazar la anterior
+            await self.delete_previous_generations(file['id'], generation)
+            return True
             
         except Exception as e:
-            print(f"❌ Error procesando archivo {file['name']}: {str(e)}")
-            traceback.print_exc()
+            print(f"❌ Error guardando archivo {file['name']}: {str(e)}")
+            # La versión anterior sigue intacta: descartar la generación a medias
+            await self.delete_generation(file['id'], generation)
+            return False
+    
+    async def delete_previous_generations(self, file_id: str, generation: str) -> bool:
+        """Borra los chunks del archivo que no son de `generation` (incluye los anteriores a las generaciones)"""
+        return await self._delete_chunks(file_id, {
+            "or": f"(metadata->>generation.is.null,metadata->>generation.neq.{generation})"
+        })
+    
+    async def delete_generation(self, file_id: str, generation: str) -> bool:
+        """Borra los chunks de una generación concreta del archivo"""
+        return await self._delete_chunks(file_id, {"metadata->>generation": f"eq.{generation}"})
     
-    async def process_chunk_batch(self, chunks, indices, file, total_chunks):
-        """Procesa un lote de chunks de forma asíncrona"""
+    async def _delete_chunks(self, file_id: str, filters: Dict[str, str]) -> bool:
+        try:
+            response = await supabase_client.request(
+                method="DELETE",
+                endpoint="tfinal",
+                params={"metadata->>file_id": f"eq.{file_id}", **filters}
+            )
+            if response.status_code < 300:
+                return True
+            detail = response.text
+        except SupabaseUnavailable as e:
+            detail = str(e)
+        print(f"⚠️ No se pudieron borrar chunks de {file_id} ({detail}); `python indexador.py cleanup` los depura")
+        return False
+    
+    async def process_chunk_batch(self, chunks, embeddings, indices, file, total_chunks, generation=None) -> int:
+        """Guarda en Supabase un lote de chunks con sus embeddings. Devuelve las filas insertadas"""
         try:
             print(f"  🔄 Procesando lote {min(indices)}-{max(indices)} de {total_chunks}")
             
-            # Generar embeddings (esto es sincrónico porque la API de OpenAI no es async)
-            loop = asyncio.get_running_loop()
-            embeddings = []
-            
-            # Usar un ThreadPoolExecutor para paralelizar las llamadas a la API de OpenAI
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
-                # Crear tareas para generar embeddings
-                embed_tasks = [
-                    loop.run_in_executor(
-                        executor,
-                        self.embeddings_model.embed_query,
-                        chunk
-                    )
-                    for chunk in chunks
-                ]
-                
-                # Esperar a que se completen todas las tareas
-                embeddings = await asyncio.gather(*embed_tasks)
-            
             # Crear los registros para Supabase
             records = []
             for i, (chunk, embedding, chunk_index) in enumerate(zip(chunks, embeddings, indices)):
@@ -323,6 +711,7 @@ class DocumentIndexer:
                     'chunk_number': chunk_index,
                     'total_chunks': total_chunks,
                     'modifiedTime': file.get('modifiedTime', ''),
+                    'generation': generation,
                     'timestamp': datetime.now().isoformat()
                 }
                 
@@ -332,33 +721,157 @@ class DocumentIndexer:
                     "metadata": chunk_metadata
                 })
             
-            # Insertar en Supabase (asíncrono)
-            headers = {
-                "Content-Type": "application/json",
-                "apikey": SUPABASE_KEY,
-                "Authorization": f"Bearer {SUPABASE_KEY}"
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                for record in records:
-                    async with session.post(
-                        f"{SUPABASE_URL}/rest/v1/tfinal",
-                    headers=headers,
-                        json=record
-                    ) as response:
-                        if response.status == 201:
-                            print(f"    ✅ Chunk {record['metadata']['chunk_number']}/{total_chunks} indexado")
-                        else:
-                            error_text = await response.text()
-                            print(f"    ❌ Error en chunk {record['metadata']['chunk_number']}: {error_text}")
+            # Una sola petición con todo el lote (cliente compartido de la indexación)
+            inserted = await self.insert_records(records)
+            if inserted == len(records):
+                print(f"    ✅ Chunks {min(indices)}-{max(indices)}/{total_chunks} indexados")
+            else:
+                print(f"    ❌ {len(records) - inserted} chunks del lote {min(indices)}-{max(indices)} sin guardar")
+            return inserted
                 
         except Exception as e:
             print(f"  ❌ Error procesando lote {min(indices)}-{max(indices)}: {str(e)}")
             traceback.print_exc()
+            return 0
+    
+    async def insert_records(self, records: List[Dict]) -> int:
+        """
+        Inserta registros en tfinal como arrays JSON de hasta `insert_rows` filas.
+        Si un tramo falla solo se reintenta ese tramo: los errores transitorios se repiten
+        con backoff y los rechazos (4xx) se parten en mitades para aislar las filas inválidas.
+        """
+        inserted = 0
+        for i in range(0, len(records), self.insert_rows):
+            inserted += await self._insert_slice(records[i:i+self.insert_rows])
+        return inserted
+    
+    async def _insert_slice(self, rows: List[Dict], attempt: int = 0) -> int:
+        self.insert_stats["requests"] += 1
+        try:
+            response = await supabase_client.request(
+                method="POST",
+                endpoint="tfinal",
+                data=rows,
+                headers={"Prefer": "return=minimal"}
+            )
+            status, detail = response.status_code, response.text
+            retryable = status in INSERT_RETRY_STATUS
+        except SupabaseUnavailable as e:
+            # Circuito abierto o sin conexión: el POST no salió. Si pudo salir (timeout), no se
+            # repite: el POST masivo no es idempotente y duplicaría filas de esta generación
+            status, detail = None, str(e)
+            retryable = not e.maybe_sent
+        
+        if status is not None and status < 300:
+            self.insert_stats["rows"] += len(rows)
+            return len(rows)
+        
+        # Rechazo de filas: el array se inserta en una sola transacción, aislar las inválidas
+        if status in INSERT_BISECT_STATUS:
+            if len(rows) > 1:
+                middle = len(rows) // 2
+                return await self._insert_slice(rows[:middle]) + await self._insert_slice(rows[middle:])
+            print(f"    ❌ Chunk {rows[0]['metadata']['chunk_number']} rechazado: {detail}")
+            self.insert_stats["failed_rows"] += 1
+            return 0
+        
+        if not retryable:
+            # Otros 4xx (auth, tabla inexistente, tamaño) o resultado desconocido: fallar ya
+            print(f"    ❌ {len(rows)} chunks sin guardar ({status or 'sin respuesta'}): {detail}")
+            self.insert_stats["failed_rows"] += len(rows)
+            return 0
+        
+        # Fallo transitorio sin efecto (429, 5xx, no enviado): repetir el mismo tramo
+        if attempt < INDEXER_INSERT_RETRIES:
+            self.insert_stats["retries"] += 1
+            await asyncio.sleep(INDEXER_INSERT_BACKOFF * (2 ** attempt))
+            return await self._insert_slice(rows, attempt + 1)
+        print(f"    ❌ {len(rows)} chunks sin guardar tras {attempt + 1} intentos: {detail}")
+        self.insert_stats["failed_rows"] += len(rows)
+        return 0
 
     async def _process_file_async(self, file):
         """Wrapper asíncrono para procesar un archivo"""
-        await self.process_file_async(file)
+        return await self.process_file_async(file)
+
+
+async def cleanup_index(dry_run: bool = False) -> Dict[str, int]:
+    """
+    Depura tfinal: por archivo conserva solo la versión completa más reciente (mayor
+    modifiedTime y, a igualdad, la última generación insertada) y dentro de ella un chunk
+    por chunk_number. Las generaciones incompletas más nuevas se dejan: pueden estar
+    escribiéndose. Si la lectura de tfinal falla no se borra nada.
+    """
+    # 1. Recorrer la tabla por páginas de id
+    versions: Dict[str, Dict[tuple, Dict[int, List[int]]]] = {}
+    totals: Dict[tuple, int] = {}  # (file_id, versión) → total_chunks declarado
+    rows, last_id = 0, 0
+    while True:
+        response = await supabase_client.request(
+            method="GET",
+            endpoint="tfinal",
+            params={"select": "id,metadata", "id": f"gt.{last_id}", "order": "id.asc",
+                    "limit": str(INDEXER_CLEANUP_PAGE)}
+        )
+        if response.status_code != 200:
+            print(f"❌ Error leyendo tfinal ({response.status_code}): {response.text}; no se borra nada")
+            return {"files": len(versions), "rows": rows, "stale": 0, "duplicates": 0, "in_progress": 0,
+                    "deleted": 0, "error": response.status_code}
+        page = response.json()
+        for row in page:
+            metadata = row.get("metadata") or {}
+            file_id = metadata.get("file_id")
+            version = (metadata.get("modifiedTime") or "", metadata.get("generation") or "")
+            chunks = versions.setdefault(file_id, {}).setdefault(version, {})
+            chunks.setdefault(metadata.get("chunk_number"), []).append(row["id"])
+            if metadata.get("total_chunks"):
+                totals[(file_id, version)] = metadata["total_chunks"]
+        rows += len(page)
+        if len(page) < INDEXER_CLEANUP_PAGE:
+            break
+        last_id = page[-1]["id"]
+    
+    # 2. Elegir qué conservar
+    stale: List[int] = []
+    duplicates: List[int] = []
+    in_progress = 0
+    for file_id, file_versions in versions.items():
+        def recency(version):
+            return version[0], max(max(ids) for ids in file_versions[version].values())
+        
+        # Sin total_chunks (filas antiguas) no se puede verificar: se da por completa
+        complete = [version for version, chunks in file_versions.items()
+                    if len(chunks) >= totals.get((file_id, version), 0)]
+        if not complete:
+            print(f"⚠️ {file_id} no tiene ninguna versión completa; se deja sin depurar")
+            continue
+        newest = max(complete, key=recency)
+        for version, chunks in file_versions.items():
+            if version == newest:
+                duplicates.extend(row_id for ids in chunks.values() for row_id in sorted(ids)[:-1])
+            elif version not in complete and recency(version) > recency(newest):
+                in_progress += sum(len(ids) for ids in chunks.values())
+            else:
+                stale.extend(row_id for ids in chunks.values() for row_id in ids)
+    
+    # 3. Borrar por lotes de ids
+    to_delete = stale + duplicates
+    deleted = 0
+    if not dry_run:
+        for i in range(0, len(to_delete), INDEXER_DELETE_IDS):
+            ids = to_delete[i:i+INDEXER_DELETE_IDS]
+            response = await supabase_client.request(
+                method="DELETE",
+                endpoint="tfinal",
+                params={"id": f"in.({','.join(str(row_id) for row_id in ids)})"}
+            )
+            if response.status_code < 300:
+                deleted += len(ids)
+            else:
+                print(f"❌ Error borrando {len(ids)} chunks: {response.text}")
+    
+    return {"files": len(versions), "rows": rows, "stale": len(stale),
+            "duplicates": len(duplicates), "in_progress": in_progress, "deleted": deleted}
 
 
 class IndexerAgent:
@@ -397,11 +910,12 @@ class IndexerAgent:
             print(f"   📊 Count: {params['match_count']}")
             print(f"   📏 Embedding dims: {len(query_embedding)}")
             
-            # Usar helper para RPC call
-            response = make_supabase_request(
+            # RPC de solo lectura: se puede reintentar aunque sea POST
+            response = await supabase_client.request(
                 method="POST",
                 endpoint="rpc/match_tfinal",
-                data=params
+                data=params,
+                idempotent=True
             )
             
             # 3. Procesar resultados
@@ -435,7 +949,14 @@ class IndexerAgent:
 
 
 if __name__ == "__main__":
-    # Código para ejecutar la indexación directamente
-    print("📚 Ejecutando indexación optimizada de documentos...")
-    indexer = DocumentIndexer()
-    asyncio.run(indexer.index_documents())
\ No newline at end of file
+    # python indexador.py                     → indexa la carpeta de Drive
+    # python indexador.py cleanup [--dry-run] → borra de tfinal versiones viejas y chunks duplicados
+    if len(sys.argv) > 1 and sys.argv[1] == "cleanup":
+        report = asyncio.run(cleanup_index(dry_run="--dry-run" in sys.argv))
+        print(f"🧹 {report['files']} archivos, {report['rows']} chunks: {report['stale']} de versiones anteriores, "
+              f"{report['duplicates']} duplicados, {report['in_progress']} de generaciones en curso, "
+              f"{report['deleted']} borrados")
+    else:
+        print("📚 Ejecutando indexación optimizada de documentos...")
+        indexer = DocumentIndexer()
+        asyncio.run(indexer.index_documents())
\ No newline at end of file
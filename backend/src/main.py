@@ -4,7 +4,10 @@ from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse, ORJSONResponse
 from contextlib import asynccontextmanager
 import uvicorn
-from orquestador import get_orchestrator_for_user, check_and_cleanup_inactive_users, user_orchestrators, last_activity, get_inactive_users, INACTIVITY_TIMEOUT
+from orquestador import get_orchestrator_for_user_async, check_and_cleanup_inactive_users, user_orchestrators, last_activity, get_inactive_users, INACTIVITY_TIMEOUT
+from memoria import (advanced_memory_manager, memory_write_buffer, message_embedder,
+                     session_backups, MEMORY_BACKUP_INTERVAL)
+from cliente_supabase import supabase_client
 import os
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
@@ -13,9 +16,16 @@ import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from indexador import DocumentIndexer
 import time
+import asyncio
 import uuid
 from models import HealthResponse, UserStatsResponse, UserStatsModel
 from web_api import web_api, sync_whatsapp_message, conv_manager
+from cola_mensajes import IngestionQueue, create_queue_backend
+from cliente_whatsapp import whatsapp_client
+from bandeja_salida import outbox_sender, send_whatsapp_message
+from corrector import SpanishSpellChecker, normalize_text
+from clasificador import laboral_classifier
+from utilidades import LRUTTLCache
 
 # Ya no necesitamos TempConversationManager, usamos el de web_api
 
@@ -29,6 +39,30 @@ WHATSAPP_API_URL = "https://graph.facebook.com/v17.0/508244739043826/messages"
 WEBHOOK_URL = "https://incentive-incl-moment-valium.trycloudflare.com/webhook"
 VERIFY_TOKEN = os.getenv("WEBHOOK_VERIFY_TOKEN")
 
+# Configuración de la cola de ingesta
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+
+# Configuración del pre-procesador: los mensajes cortos nunca pasan por el LLM
+PREPROCESSOR_SHORT_WORDS = int(os.getenv("PREPROCESSOR_SHORT_WORDS", "10"))
+PREPROCESSOR_CACHE_SIZE = int(os.getenv("PREPROCESSOR_CACHE_SIZE", "1000"))
+PREPROCESSOR_CACHE_TTL = int(os.getenv("PREPROCESSOR_CACHE_TTL", "3600"))
+
+# Tipos de mensaje con texto que el bot puede responder
+TEXT_MESSAGE_TYPES = {"text", "button", "interactive"}
+NON_TEXT_LABELS = {
+    "image": "Imagen",
+    "audio": "Audio",
+    "video": "Video",
+    "document": "Documento",
+    "sticker": "Sticker",
+    "location": "Ubicación",
+    "contacts": "Contacto",
+    "reaction": "Reacción"
+}
+# Tipos que solo se registran en el dashboard, sin respuesta automática
+SILENT_MESSAGE_TYPES = {"reaction", "sticker"}
+UNSUPPORTED_MESSAGE_REPLY = "📝 Por ahora solo puedo responder mensajes de texto. ¿Podrías escribir tu consulta? 😊"
+
 # Inicializar el scheduler
 scheduler = AsyncIOScheduler()
 scheduler_started = False  # Flag para evitar inicios múltiples
@@ -37,8 +71,19 @@ class MessagePreProcessor:
     def __init__(self):
         self.llm = ChatOpenAI(
             model="gpt-4o-mini",
-            temperature=0.7
+            temperature=0
         )
+        self.spellchecker = SpanishSpellChecker()
+        self.cache = LRUTTLCache(maxsize=PREPROCESSOR_CACHE_SIZE, ttl=PREPROCESSOR_CACHE_TTL)
+        self.stats = {
+            "total": 0,
+            "short_bypass": 0,
+            "clean_bypass": 0,
+            "local_corrections": 0,
+            "cache_hits": 0,
+            "llm_calls": 0,
+            "llm_errors": 0
+        }
         self.prompt = ChatPromptTemplate.from_messages([
             ("system", """Tu ÚNICA tarea es corregir errores ortográficos o gramaticales obvios.
             
@@ -65,61 +110,63 @@ class MessagePreProcessor:
         ])
 
     async def process_message(self, text: str) -> str:
+        """
+        Corrige el mensaje. Camino rápido local (errores frecuentes y tildes) para
+        mensajes cortos o sin errores probables; el LLM solo se usa cuando el
+        corrector detecta palabras mal escritas, y su resultado se cachea.
+        """
+        self.stats["total"] += 1
+        corrected, changes = self.spellchecker.correct_locally(text)
+        if changes:
+            self.stats["local_corrections"] += 1
+        
+        if len(corrected.split()) < PREPROCESSOR_SHORT_WORDS:
+            self.stats["short_bypass"] += 1
+            return corrected
+        if not self.spellchecker.suspected_typos(corrected):
+            self.stats["clean_bypass"] += 1
+            return corrected
+        
+        cache_key = normalize_text(corrected)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+        
+        self.stats["llm_calls"] += 1
         try:
             response = await self.llm.ainvoke(
-                self.prompt.format_messages(text=text)
+                self.prompt.format_messages(text=corrected)
             )
-            return response.content.strip()
+            result = response.content.strip()
+            self.cache.set(cache_key, result)
+            return result
         except Exception as e:
+            self.stats["llm_errors"] += 1
             print(f"❌ Error: {str(e)}")
-            return text
+            return corrected
+    
+    def get_stats(self) -> dict:
+        """Contadores del pre-procesador: cuántos mensajes evitan el LLM"""
+        total = self.stats["total"]
+        return {
+            **self.stats,
+            "llm_ratio": round(self.stats["llm_calls"] / total, 3) if total else 0.0,
+            "cache": self.cache.get_stats()
+        }
 
 # Inicializar el pre-procesador junto con el agente
 preprocessor = MessagePreProcessor()
 
-async def send_whatsapp_message(phone_number: str, response_data: dict):
-    """Envía un mensaje de WhatsApp usando la API de Meta """
-    try:
-        print(f"\n Intentando enviar mensaje a {phone_number}")
-        
-        token = WHATSAPP_TOKEN
-        
-        # URL de la API
-        url = f"https://graph.facebook.com/v17.0/{WHATSAPP_PHONE_ID}/messages"
+# Cola de ingesta: el webhook encola y los workers procesan
+ingestion_queue = IngestionQueue(backend=create_queue_backend(), workers=INGESTION_WORKERS)
 
-        # Datos a enviar
-        data = {
-            "messaging_product": "whatsapp",
-            "to": phone_number,
-            "type": "text",
-            "text": {
-                "body": response_data["response"]  # Enviamos solo la respuesta como cadena
-            }
-        }
-                
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=data)
-                print(f" Respuesta de WhatsApp API: {response.status_code}")
-                print(f" Contenido de respuesta: {response.text}")
-                
-                if response.status_code != 200:
-                    print(f"⚠️ Headers de respuesta: {dict(response.headers)}")
-                
-                response.raise_for_status()
-                return response.json()
-        except Exception as e:
-            print(f"❌ Error enviando mensaje: {str(e)}")
-            print(f"❌ Detalles del error: {type(e).__name__}")
-            return None
-    except Exception as e:
-        print(f"❌ Error enviando mensaje: {str(e)}")
-        return None
+def update_outbound_status(entry: dict, status: str):
+    """Refleja en la conversación el resultado de un envío de la outbox (sent / failed)"""
+    if entry.get("conversation_id") and entry.get("message_id"):
+        conv_manager.update_message_status(entry["conversation_id"], entry["message_id"], status)
+
+outbox_sender.on_status = update_outbound_status
 
 async def run_indexer():
     """Ejecuta la indexación de documentos"""
@@ -144,15 +191,28 @@ async def startup_tasks():
     
     print("🚀 Iniciando tareas de arranque...")
     
+    # Cliente HTTP compartido para la API de WhatsApp
+    await whatsapp_client.start()
+    
+    # Sender de la outbox: entrega en segundo plano las respuestas encoladas
+    await outbox_sender.start()
+    
+    # Arrancar los workers de la cola de ingesta
+    await ingestion_queue.start(process_incoming_message)
+    
     # Indexar inmediatamente al arrancar
     await run_indexer()
     
     # Programar indexación cada 60 minutos
     scheduler.add_job(run_indexer, "interval", minutes=60, id="indexer_job")
     
-    # Programar limpieza de memoria cada 15 minutos
+    # Programar limpieza de memoria cada 15 minutos (única vía de expiración por inactividad)
     scheduler.add_job(check_memory_cleanup, "interval", minutes=15, id="memory_cleanup_job")
     
+    # Backups comprimidos de las sesiones con cambios (un solo job para todas las sesiones)
+    scheduler.add_job(session_backups.run_pending, "interval", seconds=MEMORY_BACKUP_INTERVAL,
+                      id="memory_backup_job", max_instances=1, coalesce=True)
+    
     # Iniciar scheduler solo una vez
     if not scheduler.running:
         scheduler.start()
@@ -165,11 +225,26 @@ async def check_memory_cleanup():
     """Verifica y limpia memorias inactivas"""
     print("📋 Verificando usuarios inactivos para limpiar memoria...")
     check_and_cleanup_inactive_users()
+    # Sesiones de memoria inactivas y datos locales antiguos (acceso a SQLite: fuera del event loop)
+    await asyncio.to_thread(advanced_memory_manager.periodic_cleanup)
 
 async def shutdown_tasks():
     """Tareas de cierre del servidor"""
     print("🔌 Cerrando servidor...")
     
+    # Detener workers de la cola de ingesta
+    await ingestion_queue.stop()
+    
+    # Detener la outbox (lo no enviado queda en la tabla) y cerrar conexiones con WhatsApp
+    await outbox_sender.stop()
+    await whatsapp_client.close()
+    
+    # Volcar las escrituras de memoria pendientes y cerrar las conexiones SQLite
+    await asyncio.to_thread(memory_write_buffer.stop)
+    await session_backups.run_pending()
+    advanced_memory_manager.local_persistence.pool.close_all()
+    await supabase_client.close()
+    
     # Cerrar scheduler
     if scheduler.running:
         scheduler.shutdown()
@@ -224,22 +299,20 @@ async def users_stats():
     current_time = time.time()
     active_users = []
     
-    # Usar la función utilitaria para obtener usuarios inactivos
-    inactive_users = get_inactive_users(current_time)
-    
     for user_id, last_active in last_activity.items():
         time_since_last_activity = current_time - last_active
         active_users.append(UserStatsModel(
             user_id=user_id,
             last_activity_minutes_ago=round(time_since_last_activity / 60, 2),
             has_orchestrator=user_id in user_orchestrators,
-            is_active=user_id not in inactive_users  # Usar la lógica centralizada
+            is_active=not last_activity.is_expired(user_id, current_time)  # Usar la lógica centralizada
         ))
     
     return UserStatsResponse(
         success=True,
         active_users=active_users,
-        total_users=len(active_users)
+        total_users=len(active_users),
+        pool=user_orchestrators.get_stats()
     )
 
 @app.get("/webhook")
@@ -300,149 +373,206 @@ async def validate_phone_number(phone_number): #Aun no se usa , pero mas adelant
         return False, None
 
 
+async def process_incoming_message(item: dict):
+    """Procesa un mensaje de la cola de ingesta (ejecutado por los workers)"""
+    phone_number = item["phone_number"]
+    message_text = item["text"]
+    nombre = item["nombre"]
+    
+    print(f"\n👤 Mensaje de {nombre} ({phone_number}): {message_text}")
+    
+    # 1. Sincronizar mensaje con el sistema web
+    conversation_id = sync_whatsapp_message(phone_number, message_text, "user")
+    conversation = conv_manager.get_conversation(conversation_id)
+    
+    # 2. Verificar el modo de la conversación
+    conversation_mode = conversation.get("mode", "auto") if conversation else "auto"
+    
+    print(f"🔧 Modo de conversación: {conversation_mode}")
+    
+    # Mensajes sin texto (imágenes, audios, ubicaciones...): el bot no puede procesarlos
+    if item.get("type", "text") not in TEXT_MESSAGE_TYPES:
+        if conversation_mode == "auto":
+            if item.get("type") in SILENT_MESSAGE_TYPES:
+                return
+            message = conv_manager.add_message(conversation_id, UNSUPPORTED_MESSAGE_REPLY, "bot", status="queued") if conversation else None
+            await send_whatsapp_message(phone_number, {"response": UNSUPPORTED_MESSAGE_REPLY},
+                                        conversation_id=conversation_id, message_id=message["id"] if message else None)
+        elif conversation:
+            conversation["status"] = "pending"
+            print(f"📬 Mensaje {item.get('type')} en espera para operador")
+        return
+    
+    # 3. Solo responder automáticamente si está en modo "auto"
+    if conversation_mode == "auto":
+        print("🤖 Respondiendo automáticamente...")
+        
+        # Procesar mensaje con LLM
+        processed = await preprocessor.process_message(message_text)
+        print(f"🔍 Mensaje procesado: {processed}")
+        
+        try:
+            # Construir contexto con los datos del usuario
+            context = {
+                "phone_number": phone_number,
+                "user_name": nombre,
+                "nombre": nombre
+            }
+            
+            # 🧠 Obtener orquestador personalizado para este usuario
+            user_orchestrator = await get_orchestrator_for_user_async(phone_number)
+            response = await user_orchestrator.process_query(processed, context)
+            
+            # Obtener respuesta del orquestador
+            response_text = response.get("response", "Lo siento, no pude procesar tu consulta.")
+            
+            # Sincronizar respuesta del bot con el sistema web
+            message = conv_manager.add_message(conversation_id, response_text, "bot", status="queued") if conversation else None
+            
+            # Encolar respuesta en la outbox de WhatsApp
+            whatsapp_data = {"response": response_text}
+            await send_whatsapp_message(phone_number, whatsapp_data,
+                                        conversation_id=conversation_id, message_id=message["id"] if message else None)
+            
+        except Exception as e:
+            print(f"❌ Error en orquestador: {str(e)}")
+            error_msg = "Lo siento, hubo un error procesando tu consulta."
+            error_data = {"response": error_msg}
+            
+            # Sincronizar mensaje de error
+            message = conv_manager.add_message(conversation_id, error_msg, "bot", status="queued") if conversation else None
+            await send_whatsapp_message(phone_number, error_data,
+                                        conversation_id=conversation_id, message_id=message["id"] if message else None)
+                
+    elif conversation_mode == "manual":
+        print("👨‍💼 Modo manual - Esperando respuesta del operador")
+        # Solo registrar el mensaje, no responder automáticamente
+        # El operador verá el mensaje en el frontend
+        
+        # Cambiar estado a "pendiente" para alertar al operador
+        if conversation:
+            conversation["status"] = "pending"
+            # Ya se incrementó el unreadCount en add_message
+            print(f"📬 Mensaje en espera para operador. Total no leídos: {conversation.get('unreadCount', 0)}")
+            
+    elif conversation_mode == "hybrid":
+        print("🤖👨‍💼 Modo híbrido - Bot genera respuesta para aprobación")
+        
+        # Procesar mensaje con LLM (igual que modo auto)
+        processed = await preprocessor.process_message(message_text)
+        print(f"🔍 Mensaje procesado: {processed}")
+        
+        try:
+            # Construir contexto con los datos del usuario
+            context = {
+                "phone_number": phone_number,
+                "user_name": nombre,
+                "nombre": nombre
+            }
+            
+            # 🧠 Obtener orquestador personalizado para este usuario
+            user_orchestrator = await get_orchestrator_for_user_async(phone_number)
+            response = await user_orchestrator.process_query(processed, context)
+            
+            # Obtener respuesta del orquestador
+            response_text = response.get("response", "Lo siento, no pude procesar tu consulta.")
+            
+            # Guardar respuesta pendiente SIN agregar al chat todavía
+            if conversation:
+                # Solo actualizar el estado de la conversación con la respuesta pendiente
+                conversation["pending_response"] = {
+                    "content": response_text, 
+                    "timestamp": time.time(),
+                    "id": str(uuid.uuid4())
+                }
+                
+            print(f"✅ Respuesta generada pendiente de aprobación: {response_text[:50]}...")
+            
+            # NO enviar a WhatsApp automáticamente
+            # NO agregar al chat todavía
+            # El operador debe aprobar primero desde el frontend
+            
+        except Exception as e:
+            print(f"❌ Error en orquestador híbrido: {str(e)}")
+            # En caso de error, guardar mensaje de error pendiente
+            error_msg = "Lo siento, hubo un error procesando tu consulta."
+            if conversation:
+                conversation["pending_response"] = {
+                    "content": error_msg,
+                    "timestamp": time.time(),
+                    "id": str(uuid.uuid4()),
+                    "is_error": True
+                }
+
+def describe_webhook_message(message: dict) -> str:
+    """Obtiene el texto de un mensaje de WhatsApp o una descripción si no es de texto"""
+    message_type = message.get("type", "unknown")
+    
+    if message_type == "text":
+        return message.get("text", {}).get("body", "")
+    if message_type == "button":
+        return message.get("button", {}).get("text", "")
+    if message_type == "interactive":
+        interactive = message.get("interactive", {})
+        reply = interactive.get("button_reply") or interactive.get("list_reply") or {}
+        return reply.get("title", "")
+    
+    # Multimedia y otros tipos: describir el contenido para el dashboard
+    description = f"[{NON_TEXT_LABELS.get(message_type, message_type)}]"
+    payload = message.get(message_type)
+    caption = payload.get("caption") if isinstance(payload, dict) else None
+    return f"{description} {caption}" if caption else description
+
+async def enqueue_webhook_message(message: dict, contacts: dict) -> dict:
+    """Valida y encola un mensaje del webhook (la cola deduplica por message_id). Retorna el resultado del mensaje"""
+    message_id = message.get("id")
+    phone_number = message.get("from")
+    message_type = message.get("type", "unknown")
+    
+    if not message_id or not phone_number:
+        print(f"⚠️ Mensaje inválido en el webhook (sin id o remitente): {message}")
+        return {"message_id": message_id, "type": message_type, "status": "invalid"}
+    
+    nombre = contacts.get(phone_number) or next(iter(contacts.values()), None) or f"Usuario {phone_number[-4:]}"
+    
+    # Encolar para que lo procese un worker. El backend descarta los reintentos de Meta
+    # (message_id UNIQUE); si el INSERT falla no queda marcado y el reintento entra
+    queued = await ingestion_queue.enqueue_async({
+        "message_id": message_id,
+        "phone_number": phone_number,
+        "type": message_type,
+        "text": describe_webhook_message(message),
+        "nombre": nombre
+    })
+    
+    return {"message_id": message_id, "type": message_type, "status": "queued" if queued else "duplicate"}
+
 @app.post("/webhook")
 async def handle_webhook(request: Request):
-    """Maneja los webhooks entrantes de WhatsApp"""
+    """Recibe los webhooks de WhatsApp: valida, deduplica y encola todos los mensajes del lote"""
     try:
         data = await request.json()
         print(f"📨 Webhook recibido: {data}")
         
         if "object" in data and data["object"] == "whatsapp_business_account":
-            for entry in data["entry"]:
-                for change in entry["changes"]:
-                    if "messages" in change["value"]:
-                        for message in change["value"]["messages"]:
-                            if message["type"] == "text":
-                                # Verificar si el mensaje ya fue procesado
-                                message_id = message["id"]
-                                if conv_manager.is_message_processed(message_id):
-                                    print(f"⚠️ Mensaje {message_id} ya procesado, saltando...")
-                                    continue
-                                
-                                # Marcar mensaje como procesado
-                                conv_manager.mark_message_processed(message_id)
-                                
-                                phone_number = message["from"]
-                                message_text = message["text"]["body"]
-                                nombre = change["value"]["contacts"][0]["profile"]["name"]
-                                
-                                print(f"\n👤 Mensaje de {nombre} ({phone_number}): {message_text}")
-                                
-                                # 1. Sincronizar mensaje con el sistema web
-                                conversation_id = sync_whatsapp_message(phone_number, message_text, "user")
-                                conversation = conv_manager.get_conversation(conversation_id)
-                                
-                                # 2. Verificar el modo de la conversación
-                                conversation_mode = conversation.get("mode", "auto") if conversation else "auto"
-                                
-                                print(f"🔧 Modo de conversación: {conversation_mode}")
-                                
-                                # 3. Solo responder automáticamente si está en modo "auto"
-                                if conversation_mode == "auto":
-                                    print("🤖 Respondiendo automáticamente...")
-                                    
-                                    # Procesar mensaje con LLM
-                                    processed = await preprocessor.process_message(message_text)
-                                    print(f"🔍 Mensaje procesado: {processed}")
-                                    
-                                    try:
-                                        # Construir contexto con los datos del usuario
-                                        context = {
-                                            "phone_number": phone_number,
-                                            "user_name": nombre,
-                                            "nombre": nombre
-                                        }
-                                        
-                                        # 🧠 Obtener orquestador personalizado para este usuario
-                                        user_orchestrator = get_orchestrator_for_user(phone_number)
-                                        response = await user_orchestrator.process_query(processed, context)
-                                        
-                                        # Obtener respuesta del orquestador
-                                        response_text = response.get("response", "Lo siento, no pude procesar tu consulta.")
-                                        
-                                        # Sincronizar respuesta del bot con el sistema web
-                                        if conversation:
-                                            conv_manager.add_message(conversation_id, response_text, "bot")
-                                        
-                                        # Enviar respuesta por WhatsApp
-                                        whatsapp_data = {"response": response_text}
-                                        await send_whatsapp_message(phone_number, whatsapp_data)
-                                        
-                                    except Exception as e:
-                                        print(f"❌ Error en orquestador: {str(e)}")
-                                        error_msg = "Lo siento, hubo un error procesando tu consulta."
-                                        error_data = {"response": error_msg}
-                                        await send_whatsapp_message(phone_number, error_data)
-                                        
-                                        # Sincronizar mensaje de error
-                                        if conversation:
-                                            conv_manager.add_message(conversation_id, error_msg, "bot")
-                                            
-                                elif conversation_mode == "manual":
-                                    print("👨‍💼 Modo manual - Esperando respuesta del operador")
-                                    # Solo registrar el mensaje, no responder automáticamente
-                                    # El operador verá el mensaje en el frontend
-                                    
-                                    # Cambiar estado a "pendiente" para alertar al operador
-                                    if conversation:
-                                        conversation["status"] = "pending"
-                                        # Ya se incrementó el unreadCount en add_message
-                                        print(f"📬 Mensaje en espera para operador. Total no leídos: {conversation.get('unreadCount', 0)}")
-                                        
-                                elif conversation_mode == "hybrid":
-                                    print("🤖👨‍💼 Modo híbrido - Bot genera respuesta para aprobación")
-                                    
-                                    # Procesar mensaje con LLM (igual que modo auto)
-                                    processed = await preprocessor.process_message(message_text)
-                                    print(f"🔍 Mensaje procesado: {processed}")
-                                    
-                                    try:
-                                        # Construir contexto con los datos del usuario
-                                        context = {
-                                            "phone_number": phone_number,
-                                            "user_name": nombre,
-                                            "nombre": nombre
-                                        }
-                                        
-                                        # 🧠 Obtener orquestador personalizado para este usuario
-                                        user_orchestrator = get_orchestrator_for_user(phone_number)
-                                        response = await user_orchestrator.process_query(processed, context)
-                                        
-                                        # Obtener respuesta del orquestador
-                                        response_text = response.get("response", "Lo siento, no pude procesar tu consulta.")
-                                        
-                                        # Guardar respuesta pendiente SIN agregar al chat todavía
-                                        if conversation:
-                                            # Solo actualizar el estado de la conversación con la respuesta pendiente
-                                            conversation["pending_response"] = {
-                                                "content": response_text, 
-                                                "timestamp": time.time(),
-                                                "id": str(uuid.uuid4())
-                                            }
-                                            
-                                        print(f"✅ Respuesta generada pendiente de aprobación: {response_text[:50]}...")
-                                        
-                                        # NO enviar a WhatsApp automáticamente
-                                        # NO agregar al chat todavía
-                                        # El operador debe aprobar primero desde el frontend
-                                        
-                                    except Exception as e:
-                                        print(f"❌ Error en orquestador híbrido: {str(e)}")
-                                        # En caso de error, guardar mensaje de error pendiente
-                                        error_msg = "Lo siento, hubo un error procesando tu consulta."
-                                        if conversation:
-                                            conversation["pending_response"] = {
-                                                "content": error_msg,
-                                                "timestamp": time.time(),
-                                                "id": str(uuid.uuid4()),
-                                                "is_error": True
-                                            }
-                                        
-
-                            
-                                return {"status": "ok"}
+            results = []
+            
+            # Meta puede agrupar varios entries, changes y mensajes en un solo POST
+            for entry in data.get("entry", []):
+                for change in entry.get("changes", []):
+                    value = change.get("value", {})
+                    contacts = {
+                        contact.get("wa_id"): contact.get("profile", {}).get("name")
+                        for contact in value.get("contacts", [])
+                    }
+                    for message in value.get("messages", []):
+                        results.append(await enqueue_webhook_message(message, contacts))
             
-            return {"status": "ok"}
+            queued = sum(1 for result in results if result["status"] == "queued")
+            if results:
+                print(f"📥 Webhook: {queued}/{len(results)} mensajes encolados")
+            
+            return {"status": "ok", "received": len(results), "queued": queued, "results": results}
             
         print("❌ Objeto no reconocido:", data.get("object"))
         raise HTTPException(status_code=404, detail="Objeto no reconocido")
@@ -453,6 +583,27 @@ async def handle_webhook(request: Request):
         print(f"❌ Error en webhook: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error procesando webhook: {str(e)}")
 
+@app.get("/queue/stats")
+async def queue_stats():
+    """Estadísticas de la cola de ingesta de mensajes"""
+    return {"success": True, "queue": ingestion_queue.get_stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas de rendimiento del servidor"""
+    return {
+        "success": True,
+        "queue": ingestion_queue.get_stats(),
+        "outbox": outbox_sender.get_stats(),
+        "preprocessor": preprocessor.get_stats(),
+        "classifier": laboral_classifier.get_stats(),
+        "whatsapp_client": whatsapp_client.get_stats(),
+        "memory_writes": memory_write_buffer.get_stats(),
+        "memory_embeddings": message_embedder.get_stats(),
+        "memory_backups": session_backups.get_stats(),
+        "supabase": supabase_client.get_stats()
+    }
+
 # ================================================================
 # API ENDPOINTS PARA EL FRONTEND
 # ================================================================
@@ -623,7 +774,8 @@ async def send_message_to_conversation(conversation_id: str, request: Request):
             "content": content,
             "sender": "operator" if sender_mode == "operator" else "bot",
             "timestamp": time.time(),
-            "operator_id": operator_id if sender_mode == "operator" else None
+            "operator_id": operator_id if sender_mode == "operator" else None,
+            "status": "queued" if sender_mode == "operator" else "sent"
         }
         
         # Agregar mensaje a la conversación
@@ -639,7 +791,8 @@ async def send_message_to_conversation(conversation_id: str, request: Request):
         if sender_mode == "operator":
             phone_number = conversation_id.replace("whatsapp_", "")
             whatsapp_data = {"response": content}
-            await send_whatsapp_message(phone_number, whatsapp_data)
+            await send_whatsapp_message(phone_number, whatsapp_data,
+                                        conversation_id=conversation_id, message_id=message["id"])
         
         return {"success": True, "message": message}
     except Exception as e:
@@ -699,21 +852,22 @@ async def approve_pending_response(conversation_id: str):
         pending_response = conversation["pending_response"]
         response_content = pending_response["content"]
         
-        # Enviar respuesta por WhatsApp
-        phone_number = conversation_id.replace("whatsapp_", "")
-        whatsapp_data = {"response": response_content}
-        await send_whatsapp_message(phone_number, whatsapp_data)
-        
         # Agregar mensaje a la conversación
         message = {
             "id": str(uuid.uuid4()),
             "content": response_content,
             "sender": "bot",
             "timestamp": time.time(),
-            "status": "sent"
+            "status": "queued"
         }
         conversation["messages"].append(message)
         
+        # Encolar respuesta en la outbox de WhatsApp
+        phone_number = conversation_id.replace("whatsapp_", "")
+        whatsapp_data = {"response": response_content}
+        await send_whatsapp_message(phone_number, whatsapp_data,
+                                    conversation_id=conversation_id, message_id=message["id"])
+        
         # Limpiar respuesta pendiente
         conversation["pending_response"] = None
         
@@ -760,22 +914,23 @@ async def edit_and_approve_pending_response(conversation_id: str, request: Reque
         if not conversation or not conversation.get("pending_response"):
             raise HTTPException(status_code=404, detail="Respuesta pendiente no encontrada")
         
-        # Enviar respuesta editada por WhatsApp
-        phone_number = conversation_id.replace("whatsapp_", "")
-        whatsapp_data = {"response": new_content}
-        await send_whatsapp_message(phone_number, whatsapp_data)
-        
         # Agregar mensaje editado a la conversación
         message = {
             "id": str(uuid.uuid4()),
             "content": new_content,
             "sender": "bot",
             "timestamp": time.time(),
-            "status": "sent",
+            "status": "queued",
             "edited": True
         }
         conversation["messages"].append(message)
         
+        # Encolar respuesta editada en la outbox de WhatsApp
+        phone_number = conversation_id.replace("whatsapp_", "")
+        whatsapp_data = {"response": new_content}
+        await send_whatsapp_message(phone_number, whatsapp_data,
+                                    conversation_id=conversation_id, message_id=message["id"])
+        
         # Limpiar respuesta pendiente
         conversation["pending_response"] = None
         
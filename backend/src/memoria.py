@@ -4,16 +4,133 @@ import sqlite3
 import pickle
 import gzip
 import os
+import re
+import sys
+import hashlib
+import unicodedata
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
-from threading import Lock, Timer
+import uuid
+import asyncio
+import itertools
+import threading
+from collections import deque
+from threading import Lock
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.schema import BaseMessage, HumanMessage, AIMessage, SystemMessage
-from utilidades import SUPABASE_URL, SUPABASE_KEY, get_supabase_headers, make_supabase_request
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+from utilidades import (
+    SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY, get_supabase_headers, make_supabase_request,
+    ExpiryTracker, LRUTTLCache
+)
+# ============================================================================
+# 🪪 IDENTIDAD DE SESIÓN POR USUARIO
+# ============================================================================
+
+# true: el session_id es un hash del número (no se guarda el teléfono en claro)
+MEMORY_SESSION_HASH = os.getenv("MEMORY_SESSION_HASH", "true").lower() == "true"
+MEMORY_SESSION_SALT = os.getenv("MEMORY_SESSION_SALT", "")
+
+# Sesiones antiguas: session_<timestamp unix de 10 dígitos>
+LEGACY_SESSION_RE = re.compile(r"^session_\d{10}$")
+
+
+def session_id_for_user(user_id: str, hashed: bool = None) -> str:
+    """Session id estable derivado del número de teléfono del usuario"""
+    digits = re.sub(r"\D", "", str(user_id)) or str(user_id)
+    if hashed is None:
+        hashed = MEMORY_SESSION_HASH
+    if hashed:
+        return "session_" + hashlib.sha256((MEMORY_SESSION_SALT + digits).encode("utf-8")).hexdigest()[:24]
+    return f"session_{digits}"
+
+
+def _phone_from_metadata(metadata: str) -> Optional[str]:
+    """Número de teléfono guardado en el contexto de un mensaje episódico (si lo hay)"""
+    try:
+        context = json.loads(metadata or "{}").get("context") or {}
+    except (TypeError, ValueError):
+        return None
+    user_context = context.get("user_context") or {}
+    return user_context.get("phone_number") or context.get("phone_number")
+
 # ============================================================================
 # 💾 CAPA DE PERSISTENCIA LOCAL
 # ============================================================================
 
+# Palabras vacías que no aportan a la búsqueda episódica (se comparan sin tildes)
+SEARCH_STOPWORDS = {
+    "a", "al", "algo", "como", "con", "cual", "de", "del", "el", "en", "es", "esta", "este", "hay",
+    "la", "las", "le", "lo", "los", "me", "mi", "mis", "no", "o", "para", "pero", "por", "que",
+    "se", "si", "sin", "sobre", "su", "sus", "te", "tu", "un", "una", "y", "ya", "yo"
+}
+
+
+def fts_query(text: str, operator: str = "OR") -> str:
+    """Convierte texto libre en una consulta FTS5: términos entre comillas unidos con OR/AND"""
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        folded = unicodedata.normalize("NFKD", word).encode("ascii", "ignore").decode()
+        if folded and folded not in SEARCH_STOPWORDS and word not in terms:
+            terms.append(word)
+    return f" {operator} ".join(f'"{term}"' for term in terms)
+
+
+class SQLiteConnectionPool:
+    """
+    Conexiones SQLite de larga vida, una por hilo, para una base de datos.
+    Usa WAL (lecturas concurrentes con una escritura) y synchronous=NORMAL;
+    al reutilizar la conexión también se reutiliza su caché de sentencias preparadas.
+    """
+    
+    def __init__(self, db_path: str, cached_statements: int = 256):
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self.schema_ready = False
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self.lock = threading.RLock()
+    
+    def connection(self) -> sqlite3.Connection:
+        """Conexión del hilo actual (se crea en el primer uso). Usar con `with` para la transacción"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, cached_statements=self.cached_statements,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self.lock:
+                self._connections.append(conn)
+        return conn
+    
+    def close_all(self) -> None:
+        """Cierra todas las conexiones del pool (al apagar el proceso)"""
+        with self.lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+
+# Un pool por archivo de base de datos en el proceso
+_sqlite_pools: Dict[str, SQLiteConnectionPool] = {}
+_sqlite_pools_lock = Lock()
+
+
+def get_sqlite_pool(db_path: str) -> SQLiteConnectionPool:
+    """Pool compartido por todas las instancias que usan el mismo archivo"""
+    key = os.path.abspath(db_path)
+    with _sqlite_pools_lock:
+        if key not in _sqlite_pools:
+            _sqlite_pools[key] = SQLiteConnectionPool(db_path)
+        return _sqlite_pools[key]
+
+
 class LocalMemoryPersistence:
     """Capa de persistencia local para memoria de largo plazo"""
     
@@ -21,8 +138,14 @@ class LocalMemoryPersistence:
         self.base_path = base_path
         self.db_path = os.path.join(base_path, "memory.db")
         self.lock = Lock()
+        self._fts_enabled: Optional[bool] = None
         self._ensure_directory()
-        self._init_local_db()
+        self.pool = get_sqlite_pool(self.db_path)
+        # El esquema se crea una sola vez por proceso y archivo
+        with self.pool.lock:
+            if not self.pool.schema_ready:
+                self._init_local_db()
+                self.pool.schema_ready = True
     
     def _ensure_directory(self):
         """Crear directorio si no existe"""
@@ -30,7 +153,7 @@ class LocalMemoryPersistence:
     
     def _init_local_db(self):
         """Inicializar base de datos local SQLite"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             
             # Tabla para memoria episódica
@@ -42,7 +165,8 @@ class LocalMemoryPersistence:
                     content TEXT NOT NULL,
                     metadata TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    synced_to_remote BOOLEAN DEFAULT FALSE
+                    synced_to_remote BOOLEAN DEFAULT FALSE,
+                    sync_failed BOOLEAN DEFAULT FALSE
                 )
             """)
             
@@ -57,7 +181,8 @@ class LocalMemoryPersistence:
                     confidence REAL DEFAULT 1.0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    synced_to_remote BOOLEAN DEFAULT FALSE
+                    synced_to_remote BOOLEAN DEFAULT FALSE,
+                    sync_failed BOOLEAN DEFAULT FALSE
                 )
             """)
             
@@ -93,12 +218,96 @@ class LocalMemoryPersistence:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_semantic_session ON semantic_memory(session_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_procedural_session ON procedural_memory(session_id)")
             
+            # v1: la sincronización con Supabase pasa a leer synced_to_remote. Las filas previas
+            # ya se enviaron en línea, así que se marcan como sincronizadas para no duplicarlas
+            if cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+                cursor.execute("UPDATE episodic_memory SET synced_to_remote = 1")
+                cursor.execute("UPDATE semantic_memory SET synced_to_remote = 1")
+                cursor.execute("PRAGMA user_version = 1")
+            
+            # Filas que Supabase rechazó (CHECK, RLS, columnas): se apartan para no frenar la cola
+            for table in self.SYNCED_TABLES:
+                columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+                if "sync_failed" not in columns:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN sync_failed BOOLEAN DEFAULT FALSE")
+            # Índices parciales: la cola de sincronización se lee sin recorrer la tabla entera
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_episodic_unsynced ON episodic_memory(id) WHERE NOT synced_to_remote")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_semantic_unsynced ON semantic_memory(id) WHERE NOT synced_to_remote")
+            
+            # v2: índice de texto completo sobre los mensajes (FTS5, contenido externo)
+            # v4: el índice incluye session_id para filtrar la sesión dentro del MATCH
+            if cursor.execute("PRAGMA user_version").fetchone()[0] < 4:
+                try:
+                    self._create_episodic_fts(cursor)
+                    cursor.execute("PRAGMA user_version = 4")
+                except sqlite3.OperationalError as e:
+                    # SQLite compilado sin FTS5: search_memory usa el recorrido lineal
+                    print(f"⚠️ FTS5 no disponible, búsqueda episódica sin índice: {e}")
+            
+            # v3: embeddings de los mensajes del usuario (float32 normalizados, un BLOB por mensaje)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS episodic_vectors (
+                    message_id INTEGER PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vectors_session ON episodic_vectors(session_id, message_id)")
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS episodic_vectors_delete AFTER DELETE ON episodic_memory BEGIN
+                    DELETE FROM episodic_vectors WHERE message_id = old.id;
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS episodic_vectors_rekey AFTER UPDATE OF session_id ON episodic_memory BEGIN
+                    UPDATE episodic_vectors SET session_id = new.session_id WHERE message_id = new.id;
+                END
+            """)
+            
             conn.commit()
     
+    def _create_episodic_fts(self, cursor):
+        """Tabla FTS5 sobre episodic_memory (content, session_id), sincronizada por triggers"""
+        # Se recrea entera: las versiones anteriores solo indexaban content
+        for trigger in ("insert", "delete", "update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS episodic_fts_{trigger}")
+        cursor.execute("DROP TABLE IF EXISTS episodic_fts")
+        # remove_diacritics 2: "vacación" y "vacacion" son el mismo término
+        cursor.execute("""
+            CREATE VIRTUAL TABLE episodic_fts USING fts5(
+                content,
+                session_id,
+                content='episodic_memory',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        cursor.execute("""
+            CREATE TRIGGER episodic_fts_insert AFTER INSERT ON episodic_memory BEGIN
+                INSERT INTO episodic_fts(rowid, content, session_id) VALUES (new.id, new.content, new.session_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER episodic_fts_delete AFTER DELETE ON episodic_memory BEGIN
+                INSERT INTO episodic_fts(episodic_fts, rowid, content, session_id)
+                VALUES ('delete', old.id, old.content, old.session_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER episodic_fts_update AFTER UPDATE OF content, session_id ON episodic_memory BEGIN
+                INSERT INTO episodic_fts(episodic_fts, rowid, content, session_id)
+                VALUES ('delete', old.id, old.content, old.session_id);
+                INSERT INTO episodic_fts(rowid, content, session_id) VALUES (new.id, new.content, new.session_id);
+            END
+        """)
+        # Indexar los mensajes que ya existían
+        cursor.execute("INSERT INTO episodic_fts(episodic_fts) VALUES ('rebuild')")
+    
     def save_episodic_message(self, session_id: str, message_type: str, content: str, metadata: Dict = None) -> int:
         """Guardar mensaje episódico localmente"""
         with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO episodic_memory (session_id, message_type, content, metadata)
@@ -114,7 +323,7 @@ class LocalMemoryPersistence:
                                category: str = "general", confidence: float = 1.0) -> int:
         """Guardar conocimiento semántico localmente"""
         with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT OR REPLACE INTO semantic_memory 
@@ -130,7 +339,7 @@ class LocalMemoryPersistence:
                                  context: str = "", success_rate: float = 1.0) -> int:
         """Guardar procedimiento localmente"""
         with self.lock:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.pool.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT OR REPLACE INTO procedural_memory 
@@ -142,9 +351,81 @@ class LocalMemoryPersistence:
                 conn.commit()
                 return proc_id
     
+    def save_episodic_messages(self, rows: List[tuple]) -> int:
+        """Guarda en lote (session_id, message_type, content, metadata) y actualiza la actividad de cada sesión"""
+        if not rows:
+            return 0
+        per_session: Dict[str, int] = {}
+        for row in rows:
+            per_session[row[0]] = per_session.get(row[0], 0) + 1
+        now = datetime.now()
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.executemany("""
+                    INSERT INTO episodic_memory (session_id, message_type, content, metadata)
+                    VALUES (?, ?, ?, ?)
+                """, [(session_id, message_type, content, json.dumps(metadata or {}))
+                      for session_id, message_type, content, metadata in rows])
+                conn.executemany("""
+                    INSERT INTO session_metadata (session_id, last_activity, total_messages)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        last_activity = excluded.last_activity,
+                        total_messages = COALESCE(total_messages, 0) + excluded.total_messages
+                """, [(session_id, now, count) for session_id, count in per_session.items()])
+        return len(rows)
+    
+    def save_semantic_knowledge_many(self, rows: List[tuple]) -> int:
+        """Guarda en lote (session_id, concept, knowledge, category, confidence)"""
+        if not rows:
+            return 0
+        now = datetime.now().isoformat()
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.executemany("""
+                    INSERT INTO semantic_memory
+                    (session_id, concept, knowledge, category, confidence, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [row + (now,) for row in rows])
+        return len(rows)
+    
+    # Tablas locales que se replican en Supabase
+    SYNCED_TABLES = ("episodic_memory", "semantic_memory")
+    
+    def get_unsynced(self, table: str, limit: int = 100) -> List[Dict]:
+        """Filas aún no enviadas a Supabase (sin las rechazadas), en orden de inserción"""
+        if table not in self.SYNCED_TABLES:
+            raise ValueError(f"Tabla no sincronizable: {table}")
+        conn = self.pool.connection()
+        cursor = conn.execute(
+            f"SELECT * FROM {table} WHERE NOT synced_to_remote AND NOT sync_failed ORDER BY id LIMIT ?", (limit,)
+        )
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def mark_synced(self, table: str, ids: List[int]) -> None:
+        """Marca filas como enviadas a Supabase"""
+        if table not in self.SYNCED_TABLES:
+            raise ValueError(f"Tabla no sincronizable: {table}")
+        if not ids:
+            return
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.executemany(f"UPDATE {table} SET synced_to_remote = 1 WHERE id = ?", [(i,) for i in ids])
+    
+    def mark_sync_failed(self, table: str, ids: List[int]) -> None:
+        """Aparta filas que Supabase rechaza: quedan en SQLite pero salen de la cola de sincronización"""
+        if table not in self.SYNCED_TABLES:
+            raise ValueError(f"Tabla no sincronizable: {table}")
+        if not ids:
+            return
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.executemany(f"UPDATE {table} SET sync_failed = 1 WHERE id = ?", [(i,) for i in ids])
+    
     def get_episodic_messages(self, session_id: str, limit: int = None) -> List[Dict]:
         """Recuperar mensajes episódicos"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             query = "SELECT * FROM episodic_memory WHERE session_id = ? ORDER BY created_at ASC"
             if limit:
@@ -154,9 +435,117 @@ class LocalMemoryPersistence:
             columns = [description[0] for description in cursor.description]
             return [dict(zip(columns, row)) for row in cursor.fetchall()]
     
+    def get_unsynced_episodic(self, session_id: str, limit: int) -> List[Dict]:
+        """Últimos `limit` mensajes de la sesión que no están en Supabase (incluye los rechazados), en orden"""
+        conn = self.pool.connection()
+        cursor = conn.execute(
+            "SELECT * FROM episodic_memory WHERE session_id = ? AND NOT synced_to_remote ORDER BY id DESC LIMIT ?",
+            (session_id, limit)
+        )
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in reversed(cursor.fetchall())]
+    
+    def get_episodic_tail(self, session_id: str, limit: int) -> List[Dict]:
+        """Últimos `limit` mensajes episódicos, en orden cronológico"""
+        conn = self.pool.connection()
+        cursor = conn.execute(
+            "SELECT * FROM episodic_memory WHERE session_id = ? ORDER BY id DESC LIMIT ?", (session_id, limit)
+        )
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in reversed(cursor.fetchall())]
+    
+    @property
+    def fts_enabled(self) -> bool:
+        if self._fts_enabled is None:
+            conn = self.pool.connection()
+            self._fts_enabled = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'episodic_fts'"
+            ).fetchone() is not None
+        return self._fts_enabled
+    
+    def search_episodic(self, session_id: str, query: str, limit: int = 5) -> List[Dict]:
+        """
+        Mensajes de la sesión más relevantes para la consulta (BM25), del mejor al peor.
+        Primero los que contienen todos los términos (intersección barata en el índice);
+        si no alcanzan, se completa con los que contienen alguno.
+        """
+        match_any = fts_query(query)
+        if not match_any:
+            return []
+        match_all = fts_query(query, operator="AND")
+        
+        results = self._search_fts(session_id, match_all, limit) if match_all != match_any else []
+        if len(results) < limit:
+            found = {row["id"] for row in results}
+            for row in self._search_fts(session_id, match_any, limit + len(results)):
+                if row["id"] not in found:
+                    results.append(row)
+                    if len(results) >= limit:
+                        break
+        return results
+    
+    def _search_fts(self, session_id: str, match: str, limit: int) -> List[Dict]:
+        # La sesión se filtra dentro del MATCH (intersección en el índice, no después del ranking);
+        # la frase puede coincidir con ids más largos, así que se confirma con m.session_id
+        match = f"{{content}} : ({match})"
+        if re.search(r"\w", session_id):
+            match = '{session_id} : "' + session_id.replace('"', '""') + '" AND ' + match
+        conn = self.pool.connection()
+        cursor = conn.execute("""
+            SELECT m.*, bm25(episodic_fts, 1.0, 0.0) AS score
+            FROM episodic_fts
+            JOIN episodic_memory m ON m.id = episodic_fts.rowid
+            WHERE episodic_fts MATCH ? AND m.session_id = ?
+            ORDER BY score
+            LIMIT ?
+        """, (match, session_id, limit))
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def get_unembedded(self, model: str, limit: int = 64, after_id: int = 0) -> List[tuple]:
+        """(id, session_id, content) de mensajes del usuario con id > after_id aún sin embedding para `model`"""
+        conn = self.pool.connection()
+        return conn.execute("""
+            SELECT e.id, e.session_id, e.content
+            FROM episodic_memory e
+            LEFT JOIN episodic_vectors v ON v.message_id = e.id AND v.model = ?
+            WHERE e.id > ? AND e.message_type = 'human' AND v.message_id IS NULL
+            ORDER BY e.id
+            LIMIT ?
+        """, (model, after_id, limit)).fetchall()
+    
+    def save_vectors(self, rows: List[tuple]) -> None:
+        """Guarda en lote (message_id, session_id, model, vector float32)"""
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO episodic_vectors (message_id, session_id, model, vector) VALUES (?, ?, ?, ?)",
+                    [(message_id, session_id, model, vector.astype(np.float32).tobytes())
+                     for message_id, session_id, model, vector in rows]
+                )
+    
+    def get_vectors(self, session_id: str, model: str, after_id: int = 0) -> List[tuple]:
+        """(message_id, BLOB) de la sesión con message_id > after_id"""
+        conn = self.pool.connection()
+        return conn.execute(
+            "SELECT message_id, vector FROM episodic_vectors "
+            "WHERE session_id = ? AND model = ? AND message_id > ? ORDER BY message_id",
+            (session_id, model, after_id)
+        ).fetchall()
+    
+    def get_episodic_by_ids(self, ids: List[int]) -> Dict[int, Dict]:
+        if not ids:
+            return {}
+        conn = self.pool.connection()
+        cursor = conn.execute(
+            f"SELECT * FROM episodic_memory WHERE id IN ({','.join('?' for _ in ids)})", list(ids)
+        )
+        columns = [description[0] for description in cursor.description]
+        return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+    
     def get_semantic_knowledge(self, session_id: str, concept: str = None, category: str = None) -> List[Dict]:
         """Recuperar conocimiento semántico"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             query = "SELECT * FROM semantic_memory WHERE session_id = ?"
             params = [session_id]
@@ -174,7 +563,7 @@ class LocalMemoryPersistence:
     
     def get_procedural_knowledge(self, session_id: str, procedure_name: str = None) -> List[Dict]:
         """Recuperar conocimiento procedimental"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             query = "SELECT * FROM procedural_memory WHERE session_id = ?"
             params = [session_id]
@@ -204,21 +593,22 @@ class LocalMemoryPersistence:
         # Comprimir datos
         compressed_data = gzip.compress(pickle.dumps(session_data))
         
-        # Guardar en metadatos
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO session_metadata 
-                (session_id, compressed_backup, backup_timestamp)
-                VALUES (?, ?, ?)
-            """, (session_id, compressed_data, datetime.now()))
-            conn.commit()
+        # Guardar en metadatos (sin pisar last_activity ni total_messages)
+        with self.lock:
+            with self.pool.connection() as conn:
+                conn.execute("""
+                    INSERT INTO session_metadata (session_id, compressed_backup, backup_timestamp)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        compressed_backup = excluded.compressed_backup,
+                        backup_timestamp = excluded.backup_timestamp
+                """, (session_id, compressed_data, datetime.now()))
         
         return f"Backup creado: {len(compressed_data)} bytes"
     
     def restore_from_backup(self, session_id: str) -> bool:
         """Restaurar sesión desde backup"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT compressed_backup FROM session_metadata WHERE session_id = ?",
@@ -252,6 +642,14 @@ class LocalMemoryPersistence:
                         proc['context'], proc['success_rate']
                     )
                 
+                # Lo restaurado ya estaba en Supabase: que la sincronización no lo duplique
+                with self.lock:
+                    with self.pool.connection() as restored:
+                        for table in self.SYNCED_TABLES:
+                            restored.execute(
+                                f"UPDATE {table} SET synced_to_remote = 1 WHERE session_id = ?", (session_id,)
+                            )
+                
                 return True
             except Exception as e:
                 print(f"Error restaurando backup: {e}")
@@ -267,11 +665,76 @@ class LocalMemoryPersistence:
             ) + 1)
         """, (session_id, datetime.now(), session_id))
     
+    def rekey_legacy_sessions(self, session_id_for=session_id_for_user) -> Dict[str, Any]:
+        """
+        Migra las sesiones antiguas (session_<timestamp>) al session_id estable de cada usuario.
+        El número se toma del contexto guardado en los mensajes episódicos. Si una sesión
+        antigua mezcla varios números, se re-asignan los mensajes uno a uno y el conocimiento
+        semántico/procedimental queda en la sesión antigua (no se puede atribuir).
+        
+        Returns:
+            Resumen de la migración y el mapeo sesión antigua → nueva (para migrar Supabase)
+        """
+        report = {"sessions_migrated": 0, "rows_rekeyed": 0, "ambiguous": [], "without_phone": [], "mapping": {}}
+        with self.lock:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT session_id FROM episodic_memory UNION SELECT session_id FROM semantic_memory
+                    UNION SELECT session_id FROM procedural_memory UNION SELECT session_id FROM session_metadata
+                """)
+                legacy_sessions = [row[0] for row in cursor.fetchall() if LEGACY_SESSION_RE.match(row[0] or "")]
+                
+                for old_id in legacy_sessions:
+                    cursor.execute("SELECT id, metadata FROM episodic_memory WHERE session_id = ?", (old_id,))
+                    phones_by_row = {row_id: _phone_from_metadata(metadata) for row_id, metadata in cursor.fetchall()}
+                    phones = {phone for phone in phones_by_row.values() if phone}
+                    
+                    if not phones:
+                        report["without_phone"].append(old_id)
+                        continue
+                    
+                    if len(phones) > 1:
+                        # Sesión compartida por varios usuarios creados en el mismo segundo
+                        for row_id, phone in phones_by_row.items():
+                            if phone:
+                                cursor.execute("UPDATE episodic_memory SET session_id = ? WHERE id = ?",
+                                               (session_id_for(phone), row_id))
+                                report["rows_rekeyed"] += 1
+                        report["ambiguous"].append(old_id)
+                        continue
+                    
+                    new_id = session_id_for(phones.pop())
+                    for table in ("episodic_memory", "semantic_memory", "procedural_memory"):
+                        cursor.execute(f"UPDATE {table} SET session_id = ? WHERE session_id = ?", (new_id, old_id))
+                        report["rows_rekeyed"] += cursor.rowcount
+                    self._merge_session_metadata(cursor, old_id, new_id)
+                    report["mapping"][old_id] = new_id
+                    report["sessions_migrated"] += 1
+                
+                conn.commit()
+        return report
+    
+    def _merge_session_metadata(self, cursor, old_id: str, new_id: str):
+        """Suma los metadatos de la sesión antigua a la nueva (el backup antiguo se descarta)"""
+        cursor.execute("SELECT last_activity, total_messages FROM session_metadata WHERE session_id = ?", (old_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        cursor.execute("""
+            INSERT INTO session_metadata (session_id, last_activity, total_messages)
+            VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_activity = MAX(COALESCE(last_activity, excluded.last_activity), excluded.last_activity),
+                total_messages = COALESCE(total_messages, 0) + excluded.total_messages
+        """, (new_id, row[0], row[1] or 0))
+        cursor.execute("DELETE FROM session_metadata WHERE session_id = ?", (old_id,))
+    
     def cleanup_old_sessions(self, days_old: int = 30) -> int:
         """Limpiar sesiones antiguas"""
         cutoff_date = datetime.now() - timedelta(days=days_old)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             
             # Obtener sesiones a limpiar
@@ -296,86 +759,620 @@ class LocalMemoryPersistence:
             conn.commit()
             return len(old_sessions)
 
+# Instancia compartida por todos los sistemas de memoria del proceso
+_local_persistence: Optional[LocalMemoryPersistence] = None
+
+
+def get_local_persistence() -> LocalMemoryPersistence:
+    """Persistencia local compartida (misma base, mismo pool de conexiones)"""
+    global _local_persistence
+    if _local_persistence is None:
+        _local_persistence = LocalMemoryPersistence()
+    return _local_persistence
+
+# ============================================================================
+# 🧭 RECUERDO VECTORIAL - Preguntas pasadas parecidas a la actual
+# ============================================================================
+
+# false: sin embeddings de mensajes (el recuerdo episódico usa solo FTS5)
+MEMORY_VECTOR_RECALL = os.getenv("MEMORY_VECTOR_RECALL", "true").lower() == "true"
+MEMORY_EMBEDDING_MODEL = os.getenv("MEMORY_EMBEDDING_MODEL", "text-embedding-3-small")
+# Dimensiones reducidas (text-embedding-3-*): 256 float32 = 1 KB por mensaje
+MEMORY_EMBEDDING_DIMENSIONS = int(os.getenv("MEMORY_EMBEDDING_DIMENSIONS", "256"))
+MEMORY_EMBEDDING_BATCH = int(os.getenv("MEMORY_EMBEDDING_BATCH", "64"))
+MEMORY_EMBEDDING_CACHE_SIZE = int(os.getenv("MEMORY_EMBEDDING_CACHE_SIZE", "5000"))
+# Similitud coseno mínima para considerar relacionada una pregunta pasada
+MEMORY_RECALL_MIN_SIMILARITY = float(os.getenv("MEMORY_RECALL_MIN_SIMILARITY", "0.45"))
+
+
+class MessageEmbedder:
+    """
+    Embeddings de mensajes con caché LRU por texto y llamadas en lote.
+    La consulta se embebe al llegar (aembed) y el mismo texto, al guardarse,
+    sale de la caché en lugar de volver a pedirse a OpenAI.
+    """
+
+    def __init__(self, embeddings=None, model: str = MEMORY_EMBEDDING_MODEL,
+                 dimensions: int = MEMORY_EMBEDDING_DIMENSIONS, batch_size: int = MEMORY_EMBEDDING_BATCH,
+                 cache_size: int = MEMORY_EMBEDDING_CACHE_SIZE):
+        self._embeddings = embeddings
+        self.model = model
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.cache = LRUTTLCache(maxsize=cache_size, ttl=86400)
+        self.stats = {"embedded": 0, "batches": 0}
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = OpenAIEmbeddings(
+                model=self.model, dimensions=self.dimensions, openai_api_key=OPENAI_API_KEY,
+                request_timeout=10, max_retries=1
+            )
+        return self._embeddings
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def embed_many(self, texts: List[str]) -> np.ndarray:
+        """Matriz (n, d) de vectores normalizados; solo se piden a la API los que no están en caché"""
+        vectors: List[Optional[np.ndarray]] = [self.cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        fresh: Dict[str, np.ndarray] = {}
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            for text, vector in zip(batch, self._normalize(self.embeddings.embed_documents(batch))):
+                fresh[text] = vector
+                self.cache.set(text, vector)
+            self.stats["batches"] += 1
+            self.stats["embedded"] += len(batch)
+        return np.vstack([vector if vector is not None else fresh[text] for text, vector in zip(texts, vectors)])
+
+    async def aembed(self, text: str) -> np.ndarray:
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = self._normalize(await self.embeddings.aembed_query(text))
+            self.cache.set(text, vector)
+            self.stats["embedded"] += 1
+        return vector
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"model": self.model, "dimensions": self.dimensions, **self.stats, "cache": self.cache.get_stats()}
+
+
+# Embedder compartido: la caché sirve tanto a la consulta como al guardado
+message_embedder = MessageEmbedder()
+
+
+class EpisodicVectorIndex:
+    """
+    Vectores de los mensajes del usuario de una sesión, en una matriz float32 en RAM.
+    Se carga de memory.db la primera vez y después solo lee los message_id nuevos;
+    la búsqueda es un producto matriz-vector (coseno, vectores ya normalizados).
+    """
+
+    def __init__(self, session_id: str, persistence: LocalMemoryPersistence, embedder: MessageEmbedder):
+        self.session_id = session_id
+        self.persistence = persistence
+        self.embedder = embedder
+        self._ids = np.empty(0, dtype=np.int64)
+        self._matrix: Optional[np.ndarray] = None
+        self._last_id = 0
+        self._lock = Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return self._ids.nbytes + (self._matrix.nbytes if self._matrix is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _sync(self) -> None:
+        rows = self.persistence.get_vectors(self.session_id, self.embedder.model, self._last_id)
+        if not rows:
+            return
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        vectors = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        self._ids = np.concatenate([self._ids, ids])
+        self._matrix = vectors if self._matrix is None else np.vstack([self._matrix, vectors])
+        self._last_id = int(ids[-1])
+
+    def search(self, query_vector: np.ndarray, k: int = 3,
+               min_similarity: float = MEMORY_RECALL_MIN_SIMILARITY) -> List[tuple]:
+        """[(message_id, similitud)] de mayor a menor"""
+        with self._lock:
+            self._sync()
+            if self._matrix is None:
+                return []
+            scores = self._matrix @ query_vector
+            if len(scores) > k:
+                top = np.argpartition(scores, -k)[-k:]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(scores[top])[::-1]]
+            return [(int(self._ids[i]), float(scores[i])) for i in top if scores[i] >= min_similarity]
+
+    async def recall(self, query: str, k: int = 3) -> List[tuple]:
+        """[(HumanMessage, similitud)] de preguntas pasadas parecidas a `query`"""
+        query_vector = await self.embedder.aembed(query)
+        matches = self.search(query_vector, k)
+        rows = self.persistence.get_episodic_by_ids([message_id for message_id, _ in matches])
+        return [(HumanMessage(content=rows[message_id]['content']), score)
+                for message_id, score in matches if message_id in rows]
+
+# ============================================================================
+# ✍️ ESCRITURA DIFERIDA (WRITE-BEHIND)
+# ============================================================================
+
+# Escrituras acumuladas antes de forzar un volcado
+MEMORY_WRITE_BATCH_SIZE = int(os.getenv("MEMORY_WRITE_BATCH_SIZE", "50"))
+# Segundos máximos que una escritura espera en RAM antes de llegar a SQLite
+MEMORY_WRITE_FLUSH_INTERVAL = float(os.getenv("MEMORY_WRITE_FLUSH_INTERVAL", "1.0"))
+# false: la memoria solo se guarda en SQLite local
+MEMORY_REMOTE_SYNC = os.getenv("MEMORY_REMOTE_SYNC", "true").lower() == "true"
+# Mensajes episódicos que se mantienen en RAM por sesión (cola de la conversación)
+MEMORY_EPISODIC_WINDOW = int(os.getenv("MEMORY_EPISODIC_WINDOW", "200"))
+# Segundos entre consultas delta a Supabase (mensajes escritos por otros workers)
+MEMORY_EPISODIC_REFRESH = float(os.getenv("MEMORY_EPISODIC_REFRESH", "300"))
+
+# Respuestas que rechazan filas concretas (CHECK, RLS, columnas, tamaño): se aíslan partiendo
+# el lote. El resto (429, 5xx, sin conexión, auth) pausa la sincronización y se reintenta
+MEMORY_SYNC_REJECT_STATUS = {400, 403, 409, 413, 422}
+
+
+class MemoryWriteBuffer:
+    """
+    Buffer de escrituras de memoria fuera del camino de la respuesta.
+    Acumula mensajes, conocimiento y tareas de aprendizaje en RAM y los vuelca en lote
+    (por tamaño, por tiempo o al cerrar): primero executemany en SQLite y después un
+    POST con un array JSON por tabla a Supabase, leyendo las filas con synced_to_remote = 0.
+    El POST es idempotente (sync_key + on_conflict), así que un lote que pudo llegar se
+    reenvía sin duplicar. Si Supabase falla las filas quedan pendientes en SQLite y se
+    reintentan más tarde; las que rechaza se apartan (sync_failed) sin frenar las demás.
+    """
+
+    REMOTE_TABLES = {"episodic_memory": "chat_history", "semantic_memory": "semantic_memory"}
+
+    def __init__(self, persistence: LocalMemoryPersistence = None,
+                 batch_size: int = MEMORY_WRITE_BATCH_SIZE,
+                 flush_interval: float = MEMORY_WRITE_FLUSH_INTERVAL,
+                 remote_sync: bool = MEMORY_REMOTE_SYNC,
+                 remote_request=make_supabase_request,
+                 remote_retry_interval: float = 30.0,
+                 embedder: MessageEmbedder = None):
+        self._persistence = persistence
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.remote_sync = remote_sync
+        self.remote_request = remote_request
+        self.remote_retry_interval = remote_retry_interval
+        self.embedder = embedder
+
+        self._episodic: List[tuple] = []
+        self._semantic: List[tuple] = []
+        self._tasks: List[tuple] = []
+        self._condition = threading.Condition()
+        self._flush_lock = Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._remote_retry_at = 0.0
+        self._embed_retry_at = 0.0
+        # Solo se consulta SQLite tras una escritura o un fallo (al arrancar puede quedar trabajo previo)
+        self._remote_dirty = True
+        self._embed_dirty = True
+        # Todos los mensajes del usuario con id <= este ya tienen vector
+        self._embedded_through = 0
+
+        self.stats = {
+            "enqueued": 0,
+            "flushes": 0,
+            "local_rows": 0,
+            "remote_rows": 0,
+            "remote_requests": 0,
+            "remote_failures": 0,
+            "remote_rejected": 0,
+            "task_errors": 0,
+            "vectors": 0,
+            "embed_failures": 0,
+        }
+
+    @property
+    def persistence(self) -> LocalMemoryPersistence:
+        if self._persistence is None:
+            self._persistence = get_local_persistence()
+        return self._persistence
+
+    def pending(self) -> int:
+        """Escrituras en RAM aún no volcadas a SQLite"""
+        with self._condition:
+            return self._pending_unlocked()
+
+    def _pending_unlocked(self) -> int:
+        return len(self._episodic) + len(self._semantic) + len(self._tasks)
+
+    def add_episodic(self, session_id: str, message_type: str, content: str, metadata: Dict = None) -> None:
+        self._enqueue(self._episodic, (session_id, message_type, content, metadata))
+
+    def add_semantic(self, session_id: str, concept: str, knowledge: str,
+                     category: str = "general", confidence: float = 1.0) -> None:
+        self._enqueue(self._semantic, (session_id, concept, knowledge, category, confidence))
+
+    def pending_episodic(self, session_id: str) -> List[tuple]:
+        """(message_type, content, metadata) aún en RAM para una sesión"""
+        with self._condition:
+            return [row[1:] for row in self._episodic if row[0] == session_id]
+
+    def add_task(self, func, *args) -> None:
+        """Difiere trabajo de memoria que no debe bloquear la respuesta (extracción, aprendizaje)"""
+        self._enqueue(self._tasks, (func, args))
+
+    def _enqueue(self, target: list, item: tuple) -> None:
+        with self._condition:
+            target.append(item)
+            self.stats["enqueued"] += 1
+            if not self._running:
+                self._start()
+            if self._pending_unlocked() >= self.batch_size:
+                self._condition.notify()
+
+    def _start(self) -> None:
+        """Arranca el hilo de volcado (se llama con el lock tomado)"""
+        self._running = True
+        self._thread = threading.Thread(target=self._flusher, name="memory-write-buffer", daemon=True)
+        self._thread.start()
+
+    def _flusher(self) -> None:
+        while True:
+            with self._condition:
+                if self._running and self._pending_unlocked() < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+                if not self._running:
+                    return
+            self.flush()
+
+    def flush(self, remote: bool = True) -> int:
+        """Vuelca lo acumulado en SQLite, ejecuta las tareas diferidas y sincroniza con Supabase"""
+        with self._flush_lock:
+            # Primero el volcado local: las tareas (GET/PATCH a Supabase) no retrasan los mensajes
+            written = self._write_local()
+            if written is None:
+                return 0
+
+            with self._condition:
+                tasks, self._tasks = self._tasks, []
+            for func, args in tasks:
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.stats["task_errors"] += 1
+                    print(f"Error en tarea de memoria diferida: {e}")
+
+            # Conocimiento que hayan encolado las tareas
+            if tasks:
+                written += self._write_local() or 0
+
+            if written or tasks:
+                self.stats["flushes"] += 1
+            if written:
+                self._remote_dirty = self._embed_dirty = True
+
+            # En reposo no hay nada nuevo: sin consultas a SQLite hasta la próxima escritura o reintento
+            if remote and self.remote_sync and self._remote_dirty and time.time() >= self._remote_retry_at:
+                self._remote_dirty = not self._sync_remote()
+            if remote and self.embedder is not None and self._embed_dirty and time.time() >= self._embed_retry_at:
+                self._embed_dirty = not self._embed_pending()
+            return written
+
+    def _write_local(self) -> Optional[int]:
+        """Guarda en SQLite los mensajes y el conocimiento en RAM; None si SQLite falló"""
+        with self._condition:
+            episodic, self._episodic = self._episodic, []
+            semantic, self._semantic = self._semantic, []
+        if not episodic and not semantic:
+            return 0
+
+        try:
+            written = self.persistence.save_episodic_messages(episodic)
+            written += self.persistence.save_semantic_knowledge_many(semantic)
+        except Exception as e:
+            # Se devuelven al buffer para el siguiente intento
+            print(f"Error volcando memoria en SQLite: {e}")
+            with self._condition:
+                self._episodic[:0] = episodic
+                self._semantic[:0] = semantic
+            return None
+
+        self.stats["local_rows"] += written
+        return written
+
+    def _sync_remote(self) -> bool:
+        """Envía a Supabase las filas locales no sincronizadas, un array JSON por tabla; False si hay que reintentar"""
+        for table, endpoint in self.REMOTE_TABLES.items():
+            while True:
+                rows = self.persistence.get_unsynced(table, limit=self.batch_size)
+                if not rows:
+                    break
+                if not self._post_rows(table, endpoint, rows):
+                    self.stats["remote_failures"] += 1
+                    self._remote_retry_at = time.time() + self.remote_retry_interval
+                    return False
+                if len(rows) < self.batch_size:
+                    break
+        return True
+
+    def _post_rows(self, table: str, endpoint: str, rows: List[Dict]) -> bool:
+        """
+        POST de un tramo; False si hay que esperar y reintentar. El array entra en una sola
+        transacción: si Supabase rechaza filas se parte en mitades hasta aislarlas y apartarlas.
+        """
+        self.stats["remote_requests"] += 1
+        try:
+            response = self.remote_request(
+                method="POST",
+                endpoint=endpoint,
+                data=[self._remote_row(table, row) for row in rows],
+                params={"on_conflict": "sync_key"},
+                headers={"Prefer": "resolution=ignore-duplicates,return=minimal"}
+            )
+        except Exception as e:
+            # Sin respuesta (también si el POST pudo llegar): se reenvía, sync_key evita duplicados
+            print(f"Error conectando con Supabase: {str(e)}, memoria guardada localmente")
+            return False
+
+        status = response.status_code
+        if 200 <= status < 300:
+            self.persistence.mark_synced(table, [row["id"] for row in rows])
+            self.stats["remote_rows"] += len(rows)
+            return True
+
+        if status in MEMORY_SYNC_REJECT_STATUS:
+            if len(rows) > 1:
+                middle = len(rows) // 2
+                return self._post_rows(table, endpoint, rows[:middle]) and self._post_rows(table, endpoint, rows[middle:])
+            print(f"Supabase rechazó la fila {rows[0]['id']} de {table} ({status}): {getattr(response, 'text', '')}")
+            self.persistence.mark_sync_failed(table, [rows[0]["id"]])
+            self.stats["remote_rejected"] += 1
+            return True
+
+        print(f"Error sincronizando {endpoint} con Supabase: {status}")
+        return False
+
+    def _embed_pending(self) -> bool:
+        """Embebe en lote los mensajes del usuario guardados que aún no tienen vector; False si hay que reintentar"""
+        while True:
+            rows = self.persistence.get_unembedded(self.embedder.model, limit=self.embedder.batch_size,
+                                                   after_id=self._embedded_through)
+            if not rows:
+                return True
+            try:
+                vectors = self.embedder.embed_many([content for _, _, content in rows])
+            except Exception as e:
+                self.stats["embed_failures"] += 1
+                self._embed_retry_at = time.time() + self.remote_retry_interval
+                print(f"Error generando embeddings de memoria: {e}")
+                return False
+            self.persistence.save_vectors([
+                (message_id, session_id, self.embedder.model, vector)
+                for (message_id, session_id, _), vector in zip(rows, vectors)
+            ])
+            self.stats["vectors"] += len(rows)
+            # Las filas salen en orden de id: por debajo de la última ya no queda nada sin vector
+            self._embedded_through = rows[-1][0]
+            if len(rows) < self.embedder.batch_size:
+                return True
+
+    @staticmethod
+    def _sync_key(*parts: Any) -> str:
+        return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _remote_row(cls, table: str, row: Dict) -> Dict:
+        """Fila local → fila de Supabase (sync_key: clave estable para reenviar sin duplicar)"""
+        if table == "episodic_memory":
+            metadata = json.loads(row["metadata"] or "{}")
+            return {
+                "sync_key": metadata.get("message_id") or cls._sync_key(
+                    table, row["session_id"], row["id"], row["created_at"], row["content"]),
+                "session_id": row["session_id"],
+                "message_type": row["message_type"],
+                "content": {"content": row["content"]},
+                "metadata": metadata,
+                "created_at": metadata.get("timestamp") or row["created_at"]
+            }
+        return {
+            "sync_key": cls._sync_key(table, row["session_id"], row["id"], row["updated_at"],
+                                      row["concept"], row["knowledge"]),
+            "session_id": row["session_id"],
+            "concept": row["concept"],
+            "knowledge": row["knowledge"],
+            "category": row["category"],
+            "confidence": row["confidence"],
+            "created_at": row["updated_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    def stop(self) -> None:
+        """Detiene el hilo y vuelca todo lo pendiente (cierre del servidor)"""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._running = False
+            self._condition.notify()
+        if thread is not None:
+            thread.join(timeout=10)
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["pending"] = self.pending()
+        stats["batch_size"] = self.batch_size
+        stats["flush_interval"] = self.flush_interval
+        stats["remote_sync"] = self.remote_sync
+        return stats
+
+
+# Buffer compartido por todos los sistemas de memoria del proceso
+memory_write_buffer = MemoryWriteBuffer(embedder=message_embedder if MEMORY_VECTOR_RECALL else None)
+
 # ============================================================================
 # 📚 MEMORIA EPISÓDICA - Conversaciones y eventos temporales
 # ============================================================================
 
 class EpisodicMemory:
-    """Memoria episódica: almacena conversaciones completas con contexto temporal"""
+    """
+    Memoria episódica: almacena conversaciones completas con contexto temporal.
+    Mantiene en RAM un log de solo-anexar con la cola de la conversación: se carga una vez
+    (últimos `window` mensajes), crece con cada add_message y se refresca pidiendo a
+    Supabase solo los mensajes con id posterior al último visto. El id lo asigna la base:
+    created_at viene del reloj de quien escribe y las filas llegan tarde por el write-behind.
+    Tras la cola remota se anexan los mensajes que aún no subieron (RAM y SQLite sin sincronizar).
+    """
     
-    def __init__(self, session_id: str, table_name: str = "chat_history", local_persistence: LocalMemoryPersistence = None):
+    def __init__(self, session_id: str, table_name: str = "chat_history", local_persistence: LocalMemoryPersistence = None,
+                 write_buffer: MemoryWriteBuffer = None, window: int = None, refresh_interval: float = None):
         self.session_id = session_id
         self.table_name = table_name
-        self.local_persistence = local_persistence or LocalMemoryPersistence()
-        self._message_cache = {}
-        self._cache_ttl = 300  # 5 minutos
-    
-    @property
-    def messages(self) -> List[BaseMessage]:
-        """Obtiene todos los mensajes episódicos para esta sesión con fallback local"""
-        cache_key = f"messages_{self.session_id}"
-        current_time = time.time()
-        
-        # Verificar caché
-        if cache_key in self._message_cache:
-            cached_data, cache_time = self._message_cache[cache_key]
-            if current_time - cache_time < self._cache_ttl:
-                return cached_data
+        self.local_persistence = local_persistence or get_local_persistence()
+        self.write_buffer = write_buffer or memory_write_buffer
+        self.window = window or MEMORY_EPISODIC_WINDOW
+        self.refresh_interval = MEMORY_EPISODIC_REFRESH if refresh_interval is None else refresh_interval
         
-        messages = []
+        self._log: deque = deque(maxlen=self.window)
+        # message_id de lo que ya está en el log (para no duplicarlo cuando vuelve en un delta)
+        self._message_ids: Dict[str, None] = {}
+        self._loaded = False
+        self._last_id: Optional[int] = None  # id (asignado por Supabase) más alto recibido
+        self._last_refresh = 0.0
+        self._lock = threading.RLock()
+    
+    @staticmethod
+    def _to_message(message_type: str, content: str) -> Optional[BaseMessage]:
+        if message_type == 'human':
+            return HumanMessage(content=content)
+        if message_type == 'ai':
+            return AIMessage(content=content)
+        if message_type == 'system':
+            return SystemMessage(content=content)
+        return None
+    
+    def _append(self, message_type: str, content: str, message_id: str = None) -> None:
+        """Anexa al log salvo que el mensaje ya esté (mismo message_id)"""
+        if message_id:
+            if message_id in self._message_ids:
+                return
+            self._message_ids[message_id] = None
+            if len(self._message_ids) > 2 * self.window:
+                del self._message_ids[next(iter(self._message_ids))]
+        message = self._to_message(message_type, content)
+        if message is not None:
+            self._log.append(message)
+    
+    def _append_remote(self, records: List[Dict]) -> None:
+        for record in records:
+            row_id = record.get('id')
+            if row_id is not None and (self._last_id is None or row_id > self._last_id):
+                self._last_id = row_id
+            self._append(
+                record.get('message_type', 'human'),
+                (record.get('content') or {}).get('content', ''),
+                (record.get('metadata') or {}).get('message_id')
+            )
+    
+    def _unsent(self) -> List[tuple]:
+        """
+        (message_type, content, message_id) que aún no están en Supabase: filas de SQLite sin
+        sincronizar (envío en espera o rechazado) y lo que sigue en el buffer de escritura.
+        Se lee antes que Supabase, al revés del flujo RAM → SQLite → Supabase: una fila que
+        avanza mientras tanto aparece al menos una vez y el message_id descarta la repetida.
+        """
+        pending = self.write_buffer.pending_episodic(self.session_id)
+        unsynced = self.write_buffer.persistence.get_unsynced_episodic(self.session_id, self.window)
+        return [(record['message_type'], record['content'], json.loads(record['metadata'] or '{}').get('message_id'))
+                for record in unsynced] + \
+               [(message_type, content, (metadata or {}).get('message_id'))
+                for message_type, content, metadata in pending]
+    
+    def _fetch_tail(self) -> Optional[List[Dict]]:
+        """Últimos `window` mensajes de Supabase en orden cronológico (None si falla)"""
+        response = make_supabase_request(
+            method="GET",
+            endpoint=self.table_name,
+            params={
+                "session_id": f"eq.{self.session_id}",
+                "order": "created_at.desc",
+                "limit": str(self.window)
+            }
+        )
+        if response.status_code != 200:
+            return None
+        return list(reversed(response.json()))
+    
+    def _rebuild(self, records: List[Dict], unsent: List[tuple]) -> None:
+        self._log.clear()
+        self._message_ids.clear()
+        self._append_remote(records)
+        for message_type, content, message_id in unsent:
+            self._append(message_type, content, message_id)
+    
+    def _load_tail(self) -> None:
+        """Carga inicial: solo la cola de la conversación, con fallback local"""
+        try:
+            unsent = self._unsent()
+            records = self._fetch_tail()
+            if records is not None:
+                self._rebuild(records, unsent)
+                return
+        except Exception as e:
+            print(f"Error conectando con Supabase, usando backup local: {str(e)}")
         
-        # Intentar obtener desde Supabase primero
+        # Fallback a persistencia local
+        try:
+            self.write_buffer.flush(remote=False)
+            for record in self.local_persistence.get_episodic_tail(self.session_id, self.window):
+                message_id = json.loads(record['metadata'] or '{}').get('message_id')
+                self._append(record['message_type'], record['content'], message_id)
+        except Exception as e:
+            print(f"Error en fallback local: {str(e)}")
+    
+    def _refresh(self) -> None:
+        """Delta: solo mensajes con id posterior al último visto (otros workers)"""
         try:
+            if self._last_id is None:
+                # Sin referencia remota (sesión nueva o carga desde el respaldo local)
+                unsent = self._unsent()
+                records = self._fetch_tail()
+                if records:
+                    self._rebuild(records, unsent)
+                return
             response = make_supabase_request(
                 method="GET",
                 endpoint=self.table_name,
                 params={
                     "session_id": f"eq.{self.session_id}",
-                    "order": "created_at.asc"
+                    "id": f"gt.{self._last_id}",
+                    "order": "id.asc"
                 }
             )
-            
             if response.status_code == 200:
-                records = response.json()
-                for record in records:
-                    message_data = record.get('content', {})
-                    message_type = record.get('message_type', 'human')
-                    
-                    if message_type == 'human':
-                        messages.append(HumanMessage(content=message_data.get('content', '')))
-                    elif message_type == 'ai':
-                        messages.append(AIMessage(content=message_data.get('content', '')))
-                    elif message_type == 'system':
-                        messages.append(SystemMessage(content=message_data.get('content', '')))
-                
-                # Guardar en caché
-                self._message_cache[cache_key] = (messages, current_time)
-                return messages
-                
-        except Exception as e:
-            print(f"Error conectando con Supabase, usando backup local: {str(e)}")
-        
-        # Fallback a persistencia local
-        try:
-            local_messages = self.local_persistence.get_episodic_messages(self.session_id)
-            for record in local_messages:
-                message_type = record['message_type']
-                content = record['content']
-                
-                if message_type == 'human':
-                    messages.append(HumanMessage(content=content))
-                elif message_type == 'ai':
-                    messages.append(AIMessage(content=content))
-                elif message_type == 'system':
-                    messages.append(SystemMessage(content=content))
-            
-            # Guardar en caché
-            self._message_cache[cache_key] = (messages, current_time)
-            return messages
-            
+                self._append_remote(response.json())
         except Exception as e:
-            print(f"Error en fallback local: {str(e)}")
-            return []
+            print(f"Error refrescando memoria episódica: {str(e)}")
+    
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """Últimos mensajes episódicos de la sesión (hasta `window`)"""
+        with self._lock:
+            now = time.time()
+            if not self._loaded:
+                self._load_tail()
+                self._loaded = True
+                self._last_refresh = now
+            elif now - self._last_refresh >= self.refresh_interval:
+                self._refresh()
+                self._last_refresh = now
+            return list(self._log)
     
     def add_message(self, message: BaseMessage, context: Dict = None) -> None:
         """Añade un mensaje episódico con contexto temporal y persistencia dual"""
@@ -394,43 +1391,17 @@ class EpisodicMemory:
             "timestamp": datetime.now().isoformat(),
             "context": context or {},
             "message_length": len(message.content),
-            "session_id": self.session_id
+            "session_id": self.session_id,
+            "message_id": uuid.uuid4().hex
         }
         
-        # Guardar localmente SIEMPRE primero
-        try:
-            self.local_persistence.save_episodic_message(
-                self.session_id, message_type, message.content, episodic_metadata
-            )
-        except Exception as e:
-            print(f"Error guardando mensaje local: {str(e)}")
+        # Escritura diferida: SQLite en el siguiente lote, después Supabase
+        self.write_buffer.add_episodic(self.session_id, message_type, message.content, episodic_metadata)
         
-        # Intentar guardar en Supabase
-        try:
-            data = {
-                "session_id": self.session_id,
-                "message_type": message_type,
-                "content": {"content": message.content},
-                "metadata": episodic_metadata,
-                "created_at": datetime.now().isoformat()
-            }
-            
-            response = make_supabase_request(
-                method="POST",
-                endpoint=self.table_name,
-                data=data
-            )
-            
-            if response.status_code != 201:
-                print(f"Error guardando mensaje en Supabase: {response.status_code}, usando solo local")
-                
-        except Exception as e:
-            print(f"Error conectando con Supabase: {str(e)}, mensaje guardado localmente")
-        
-        # Invalidar caché
-        cache_key = f"messages_{self.session_id}"
-        if cache_key in self._message_cache:
-            del self._message_cache[cache_key]
+        # El log en RAM se actualiza sin volver a descargar la conversación
+        with self._lock:
+            if self._loaded:
+                self._append(message_type, message.content, episodic_metadata["message_id"])
     
     def get_conversation_summary(self) -> Dict[str, Any]:
         """Obtiene un resumen de la conversación episódica"""
@@ -448,6 +1419,13 @@ class EpisodicMemory:
     
     def clear(self) -> None:
         """Limpia la memoria episódica"""
+        # Que ningún mensaje pendiente llegue a Supabase después del borrado
+        self.write_buffer.flush()
+        with self._lock:
+            self._log.clear()
+            self._message_ids.clear()
+            self._last_id = None
+            self._loaded = True
         try:
             response = make_supabase_request(
                 method="DELETE",
@@ -468,48 +1446,18 @@ class EpisodicMemory:
 class SemanticMemory:
     """Memoria semántica: almacena conocimiento, hechos y conceptos aprendidos"""
     
-    def __init__(self, session_id: str, table_name: str = "semantic_memory", local_persistence: LocalMemoryPersistence = None):
+    def __init__(self, session_id: str, table_name: str = "semantic_memory", local_persistence: LocalMemoryPersistence = None,
+                 write_buffer: MemoryWriteBuffer = None):
         self.session_id = session_id
         self.table_name = table_name
-        self.local_persistence = local_persistence or LocalMemoryPersistence()
+        self.local_persistence = local_persistence or get_local_persistence()
+        self.write_buffer = write_buffer or memory_write_buffer
         self._knowledge_cache = {}
         self._cache_ttl = 600  # 10 minutos
     
     def store_knowledge(self, concept: str, knowledge: str, category: str = "general", confidence: float = 1.0) -> None:
-        """Almacena conocimiento semántico con persistencia dual"""
-        # Guardar localmente SIEMPRE primero
-        try:
-            self.local_persistence.save_semantic_knowledge(
-                self.session_id, concept, knowledge, category, confidence
-            )
-        except Exception as e:
-            print(f"Error guardando conocimiento local: {str(e)}")
-        
-        # Intentar guardar en Supabase
-        try:
-            data = {
-                "session_id": self.session_id,
-                "concept": concept,
-                "knowledge": knowledge,
-                "category": category,
-                "confidence": confidence,
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
-            
-            response = make_supabase_request(
-                method="POST",
-                endpoint=self.table_name,
-                data=data
-            )
-            
-            if response.status_code == 201:
-                print(f"🧠 Conocimiento semántico guardado: {concept}")
-            else:
-                print(f"Error guardando en Supabase: {response.status_code}, usando solo local")
-                
-        except Exception as e:
-            print(f"Error conectando con Supabase: {str(e)}, conocimiento guardado localmente")
+        """Almacena conocimiento semántico con persistencia dual (diferida)"""
+        self.write_buffer.add_semantic(self.session_id, concept, knowledge, category, confidence)
         
         # Invalidar caché
         self._knowledge_cache.clear()
@@ -631,7 +1579,7 @@ class ProceduralMemory:
     def __init__(self, session_id: str, table_name: str = "procedural_memory", local_persistence: LocalMemoryPersistence = None):
         self.session_id = session_id
         self.table_name = table_name
-        self.local_persistence = local_persistence or LocalMemoryPersistence()
+        self.local_persistence = local_persistence or get_local_persistence()
         self._procedure_cache = {}
         self._cache_ttl = 600  # 10 minutos
     
@@ -829,6 +1777,104 @@ class ProceduralMemory:
             print(f"Error en cleanup_old_patterns: {str(e)}")
             return 0
 
+# ============================================================================
+# 🔄 BACKUPS PROGRAMADOS
+# ============================================================================
+
+# Cada cuánto corre el job de backups en main.py (segundos)
+MEMORY_BACKUP_INTERVAL = int(os.getenv("MEMORY_BACKUP_INTERVAL", "1800"))
+# Sesiones por lote y backups simultáneos por lote
+MEMORY_BACKUP_BATCH = int(os.getenv("MEMORY_BACKUP_BATCH", "100"))
+MEMORY_BACKUP_CONCURRENCY = int(os.getenv("MEMORY_BACKUP_CONCURRENCY", "4"))
+
+
+class SessionBackupScheduler:
+    """
+    Backups comprimidos de sesiones, sin hilos por sesión.
+    Las sesiones se marcan como sucias al recibir mensajes; el job de APScheduler
+    (main.py) llama a run_pending, que respalda solo las sucias, por lotes y con
+    concurrencia acotada. Una sesión borrada o desalojada sin cambios no deja nada programado.
+    """
+
+    def __init__(self, persistence: LocalMemoryPersistence = None,
+                 batch_size: int = MEMORY_BACKUP_BATCH, max_concurrency: int = MEMORY_BACKUP_CONCURRENCY):
+        self._persistence = persistence
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self._dirty: Dict[str, None] = {}   # ordenado: las más antiguas se respaldan primero
+        self._lock = Lock()
+        self.stats = {"backups": 0, "failures": 0, "cancelled": 0, "runs": 0, "last_run_ms": 0.0}
+
+    @property
+    def persistence(self) -> LocalMemoryPersistence:
+        if self._persistence is None:
+            self._persistence = get_local_persistence()
+        return self._persistence
+
+    def mark_dirty(self, session_id: str) -> None:
+        with self._lock:
+            self._dirty[session_id] = None
+
+    def cancel(self, session_id: str) -> bool:
+        """Quita el backup pendiente de una sesión (p. ej. al borrar su memoria)"""
+        with self._lock:
+            if self._dirty.pop(session_id, 0) is None:
+                self.stats["cancelled"] += 1
+                return True
+            return False
+
+    def is_dirty(self, session_id: str) -> bool:
+        return session_id in self._dirty
+
+    def _take_batch(self) -> List[str]:
+        with self._lock:
+            batch = list(itertools.islice(self._dirty, self.batch_size))
+            for session_id in batch:
+                del self._dirty[session_id]
+            return batch
+
+    async def run_pending(self) -> int:
+        """Respalda todas las sesiones sucias; las que fallan quedan marcadas para la próxima vez"""
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        failed: List[str] = []
+
+        async def backup(session_id: str) -> bool:
+            async with semaphore:
+                try:
+                    await asyncio.to_thread(self.persistence.create_compressed_backup, session_id)
+                    return True
+                except Exception as e:
+                    print(f"Error creando backup para {session_id}: {e}")
+                    failed.append(session_id)
+                    return False
+
+        done = 0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            results = await asyncio.gather(*(backup(session_id) for session_id in batch))
+            done += sum(results)
+
+        for session_id in failed:
+            self.mark_dirty(session_id)
+        self.stats["backups"] += done
+        self.stats["failures"] += len(failed)
+        self.stats["runs"] += 1
+        self.stats["last_run_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        if done:
+            print(f"🔄 Backups de memoria: {done} sesiones respaldadas")
+        return done
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "dirty": len(self._dirty), "batch_size": self.batch_size,
+                "max_concurrency": self.max_concurrency}
+
+
+# Planificador compartido (lo ejecuta el job memory_backup_job de main.py)
+session_backups = SessionBackupScheduler()
+
 # ============================================================================
 # 🎯 SISTEMA HÍBRIDO COMPLETO - Integra los 3 tipos de memoria
 # ============================================================================
@@ -841,7 +1887,7 @@ class AdvancedMemorySystem:
         self.short_term_k = short_term_k
         
         # Capa de persistencia compartida
-        self.local_persistence = LocalMemoryPersistence()
+        self.local_persistence = get_local_persistence()
         
         # Memoria a corto plazo (RAM) - compatible con langchain 0.1.14
         self.short_term_memory = ConversationBufferWindowMemory(
@@ -857,8 +1903,10 @@ class AdvancedMemorySystem:
         self.semantic_memory = SemanticMemory(session_id, local_persistence=self.local_persistence)
         self.procedural_memory = ProceduralMemory(session_id, local_persistence=self.local_persistence)
         
-        # Sistema de backup automático
-        self._setup_auto_backup()
+        # Recuerdo vectorial de preguntas pasadas
+        self.vector_index = (
+            EpisodicVectorIndex(session_id, self.local_persistence, message_embedder) if MEMORY_VECTOR_RECALL else None
+        )
         
         # Restaurar desde backup si es necesario
         self._restore_if_needed()
@@ -870,23 +1918,7 @@ class AdvancedMemorySystem:
         print(f"  📚 Memoria Episódica: Conversaciones y eventos")
         print(f"  🧠 Memoria Semántica: Conocimiento y conceptos")
         print(f"  ⚙️ Memoria Procedimental: Workflows y procedimientos")
-        print(f"  💾 Persistencia Local: Backup automático habilitado")
-    
-    def _setup_auto_backup(self):
-        """Configurar backup automático cada 30 minutos"""
-        def create_backup():
-            try:
-                result = self.local_persistence.create_compressed_backup(self.session_id)
-                print(f"🔄 Backup automático creado: {result}")
-                # Programar siguiente backup
-                Timer(1800, create_backup).start()  # 30 minutos
-            except Exception as e:
-                print(f"Error en backup automático: {e}")
-                # Reintentar en 5 minutos
-                Timer(300, create_backup).start()
-        
-        # Iniciar primer backup en 30 segundos
-        Timer(30, create_backup).start()
+        print(f"  💾 Persistencia Local: Backup programado de sesiones con cambios")
     
     def _restore_if_needed(self):
         """Restaurar desde backup si no hay datos recientes"""
@@ -922,17 +1954,22 @@ class AdvancedMemorySystem:
         elif isinstance(message, AIMessage):
             self.short_term_memory.chat_memory.add_ai_message(message.content)
         
-        # 2. Memoria episódica
+        # 2. Memoria episódica (la sesión entra en el próximo lote de backups)
         self.episodic_memory.add_message(message, context)
+        session_backups.mark_dirty(self.session_id)
         
-        # 3. Actualizar memoria semántica si es mensaje del usuario
+        # 3. Actualizar memoria semántica si es mensaje del usuario (fuera del camino de la respuesta)
         if isinstance(message, HumanMessage):
-            recent_messages = self.get_recent_messages()
-            self.semantic_memory.extract_and_store_from_conversation(recent_messages[-5:])  # Últimos 5 mensajes
+            recent_messages = list(self.get_recent_messages()[-5:])  # Últimos 5 mensajes
+            self.episodic_memory.write_buffer.add_task(
+                self.semantic_memory.extract_and_store_from_conversation, recent_messages
+            )
         
-        # 4. Actualizar memoria procedimental si se usaron herramientas
+        # 4. Actualizar memoria procedimental si se usaron herramientas (GET + PATCH/POST diferidos)
         if isinstance(message, HumanMessage) and tools_used:
-            self.procedural_memory.learn_from_interaction(message.content, tools_used, success)
+            self.episodic_memory.write_buffer.add_task(
+                self.procedural_memory.learn_from_interaction, message.content, list(tools_used), success
+            )
     
     def get_recent_messages(self) -> List[BaseMessage]:
         """Obtiene mensajes recientes de la memoria a corto plazo"""
@@ -943,7 +1980,16 @@ class AdvancedMemorySystem:
         return self.episodic_memory.messages
     
     def search_memory(self, query: str, limit: int = 5) -> List[BaseMessage]:
-        """Busca en la memoria episódica"""
+        """Busca en la memoria episódica: índice FTS5 con ranking BM25 (más relevante primero)"""
+        if self.local_persistence.fts_enabled:
+            try:
+                results = self.local_persistence.search_episodic(self.session_id, query, limit)
+                return [message for message in
+                        (EpisodicMemory._to_message(row['message_type'], row['content']) for row in results)
+                        if message is not None]
+            except sqlite3.Error as e:
+                print(f"Error en búsqueda FTS, usando recorrido lineal: {e}")
+        
         all_messages = self.get_all_messages()
         relevant_messages = []
         
@@ -956,6 +2002,16 @@ class AdvancedMemorySystem:
         
         return relevant_messages
     
+    async def recall_similar(self, query: str, limit: int = 3) -> List[BaseMessage]:
+        """Preguntas pasadas del usuario semánticamente parecidas a la consulta (más parecida primero)"""
+        if self.vector_index is None:
+            return []
+        try:
+            return [message for message, _ in await self.vector_index.recall(query, limit)]
+        except Exception as e:
+            print(f"Error en recuerdo vectorial, usando búsqueda de texto: {e}")
+            return []
+    
     def get_user_profile(self) -> Dict[str, Any]:
         """Obtiene el perfil del usuario desde la memoria semántica"""
         user_knowledge = self.semantic_memory.get_knowledge(category="user_profile")
@@ -993,6 +2049,7 @@ class AdvancedMemorySystem:
         """Limpia todas las memorias"""
         self.short_term_memory.clear()
         self.episodic_memory.clear()
+        session_backups.cancel(self.session_id)
         print("🧠 Todas las memorias limpiadas")
     
     def cleanup_old_procedural_patterns(self) -> int:
@@ -1008,67 +2065,57 @@ class AdvancedMemoryManager:
     
     def __init__(self):
         self.active_sessions: Dict[str, AdvancedMemorySystem] = {}
-        self.last_activity: Dict[str, float] = {}
         self.cleanup_interval = 7200  # 2 horas (aumentado)
-        self.local_persistence = LocalMemoryPersistence()
-        
-        # Configurar limpieza automática
-        self._setup_periodic_cleanup()
+        self.last_activity = ExpiryTracker(self.cleanup_interval)
+        self.local_persistence = get_local_persistence()
     
-    def _setup_periodic_cleanup(self):
-        """Configurar limpieza periódica de sesiones"""
-        def periodic_cleanup():
-            try:
-                # Limpiar sesiones inactivas de RAM
-                self.cleanup_inactive_sessions()
-                
-                # Limpiar datos antiguos de base local
-                cleaned = self.local_persistence.cleanup_old_sessions(30)
-                if cleaned > 0:
-                    print(f"🧹 Limpieza automática: {cleaned} sesiones archivadas")
-                
-                # Programar siguiente limpieza
-                Timer(3600, periodic_cleanup).start()  # 1 hora
-            except Exception as e:
-                print(f"Error en limpieza periódica: {e}")
-                Timer(1800, periodic_cleanup).start()  # Reintentar en 30 min
-        
-        # Iniciar primera limpieza en 1 hora
-        Timer(3600, periodic_cleanup).start()
+    def periodic_cleanup(self) -> None:
+        """Limpieza periódica de sesiones (la ejecuta el scheduler de main.py)"""
+        try:
+            # Limpiar sesiones inactivas de RAM
+            self.cleanup_inactive_sessions()
+            
+            # Limpiar datos antiguos de base local
+            cleaned = self.local_persistence.cleanup_old_sessions(30)
+            if cleaned > 0:
+                print(f"🧹 Limpieza automática: {cleaned} sesiones archivadas")
+        except Exception as e:
+            print(f"Error en limpieza periódica: {e}")
     
     def get_memory_for_session(self, session_id: str, short_term_k: int = 10) -> AdvancedMemorySystem:
         """Obtiene o crea un sistema de memoria avanzado para una sesión"""
-        if session_id not in self.active_sessions:
-            self.active_sessions[session_id] = AdvancedMemorySystem(
+        memory_system = self.active_sessions.get(session_id)
+        if memory_system is None:
+            # Se construye en hilos del pool de orquestadores: si dos llegan a la vez, gana el primero
+            memory_system = self.active_sessions.setdefault(session_id, AdvancedMemorySystem(
                 session_id=session_id,
                 short_term_k=short_term_k
-            )
+            ))
         
-        self.last_activity[session_id] = time.time()
-        return self.active_sessions[session_id]
+        self.last_activity.touch(session_id)
+        return memory_system
     
     def cleanup_inactive_sessions(self):
         """Limpia sesiones inactivas de RAM (los datos persisten localmente)"""
-        current_time = time.time()
-        inactive_sessions = []
-        
-        for session_id, last_active in self.last_activity.items():
-            if current_time - last_active > self.cleanup_interval:
-                inactive_sessions.append(session_id)
+        inactive_sessions = self.last_activity.expired()
         
         for session_id in inactive_sessions:
-            if session_id in self.active_sessions:
-                # Crear backup antes de limpiar de RAM
-                try:
-                    self.active_sessions[session_id].local_persistence.create_compressed_backup(session_id)
-                    print(f"🧹 Sesión {session_id} guardada y removida de RAM")
-                except Exception as e:
-                    print(f"Error creando backup para {session_id}: {e}")
-                
-                del self.active_sessions[session_id]
-                del self.last_activity[session_id]
+            self.release_session(session_id)
         
         return len(inactive_sessions)
+    
+    def release_session(self, session_id: str) -> bool:
+        """Quita la sesión de RAM (se recarga desde la persistencia al volver)"""
+        memory_system = self.active_sessions.pop(session_id, None)
+        self.last_activity.remove(session_id)
+        if memory_system is None:
+            return False
+        
+        # Los datos ya están en SQLite: si hubo cambios, el backup sale en el próximo lote
+        # del planificador, sin trabajo síncrono en el desalojo ni temporizadores por sesión
+        print(f"🧹 Sesión {session_id} removida de RAM"
+              f"{' (backup pendiente)' if session_backups.is_dirty(session_id) else ''}")
+        return True
 
 # Instancia global del gestor avanzado
 advanced_memory_manager = AdvancedMemoryManager()
@@ -1080,12 +2127,47 @@ def get_memory(llm, session_id: str = None, short_term_k: int = 10):
     if not session_id:
         session_id = f"session_{int(time.time())}"
     
-    # Limpiar sesiones inactivas periódicamente
-    advanced_memory_manager.cleanup_inactive_sessions()
-    
     # Obtener sistema de memoria avanzado
     memory_system = advanced_memory_manager.get_memory_for_session(session_id, short_term_k)
     
     print(f"🎯 Sistema de memoria avanzado listo para: {session_id}")
     
     return memory_system
+
+
+def migrate_remote_sessions(mapping: Dict[str, str]) -> int:
+    """Re-asigna en Supabase las filas de las sesiones migradas localmente"""
+    updated = 0
+    for old_id, new_id in mapping.items():
+        for table in ("chat_history", "semantic_memory", "procedural_memory"):
+            try:
+                response = make_supabase_request(
+                    method="PATCH",
+                    endpoint=table,
+                    data={"session_id": new_id},
+                    params={"session_id": f"eq.{old_id}"}
+                )
+                if response.status_code in [200, 204]:
+                    updated += 1
+                else:
+                    print(f"Error migrando {table} de {old_id}: {response.status_code}")
+            except Exception as e:
+                print(f"Error conectando con Supabase migrando {old_id}: {str(e)}")
+    return updated
+
+
+if __name__ == "__main__":
+    # python memoria.py migrate-sessions [--remote] → re-asigna las sesiones session_<timestamp>
+    # de memory.db (y opcionalmente de Supabase) al session_id estable de cada usuario
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-sessions":
+        report = LocalMemoryPersistence().rekey_legacy_sessions()
+        print(f"✅ Sesiones migradas: {report['sessions_migrated']} ({report['rows_rekeyed']} filas)")
+        if report["ambiguous"]:
+            print(f"⚠️ Sesiones compartidas (solo se migraron los mensajes): {', '.join(report['ambiguous'])}")
+        if report["without_phone"]:
+            print(f"⚠️ Sesiones sin número identificable: {len(report['without_phone'])}")
+        if "--remote" in sys.argv:
+            print(f"☁️ Actualizaciones en Supabase: {migrate_remote_sessions(report['mapping'])}")
+    else:
+        print("Uso: python memoria.py migrate-sessions [--remote]")
+
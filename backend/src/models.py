@@ -11,7 +11,9 @@ class MessageSender(str, Enum):
 
 class MessageStatus(str, Enum):
     """Estados de mensaje"""
+    QUEUED = "queued"
     SENT = "sent"
+    FAILED = "failed"
     PENDING_APPROVAL = "pending_approval"
     APPROVED = "approved"
     REJECTED = "rejected"
@@ -121,6 +123,7 @@ class UserStatsResponse(ApiResponse):
     """Respuesta para estadísticas de usuarios"""
     active_users: Optional[List[UserStatsModel]] = None
     total_users: Optional[int] = None
+    pool: Optional[Dict[str, Any]] = None
 
 class HealthResponse(BaseModel):
     """Respuesta del health check"""
@@ -1,7 +1,10 @@
-from typing import Dict, Any
+import os
+import sys
+from collections import OrderedDict, deque
+from typing import Dict, Any, List
 import traceback
 import asyncio
-import nest_asyncio
+import threading
 from langchain_openai import ChatOpenAI
 from langchain.tools import Tool
 from langchain_openai import ChatOpenAI
@@ -9,27 +12,215 @@ from langchain.prompts import MessagesPlaceholder, ChatPromptTemplate
 from langchain_core.messages import HumanMessage, SystemMessage
 from indexador import  IndexerAgent
 from busqueda_Web import WebSearchAgent
-from memoria import get_memory
+from memoria import get_memory, advanced_memory_manager, session_id_for_user
+from clasificador import laboral_classifier
+from utilidades import ExpiryTracker
 from langchain.agents import AgentType, initialize_agent
 import time
 from datetime import datetime
-from langchain.schema import HumanMessage, AIMessage
-
-# Aplicar nest_asyncio para permitir loops anidados
-nest_asyncio.apply()
-
-# Diccionario global para mantener las instancias de orquestadores por usuario
-user_orchestrators = {}
-# Diccionario para seguir la última actividad de cada usuario
-last_activity = {}
+from langchain.schema import HumanMessage, AIMessage, BaseMessage
 
 # Tiempo de inactividad en segundos antes de limpiar la memoria (1 hora)
 INACTIVITY_TIMEOUT = 3600  # 1 hora en segundos
 
+# Tiempo máximo de ejecución de una herramienta del agente
+TOOL_TIMEOUT = float(os.getenv("AGENT_TOOL_TIMEOUT", "30"))
+
+# Límites del pool de orquestadores en RAM
+ORCHESTRATOR_POOL_MAX_ENTRIES = int(os.getenv("ORCHESTRATOR_POOL_MAX_ENTRIES", "1000"))
+ORCHESTRATOR_POOL_MAX_MB = float(os.getenv("ORCHESTRATOR_POOL_MAX_MB", "256"))
+# Costo fijo estimado de un orquestador (memoria avanzada, persistencia, cachés)
+ORCHESTRATOR_BASE_BYTES = 16 * 1024
+
+
+# ============================================================================
+# 🗂️ POOL DE ORQUESTADORES POR USUARIO
+# ============================================================================
+
+class OrchestratorPool:
+    """
+    Pool LRU de orquestadores por usuario, acotado en entradas y en bytes aproximados.
+    Al desalojar un usuario se persiste su memoria y se libera el objeto; con el
+    siguiente mensaje se rehidrata desde la persistencia (SQLite/Supabase) usando
+    su session_id estable
+    """
+    
+    def __init__(self, max_entries: int = ORCHESTRATOR_POOL_MAX_ENTRIES,
+                 max_bytes: int = int(ORCHESTRATOR_POOL_MAX_MB * 1024 * 1024), factory=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.factory = factory or (lambda user_id: MainOrchestrator(session_id=session_id_for_user(user_id)))
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        # Usuarios desalojados cuya memoria aún se está persistiendo
+        self._releasing: Dict[str, threading.Event] = {}
+        self.hits = 0
+        self.creations = 0
+        self.rehydrations = 0
+        self.evictions = 0
+        self.rehydration_ms = deque(maxlen=1000)
+    
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._entries
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get(self, user_id: str):
+        """Obtiene el orquestador del usuario, creándolo o rehidratándolo si no está en RAM"""
+        orchestrator, victims = self._lookup(user_id)
+        if orchestrator is None:
+            self._wait_for_release(user_id)
+            orchestrator, victims = self._build(user_id)
+        self._release(victims)
+        return orchestrator
+    
+    async def get_async(self, user_id: str):
+        """
+        Como get(), pero fuera del event loop: la creación/rehidratación (GET de la cola
+        episódica a Supabase) y la persistencia de los desalojados corren en un hilo
+        """
+        orchestrator, victims = self._lookup(user_id)
+        if orchestrator is None:
+            if user_id in self._releasing:
+                await asyncio.to_thread(self._wait_for_release, user_id)
+            orchestrator, victims = await asyncio.to_thread(self._build, user_id)
+        if victims:
+            await asyncio.to_thread(self._release, victims)
+        return orchestrator
+    
+    def _lookup(self, user_id: str):
+        """(orquestador en RAM o None, desalojados pendientes de liberar)"""
+        with self.lock:
+            orchestrator = self._entries.get(user_id)
+            if orchestrator is None:
+                return None, []
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            self._resize(user_id)
+            return orchestrator, self._evict_over_capacity(keep=user_id)
+    
+    def _build(self, user_id: str):
+        # Construir fuera del lock: la rehidratación lee la persistencia
+        start = time.perf_counter()
+        orchestrator = self.factory(user_id)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        
+        with self.lock:
+            if user_id in self._entries:
+                # Otro hilo lo creó mientras tanto
+                self._entries.move_to_end(user_id)
+                return self._entries[user_id], []
+            if getattr(orchestrator, "rehydrated", False):
+                self.rehydrations += 1
+                self.rehydration_ms.append(elapsed_ms)
+                print(f"♻️ Orquestador de {user_id} rehidratado en {elapsed_ms:.1f}ms")
+            else:
+                self.creations += 1
+            self._entries[user_id] = orchestrator
+            self._sizes[user_id] = 0
+            self._resize(user_id)
+            return orchestrator, self._evict_over_capacity(keep=user_id)
+    
+    def evict(self, user_id: str) -> bool:
+        """Persiste la memoria del usuario y libera su orquestador (se rehidrata al volver)"""
+        with self.lock:
+            orchestrator = self._remove(user_id)
+            if orchestrator is None:
+                return False
+            self.evictions += 1
+            self._releasing[user_id] = threading.Event()
+        try:
+            orchestrator.release()
+        finally:
+            self._release_done(user_id)
+        return True
+    
+    def discard(self, user_id: str):
+        """Quita al usuario del pool sin persistir su memoria. Retorna su orquestador (o None)"""
+        with self.lock:
+            return self._remove(user_id)
+    
+    def _remove(self, user_id: str):
+        orchestrator = self._entries.pop(user_id, None)
+        self.total_bytes -= self._sizes.pop(user_id, 0)
+        return orchestrator
+    
+    def _resize(self, user_id: str) -> None:
+        size = self._entries[user_id].approximate_size()
+        self.total_bytes += size - self._sizes[user_id]
+        self._sizes[user_id] = size
+    
+    def _evict_over_capacity(self, keep: str) -> List[tuple]:
+        """
+        Saca del pool a los menos usados hasta volver a los límites (nunca el usuario actual).
+        Se llama con el lock tomado; la liberación (persistencia) la hace el llamador fuera de él.
+        """
+        victims = []
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            user_id = next(iter(self._entries))
+            if user_id == keep:
+                break
+            victims.append((user_id, self._remove(user_id)))
+            self._releasing[user_id] = threading.Event()
+            self.evictions += 1
+        return victims
+    
+    def _release(self, victims: List[tuple]) -> None:
+        """Persiste y libera los orquestadores desalojados (sin el lock del pool)"""
+        for user_id, orchestrator in victims:
+            try:
+                orchestrator.release()
+                print(f"🗂️ Orquestador de {user_id} desalojado del pool (LRU)")
+            except Exception as e:
+                print(f"❌ Error persistiendo orquestador de {user_id}: {str(e)}")
+            finally:
+                self._release_done(user_id)
+    
+    def _release_done(self, user_id: str) -> None:
+        with self.lock:
+            done = self._releasing.pop(user_id, None)
+        if done is not None:
+            done.set()
+    
+    def _wait_for_release(self, user_id: str) -> None:
+        """Si el usuario se está desalojando, espera a que su memoria quede persistida antes de rehidratarlo"""
+        with self.lock:
+            pending = self._releasing.get(user_id)
+        if pending is not None:
+            pending.wait()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.creations + self.rehydrations
+        latencies = sorted(self.rehydration_ms)
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "approx_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "creations": self.creations,
+            "rehydrations": self.rehydrations,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "rehydration_avg_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "rehydration_p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2) if latencies else 0.0
+        }
+
+
+# Pool global de orquestadores por usuario
+user_orchestrators = OrchestratorPool()
+# Última actividad de cada usuario, con expiración por inactividad en O(1) por mensaje
+last_activity = ExpiryTracker(INACTIVITY_TIMEOUT)
+
 
 def get_inactive_users(current_time: float = None) -> list:
     """
-    Identifica usuarios inactivos basado en el tiempo de inactividad
+    Identifica usuarios inactivos basado en el tiempo de inactividad (sin expirarlos).
+    Recorre todos los usuarios: solo para reportes como /users/stats
     
     Args:
         current_time: Timestamp actual (opcional, usa time.time() si no se proporciona)
@@ -40,99 +231,93 @@ def get_inactive_users(current_time: float = None) -> list:
     if current_time is None:
         current_time = time.time()
     
-    inactive_users = []
-    for user_id, last_active in last_activity.items():
-        if current_time - last_active > INACTIVITY_TIMEOUT:
-            inactive_users.append(user_id)
-    
-    return inactive_users
+    return [user_id for user_id, _ in last_activity.items() if last_activity.is_expired(user_id, current_time)]
 
 
 def get_orchestrator_for_user(user_id):
-    """Obtiene o crea un orquestador para un usuario específico"""
-    # Verificar si debemos limpiar alguna memoria por inactividad
-    check_and_cleanup_inactive_users()
-    
-    if user_id not in user_orchestrators:
-        user_orchestrators[user_id] = MainOrchestrator()
+    """Obtiene o crea un orquestador para un usuario específico (la limpieza la hace el scheduler)"""
+    orchestrator = user_orchestrators.get(user_id)
     
     # Actualizar timestamp de último acceso
-    last_activity[user_id] = time.time()
+    last_activity.touch(user_id)
     
-    return user_orchestrators[user_id]
+    return orchestrator
+
+
+async def get_orchestrator_for_user_async(user_id):
+    """Versión para el event loop: los desalojos del pool se persisten en un hilo"""
+    orchestrator = await user_orchestrators.get_async(user_id)
+    last_activity.touch(user_id)
+    return orchestrator
 
 
 def check_and_cleanup_inactive_users():
-    """Verifica y limpia la memoria de usuarios inactivos"""
-    inactive_users = get_inactive_users()
+    """Libera de RAM a los usuarios inactivos (job periódico del scheduler)"""
+    inactive_users = last_activity.expired()
     
-    # Limpiar memoria de usuarios inactivos
+    # Persistir su memoria y liberar el orquestador: la sesión es estable, así que
+    # el usuario retoma su historial con el siguiente mensaje
     for user_id in inactive_users:
-        if user_id in user_orchestrators:
-            print(f"Limpiando memoria de usuario inactivo: {user_id}")
-            user_orchestrators[user_id].clear_memory()
+        if user_orchestrators.evict(user_id):
+            print(f"Liberando orquestador de usuario inactivo: {user_id}")
     
     # Registrar actividad de limpieza
     if inactive_users:
-        print(f"Se limpió la memoria de {len(inactive_users)} usuarios inactivos")
+        print(f"Se liberó la memoria de {len(inactive_users)} usuarios inactivos")
 
 
-class MainOrchestrator:
-    """Orquestador principal basado en LangChain con herramientas extensibles"""
+# ============================================================================
+# 🤖 PLANTILLA COMPARTIDA DEL AGENTE
+# ============================================================================
+
+class AgentTemplate:
+    """
+    Partes sin estado del agente (LLM, herramientas, prompt y executor).
+    Se construyen una sola vez y las comparten todos los usuarios; la memoria
+    de cada usuario se pasa en cada llamada
+    """
     
     def __init__(self):
-        """Inicializa el orquestador con las herramientas necesarias"""
-        print(" Inicializando MainOrchestrator con LangChain (Agente)")
-        
-        # Inicializar LLM (lo necesitamos antes para la memoria)
+        """Construye el LLM, las herramientas y el executor del agente"""
+        print("🤖 Construyendo plantilla compartida del agente")
         self.llm = ChatOpenAI(temperature=0.3, model="gpt-4o-mini")
-
-        # Generar un session_id único para esta instancia
-        self.session_id = f"session_{int(time.time())}"
-        
-        # Inicializar sistema de memoria híbrido completo
-        self.memory_system = get_memory(self.llm, self.session_id, short_term_k=10)
-        
-        # Para compatibilidad con LangChain, usar solo la memoria a corto plazo en el agente
-        self.memory = self.memory_system.short_term_memory
-        
-        # Timestamp de última actividad
-        self.last_active = time.time()
         
         # Inicializar las herramientas (tools)
         self.document_indexer = IndexerAgent()
         self.web_search_agent = WebSearchAgent()
         
-        # Crear funciones adaptadoras (para manejar async/sync)
-        def search_documents_wrapper(query: str) -> str:
-            """Adapter para el método asíncrono search_documents"""
-            results = self._execute_async_tool(
-                "buscar_documentos", 
-                self.document_indexer.search_documents, 
+        # Herramientas asíncronas: se ejecutan en el event loop principal
+        async def search_documents_tool(query: str) -> str:
+            """Busca en los documentos internos (IndexerAgent.search_documents)"""
+            results = await self._run_tool(
+                "buscar_documentos",
+                self.document_indexer.search_documents,
                 query
             )
-            return self._format_document_results(results)
+            return results if isinstance(results, str) else self._format_document_results(results)
         
-        def search_web_wrapper(query: str) -> str:
-            """Adapter para el método asíncrono get_web_data"""
-            web_data = self._execute_async_tool(
-                "buscar_web", 
-                self.web_search_agent.get_web_data, 
+        async def search_web_tool(query: str) -> str:
+            """Busca en internet (WebSearchAgent.get_web_data)"""
+            web_data = await self._run_tool(
+                "buscar_web",
+                self.web_search_agent.get_web_data,
                 query
             )
-            return self._format_web_results(web_data)
+            return web_data if isinstance(web_data, str) else self._format_web_results(web_data)
         
         # Definir las herramientas LangChain
         self.tools = [
             Tool(
                 name="buscar_documentos",
                 description="Busca información en documentos internos de la empresa sobre temas laborales, legales, normativos y políticas internas. Útil para consultas sobre reglamentos, procedimientos y normativas específicas de la empresa.",
-                func=search_documents_wrapper
+                func=None,
+                coroutine=search_documents_tool
             ),
             Tool(
                 name="buscar_web",
                 description="Busca información actualizada en internet sobre temas laborales, legales y normativos. Útil para obtener información general, actualizaciones legales o cuando se necesita información más amplia.",
-                func=search_web_wrapper
+                func=None,
+                coroutine=search_web_tool
             )
         ]
         
@@ -198,14 +383,14 @@ class MainOrchestrator:
             MessagesPlaceholder(variable_name="chat_history")  # 4. ÚLTIMO: Contexto/historial
         ])
         
-        # Crear el agente con prompt personalizado
-        self.agent = initialize_agent(
+        # Crear el agente con prompt personalizado (sin memoria: se pasa el historial en cada llamada)
+        self.executor = initialize_agent(
             tools=self.tools,
             llm=self.llm,
             agent=AgentType.CHAT_CONVERSATIONAL_REACT_DESCRIPTION,
             verbose=True,
-            memory=self.memory,
             handle_parsing_errors=True,
+            return_intermediate_steps=True,
             max_iterations=10,  
             early_stopping_method="generate", 
             agent_kwargs={
@@ -213,19 +398,14 @@ class MainOrchestrator:
                 "input_variables": ["input", "agent_scratchpad", "chat_history"]
             }
         )
-        
-        # Variable para seguimiento de conversación activa
-        self.conversation_active = False
-        
-        print("\u2705 MainOrchestrator inicializado correctamente con memoria conversacional")
     
-    def _execute_async_tool(self, tool_name: str, async_func, *args, **kwargs):
-        """Ejecutor genérico para herramientas asíncronas"""
-        # 🔧 RASTREAR USO DE HERRAMIENTA
-        if not hasattr(self, '_tools_used_in_current_query'):
-            self._tools_used_in_current_query = []
-        self._tools_used_in_current_query.append(tool_name)
-        
+    async def run(self, query: str, memory) -> Dict[str, Any]:
+        """Ejecuta el agente con el historial de la memoria a corto plazo del usuario"""
+        history = memory.load_memory_variables({}).get(memory.memory_key, [])
+        return await self.executor.ainvoke({"input": query, "chat_history": history})
+    
+    async def _run_tool(self, tool_name: str, async_func, *args, **kwargs):
+        """Ejecutor genérico para herramientas asíncronas (sin bloquear el event loop)"""
         # Mapeo de emojis por herramienta
         emoji_map = {
             "buscar_documentos": "🔍",
@@ -234,36 +414,20 @@ class MainOrchestrator:
         emoji = emoji_map.get(tool_name, "🔧")
         print(f"{emoji} Herramienta ejecutada: {tool_name}")
         
-        # Ejecutar función asíncrona
         try:
-            import concurrent.futures
-            import threading
-            
-            # Crear un nuevo thread para ejecutar la función asíncrona
-            def run_in_thread():
-                try:
-                    # Crear un nuevo event loop en el thread
-                    new_loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(new_loop)
-                    try:
-                        result = new_loop.run_until_complete(async_func(*args, **kwargs))
-                        return result
-                    finally:
-                        new_loop.close()
-                except Exception as e:
-                    print(f"❌ Error en thread: {str(e)}")
-                    return f"Error ejecutando {tool_name}: {str(e)}"
-            
-            # Ejecutar en un thread separado
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(run_in_thread)
-                result = future.result(timeout=30)  # Timeout de 30 segundos
-                return result
-                
+            return await asyncio.wait_for(async_func(*args, **kwargs), timeout=TOOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⏱️ Timeout ejecutando herramienta {tool_name} ({TOOL_TIMEOUT}s)")
+            return f"Error al ejecutar {tool_name}: tiempo de espera agotado"
         except Exception as e:
             print(f"❌ Error ejecutando herramienta {tool_name}: {str(e)}")
             return f"Error al ejecutar {tool_name}: {str(e)}"
     
+    def tools_from_steps(self, intermediate_steps) -> list:
+        """Herramientas realmente ejecutadas por el agente, en orden"""
+        tool_names = {tool.name for tool in self.tools}
+        return [action.tool for action, _ in intermediate_steps if action.tool in tool_names]
+    
     def _format_document_results(self, results):
         """Formatea resultados de documentos"""
         if not results:
@@ -326,79 +490,62 @@ class MainOrchestrator:
         
         return "\n".join(results)
 
-    def _classify_query_as_laboral(self, query: str) -> bool:
-        """
-        Clasifica si una consulta es laboral o no usando el LLM
-        """
-        try:
-            # Crear un prompt específico para clasificación
-            classification_prompt = f"""Eres un clasificador especializado en determinar si una consulta es LABORAL(saludos tambien son laborales) o NO LABORAL.
 
-CONSULTAS LABORALES (RESPONDER "LABORAL"):
-✅ Temas de trabajo, empleo, contratos, sueldos, horarios
-✅ Saludos, bienvenidas, despedidas, etc.
-✅ Vacaciones, permisos, licencias, días festivos
-✅ Beneficios laborales, bonificaciones, compensaciones
-✅ Seguridad social, salud ocupacional, riesgos laborales
-✅ Capacitación, desarrollo profesional, cursos laborales
-✅ Políticas de empresa, reglamentos internos, procedimientos
-✅ Relaciones laborales, conflictos, mediación
-✅ Terminación laboral, renuncias, despidos
-✅ Jornada de trabajo, horas extras, descansos
-✅ Condiciones de trabajo, ambiente laboral
-✅ Derechos y obligaciones del trabajador
-✅ Normativas laborales, leyes de trabajo
-✅ Evaluaciones de desempeño, ascensos
-✅ Herramientas de trabajo, equipos, recursos
-✅ Comunicación interna, reuniones, reportes
+_agent_template = None
+_agent_template_lock = threading.Lock()
 
-CONSULTAS NO LABORALES (RESPONDER "NO_LABORAL"):
-❌ Chistes, memes, entretenimiento
-❌ Deportes, noticias generales, política
-❌ Cocina, recetas, restaurantes
-❌ Viajes, turismo, hoteles
-❌ Música, películas, series
-❌ Salud personal (no ocupacional)
-❌ Educación general (no capacitación laboral)
-❌ Compras personales, moda, tecnología
-❌ Familia, relaciones personales
-❌ Hobbies, pasatiempos, juegos
-❌ Religión, espiritualidad
-❌ Consultas técnicas generales (no relacionadas al trabajo)
-❌ Consultas sobre otros empleos o empresas
-❌ Temas personales no relacionados al trabajo actual
 
-REGLAS IMPORTANTES:
-1. Si hay AMBIGÜEDAD, clasifica como "LABORAL" para dar beneficio de la duda
-2. Considera el CONTEXTO de una empresa/ambiente laboral
-3. Si la consulta puede interpretarse como laboral, es LABORAL
-4. Solo clasifica como NO_LABORAL si es claramente no relacionado al trabajo
+def get_agent_template() -> AgentTemplate:
+    """Obtiene la plantilla compartida del agente (se construye en el primer uso)"""
+    global _agent_template
+    if _agent_template is None:
+        with _agent_template_lock:
+            if _agent_template is None:
+                _agent_template = AgentTemplate()
+    return _agent_template
 
-RESPUESTA OBLIGATORIA:
-Responde ÚNICAMENTE con "LABORAL" o "NO_LABORAL" sin explicaciones adicionales.
 
-CONSULTA A CLASIFICAR: {query}"""
+class MainOrchestrator:
+    """Orquestador principal basado en LangChain con herramientas extensibles"""
+    
+    def __init__(self, template: AgentTemplate = None, session_id: str = None):
+        """Inicializa el estado del usuario; el agente se toma de la plantilla compartida"""
+        print(" Inicializando MainOrchestrator con LangChain (Agente)")
+        
+        self.template = template or get_agent_template()
+        self.llm = self.template.llm
 
-            # Usar el LLM para clasificar
-            response = self.llm.invoke(classification_prompt)
-            classification = response.content.strip().upper()
-            
-            print(f"🏷️ Clasificación de consulta: {classification}")
-            
-            # Validar respuesta
-            if classification == "LABORAL":
-                return True
-            elif classification == "NO_LABORAL":
-                return False
-            else:
-                print(f"⚠️ Clasificación inesperada: {classification}, asumiendo LABORAL")
-                return True
-                
-        except Exception as e:
-            print(f"❌ Error en clasificación laboral: {str(e)}")
-            return True  # Por defecto, asumir laboral en caso de error
+        # Sesión estable del usuario (ver session_id_for_user); sin usuario, una sesión temporal
+        self.session_id = session_id or f"session_{int(time.time())}"
+        
+        # Inicializar sistema de memoria híbrido completo
+        self.memory_system = get_memory(self.llm, self.session_id, short_term_k=10)
+        
+        # Para compatibilidad con LangChain, usar solo la memoria a corto plazo en el agente
+        self.memory = self.memory_system.short_term_memory
+        
+        # True si la sesión ya tenía historial persistido (usuario que vuelve)
+        self.rehydrated = bool(getattr(self.memory, "chat_memory", None) and self.memory.chat_memory.messages)
+        
+        # Timestamp de última actividad
+        self.last_active = time.time()
+        
+        # Variable para seguimiento de conversación activa
+        self.conversation_active = False
+        
+        print("\u2705 MainOrchestrator inicializado correctamente con memoria conversacional")
+    
+    async def _classify_query_as_laboral(self, query: str) -> bool:
+        """
+        Clasifica si una consulta es laboral o no. Las reglas locales y el modelo
+        de n-gramas resuelven los casos claros; el LLM solo se usa si hay ambigüedad
+        """
+        result = await laboral_classifier.classify(query, llm=self.llm)
+        print(f"🏷️ Clasificación de consulta: {result.label} ({result.source}, confianza {result.confidence:.2f})")
+        return result.is_laboral
 
-    def _enrich_query_with_longterm_memory(self, query: str, context: Dict[str, Any] = None) -> str:
+    def _enrich_query_with_longterm_memory(self, query: str, context: Dict[str, Any] = None,
+                                           related_messages: List[BaseMessage] = None) -> str:
         """
         Enriquece la consulta con información de la memoria a largo plazo
         para que el agente tenga más contexto
@@ -432,11 +579,11 @@ CONSULTA A CLASIFICAR: {query}"""
                         steps = ', '.join(best_proc['steps'][:2])  # Primeros 2 pasos
                         enriched_info.append(f"[EXPERIENCIA PREVIA: {steps}]")
             
-            # 3. 📚 Buscar conversaciones relevantes (memoria episódica)
-            relevant_messages = self.memory_system.search_memory(query, limit=3)
+            # 3. 📚 Conversaciones relevantes: recuerdo vectorial y, si no hay, búsqueda de texto
+            relevant_messages = related_messages or self.memory_system.search_memory(query, limit=3)
             if relevant_messages:
                 recent_context = []
-                for msg in relevant_messages[-2:]:  # Últimos 2 mensajes relevantes
+                for msg in relevant_messages[:2]:  # Los 2 mensajes más relevantes
                     if isinstance(msg, HumanMessage):
                         snippet = msg.content[:50] + "..." if len(msg.content) > 50 else msg.content
                         recent_context.append(f"Usuario preguntó: {snippet}")
@@ -470,7 +617,7 @@ CONSULTA A CLASIFICAR: {query}"""
             print(f"Procesando consulta: '{query}'")
             
             # 🔍 PRIMERO: Verificar si la consulta es laboral
-            is_laboral = self._classify_query_as_laboral(query)
+            is_laboral = await self._classify_query_as_laboral(query)
             
             if not is_laboral:
                 no_laboral_response = "🚫 Lo siento, solo puedo ayudarte con consultas relacionadas al área laboral de la empresa. Por favor, pregunta sobre temas de trabajo, contratos, vacaciones, beneficios, capacitación, políticas de empresa, etc. 😊"
@@ -489,7 +636,11 @@ CONSULTA A CLASIFICAR: {query}"""
             print("✅ Consulta laboral confirmada, procesando normalmente...")
             
             # 🧠 ENRIQUECER CONSULTA CON MEMORIA A LARGO PLAZO
-            enriched_query = self._enrich_query_with_longterm_memory(query, context)
+            related_messages = await self.memory_system.recall_similar(query, limit=3)
+            # Perfil, procedimientos y delta episódico se leen de Supabase con el cliente síncrono: en un hilo
+            enriched_query = await asyncio.to_thread(
+                self._enrich_query_with_longterm_memory, query, context, related_messages
+            )
             
             # La consulta enriquecida va directamente al prompt (sin duplicar instrucciones)
             formatted_query = enriched_query
@@ -504,17 +655,16 @@ CONSULTA A CLASIFICAR: {query}"""
             # 🧠 GUARDAR MENSAJE DEL USUARIO EN MEMORIA AVANZADA
             user_message = HumanMessage(content=query)
             
-            # Inicializar rastreo de herramientas para esta consulta
-            self._tools_used_in_current_query = []
             tools_used = []
             success = True
             
             try:
-                # Ejecutar el agente
-                response = self.agent.run(input=formatted_query)
+                # Ejecutar el agente sin bloquear el event loop
+                result = await self.template.run(formatted_query, self.memory)
+                response = result["output"]
                 
                 # Usar las herramientas realmente ejecutadas
-                tools_used = getattr(self, '_tools_used_in_current_query', [])
+                tools_used = self.template.tools_from_steps(result.get("intermediate_steps", []))
                 
                 # Si no se ejecutó ninguna herramienta, es una respuesta directa
                 if not tools_used:
@@ -526,10 +676,6 @@ CONSULTA A CLASIFICAR: {query}"""
                 response = f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
                 success = False
                 tools_used = ["error_handling"]
-            finally:
-                # Limpiar el rastreo para la próxima consulta
-                if hasattr(self, '_tools_used_in_current_query'):
-                    delattr(self, '_tools_used_in_current_query')
             
             # 🧠 GUARDAR EN SISTEMA DE MEMORIA AVANZADO
             # Incluir contexto enriquecido
@@ -562,7 +708,7 @@ CONSULTA A CLASIFICAR: {query}"""
             
             # 📊 MOSTRAR RESUMEN DE MEMORIA (opcional, para debug)
             if hasattr(self.memory_system, 'get_memory_summary'):
-                summary = self.memory_system.get_memory_summary()
+                summary = await asyncio.to_thread(self.memory_system.get_memory_summary)
                 print(f"📊 Resumen de memoria:")
                 print(f"  📚 Episódica: {summary.get('episodic', {}).get('total_messages', 0)} mensajes")
                 print(f"  🧠 Semántica: {summary.get('semantic', {}).get('total_concepts', 0)} conceptos")
@@ -605,4 +751,22 @@ CONSULTA A CLASIFICAR: {query}"""
             print("💾 Memoria a largo plazo también limpiada")
             
         self.conversation_active = False
-        print("Memoria de conversacion reiniciada") 
\ No newline at end of file
+        print("Memoria de conversacion reiniciada")
+
+    def approximate_size(self) -> int:
+        """Bytes aproximados que ocupa el orquestador en RAM (costo fijo + mensajes cargados)"""
+        size = ORCHESTRATOR_BASE_BYTES
+        chat_memory = getattr(self.memory, "chat_memory", None)
+        if chat_memory is not None:
+            size += sum(sys.getsizeof(message.content) for message in chat_memory.messages)
+        episodic_log = getattr(getattr(self.memory_system, "episodic_memory", None), "_log", None)
+        if episodic_log is not None:
+            size += sum(sys.getsizeof(message.content) for message in episodic_log)
+        vector_bytes = getattr(getattr(self.memory_system, "vector_index", None), "nbytes", None)
+        if isinstance(vector_bytes, int):
+            size += vector_bytes
+        return size
+
+    def release(self):
+        """Persiste la memoria de la sesión y la saca de RAM (al desalojar del pool)"""
+        advanced_memory_manager.release_session(self.session_id) 
\ No newline at end of file
@@ -14,6 +14,10 @@ CREATE TABLE IF NOT EXISTS semantic_memory (
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Clave generada por el backend: el envío en lote se repite sin duplicar (on_conflict=sync_key)
+ALTER TABLE semantic_memory ADD COLUMN IF NOT EXISTS sync_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_semantic_memory_sync_key ON semantic_memory(sync_key);
+
 -- Índices para memoria semántica
 CREATE INDEX IF NOT EXISTS idx_semantic_memory_session_id ON semantic_memory(session_id);
 CREATE INDEX IF NOT EXISTS idx_semantic_memory_concept ON semantic_memory(concept);
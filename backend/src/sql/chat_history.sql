@@ -9,6 +9,10 @@ CREATE TABLE IF NOT EXISTS chat_history (
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Clave generada por el backend: el envío en lote se repite sin duplicar (on_conflict=sync_key)
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS sync_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_history_sync_key ON chat_history(sync_key);
+
 -- Crear índices para búsquedas eficientes
 CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history(session_id);
 CREATE INDEX IF NOT EXISTS idx_chat_history_created_at ON chat_history(created_at);
@@ -115,6 +119,7 @@ COMMENT ON COLUMN chat_history.session_id IS 'Identificador único de la sesión
 COMMENT ON COLUMN chat_history.message_type IS 'Tipo de mensaje: human, ai, o system';
 COMMENT ON COLUMN chat_history.content IS 'Contenido del mensaje en formato JSON';
 COMMENT ON COLUMN chat_history.metadata IS 'Metadatos adicionales del mensaje';
+COMMENT ON COLUMN chat_history.sync_key IS 'Clave idempotente asignada por el backend al sincronizar';
 
 -- Ejemplo de uso:
 -- INSERT INTO chat_history (session_id, message_type, content) 
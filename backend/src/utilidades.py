@@ -7,8 +7,11 @@ from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 import json
 import re
+import heapq
+import time
+from collections import OrderedDict
+from threading import Lock
 from typing import Dict, Any, Optional
-import requests
 # Determinar la ruta base del proyecto (un nivel arriba de src)
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -30,8 +33,8 @@ SUPABASE_TABLE = "tfinal"
 GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
 SERP_API_KEY = os.getenv("SERP_API_KEY")
 
-def get_google_drive_service():
-    """Obtiene el servicio de Google Drive utilizando credenciales guardadas o autenticación OOB."""
+def get_google_drive_credentials():
+    """Obtiene las credenciales de Google Drive guardadas en token.json o mediante autenticación OOB."""
     creds = None
     
     # Definir la ruta para token.json
@@ -94,6 +97,16 @@ def get_google_drive_service():
 
             print(f"✅ ¡Éxito! Se ha creado el archivo token.json en {token_path}")
 
+    return creds
+
+
+def get_google_drive_service(creds=None):
+    """
+    Crea un servicio de Google Drive. Cada servicio tiene su propia conexión httplib2,
+    que no es thread-safe: los hilos que descargan en paralelo crean el suyo reutilizando `creds`.
+    """
+    if creds is None:
+        creds = get_google_drive_credentials()
     # Crear el servicio de Google Drive con las credenciales obtenidas
     service = build('drive', 'v3', credentials=creds)
     return service
@@ -135,26 +148,165 @@ def get_supabase_headers() -> Dict[str, str]:
         "Authorization": f"Bearer {SUPABASE_KEY}"
     }
 
-def make_supabase_request(method: str, endpoint: str, data: Dict = None, params: Dict = None) -> requests.Response:
+def make_supabase_request(method: str, endpoint: str, data: Any = None, params: Dict = None,
+                          headers: Dict = None):
     """
-    Realiza peticiones HTTP a Supabase de forma simplificada.
+    Realiza peticiones HTTP a Supabase de forma simplificada (versión síncrona).
+    Delega en el cliente compartido de cliente_supabase.py: pool de conexiones,
+    timeouts, reintentos y circuit breaker. El código asíncrono debe usar
+    `await supabase_client.request(...)` directamente.
     
     Args:
         method: Método HTTP (GET, POST, PUT, DELETE, etc.)
         endpoint: Endpoint relativo (ej: 'tfinal', 'chat_history')
-        data: Datos para el body (opcional)
+        data: Datos para el body (opcional; dict o lista para inserciones en lote)
         params: Parámetros de query (opcional)
+        headers: Headers adicionales (opcional, ej: Prefer)
     
     Returns:
-        requests.Response object
-    """
-    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
-    headers = get_supabase_headers()
+        httpx.Response
     
-    return requests.request(
-        method=method,
-        url=url,
-        headers=headers,
-        json=data,
-        params=params
-    )
\ No newline at end of file
+    Raises:
+        SupabaseUnavailable: circuito abierto o Supabase sin respuesta
+    """
+    # Import diferido: cliente_supabase importa la configuración de este módulo
+    from cliente_supabase import supabase_client
+    return supabase_client.request_sync(method, endpoint, data=data, params=params, headers=headers)
+
+
+class LRUTTLCache:
+    """
+    Caché en memoria con tamaño máximo (LRU) y expiración por tiempo (TTL).
+    Segura para hilos; lleva contadores de aciertos para exponer métricas.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Retorna el valor si existe y no expiró; lo marca como usado recientemente"""
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """Guarda un valor, desalojando el menos usado si se supera el tamaño máximo"""
+        with self.lock:
+            self._data[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._data.pop(key, None)
+            return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class ExpiryTracker:
+    """
+    Registro de última actividad con expiración por inactividad.
+    touch() es O(1) para claves conocidas: cada clave tiene una sola entrada en un heap
+    ordenado por vencimiento, que se reprograma al sacarla si hubo actividad posterior.
+    expired() solo recorre las claves realmente vencidas.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._last_seen: Dict[Any, float] = {}
+        self._scheduled: Dict[Any, float] = {}  # clave → vencimiento de su entrada vigente en el heap
+        self._heap: list = []
+        self.lock = Lock()
+
+    def touch(self, key, now: float = None) -> None:
+        """Registra actividad de la clave"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._last_seen[key] = now
+            if key not in self._scheduled:
+                deadline = now + self.timeout
+                self._scheduled[key] = deadline
+                heapq.heappush(self._heap, (deadline, key))
+
+    def remove(self, key) -> None:
+        """Deja de seguir la clave (su entrada en el heap queda obsoleta y se descarta al salir)"""
+        with self.lock:
+            self._last_seen.pop(key, None)
+            self._scheduled.pop(key, None)
+
+    def expired(self, now: float = None) -> list:
+        """Saca y retorna las claves sin actividad durante más de `timeout` segundos"""
+        now = time.time() if now is None else now
+        expired_keys = []
+        with self.lock:
+            while self._heap and self._heap[0][0] < now:
+                deadline, key = heapq.heappop(self._heap)
+                if self._scheduled.get(key) != deadline:
+                    continue  # entrada obsoleta (clave removida o reprogramada)
+                real_deadline = self._last_seen[key] + self.timeout
+                if real_deadline >= now:
+                    # Hubo actividad después de programarla: reprogramar
+                    self._scheduled[key] = real_deadline
+                    heapq.heappush(self._heap, (real_deadline, key))
+                    continue
+                del self._scheduled[key]
+                del self._last_seen[key]
+                expired_keys.append(key)
+        return expired_keys
+
+    def last_seen(self, key) -> Optional[float]:
+        return self._last_seen.get(key)
+
+    def is_expired(self, key, now: float = None) -> bool:
+        last_seen = self._last_seen.get(key)
+        now = time.time() if now is None else now
+        return last_seen is None or now - last_seen > self.timeout
+
+    def items(self):
+        with self.lock:
+            return list(self._last_seen.items())
+
+    def __contains__(self, key) -> bool:
+        return key in self._last_seen
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
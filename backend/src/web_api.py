@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import JSONResponse
-from orquestador import get_orchestrator_for_user, user_orchestrators, last_activity
+from orquestador import get_orchestrator_for_user_async, user_orchestrators, last_activity
 from database_manager import message_db
+from bandeja_salida import send_whatsapp_message
 from models import *
 import time
 import uuid
@@ -17,7 +18,6 @@ class ConversationManager:
         self.conversations = {}
         self.operators = {}
         self.pending_queue = []
-        self.processed_messages = set()  # Para evitar mensajes duplicados
         self._load_conversations_from_db()
     
     def _load_conversations_from_db(self):
@@ -144,7 +144,8 @@ class ConversationManager:
                 conversation_id=conversation_id,
                 content=content,
                 sender_type=sender,
-                whatsapp_message_id=message_id
+                whatsapp_message_id=message_id,
+                status=status
             )
         except Exception as e:
             print(f"❌ Error guardando mensaje en BD: {e}")
@@ -201,13 +202,18 @@ class ConversationManager:
             except Exception as e:
                 print(f"❌ Error marcando mensajes como leídos en BD: {e}")
     
-    def is_message_processed(self, message_id: str) -> bool:
-        """Verifica si un mensaje ya fue procesado"""
-        return message_id in self.processed_messages
-    
-    def mark_message_processed(self, message_id: str):
-        """Marca un mensaje como procesado"""
-        self.processed_messages.add(message_id)
+    def update_message_status(self, conversation_id: str, message_id: str, status: str):
+        """Actualiza el estado de envío de un mensaje (lo llama la outbox al entregarlo o fallar)"""
+        conversation = self.conversations.get(conversation_id)
+        if conversation:
+            for message in reversed(conversation["messages"]):
+                if message.get("id") == message_id:
+                    message["status"] = status
+                    break
+        try:
+            message_db.update_message_status(message_id, status)
+        except Exception as e:
+            print(f"❌ Error actualizando estado del mensaje en BD: {e}")
 
 # Instancia global del manager
 conv_manager = ConversationManager()
@@ -292,7 +298,7 @@ async def send_message(conversation_id: str, request: SendMessageRequest):
             }
             
             # Obtener orquestador para este usuario
-            user_orchestrator = get_orchestrator_for_user(user_phone)
+            user_orchestrator = await get_orchestrator_for_user_async(user_phone)
             response = await user_orchestrator.process_query(request.content, context)
             
             # Agregar mensaje del usuario
@@ -303,17 +309,20 @@ async def send_message(conversation_id: str, request: SendMessageRequest):
             message = conv_manager.add_message(conversation_id, bot_response, "bot")
             
         else:
-            # Respuesta manual del operador
-            message = conv_manager.add_message(conversation_id, request.content, "operator")
+            # Respuesta manual del operador (queda "queued" hasta que la outbox la entregue)
+            message = conv_manager.add_message(conversation_id, request.content, "operator", status="queued")
             
             # Cambiar el modo a manual si no lo estaba
             conv_manager.set_conversation_mode(conversation_id, "manual", request.operator_id)
         
         # Enviar mensaje por WhatsApp cuando es del operador
         if request.sender_mode == MessageSender.OPERATOR:
-            # Importar la función desde main
-            from main import send_whatsapp_message
-            await send_whatsapp_message(conversation["user"]["phone"], {"response": request.content})
+            await send_whatsapp_message(
+                conversation["user"]["phone"], 
+                {"response": request.content},
+                conversation_id=conversation_id,
+                message_id=message["id"]
+            )
         
         return MessageResponse(
             success=True,
@@ -391,14 +400,16 @@ async def approve_pending_response(conversation_id: str, request: ApproveRespons
         message = conv_manager.add_message(
             conversation_id, 
             pending["content"], 
-            "bot"
+            "bot",
+            status="queued"
         )
         
         # Enviar a WhatsApp
-        from main import send_whatsapp_message
         await send_whatsapp_message(
             conversation["user"]["phone"], 
-            {"response": pending["content"]}
+            {"response": pending["content"]},
+            conversation_id=conversation_id,
+            message_id=message["id"]
         )
         
         # Limpiar respuesta pendiente
@@ -447,17 +458,19 @@ async def edit_and_approve_pending_response(conversation_id: str, request: EditA
         message = conv_manager.add_message(
             conversation_id, 
             request.content, 
-            "bot"
+            "bot",
+            status="queued"
         )
         
         # Marcar como editado
         message["edited"] = True
         
         # Enviar a WhatsApp
-        from main import send_whatsapp_message
         await send_whatsapp_message(
             conversation["user"]["phone"], 
-            {"response": request.content}
+            {"response": request.content},
+            conversation_id=conversation_id,
+            message_id=message["id"]
         )
         
         # Limpiar respuesta pendiente
@@ -0,0 +1,139 @@
+"""
+PostgREST falso en memoria para los tests.
+
+Se conecta a SupabaseClient con `transport=stub.transport()` (httpx.MockTransport),
+sirve tanto al cliente asíncrono como al síncrono y permite simular caídas,
+errores 5xx y latencia sin levantar Supabase.
+"""
+import json
+import re
+import time
+from itertools import count
+from typing import Any, Callable, Dict, List
+from urllib.parse import parse_qsl
+
+import httpx
+
+
+class PostgRESTStub:
+    """Tablas en memoria con el subconjunto de PostgREST que usa el backend"""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.rpcs: Dict[str, Callable[[Dict], Any]] = {}
+        self.requests: List[httpx.Request] = []
+        self.latency = 0.0
+        self.down = False
+        self._failures: List[Any] = []
+        self._ids = count(1)
+
+    # ------------------------------------------------------------------
+    # Control desde los tests
+    # ------------------------------------------------------------------
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def fail_next(self, times: int = 1, status: int = 503) -> None:
+        """Las próximas `times` peticiones responden `status` (o ConnectError si status es None)"""
+        self._failures.extend([status] * times)
+
+    def rows(self, table: str) -> List[Dict[str, Any]]:
+        return self.tables.setdefault(table, [])
+
+    # ------------------------------------------------------------------
+    # Servidor
+    # ------------------------------------------------------------------
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.down:
+            raise httpx.ConnectError("Supabase caído", request=request)
+        if self._failures:
+            status = self._failures.pop(0)
+            if status is None:
+                raise httpx.ConnectError("Supabase caído", request=request)
+            return httpx.Response(status, json={"message": "fallo simulado"})
+
+        endpoint = request.url.path.split("/rest/v1/", 1)[-1]
+        params = parse_qsl(request.url.query.decode())
+        body = json.loads(request.content) if request.content else None
+
+        if endpoint.startswith("rpc/"):
+            return httpx.Response(200, json=self.rpcs[endpoint[4:]](body))
+
+        # Algunos callers pasan el filtro dentro del endpoint (tabla?id=eq.1)
+        table = endpoint.split("?", 1)[0]
+        rows = self.rows(table)
+        filters = [(key, value) for key, value in params
+                   if key not in ("select", "order", "limit", "offset", "on_conflict")]
+        selected = [row for row in rows if all(self._matches(row, key, value) for key, value in filters)]
+
+        if request.method == "GET":
+            return self._select(selected, dict(params))
+        if request.method == "POST":
+            records = body if isinstance(body, list) else [body]
+            conflict = dict(params).get("on_conflict")
+            if conflict and "resolution=ignore-duplicates" in request.headers.get("Prefer", ""):
+                existing = {row.get(conflict) for row in rows}
+                records = [record for record in records
+                           if record.get(conflict) is None or record.get(conflict) not in existing]
+            created = [dict(record, id=record.get("id", next(self._ids))) for record in records]
+            rows.extend(created)
+            if "return=representation" in request.headers.get("Prefer", ""):
+                return httpx.Response(201, json=created)
+            return httpx.Response(201)
+        if request.method == "PATCH":
+            for row in selected:
+                row.update(body)
+            return httpx.Response(204)
+        if request.method == "DELETE":
+            self.tables[table] = [row for row in rows if row not in selected]
+            return httpx.Response(204)
+        return httpx.Response(405)
+
+    def _select(self, rows: List[Dict], params: Dict[str, str]) -> httpx.Response:
+        if params.get("select") == "count":
+            return httpx.Response(200, json=[{"count": len(rows)}])
+        if "order" in params:
+            column, _, direction = params["order"].partition(".")
+            rows = sorted(rows, key=lambda row: row.get(column) or "", reverse=direction == "desc")
+        if "limit" in params:
+            rows = rows[:int(params["limit"])]
+        return httpx.Response(200, json=rows)
+
+    @staticmethod
+    def _value(row: Dict, key: str) -> Any:
+        """Soporta columnas simples y rutas JSON de un nivel (metadata->>file_id)"""
+        if "->>" in key:
+            column, field = key.split("->>", 1)
+            value = (row.get(column) or {}).get(field)
+            return None if value is None else str(value)
+        return row.get(key)
+
+    def _matches(self, row: Dict, key: str, condition: str) -> bool:
+        if key == "or":
+            # or=(columna.op.valor,columna.op.valor)
+            return any(self._matches(row, *part.split(".", 1)) for part in condition.strip("()").split(","))
+        operator, _, expected = condition.partition(".")
+        value = self._value(row, key)
+        if operator == "is":
+            return value is {"null": None, "true": True, "false": False}[expected]
+        if operator == "eq":
+            return str(value) == expected
+        if operator == "neq":
+            return str(value) != expected
+        if operator in ("gt", "gte", "lt", "lte"):
+            if value is None:
+                return False
+            actual, target = (value, type(value)(expected)) if isinstance(value, (int, float)) else (str(value), expected)
+            return {"gt": actual > target, "gte": actual >= target,
+                    "lt": actual < target, "lte": actual <= target}[operator]
+        if operator == "ilike":
+            pattern = "^" + re.escape(expected).replace("%", ".*").replace("\\*", ".*") + "$"
+            return value is not None and re.match(pattern, str(value), re.IGNORECASE) is not None
+        if operator == "in":
+            return str(value) in expected.strip("()").split(",")
+        raise ValueError(f"Operador no soportado por el stub: {operator}")
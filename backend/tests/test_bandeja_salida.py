@@ -0,0 +1,260 @@
+import pytest
+import asyncio
+import sys
+import os
+import time
+import sqlite3
+import threading
+import httpx
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import bandeja_salida
+from bandeja_salida import OutboxSender, OutboxStore
+from database_manager import MessageDatabase
+
+
+class FakeGraphClient:
+    """Cliente falso: devuelve las respuestas programadas y registra cada envío"""
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.calls = []
+
+    async def send_text(self, phone_number, body):
+        self.calls.append((phone_number, body, time.monotonic()))
+        response = self.responses.pop(0) if self.responses else None
+        if isinstance(response, Exception):
+            raise response
+        if response is None:
+            response = httpx.Response(200, json={"messages": [{"id": f"wamid.{len(self.calls)}"}]})
+        return response
+
+
+class SlowGraphClient(FakeGraphClient):
+    """Cliente falso cuyo POST tarda `delay` segundos en responder"""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def send_text(self, phone_number, body):
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        return await super().send_text(phone_number, body)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return OutboxStore(str(tmp_path / "messages.db"))
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    """Backoff corto para que los reintentos ocurran dentro del test"""
+    monkeypatch.setattr(bandeja_salida, "OUTBOX_BASE_BACKOFF", 0.01)
+    monkeypatch.setattr(bandeja_salida, "OUTBOX_POLL_INTERVAL", 0.01)
+
+
+class TestOutboxSender:
+    """Tests para el envío en segundo plano de la outbox"""
+
+    @pytest.mark.asyncio
+    async def test_enqueued_message_is_sent_and_status_reported(self, store):
+        """El mensaje encolado se entrega y se notifica el estado 'sent'"""
+        statuses = []
+        sender = OutboxSender(store=store, client=FakeGraphClient(), per_number_interval=0,
+                              on_status=lambda entry, status: statuses.append((entry["message_id"], status)))
+        await sender.start()
+        await sender.enqueue("51987654321", "Hola", conversation_id="whatsapp_51987654321", message_id="msg-1")
+        await sender.flush()
+        await sender.stop()
+
+        assert statuses == [("msg-1", "sent")]
+        assert store.count_by_status() == {"sent": 1}
+        assert sender.get_stats()["sent"] == 1
+
+    @pytest.mark.asyncio
+    async def test_server_errors_are_retried_with_backoff(self, store):
+        """Un 5xx o un error de red se reintenta hasta entregarse"""
+        client = FakeGraphClient([
+            httpx.Response(503, text="unavailable"),
+            httpx.ConnectError("sin conexión"),
+        ])
+        sender = OutboxSender(store=store, client=client, per_number_interval=0)
+        await sender.start()
+        await sender.enqueue("51987654321", "Hola")
+        await sender.flush()
+        await sender.stop()
+
+        stats = sender.get_stats()
+        assert len(client.calls) == 3
+        assert stats["retries"] == 2
+        assert stats["sent"] == 1
+
+    @pytest.mark.asyncio
+    async def test_rate_limit_honours_retry_after(self, store):
+        """Un 429 reprograma el envío según la cabecera Retry-After"""
+        client = FakeGraphClient([httpx.Response(429, headers={"Retry-After": "0.2"}, json={"error": {"code": 131056}})])
+        sender = OutboxSender(store=store, client=client, per_number_interval=0)
+        await sender.start()
+        await sender.enqueue("51987654321", "Hola")
+        await sender.flush()
+        await sender.stop()
+
+        first, second = client.calls[0][2], client.calls[1][2]
+        assert second - first >= 0.2
+        assert sender.get_stats()["rate_limited"] == 1
+        assert store.count_by_status() == {"sent": 1}
+
+    @pytest.mark.asyncio
+    async def test_client_errors_fail_without_retry(self, store):
+        """Un 4xx (distinto de 429) marca el mensaje como fallido de inmediato"""
+        statuses = []
+        client = FakeGraphClient([httpx.Response(400, json={"error": {"message": "Invalid parameter"}})])
+        sender = OutboxSender(store=store, client=client, per_number_interval=0,
+                              on_status=lambda entry, status: statuses.append(status))
+        await sender.start()
+        await sender.enqueue("000", "Hola", message_id="msg-1")
+        await sender.flush()
+        await sender.stop()
+
+        assert len(client.calls) == 1
+        assert statuses == ["failed"]
+        assert store.count_by_status() == {"failed": 1}
+
+    @pytest.mark.asyncio
+    async def test_terminal_writes_run_off_the_event_loop(self, store, monkeypatch):
+        """mark_sent, reschedule, mark_failed y on_status (SQLite) no corren en el hilo del loop"""
+        threads = {}
+        for name in ("mark_sent", "reschedule", "mark_failed"):
+            original = getattr(store, name)
+
+            def spy(*args, _name=name, _original=original):
+                threads.setdefault(_name, threading.current_thread())
+                return _original(*args)
+            monkeypatch.setattr(store, name, spy)
+
+        client = FakeGraphClient([httpx.Response(503, text="unavailable"),
+                                  httpx.Response(400, json={"error": {"message": "Invalid parameter"}})])
+        sender = OutboxSender(store=store, client=client, per_number_interval=0,
+                              on_status=lambda entry, status: threads.setdefault(status, threading.current_thread()))
+        await sender.start()
+        await sender.enqueue("000", "Hola")
+        await sender.enqueue("51987654321", "Hola")
+        await sender.flush()
+        await sender.stop()
+
+        assert set(threads) == {"mark_sent", "reschedule", "mark_failed", "sent", "failed"}
+        assert threading.current_thread() not in threads.values()
+
+    @pytest.mark.asyncio
+    async def test_messages_to_one_number_keep_order_and_spacing(self, store):
+        """Los mensajes a un número salen en orden y separados; otros números no esperan"""
+        client = FakeGraphClient()
+        sender = OutboxSender(store=store, client=client, per_number_interval=0.1)
+        await sender.start()
+        await sender.enqueue("51911111111", "primero")
+        await sender.enqueue("51911111111", "segundo")
+        await sender.enqueue("51922222222", "otro usuario")
+        await sender.flush()
+        await sender.stop()
+
+        same_number = [call for call in client.calls if call[0] == "51911111111"]
+        other = [call for call in client.calls if call[0] == "51922222222"]
+        assert [call[1] for call in same_number] == ["primero", "segundo"]
+        assert same_number[1][2] - same_number[0][2] >= 0.1
+        assert other[0][2] < same_number[1][2]
+
+    @pytest.mark.asyncio
+    async def test_backlog_of_one_number_does_not_block_others(self, store):
+        """Un número con cientos de mensajes retenidos no oculta los de otros números"""
+        for i in range(300):
+            store.add("51911111111", f"retenido {i}")
+        with sqlite3.connect(store.db_path) as conn:
+            conn.execute("UPDATE outbox SET next_attempt_at = ?", (time.time() + 3600,))
+        store.add("51922222222", "otro usuario")
+
+        client = FakeGraphClient()
+        sender = OutboxSender(store=store, client=client, per_number_interval=0)
+        await sender.start()
+        for _ in range(100):
+            if client.calls:
+                break
+            await asyncio.sleep(0.01)
+        await sender.stop()
+
+        assert [call[0] for call in client.calls] == ["51922222222"]
+        assert [entry["body"] for entry in store.due_heads(time.time())] == []
+
+    @pytest.mark.asyncio
+    async def test_pending_entries_survive_restart(self, store):
+        """Lo encolado sin sender activo se entrega al arrancar otro sender"""
+        await OutboxSender(store=store, client=FakeGraphClient()).enqueue("51987654321", "Hola")
+
+        client = FakeGraphClient()
+        sender = OutboxSender(store=OutboxStore(store.db_path), client=client, per_number_interval=0)
+        await sender.start()
+        await sender.flush()
+        await sender.stop()
+
+        assert [call[1] for call in client.calls] == ["Hola"]
+
+    @pytest.mark.asyncio
+    async def test_stop_waits_for_in_flight_sends(self, store):
+        """stop() deja terminar el POST en curso en vez de cortarlo y reenviarlo luego"""
+        client = SlowGraphClient(delay=0.1)
+        sender = OutboxSender(store=store, client=client, per_number_interval=0)
+        await sender.start()
+        await sender.enqueue("51987654321", "Hola")
+        await client.started.wait()
+        await sender.stop(drain_timeout=5)
+
+        assert store.count_by_status() == {"sent": 1}
+
+        restarted = FakeGraphClient()
+        sender = OutboxSender(store=OutboxStore(store.db_path), client=restarted, per_number_interval=0)
+        await sender.start()
+        await sender.flush()
+        await sender.stop()
+        assert restarted.calls == []
+
+    @pytest.mark.asyncio
+    async def test_interrupted_send_is_not_resent(self, store):
+        """Un envío cortado a mitad del POST se marca failed al arrancar, sin duplicarlo"""
+        client = SlowGraphClient(delay=10)
+        sender = OutboxSender(store=store, client=client, per_number_interval=0)
+        await sender.start()
+        await sender.enqueue("51987654321", "Hola", message_id="msg-1")
+        await client.started.wait()
+        await sender.stop(drain_timeout=0.05)
+
+        assert store.count_by_status() == {"sending": 1}
+
+        statuses = []
+        restarted = FakeGraphClient()
+        sender = OutboxSender(store=OutboxStore(store.db_path), client=restarted, per_number_interval=0,
+                              on_status=lambda entry, status: statuses.append((entry["message_id"], status)))
+        await sender.start()
+        await sender.flush()
+        await sender.stop()
+
+        assert restarted.calls == []
+        assert statuses == [("msg-1", "failed")]
+        assert store.count_by_status() == {"failed": 1}
+
+
+class TestMessageStatus:
+    """Tests para el estado de envío en MessageDatabase"""
+
+    def test_update_message_status(self, tmp_path):
+        """El estado del mensaje pasa de 'queued' a 'sent'"""
+        db = MessageDatabase(str(tmp_path / "messages.db"))
+        conversation_id = db.save_conversation("whatsapp_51987654321", "51987654321", "Test User")
+        db.save_message(conversation_id, "Hola", "bot", whatsapp_message_id="msg-1", status="queued")
+
+        db.update_message_status("msg-1", "sent")
+
+        assert [m["status"] for m in db.get_messages(conversation_id)] == ["sent"]
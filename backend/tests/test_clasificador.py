@@ -0,0 +1,184 @@
+import pytest
+import sys
+import os
+from unittest.mock import AsyncMock, MagicMock
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from clasificador import (
+    LABORAL, NO_LABORAL, ClassificationCache, ClassificationLog, ClassificationResult,
+    LaboralClassifier, NgramClassifier, RuleClassifier, evaluate, load_labelled_samples
+)
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'clasificacion_laboral.json')
+
+
+def make_llm(answer: str):
+    """LLM falso que responde siempre la misma etiqueta"""
+    llm = MagicMock()
+    response = MagicMock()
+    response.content = answer
+    llm.ainvoke = AsyncMock(return_value=response)
+    return llm
+
+
+class TestRuleClassifier:
+    """Tests para las reglas por palabras clave"""
+
+    @pytest.mark.parametrize("query", ["hola", "Buenos días!", "gracias", "ok, gracias"])
+    def test_greetings_are_laboral(self, query):
+        result = RuleClassifier().classify(query)
+        assert result.label == LABORAL
+        assert result.confidence > 0.9
+
+    def test_work_topics_are_laboral(self):
+        result = RuleClassifier().classify("¿Cuántos días de vacaciones me corresponden?")
+        assert result.label == LABORAL
+        assert result.confidence >= 0.9
+
+    def test_unrelated_topics_are_not_laboral(self):
+        result = RuleClassifier().classify("cuéntame un chiste de fútbol")
+        assert result.label == NO_LABORAL
+
+    def test_mixed_topics_are_ambiguous(self):
+        result = RuleClassifier().classify("¿la empresa paga el hotel en un viaje?")
+        assert result.label == LABORAL
+        assert result.confidence < 0.8
+
+    @pytest.mark.parametrize("query", ["busco empleo en otra empresa", "¿qué tal pagan en otras empresas?",
+                                       "¿conoces ofertas de empleo en Google?"])
+    def test_other_jobs_or_companies_are_not_laboral(self, query):
+        result = RuleClassifier().classify(query)
+        assert result.label == NO_LABORAL
+        assert result.confidence >= 0.8
+
+    @pytest.mark.parametrize("query", ["¿cuánto gana un empleado de Amazon?", "¿qué empresa de celulares es mejor?"])
+    def test_company_or_job_alone_defers_to_llm(self, query):
+        """'empresa'/'empleo' sin más contexto pueden ser la propia u otra: decide el LLM"""
+        assert RuleClassifier().classify(query).confidence < 0.8
+
+    def test_greeting_with_off_topic_request_is_not_laboral(self):
+        result = RuleClassifier().classify("hola, cuéntame un chiste")
+        assert result.label == NO_LABORAL
+
+
+class TestLaboralClassifier:
+    """Tests para el clasificador escalonado"""
+
+    @pytest.mark.asyncio
+    async def test_confident_queries_skip_the_llm(self):
+        classifier = LaboralClassifier(model_path=None)
+        llm = make_llm("NO_LABORAL")
+
+        result = await classifier.classify("quiero pedir permiso para el lunes", llm=llm)
+
+        assert result.label == LABORAL
+        assert result.source == "rules"
+        llm.ainvoke.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_ambiguous_queries_fall_back_to_llm_and_are_logged(self, tmp_path):
+        log = ClassificationLog(str(tmp_path / "messages.db"))
+        classifier = LaboralClassifier(model_path=None, log=log)
+        llm = make_llm("NO_LABORAL")
+
+        result = await classifier.classify("¿qué opinas de los gatos?", llm=llm)
+
+        assert result.label == NO_LABORAL
+        assert result.source == "llm"
+        llm.ainvoke.assert_awaited_once()
+        assert log.samples() == [("¿qué opinas de los gatos?", NO_LABORAL)]
+        assert classifier.get_stats()["llm"] == 1
+
+    @pytest.mark.asyncio
+    async def test_llm_errors_default_to_laboral(self):
+        classifier = LaboralClassifier(model_path=None)
+        llm = MagicMock()
+        llm.ainvoke = AsyncMock(side_effect=Exception("API Error"))
+
+        result = await classifier.classify("¿qué opinas de los gatos?", llm=llm)
+
+        assert result.label == LABORAL
+        assert classifier.get_stats()["llm_errors"] == 1
+
+    @pytest.mark.asyncio
+    async def test_trained_model_resolves_queries_rules_cannot(self, tmp_path):
+        samples = [("¿qué opinas de los gatos?", NO_LABORAL), ("mi perro está enfermo", NO_LABORAL),
+                   ("¿los gatos son buenas mascotas?", NO_LABORAL), ("¿cómo cuido a mi gato?", NO_LABORAL),
+                   ("¿a qué hora entro mañana?", LABORAL), ("¿mañana entro temprano?", LABORAL),
+                   ("¿a qué hora es la salida?", LABORAL), ("¿me toca entrar temprano?", LABORAL)]
+        model_path = str(tmp_path / "model.json")
+        NgramClassifier().fit(samples, epochs=30).save(model_path)
+        classifier = LaboralClassifier(model_path=model_path, threshold=0.7)
+        llm = make_llm("LABORAL")
+
+        result = await classifier.classify("opinas de los gatos", llm=llm)
+
+        assert result.source == "model"
+        assert result.label == NO_LABORAL
+        llm.ainvoke.assert_not_called()
+
+
+class TestClassificationLog:
+    """Tests para el registro de clasificaciones"""
+
+    def test_database_is_created_on_first_use(self, tmp_path):
+        db_path = tmp_path / "memory_data" / "classifier.db"
+        log = ClassificationLog(str(db_path))
+        assert not db_path.exists()
+
+        log.record("¿qué opinas de los gatos?", NO_LABORAL, "llm")
+        assert db_path.exists()
+        assert log.samples() == [("¿qué opinas de los gatos?", NO_LABORAL)]
+
+
+class TestClassifierAccuracy:
+    """Exactitud y latencia del nivel local sobre el conjunto etiquetado"""
+
+    def test_labelled_fixture_report(self):
+        report = evaluate(LaboralClassifier(model_path=None), load_labelled_samples(FIXTURE_PATH))
+        print(f"\n📊 Clasificador local: {report}")
+
+        assert report["samples"] >= 50
+        assert report["coverage"] >= 0.9
+        assert report["covered_accuracy"] >= 0.95
+        assert report["p95_us"] < 1000
+
+
+class TestClassificationCache:
+    """Tests para la caché de clasificaciones"""
+
+    @pytest.mark.asyncio
+    async def test_repeated_ambiguous_query_calls_llm_once(self):
+        classifier = LaboralClassifier(model_path=None, cache=ClassificationCache())
+        llm = make_llm("NO_LABORAL")
+
+        first = await classifier.classify("¿Qué opinas de los gatos?", llm=llm)
+        second = await classifier.classify("  ¿qué opinas de los GATOS? ", llm=llm)
+
+        assert first.label == second.label == NO_LABORAL
+        llm.ainvoke.assert_awaited_once()
+        stats = classifier.get_stats()
+        assert stats["cache"] == 1
+        assert stats["cache_stats"]["hit_rate"] == 0.5
+
+    def test_persistent_tier_is_shared_between_instances(self, tmp_path):
+        db_path = str(tmp_path / "messages.db")
+        ClassificationCache(db_path=db_path).set("¿qué opinas de los gatos?", ClassificationResult(NO_LABORAL, 1.0, "llm"))
+
+        other_worker = ClassificationCache(db_path=db_path)
+        result = other_worker.get("¿Qué opinas de los gatos?")
+
+        assert result.label == NO_LABORAL
+        assert other_worker.get_stats()["persistent_hits"] == 1
+        # La segunda consulta ya se resuelve en memoria
+        other_worker.get("¿qué opinas de los gatos?")
+        assert other_worker.get_stats()["memory_hits"] == 1
+
+    def test_expired_entries_are_ignored(self, tmp_path):
+        cache = ClassificationCache(ttl=-1, db_path=str(tmp_path / "messages.db"))
+        cache.set("hola gatos", ClassificationResult(NO_LABORAL, 1.0, "llm"))
+
+        assert cache.get("hola gatos") is None
+        assert cache.get_stats()["misses"] == 1
@@ -0,0 +1,250 @@
+import pytest
+import asyncio
+import sys
+import os
+import time
+from unittest.mock import patch
+
+import httpx
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from cliente_supabase import SupabaseClient, CircuitBreaker, SupabaseUnavailable
+from memoria import EpisodicMemory, LocalMemoryPersistence
+from postgrest_stub import PostgRESTStub
+
+
+@pytest.fixture
+def stub():
+    return PostgRESTStub()
+
+
+@pytest.fixture
+def client(stub):
+    return SupabaseClient(base_url="http://supabase.test", key="test-key", transport=stub.transport(),
+                          retry_backoff=0, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+
+
+class TestSupabaseClient:
+    """Tests para el cliente PostgREST compartido"""
+
+    @pytest.mark.asyncio
+    async def test_insert_and_select(self, client, stub):
+        response = await client.request("POST", "chat_history", data=[
+            {"session_id": "session_a", "message_type": "human"},
+            {"session_id": "session_b", "message_type": "human"},
+        ])
+        assert response.status_code == 201
+
+        response = await client.request("GET", "chat_history", params={"session_id": "eq.session_a"})
+        assert [row["session_id"] for row in response.json()] == ["session_a"]
+        assert stub.requests[0].headers["apikey"] == "test-key"
+        await client.close()
+
+    @pytest.mark.asyncio
+    async def test_reuses_one_async_client(self, client):
+        await client.request("GET", "chat_history")
+        first = client._async_client
+        await client.request("GET", "chat_history")
+        assert client._async_client is first
+        await client.close()
+        assert client._async_client is None
+
+    @pytest.mark.asyncio
+    async def test_retries_transient_errors(self, client, stub):
+        stub.fail_next(2, status=503)
+        response = await client.request("GET", "chat_history")
+        assert response.status_code == 200
+        assert client.get_stats()["retries"] == 2
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_post_is_not_retried_after_reaching_server(self, client, stub):
+        stub.fail_next(1, status=503)
+        response = await client.request("POST", "chat_history", data={"session_id": "session_a"})
+        assert response.status_code == 503
+        assert stub.rows("chat_history") == []
+        assert client.get_stats()["retries"] == 0
+
+    @pytest.mark.asyncio
+    async def test_post_is_retried_when_connection_fails(self, client, stub):
+        stub.fail_next(1, status=None)
+        response = await client.request("POST", "chat_history", data={"session_id": "session_a"})
+        assert response.status_code == 201
+        assert len(stub.rows("chat_history")) == 1
+
+    @pytest.mark.asyncio
+    async def test_idempotent_rpc_is_retried(self, client, stub):
+        stub.rpcs["match_tfinal"] = lambda params: [{"content": "art. 1", "similarity": 0.9}]
+        stub.fail_next(1, status=502)
+        response = await client.request("POST", "rpc/match_tfinal", data={}, idempotent=True)
+        assert response.json()[0]["content"] == "art. 1"
+
+    @pytest.mark.asyncio
+    async def test_unreachable_raises_supabase_unavailable(self, client, stub):
+        stub.down = True
+        with pytest.raises(SupabaseUnavailable):
+            await client.request("GET", "chat_history")
+        assert len(stub.requests) == 1 + client.max_retries
+
+    @pytest.mark.asyncio
+    async def test_timeout_is_a_failure(self, client, stub):
+        def slow(request):
+            raise httpx.ReadTimeout("timeout", request=request)
+        client.transport = httpx.MockTransport(slow)
+        with pytest.raises(SupabaseUnavailable):
+            await client.request("GET", "chat_history")
+        assert client.get_stats()["errors"] == 1
+
+    def test_sync_shim(self, client, stub):
+        client.request_sync("POST", "semantic_memory", data={"session_id": "session_a", "concept": "x"})
+        response = client.request_sync("GET", "semantic_memory", params={"concept": "ilike.%X%"})
+        assert len(response.json()) == 1
+
+    def test_make_supabase_request_uses_shared_client(self, client, stub):
+        from utilidades import make_supabase_request
+        with patch("cliente_supabase.supabase_client", client):
+            response = make_supabase_request("GET", "chat_history", params={"limit": "1"})
+        assert response.status_code == 200
+        assert len(stub.requests) == 1
+
+
+class TestCircuitBreaker:
+    """Tests para el circuit breaker de Supabase"""
+
+    @pytest.mark.asyncio
+    async def test_opens_after_consecutive_failures(self, client, stub):
+        stub.down = True
+        for _ in range(3):
+            with pytest.raises(SupabaseUnavailable):
+                await client.request("GET", "chat_history")
+        sent = len(stub.requests)
+
+        with pytest.raises(SupabaseUnavailable):
+            await client.request("GET", "chat_history")
+        assert len(stub.requests) == sent  # ni siquiera sale a la red
+        stats = client.get_stats()
+        assert stats["circuit_state"] == CircuitBreaker.OPEN
+        assert stats["short_circuited"] == 1
+
+    def test_client_errors_do_not_open_circuit(self, client, stub):
+        stub.fail_next(5, status=400)
+        for _ in range(5):
+            assert client.request_sync("GET", "chat_history").status_code == 400
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe_closes_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        assert not breaker.allow()
+
+        time.sleep(0.06)
+        assert breaker.allow()          # llamada de prueba
+        assert not breaker.allow()      # solo una a la vez
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+
+    def test_failed_probe_reopens_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+    @pytest.mark.asyncio
+    async def test_cancelled_probe_releases_half_open_circuit(self):
+        """Si se cancela la llamada de prueba, el circuito no queda semiabierto para siempre"""
+        async def slow(request):
+            await asyncio.sleep(10)
+            return httpx.Response(200, json=[])
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        client = SupabaseClient(base_url="http://supabase.test", transport=httpx.MockTransport(slow),
+                                retry_backoff=0, breaker=breaker)
+        breaker.record_failure()
+        time.sleep(0.06)
+
+        probe = asyncio.create_task(client.request("GET", "chat_history"))
+        await asyncio.sleep(0.05)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow()          # la siguiente llamada puede hacer de prueba
+
+    def test_unexpected_error_in_probe_reopens_circuit(self):
+        def broken(request):
+            raise RuntimeError("fallo inesperado")
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        client = SupabaseClient(base_url="http://supabase.test", transport=httpx.MockTransport(broken),
+                                retry_backoff=0, breaker=breaker)
+        breaker.record_failure()
+        time.sleep(0.06)
+
+        with pytest.raises(RuntimeError):
+            client.request_sync("GET", "chat_history")
+        assert breaker.state == CircuitBreaker.OPEN
+        assert client.get_stats()["errors"] == 1
+
+    def test_memory_falls_back_to_local_sqlite(self, client, stub, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        persistence.save_episodic_message("session_a", "human", "hola desde SQLite")
+        client.breaker.record_failure()
+        client.breaker.record_failure()
+        client.breaker.record_failure()
+
+        with patch("cliente_supabase.supabase_client", client):
+            messages = EpisodicMemory("session_a", local_persistence=persistence).messages
+        assert [m.content for m in messages] == ["hola desde SQLite"]
+        assert stub.requests == []
+
+
+class TestSupabaseClientBenchmark:
+    """Benchmark: coste por llamada con Supabase degradado, sin circuito vs con circuito"""
+
+    CALLS = 40
+    FAILURE_LATENCY = 0.02
+
+    def test_breaker_caps_degraded_latency(self, stub):
+        stub.latency = self.FAILURE_LATENCY
+        stub.down = True
+
+        def run(client):
+            start = time.perf_counter()
+            for _ in range(self.CALLS):
+                with pytest.raises(SupabaseUnavailable):
+                    client.request_sync("GET", "chat_history")
+            return (time.perf_counter() - start) * 1000 / self.CALLS
+
+        without_breaker = SupabaseClient(base_url="http://supabase.test", transport=stub.transport(), max_retries=0,
+                                         breaker=CircuitBreaker(failure_threshold=10 ** 9))
+        with_breaker = SupabaseClient(base_url="http://supabase.test", transport=stub.transport(), max_retries=0,
+                                      breaker=CircuitBreaker(failure_threshold=5, reset_timeout=60))
+        degraded_ms = run(without_breaker)
+        breaker_ms = run(with_breaker)
+
+        print(f"\n⚡ Latencia por llamada con Supabase caído: {degraded_ms:.2f}ms → {breaker_ms:.2f}ms")
+        assert breaker_ms < degraded_ms / 4
+
+    @pytest.mark.asyncio
+    async def test_async_requests_do_not_block_event_loop(self, stub):
+        async def slow(request):
+            await asyncio.sleep(0.05)
+            return stub.handle(request)
+
+        client = SupabaseClient(base_url="http://supabase.test", transport=httpx.MockTransport(slow))
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[client.request("GET", "chat_history") for _ in range(20)])
+        elapsed = time.perf_counter() - start
+        await client.close()
+
+        print(f"\n🔀 20 peticiones concurrentes de 50ms: {elapsed * 1000:.0f}ms")
+        assert all(response.status_code == 200 for response in responses)
+        assert elapsed < 0.5
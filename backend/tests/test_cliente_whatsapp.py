@@ -0,0 +1,75 @@
+import pytest
+import json
+import sys
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from cliente_whatsapp import WhatsAppClient
+
+
+class GraphAPIHandler(BaseHTTPRequestHandler):
+    """Servidor falso de la Graph API con keep-alive (HTTP/1.1)"""
+    protocol_version = "HTTP/1.1"
+    received = []
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        GraphAPIHandler.received.append(json.loads(self.rfile.read(length)))
+        body = json.dumps({"messages": [{"id": f"wamid.{len(GraphAPIHandler.received)}"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def graph_api_url():
+    """Levanta el servidor falso en un puerto libre"""
+    GraphAPIHandler.received = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphAPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+class TestWhatsAppClient:
+    """Tests para el cliente HTTP compartido de WhatsApp"""
+
+    @pytest.mark.asyncio
+    async def test_sequential_sends_reuse_one_connection(self, graph_api_url):
+        """Los envíos consecutivos reutilizan la misma conexión keep-alive"""
+        client = WhatsAppClient(base_url=graph_api_url)
+        await client.start()
+        for n in range(5):
+            response = await client.send_text("51987654321", f"Mensaje {n}")
+            assert response.status_code == 200
+        stats = client.get_stats()
+        await client.close()
+
+        assert stats["requests"] == 5
+        assert stats["connections_opened"] == 1
+        assert stats["connections_reused"] == 4
+        assert stats["errors"] == 0
+        assert GraphAPIHandler.received[0]["text"]["body"] == "Mensaje 0"
+
+    @pytest.mark.asyncio
+    async def test_send_starts_client_on_demand(self, graph_api_url):
+        """Fuera del lifespan el cliente se crea en el primer envío"""
+        client = WhatsAppClient(base_url=graph_api_url)
+        assert client.is_started is False
+
+        await client.send_text("51987654321", "Hola")
+
+        assert client.is_started is True
+        await client.close()
+        assert client.is_started is False
@@ -0,0 +1,257 @@
+import pytest
+import asyncio
+import sqlite3
+import sys
+import threading
+import os
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from cola_mensajes import IngestionQueue, MemoryQueueBackend, SQLiteQueueBackend
+
+
+def make_item(message_id, phone_number="51987654321", text="Hola"):
+    """Crea un mensaje de prueba con el formato que encola el webhook"""
+    return {
+        "message_id": message_id,
+        "phone_number": phone_number,
+        "text": text,
+        "nombre": "Test User"
+    }
+
+
+class TestQueueBackends:
+    """Tests para los backends de persistencia de la cola"""
+
+    def test_memory_backend_deduplicates_by_message_id(self):
+        """Un mismo message_id solo se encola una vez"""
+        backend = MemoryQueueBackend()
+
+        assert backend.push(make_item("wamid.1")) is not None
+        assert backend.push(make_item("wamid.1")) is None
+        assert len(backend.pending()) == 1
+
+    def test_sqlite_backend_survives_restart(self, tmp_path):
+        """Los mensajes pendientes se recuperan al recrear el backend"""
+        db_path = str(tmp_path / "messages.db")
+        backend = SQLiteQueueBackend(db_path)
+        first_id = backend.push(make_item("wamid.1"))
+        backend.push(make_item("wamid.2"))
+        backend.ack(first_id)
+
+        restarted = SQLiteQueueBackend(db_path)
+        pending = restarted.pending()
+
+        assert [item["message_id"] for _, item in pending] == ["wamid.2"]
+        assert restarted.push(make_item("wamid.1")) is None
+
+    def test_memory_backend_dedupe_window_is_bounded(self):
+        """Los message_id vistos no crecen sin límite"""
+        backend = MemoryQueueBackend(dedupe_size=100)
+        for i in range(1000):
+            backend.ack(backend.push(make_item(f"wamid.{i}")))
+
+        assert len(backend._seen_ids) == 100
+        assert backend.push(make_item("wamid.999")) is None
+
+    def test_sqlite_backend_prunes_old_done_rows(self, tmp_path):
+        """Los procesados fuera de la ventana se borran; los pendientes y recientes se conservan"""
+        db_path = str(tmp_path / "messages.db")
+        backend = SQLiteQueueBackend(db_path, retention=3600)
+        old_id = backend.push(make_item("wamid.old"))
+        recent_id = backend.push(make_item("wamid.recent"))
+        backend.push(make_item("wamid.pending"))
+        backend.ack(old_id)
+        backend.ack(recent_id)
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("UPDATE ingestion_queue SET processed_at = datetime('now', '-2 hours') WHERE id = ?",
+                         (old_id,))
+
+        assert backend.prune() == 1
+        with sqlite3.connect(db_path) as conn:
+            remaining = [row[0] for row in conn.execute("SELECT message_id FROM ingestion_queue ORDER BY id")]
+        assert remaining == ["wamid.recent", "wamid.pending"]
+        assert backend.push(make_item("wamid.recent")) is None
+
+
+class TestIngestionQueue:
+    """Tests para la cola de ingesta con workers"""
+
+    @pytest.mark.asyncio
+    async def test_enqueue_returns_before_processing(self):
+        """Encolar no espera al handler; los workers procesan en segundo plano"""
+        processed = []
+        release = asyncio.Event()
+
+        async def slow_handler(item):
+            await release.wait()
+            processed.append(item["message_id"])
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=2)
+        await queue.start(slow_handler)
+
+        assert queue.enqueue(make_item("wamid.1")) is True
+        assert processed == []
+
+        release.set()
+        await queue.join()
+        await queue.stop()
+
+        assert processed == ["wamid.1"]
+        assert queue.get_stats()["processed"] == 1
+
+    @pytest.mark.asyncio
+    async def test_sqlite_commits_run_off_the_event_loop(self, tmp_path):
+        """push y ack (commit en SQLite) no corren en el hilo del event loop"""
+        threads = []
+
+        class SpyBackend(SQLiteQueueBackend):
+            def push(self, item):
+                threads.append(("push", threading.current_thread()))
+                return super().push(item)
+
+            def ack(self, item_id):
+                threads.append(("ack", threading.current_thread()))
+                super().ack(item_id)
+
+        async def handler(item):
+            pass
+
+        queue = IngestionQueue(backend=SpyBackend(str(tmp_path / "queue.db")), workers=1)
+        await queue.start(handler)
+        assert await queue.enqueue_async(make_item("wamid.1")) is True
+        assert await queue.enqueue_async(make_item("wamid.1")) is False
+        await queue.join()
+        await queue.stop()
+
+        assert [name for name, _ in threads] == ["push", "push", "ack"]
+        assert threading.current_thread() not in [thread for _, thread in threads]
+        assert queue.get_stats()["duplicates"] == 1
+
+    @pytest.mark.asyncio
+    async def test_pending_items_are_recovered_on_start(self):
+        """Lo encolado antes de arrancar los workers se procesa al iniciar"""
+        processed = []
+
+        async def handler(item):
+            processed.append(item["message_id"])
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=1)
+        queue.enqueue(make_item("wamid.1"))
+        queue.enqueue(make_item("wamid.2"))
+
+        await queue.start(handler)
+        await queue.join()
+        await queue.stop()
+
+        assert processed == ["wamid.1", "wamid.2"]
+        assert queue.get_stats()["recovered"] == 2
+
+    @pytest.mark.asyncio
+    async def test_handler_errors_do_not_stop_workers(self):
+        """Un error en un mensaje no detiene el procesamiento de los siguientes"""
+        processed = []
+
+        async def handler(item):
+            if item["message_id"] == "wamid.bad":
+                raise ValueError("fallo de prueba")
+            processed.append(item["message_id"])
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=1)
+        await queue.start(handler)
+        queue.enqueue(make_item("wamid.bad"))
+        queue.enqueue(make_item("wamid.ok"))
+        await queue.join()
+        await queue.stop()
+
+        stats = queue.get_stats()
+        assert processed == ["wamid.ok"]
+        assert stats["failed"] == 1
+        assert stats["processed"] == 1
+        assert stats["depth"] == 0
+
+
+class TestPhoneSharding:
+    """Tests para el scheduler con shards por número de teléfono"""
+
+    @pytest.mark.asyncio
+    async def test_same_phone_messages_are_processed_in_order(self):
+        """Los mensajes de un mismo usuario nunca se procesan en paralelo"""
+        active = {"51911111111": 0}
+        max_active = {"51911111111": 0}
+        processed = []
+
+        async def handler(item):
+            phone = item["phone_number"]
+            active[phone] += 1
+            max_active[phone] = max(max_active[phone], active[phone])
+            await asyncio.sleep(0.01)
+            processed.append(item["message_id"])
+            active[phone] -= 1
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=8)
+        await queue.start(handler)
+        for n in range(5):
+            queue.enqueue(make_item(f"wamid.{n}", phone_number="51911111111"))
+        await queue.join()
+        await queue.stop()
+
+        assert processed == [f"wamid.{n}" for n in range(5)]
+        assert max_active["51911111111"] == 1
+
+    @pytest.mark.asyncio
+    async def test_different_phones_run_in_parallel_up_to_cap(self):
+        """Usuarios distintos se atienden en paralelo sin superar el límite global"""
+        current = 0
+        peak = 0
+
+        async def handler(item):
+            nonlocal current, peak
+            current += 1
+            peak = max(peak, current)
+            await asyncio.sleep(0.05)
+            current -= 1
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=3)
+        await queue.start(handler)
+        start = asyncio.get_running_loop().time()
+        for n in range(6):
+            queue.enqueue(make_item(f"wamid.{n}", phone_number=f"5190000000{n}"))
+        await queue.join()
+        elapsed = asyncio.get_running_loop().time() - start
+        await queue.stop()
+
+        assert peak == 3
+        # 6 mensajes de 50ms con 3 en paralelo ≈ 2 rondas, no 6
+        assert elapsed < 0.25
+
+    @pytest.mark.asyncio
+    async def test_stats_report_depth_and_wait_per_shard(self):
+        """Las estadísticas incluyen profundidad y tiempos de espera por shard"""
+        release = asyncio.Event()
+
+        async def handler(item):
+            await release.wait()
+
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=2)
+        await queue.start(handler)
+        queue.enqueue(make_item("wamid.1", phone_number="51922222222"))
+        queue.enqueue(make_item("wamid.2", phone_number="51922222222"))
+        await asyncio.sleep(0)
+
+        stats = queue.get_stats()
+        shard = stats["shards"]["51922222222"]
+        assert shard["running"] is True
+        assert shard["depth"] == 1
+        assert stats["in_flight"] == 1
+
+        release.set()
+        await queue.join()
+        stats = queue.get_stats()
+        await queue.stop()
+
+        shard = stats["shards"]["51922222222"]
+        assert shard["processed"] == 2
+        assert shard["depth"] == 0
+        assert shard["max_wait_ms"] >= shard["avg_wait_ms"] >= 0
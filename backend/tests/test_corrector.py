@@ -0,0 +1,48 @@
+import pytest
+import sys
+import os
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from corrector import SpanishSpellChecker, edit_distance, normalize_text
+
+
+@pytest.fixture(scope="module")
+def checker():
+    return SpanishSpellChecker()
+
+
+class TestSpanishSpellChecker:
+    """Tests para el corrector ortográfico local"""
+
+    def test_fixes_common_typos_and_accents(self, checker):
+        """Errores frecuentes y tildes se corrigen sin LLM, respetando mayúsculas"""
+        text, changes = checker.correct_locally("Kiero informacion de la capacitacion")
+
+        assert text == "Quiero información de la capacitación"
+        assert changes == 3
+
+    def test_ambiguous_words_are_not_touched(self, checker):
+        """Palabras válidas con y sin tilde (que/qué, si/sí) no se modifican"""
+        text, changes = checker.correct_locally("si me dices que curso es")
+
+        assert text == "si me dices que curso es"
+        assert changes == 0
+
+    @pytest.mark.parametrize("query", ["una ola de calor", "q tal", "k", "ya estoy inscripto"])
+    def test_valid_words_are_not_rewritten(self, checker, query):
+        """Palabras válidas o que el LLM entiende (ola, q, inscripto) no se corrigen en mensajes cortos"""
+        assert checker.correct_locally(query) == (query, 0)
+
+    def test_suspected_typos_use_edit_distance(self, checker):
+        """Solo se marcan palabras desconocidas parecidas a una conocida"""
+        assert checker.suspected_typos("necesito mi boleta de la empresa Contoso") == []
+        assert checker.suspected_typos("necesito mi bolete de la emprsa") == ["bolete", "emprsa"]
+
+    def test_edit_distance_cutoff(self):
+        assert edit_distance("trabajo", "trabaja") == 1
+        assert edit_distance("curso", "vacaciones", max_distance=2) == 3
+
+    def test_normalize_text(self):
+        assert normalize_text("  Hola   MUNDO ") == "hola mundo"
@@ -0,0 +1,675 @@
+import pytest
+import asyncio
+import json
+import sys
+import os
+import time
+import threading
+from unittest.mock import MagicMock, patch
+
+import httpx
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from indexador import DocumentIndexer, ChunkEmbedder, EmbeddingCache, cleanup_index
+from cliente_supabase import SupabaseClient, CircuitBreaker
+from postgrest_stub import PostgRESTStub
+
+
+class FakeEmbeddings:
+    """OpenAIEmbeddings falso: una petición por llamada, con latencia y límite de concurrencia observables"""
+
+    def __init__(self, latency: float = 0.0, model: str = "fake-embedding"):
+        self.latency = latency
+        self.model = model
+        self.calls = []
+        self.in_flight = 0
+        self.peak = 0
+
+    async def aembed_documents(self, texts):
+        self.calls.append(list(texts))
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        self.calls.append([text])
+        time.sleep(self.latency)
+        return [float(len(text)), 1.0]
+
+
+def drive_file(file_id: str = "file_1") -> dict:
+    return {"id": file_id, "name": f"{file_id}.pdf", "mimeType": "application/pdf",
+            "modifiedTime": "2026-01-01T00:00:00Z"}
+
+
+@pytest.fixture
+def stub():
+    return PostgRESTStub()
+
+
+def chunk_records(count: int, file_id: str = "file_1") -> list:
+    return [{"content": f"Artículo {i}", "embedding": [0.1, 0.2],
+             "metadata": {"file_id": file_id, "chunk_number": i + 1, "total_chunks": count}}
+            for i in range(count)]
+
+
+@pytest.fixture
+def make_indexer(stub):
+    client = SupabaseClient(base_url="http://supabase.test", transport=httpx.MockTransport(lambda r: stub.handle(r)),
+                            retry_backoff=0, breaker=CircuitBreaker(failure_threshold=10 ** 9))
+
+    def factory(embeddings, **embedder_options):
+        with patch("indexador.get_google_drive_credentials"), patch("indexador.get_google_drive_service"):
+            # Hilos: los tests sustituyen convert_to_text/split_text en la instancia
+            indexer = DocumentIndexer(cpu_executor="thread")
+        indexer.embeddings_model = embeddings
+        indexer.chunk_embedder = ChunkEmbedder(embeddings, **embedder_options)
+        return indexer
+
+    with patch("indexador.supabase_client", client), patch("indexador.INDEXER_INSERT_BACKOFF", 0):
+        yield factory
+
+
+class TestChunkEmbedder:
+    """Tests para los embeddings por lotes del indexador"""
+
+    def test_batches_bounded_by_count(self):
+        embedder = ChunkEmbedder(FakeEmbeddings(), batch_size=4, max_tokens=10 ** 6)
+        assert embedder.make_batches(["chunk"] * 10) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    def test_batches_bounded_by_tokens(self):
+        embedder = ChunkEmbedder(FakeEmbeddings(), batch_size=100, max_tokens=700)
+        texts = ["a" * 900] * 5      # ~301 tokens estimados cada uno
+        assert embedder.make_batches(texts) == [[0, 1], [2, 3], [4]]
+
+    def test_oversized_chunk_gets_its_own_batch(self):
+        embedder = ChunkEmbedder(FakeEmbeddings(), batch_size=100, max_tokens=100)
+        assert embedder.make_batches(["a" * 900, "b", "c"]) == [[0], [1, 2]]
+
+    @pytest.mark.asyncio
+    async def test_embed_keeps_order(self):
+        embeddings = FakeEmbeddings()
+        embedder = ChunkEmbedder(embeddings, batch_size=3)
+        texts = [f"chunk {'x' * i}" for i in range(8)]
+
+        vectors = await embedder.embed(texts)
+        assert [vector[0] for vector in vectors] == [float(len(text)) for text in texts]
+        assert len(embeddings.calls) == 3
+
+        stats = embedder.get_stats()
+        assert stats["chunks"] == 8
+        assert stats["requests"] == 3
+        assert stats["tokens"] == sum(ChunkEmbedder.estimate_tokens(text) for text in texts)
+
+    @pytest.mark.asyncio
+    async def test_concurrency_limit_is_shared_across_files(self):
+        embeddings = FakeEmbeddings(latency=0.02)
+        embedder = ChunkEmbedder(embeddings, batch_size=2, max_concurrency=3)
+
+        await asyncio.gather(*(embedder.embed([f"archivo {f} chunk {i}" for i in range(10)]) for f in range(4)))
+        assert len(embeddings.calls) == 20
+        assert embeddings.peak == 3
+
+    @pytest.mark.asyncio
+    async def test_file_is_embedded_in_batches_and_stored(self, make_indexer, stub):
+        embeddings = FakeEmbeddings()
+        indexer = make_indexer(embeddings, batch_size=10)
+        chunks = [f"Artículo {i}. Texto del reglamento interno." for i in range(25)]
+
+        with patch.object(indexer, "download_file_from_drive", return_value="doc.pdf"), \
+                patch.object(indexer, "convert_to_text", return_value="texto"), \
+                patch.object(indexer, "split_text", return_value=chunks):
+            await indexer.process_file_async(drive_file())
+
+        assert len(embeddings.calls) == 3
+        rows = sorted(stub.rows("tfinal"), key=lambda row: row["metadata"]["chunk_number"])
+        assert [row["content"] for row in rows] == chunks
+        assert rows[0]["embedding"] == [float(len(chunks[0])), 1.0]
+        assert rows[-1]["metadata"]["total_chunks"] == 25
+
+
+class TestBulkInserts:
+    """Tests para las inserciones masivas en tfinal"""
+
+    @pytest.mark.asyncio
+    async def test_rows_are_sent_as_json_arrays(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        indexer.insert_rows = 40
+
+        assert await indexer.insert_records(chunk_records(100)) == 100
+        posts = [request for request in stub.requests if request.method == "POST"]
+        assert [len(json.loads(request.content)) for request in posts] == [40, 40, 20]
+        assert all(request.headers["Prefer"] == "return=minimal" for request in posts)
+        assert len(stub.rows("tfinal")) == 100
+        assert indexer.insert_stats == {"rows": 100, "requests": 3, "retries": 0, "failed_rows": 0}
+
+    @pytest.mark.asyncio
+    async def test_transient_failure_retries_only_that_slice(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        indexer.insert_rows = 10
+        records = chunk_records(30)
+
+        original = stub.handle
+        def fail_second_slice_once(request):
+            body = json.loads(request.content)
+            if body[0]["metadata"]["chunk_number"] == 11 and not indexer.insert_stats["retries"]:
+                stub.fail_next(1, status=503)
+            return original(request)
+        stub.handle = fail_second_slice_once
+
+        assert await indexer.insert_records(records) == 30
+        first_chunks = [json.loads(request.content)[0]["metadata"]["chunk_number"] for request in stub.requests]
+        assert first_chunks == [1, 11, 11, 21]
+        assert sorted(row["metadata"]["chunk_number"] for row in stub.rows("tfinal")) == list(range(1, 31))
+
+    @pytest.mark.asyncio
+    async def test_rejected_rows_are_isolated(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        records = chunk_records(16)
+        records[5]["embedding"] = "no es un vector"
+
+        original = stub.handle
+        def reject_invalid_arrays(request):
+            body = json.loads(request.content)
+            if any(not isinstance(row["embedding"], list) for row in body):
+                stub.requests.append(request)
+                return httpx.Response(400, json={"message": "invalid input syntax for type vector"})
+            return original(request)
+        stub.handle = reject_invalid_arrays
+
+        assert await indexer.insert_records(records) == 15
+        assert len(stub.rows("tfinal")) == 15
+        assert indexer.insert_stats["failed_rows"] == 1
+        assert indexer.insert_stats["retries"] == 0
+
+    @pytest.mark.asyncio
+    async def test_persistent_outage_reports_failed_rows(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        stub.down = True
+
+        with patch("indexador.INDEXER_INSERT_RETRIES", 2):
+            assert await indexer.insert_records(chunk_records(5)) == 0
+        assert indexer.insert_stats["failed_rows"] == 5
+        assert indexer.insert_stats["retries"] == 2
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("status", [401, 403, 404, 413])
+    async def test_other_client_errors_fail_fast(self, make_indexer, stub, status):
+        """Solo 400/409/422 se bisectan: el resto de 4xx afecta a todo el tramo"""
+        indexer = make_indexer(FakeEmbeddings())
+        stub.fail_next(1, status=status)
+
+        assert await indexer.insert_records(chunk_records(16)) == 0
+        assert len(stub.requests) == 1
+        assert indexer.insert_stats["failed_rows"] == 16
+        assert indexer.insert_stats["retries"] == 0
+
+    @pytest.mark.asyncio
+    async def test_post_that_may_have_been_applied_is_not_repeated(self, make_indexer, stub):
+        """Un timeout de lectura puede haber insertado el tramo: repetirlo duplicaría chunks"""
+        indexer = make_indexer(FakeEmbeddings())
+
+        original = stub.handle
+        def insert_then_time_out(request):
+            original(request)
+            raise httpx.ReadTimeout("sin respuesta", request=request)
+        stub.handle = insert_then_time_out
+
+        assert await indexer.insert_records(chunk_records(5)) == 0
+        assert len(stub.rows("tfinal")) == 5
+        assert indexer.insert_stats["retries"] == 0
+        assert indexer.insert_stats["failed_rows"] == 5
+
+
+def stored_row(file_id: str, chunk_number: int, modified: str = "2025-01-01T00:00:00Z", generation: str = None,
+               total: int = None) -> dict:
+    metadata = {"file_id": file_id, "chunk_number": chunk_number, "modifiedTime": modified}
+    if generation:
+        metadata["generation"] = generation
+    if total:
+        metadata["total_chunks"] = total
+    return {"content": f"{file_id} chunk {chunk_number} {modified}", "embedding": [0.0, 0.0], "metadata": metadata}
+
+
+class TestVersionedReindex:
+    """Tests para el reemplazo de los chunks de un documento al reindexar"""
+
+    @pytest.fixture
+    def previous_version(self, stub):
+        stub.rows("tfinal").extend(
+            [dict(stored_row("file_1", n), id=n) for n in range(1, 4)] +                     # sin generación
+            [dict(stored_row("file_1", n, generation="g0"), id=10 + n) for n in range(1, 4)] +
+            [dict(stored_row("file_2", n), id=20 + n) for n in range(1, 3)]
+        )
+
+    @pytest.mark.asyncio
+    async def test_new_generation_replaces_previous_chunks(self, make_indexer, stub, previous_version):
+        indexer = make_indexer(FakeEmbeddings())
+        chunks = [f"Artículo {i} reformado" for i in range(5)]
+
+        with patch.object(indexer, "download_file_from_drive", return_value="doc.pdf"), \
+                patch.object(indexer, "convert_to_text", return_value="texto"), \
+                patch.object(indexer, "split_text", return_value=chunks):
+            assert await indexer.process_file_async(drive_file("file_1"))
+
+        file_1 = [row for row in stub.rows("tfinal") if row["metadata"]["file_id"] == "file_1"]
+        assert sorted(row["content"] for row in file_1) == sorted(chunks)
+        assert len({row["metadata"]["generation"] for row in file_1}) == 1
+        assert len([row for row in stub.rows("tfinal") if row["metadata"]["file_id"] == "file_2"]) == 2
+
+    @pytest.mark.asyncio
+    async def test_failed_reindex_keeps_previous_version(self, make_indexer, stub, previous_version):
+        indexer = make_indexer(FakeEmbeddings())
+        indexer.insert_rows = 4
+        chunks = [f"Artículo {i} reformado" for i in range(8)]
+
+        original = stub.handle
+        def reject_second_slice(request):
+            if request.method == "POST" and any(row["metadata"]["chunk_number"] > 4
+                                                for row in json.loads(request.content)):
+                stub.requests.append(request)
+                return httpx.Response(400, json={"message": "rechazado"})
+            return original(request)
+        stub.handle = reject_second_slice
+
+        with patch.object(indexer, "download_file_from_drive", return_value="doc.pdf"), \
+                patch.object(indexer, "convert_to_text", return_value="texto"), \
+                patch.object(indexer, "split_text", return_value=chunks):
+            assert not await indexer.process_file_async(drive_file("file_1"))
+
+        assert sorted(row["id"] for row in stub.rows("tfinal")) == [1, 2, 3, 11, 12, 13, 21, 22]
+
+    @pytest.mark.asyncio
+    async def test_cleanup_keeps_latest_version_without_duplicates(self, make_indexer, stub):
+        make_indexer(FakeEmbeddings())
+        stub.rows("tfinal").extend([
+            dict(stored_row("file_1", 1, "2025-01-01"), id=1),
+            dict(stored_row("file_1", 2, "2025-01-01"), id=2),
+            dict(stored_row("file_1", 1, "2025-03-01"), id=3),
+            dict(stored_row("file_1", 2, "2025-03-01"), id=4),
+            dict(stored_row("file_1", 1, "2025-03-01"), id=5),       # misma versión insertada dos veces
+            dict(stored_row("file_1", 2, "2025-03-01"), id=6),
+            dict(stored_row("file_2", 1, "2025-02-01", "g1"), id=7),
+            dict(stored_row("file_2", 1, "2025-02-01", "g2"), id=8),  # reindexado sin cambios en Drive
+            dict(stored_row("file_3", 1, "2025-02-01", "g3"), id=9),
+        ])
+
+        with patch("indexador.INDEXER_CLEANUP_PAGE", 4):
+            preview = await cleanup_index(dry_run=True)
+            assert len(stub.rows("tfinal")) == 9
+            report = await cleanup_index()
+
+        assert preview["stale"] == report["stale"] == 3
+        assert preview["deleted"] == 0
+        assert report["duplicates"] == 2
+        assert report["deleted"] == 5
+        assert report["rows"] == 9 and report["files"] == 3
+        assert sorted(row["id"] for row in stub.rows("tfinal")) == [5, 6, 8, 9]
+
+    @pytest.mark.asyncio
+    async def test_cleanup_keeps_generation_being_written(self, make_indexer, stub):
+        """Una generación nueva a medio escribir no reemplaza a la completa anterior"""
+        make_indexer(FakeEmbeddings())
+        stub.rows("tfinal").extend([
+            dict(stored_row("file_1", 1, "2025-01-01", "g1", total=2), id=1),
+            dict(stored_row("file_1", 2, "2025-01-01", "g1", total=2), id=2),
+            dict(stored_row("file_1", 1, "2025-03-01", "g2", total=3), id=3),   # en curso: 1 de 3
+            dict(stored_row("file_2", 1, "2025-01-01", "g3", total=2), id=4),   # fallida y superada
+            dict(stored_row("file_2", 1, "2025-02-01", "g4", total=1), id=5),
+        ])
+
+        report = await cleanup_index()
+
+        assert report["in_progress"] == 1
+        assert report["stale"] == 1
+        assert sorted(row["id"] for row in stub.rows("tfinal")) == [1, 2, 3, 5]
+
+    @pytest.mark.asyncio
+    async def test_cleanup_aborts_when_the_scan_fails(self, make_indexer, stub):
+        make_indexer(FakeEmbeddings())
+        stub.rows("tfinal").extend([dict(stored_row("file_1", 1, "2025-01-01"), id=1),
+                                    dict(stored_row("file_1", 1, "2025-03-01"), id=2)])
+        stub.fail_next(1, status=401)
+
+        report = await cleanup_index()
+
+        assert report["deleted"] == 0 and report["error"] == 401
+        assert len(stub.rows("tfinal")) == 2
+
+
+class TestEmbeddingCache:
+    """Tests para la caché persistente de embeddings del indexador"""
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return EmbeddingCache(str(tmp_path / "embeddings.db"), max_rows=1000)
+
+    def test_round_trip_and_model_in_key(self, cache):
+        cache.put_many([("Artículo 1", [0.5, 0.25])], "modelo-a")
+        assert cache.get_many(["Artículo 1"], "modelo-a") == {"Artículo 1": [0.5, 0.25]}
+        assert cache.get_many(["Artículo 1"], "modelo-b") == {}
+        assert cache.get_stats()["hit_rate"] == 0.5
+
+    def test_survives_restart(self, cache, tmp_path):
+        cache.put_many([("Artículo 1", [1.0, 0.0])], "modelo-a")
+        reopened = EmbeddingCache(str(tmp_path / "embeddings.db"))
+        assert reopened.get_many(["Artículo 1"], "modelo-a") == {"Artículo 1": [1.0, 0.0]}
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = EmbeddingCache(str(tmp_path / "embeddings.db"), max_rows=3)
+        for i in range(3):
+            cache.put_many([(f"chunk {i}", [float(i)])], "m")
+            time.sleep(0.01)
+        cache.get_many(["chunk 0"], "m")          # vuelve a ser reciente
+        time.sleep(0.01)
+        cache.put_many([("chunk 3", [3.0])], "m")
+
+        assert cache.size() == 3
+        assert set(cache.get_many([f"chunk {i}" for i in range(4)], "m")) == {"chunk 0", "chunk 2", "chunk 3"}
+        assert cache.get_stats()["evicted"] == 1
+
+    @pytest.mark.asyncio
+    async def test_only_changed_chunks_are_embedded(self, cache):
+        embeddings = FakeEmbeddings()
+        embedder = ChunkEmbedder(embeddings, batch_size=100, cache=cache)
+        chunks = [f"Artículo {i}. Texto vigente." for i in range(20)]
+        first = await embedder.embed(chunks)
+
+        edited = list(chunks)
+        edited[3] = "Artículo 3. Texto modificado por la adenda."
+        embeddings.calls.clear()
+        second = await embedder.embed(edited)
+
+        assert embeddings.calls == [[edited[3]]]
+        assert second[:3] == first[:3] and second[4:] == first[4:]
+        assert embedder.get_stats()["cached"] == 19
+
+    @pytest.mark.asyncio
+    async def test_repeated_chunks_are_embedded_once(self):
+        embeddings = FakeEmbeddings()
+        embedder = ChunkEmbedder(embeddings)
+        vectors = await embedder.embed(["encabezado", "Artículo 1", "encabezado"])
+        assert embeddings.calls == [["encabezado", "Artículo 1"]]
+        assert vectors[0] == vectors[2]
+
+
+class FakeDrive:
+    """Descarga y conversión falsas con latencia (en hilos, como las reales) y concurrencia observable"""
+
+    def __init__(self, download_latency: float = 0.0, convert_latency: float = 0.0, broken: set = ()):
+        self.download_latency = download_latency
+        self.convert_latency = convert_latency
+        self.broken = set(broken)
+        self.downloaded = []
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def download(self, file_id, mime_type):
+        with self.lock:
+            self.downloaded.append(file_id)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.download_latency)
+        with self.lock:
+            self.in_flight -= 1
+        return file_id
+
+    def convert(self, temp_file):
+        time.sleep(self.convert_latency)
+        if temp_file in self.broken:
+            raise ValueError("No se pudo extraer texto del archivo")
+        return f"Reglamento {temp_file}. " + " ".join(f"Artículo {i} de {temp_file}." for i in range(40))
+
+    def attach(self, indexer, files):
+        indexer.drive_service = MagicMock()
+        indexer.drive_service.files.return_value.list.return_value.execute.return_value = {"files": files}
+        indexer.download_file_from_drive = self.download
+        indexer.convert_to_text = self.convert
+        indexer.cpu_executor = "thread"
+        indexer.chunk_size, indexer.chunk_overlap = 200, 0
+
+
+class TestIndexingPipeline:
+    """Tests para el pipeline por etapas de index_documents"""
+
+    @pytest.mark.asyncio
+    async def test_indexes_only_new_and_changed_files(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        files = [drive_file(f"file_{i}") for i in range(1, 4)]
+        stub.rows("tfinal").extend([
+            dict(stored_row("file_1", 1, files[0]["modifiedTime"]), id=1),   # al día
+            dict(stored_row("file_2", 1, "2024-12-31T00:00:00Z"), id=2),     # modificado en Drive
+        ])
+        drive = FakeDrive()
+        drive.attach(indexer, files)
+
+        await indexer.index_documents()
+
+        assert sorted(drive.downloaded) == ["file_2", "file_3"]
+        by_file = {}
+        for row in stub.rows("tfinal"):
+            by_file.setdefault(row["metadata"]["file_id"], []).append(row)
+        assert [row["id"] for row in by_file["file_1"]] == [1]
+        assert all(row["metadata"].get("generation") for row in by_file["file_2"] + by_file["file_3"])
+        assert indexer.stage_stats["download"]["files"] == 3
+        assert indexer.stage_stats["upload"]["files"] == 2
+
+    @pytest.mark.asyncio
+    async def test_change_check_reads_the_newest_row(self, make_indexer, stub):
+        """Con una generación anterior aún sin limpiar, decide la fila más reciente"""
+        indexer = make_indexer(FakeEmbeddings())
+        file = drive_file("file_1")
+        stub.rows("tfinal").extend([
+            dict(stored_row("file_1", 1, "2024-12-31T00:00:00Z", generation="g0"), id=1),
+            dict(stored_row("file_1", 1, file["modifiedTime"], generation="g1"), id=2),
+        ])
+        assert not await indexer.needs_indexing(file)
+
+        stub.rows("tfinal").append(dict(stored_row("file_1", 1, "2025-06-01T00:00:00Z", generation="g2"), id=3))
+        assert await indexer.needs_indexing(file)
+
+    @pytest.mark.asyncio
+    async def test_max_hilos_bounds_concurrent_downloads(self, make_indexer):
+        with patch("indexador.get_google_drive_credentials"), patch("indexador.get_google_drive_service"):
+            indexer = DocumentIndexer(max_hilos=3, lote=2, cpu_executor="thread")
+        indexer.chunk_embedder = ChunkEmbedder(FakeEmbeddings())
+        indexer.store_chunks = lambda *args: asyncio.sleep(0, result=True)
+        drive = FakeDrive(download_latency=0.03)
+        files = [drive_file(f"file_{i}") for i in range(12)]
+        drive.attach(indexer, files)
+
+        assert await indexer.run_pipeline(files, check=False) == 12
+        assert drive.peak == 3
+        assert indexer.stage_workers()["download"] == 3
+
+    @pytest.mark.asyncio
+    async def test_failed_file_does_not_stop_the_run(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        drive = FakeDrive(broken={"file_2"})
+        files = [drive_file(f"file_{i}") for i in range(1, 5)]
+        drive.attach(indexer, files)
+
+        assert await indexer.run_pipeline(files, check=False) == 3
+        assert {row["metadata"]["file_id"] for row in stub.rows("tfinal")} == {"file_1", "file_3", "file_4"}
+        assert indexer.stage_stats["extract"]["files"] == 4
+        assert indexer.stage_stats["split"]["files"] == 3
+
+    @pytest.mark.asyncio
+    async def test_each_download_thread_uses_its_own_drive_service(self, make_indexer, stub):
+        """httplib2 no es thread-safe: cada hilo de descarga crea y reutiliza su propio servicio"""
+        used_by = {}
+
+        def build_service(creds=None):
+            service = MagicMock()
+            used_by[id(service)] = set()
+            service.files.return_value.get_media.side_effect = \
+                lambda fileId: used_by[id(service)].add(threading.get_ident())
+            return service
+
+        class InstantDownload:
+            def __init__(self, fh, request):
+                time.sleep(0.01)
+
+            def next_chunk(self):
+                return None, True
+
+        indexer = make_indexer(FakeEmbeddings())
+        indexer.max_hilos = 3
+        files = [dict(drive_file(f"file_{i}"), mimeType="text/plain") for i in range(12)]
+        indexer.convert_to_text = lambda temp_file: os.remove(temp_file) or f"Reglamento de {temp_file}"
+
+        with patch("indexador.get_google_drive_service", side_effect=build_service), \
+                patch("indexador.MediaIoBaseDownload", InstantDownload):
+            assert await indexer.run_pipeline(files, check=False) == 12
+
+        assert 1 <= len(used_by) <= 3
+        assert all(len(threads) == 1 for threads in used_by.values())
+        assert len(set.union(*used_by.values())) == len(used_by)
+
+    @pytest.mark.asyncio
+    async def test_extract_and_split_run_in_worker_processes(self, make_indexer, stub, tmp_path):
+        """Con el pool de procesos, MarkItDown y el splitter corren fuera del proceso del servidor"""
+        indexer = make_indexer(FakeEmbeddings())
+        indexer.cpu_executor = "process"
+        indexer.max_hilos = 2
+        files = [dict(drive_file(f"file_{i}"), mimeType="text/plain") for i in range(3)]
+        paths = {}
+        for file in files:
+            paths[file["id"]] = tmp_path / f"{file['id']}.txt"
+            paths[file["id"]].write_text(" ".join(f"Artículo {i} de {file['id']}." for i in range(200)),
+                                         encoding="utf-8")
+        indexer.download_file_from_drive = lambda file_id, mime_type: str(paths[file_id])
+
+        assert await indexer.run_pipeline(files, check=False) == 3
+
+        rows = stub.rows("tfinal")
+        assert {row["metadata"]["file_id"] for row in rows} == {"file_0", "file_1", "file_2"}
+        assert all(len(row["content"]) <= indexer.chunk_size for row in rows)
+        assert not any(path.exists() for path in paths.values())
+
+
+class TestIndexingPipelineBenchmark:
+    """Benchmark: 16 archivos, uno tras otro vs pipeline por etapas"""
+
+    FILES = 16
+
+    @pytest.mark.asyncio
+    async def test_pipeline_overlaps_stages(self, make_indexer, stub):
+        files = [drive_file(f"file_{i}") for i in range(self.FILES)]
+
+        async def run(pipelined: bool) -> float:
+            indexer = make_indexer(FakeEmbeddings(latency=0.02))
+            FakeDrive(download_latency=0.03, convert_latency=0.01).attach(indexer, files)
+            start = time.perf_counter()
+            if pipelined:
+                assert await indexer.run_pipeline(files, check=False) == self.FILES
+            else:
+                for file in files:
+                    assert await indexer.process_file_async(file)
+            return (time.perf_counter() - start) * 1000
+
+        sequential_ms = await run(pipelined=False)
+        pipeline_ms = await run(pipelined=True)
+
+        print(f"\n🏭 {self.FILES} archivos: {sequential_ms:.0f}ms → {pipeline_ms:.0f}ms")
+        assert pipeline_ms < sequential_ms / 2.5
+
+
+class TestChunkEmbedderBenchmark:
+    """Benchmark: peticiones a OpenAI por archivo, embed_query por chunk vs lotes"""
+
+    CHUNKS = 200
+    LATENCY = 0.01
+
+    @pytest.mark.asyncio
+    async def test_batched_requests(self):
+        chunks = [f"Artículo {i}. " + "texto " * 120 for i in range(self.CHUNKS)]
+
+        # Antes: una petición por chunk, 5 chunks por lote
+        per_chunk = FakeEmbeddings(latency=self.LATENCY)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        for i in range(0, self.CHUNKS, 5):
+            await asyncio.gather(*(loop.run_in_executor(None, per_chunk.embed_query, chunk)
+                                   for chunk in chunks[i:i + 5]))
+        per_chunk_ms = (time.perf_counter() - start) * 1000
+
+        batched = FakeEmbeddings(latency=self.LATENCY)
+        embedder = ChunkEmbedder(batched)
+        start = time.perf_counter()
+        await embedder.embed(chunks)
+        batched_ms = (time.perf_counter() - start) * 1000
+
+        print(f"\n📦 {self.CHUNKS} chunks: {len(per_chunk.calls)} → {len(batched.calls)} peticiones, "
+              f"{per_chunk_ms:.0f}ms → {batched_ms:.0f}ms")
+        assert len(batched.calls) <= self.CHUNKS // 50
+        assert batched_ms < per_chunk_ms
+
+
+class TestBulkInsertBenchmark:
+    """Benchmark: inserción de un documento de 500 chunks, una fila por petición vs arrays JSON"""
+
+    CHUNKS = 500
+    LATENCY = 0.002
+
+    @pytest.mark.asyncio
+    async def test_bulk_insert(self, make_indexer, stub):
+        indexer = make_indexer(FakeEmbeddings())
+        records = chunk_records(self.CHUNKS)
+        stub.latency = self.LATENCY
+
+        import indexador
+        start = time.perf_counter()
+        for record in records:
+            await indexador.supabase_client.request("POST", "tfinal", data=record)
+        per_row_ms = (time.perf_counter() - start) * 1000
+        per_row_requests = len(stub.requests)
+
+        stub.requests.clear()
+        start = time.perf_counter()
+        await indexer.insert_records(records)
+        bulk_ms = (time.perf_counter() - start) * 1000
+
+        print(f"\n📤 {self.CHUNKS} chunks: {per_row_requests} → {len(stub.requests)} peticiones, "
+              f"{per_row_ms:.0f}ms → {bulk_ms:.0f}ms")
+        assert len(stub.requests) == self.CHUNKS // indexer.insert_rows
+        assert bulk_ms < per_row_ms / 5
+
+
+class TestEmbeddingCacheBenchmark:
+    """Benchmark: reindexar un documento de 500 chunks tras editar el 2%, sin caché vs con caché"""
+
+    CHUNKS = 500
+    BATCH = 20
+    LATENCY = 0.02
+
+    @pytest.mark.asyncio
+    async def test_reindex_after_small_edit(self, tmp_path):
+        chunks = [f"Artículo {i}. " + "texto " * 120 for i in range(self.CHUNKS)]
+        edited = [chunk + " (modificado)" if i % 50 == 0 else chunk for i, chunk in enumerate(chunks)]
+
+        async def reindex(cache):
+            embeddings = FakeEmbeddings(latency=self.LATENCY)
+            await ChunkEmbedder(embeddings, batch_size=self.BATCH, cache=cache).embed(chunks)
+            embeddings.calls.clear()
+            if cache:
+                cache.stats.update(hits=0, misses=0)
+            start = time.perf_counter()
+            await ChunkEmbedder(embeddings, batch_size=self.BATCH, cache=cache).embed(edited)
+            return (time.perf_counter() - start) * 1000, sum(len(call) for call in embeddings.calls)
+
+        uncached_ms, uncached_chunks = await reindex(None)
+        cache = EmbeddingCache(str(tmp_path / "embeddings.db"))
+        cached_ms, cached_chunks = await reindex(cache)
+
+        print(f"\n♻️ Reindexado con 2% editado: {uncached_chunks} → {cached_chunks} chunks a OpenAI, "
+              f"{uncached_ms:.0f}ms → {cached_ms:.0f}ms (hit rate {cache.get_stats()['hit_rate']:.0%})")
+        assert cached_chunks == self.CHUNKS // 50
+        assert cached_ms < uncached_ms / 2
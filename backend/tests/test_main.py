@@ -1,6 +1,8 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+import asyncio
+import sqlite3
 import sys
 import os
 
@@ -74,6 +76,13 @@ class TestUserStatsEndpoint:
         assert data["success"] is True
         assert isinstance(data["active_users"], list)
         assert isinstance(data["total_users"], int)
+    
+    def test_users_stats_include_pool(self, client):
+        """El endpoint de stats incluye las métricas del pool de orquestadores"""
+        data = client.get("/users/stats").json()
+        
+        for key in ("size", "max_entries", "approx_bytes", "hits", "evictions", "rehydrations", "rehydration_avg_ms"):
+            assert key in data["pool"]
 
 class TestWebhookEndpoint:
     """Tests para el endpoint de webhook"""
@@ -105,18 +114,8 @@ class TestWebhookEndpoint:
             )
             assert response.status_code == 403
     
-    @patch('main.sync_whatsapp_message')
-    @patch('main.get_orchestrator_for_user')
-    def test_webhook_post_processes_whatsapp_message(self, mock_orchestrator, mock_sync, client, mock_env_vars):
-        """El webhook debe procesar mensajes de WhatsApp correctamente"""
-        # Mock del orquestador
-        mock_orch_instance = MagicMock()
-        mock_orch_instance.process_query.return_value = {"response": "Test response"}
-        mock_orchestrator.return_value = mock_orch_instance
-        
-        # Mock de sync_whatsapp_message
-        mock_sync.return_value = "whatsapp_1234567890"
-        
+    def test_webhook_post_enqueues_whatsapp_message(self, client, mock_env_vars):
+        """El webhook debe encolar el mensaje y responder sin esperar al orquestador"""
         # Datos de webhook de WhatsApp
         webhook_data = {
             "object": "whatsapp_business_account",
@@ -125,6 +124,7 @@ class TestWebhookEndpoint:
                     "value": {
                         "messages": [{
                             "from": "1234567890",
+                            "id": "wamid.test_enqueue",
                             "type": "text",
                             "text": {"body": "Hola"}
                         }],
@@ -136,13 +136,143 @@ class TestWebhookEndpoint:
             }]
         }
         
-        with patch('main.send_whatsapp_message') as mock_send:
+        with patch('main.ingestion_queue') as mock_queue, \
+             patch('main.get_orchestrator_for_user_async', new_callable=AsyncMock) as mock_orchestrator:
+            mock_queue.enqueue_async = AsyncMock(return_value=True)
             response = client.post("/webhook", json=webhook_data)
             
             assert response.status_code == 200
+            mock_queue.enqueue_async.assert_called_once()
+            item = mock_queue.enqueue_async.call_args[0][0]
+            assert item["phone_number"] == "1234567890"
+            assert item["text"] == "Hola"
+            assert item["nombre"] == "Test User"
+            # El orquestador corre en los workers, no en el request
+            mock_orchestrator.assert_not_called()
+    
+    def test_webhook_enqueues_every_message_in_batch(self, client, mock_env_vars):
+        """Todos los mensajes de un lote (varios entries/changes, texto y multimedia) se encolan"""
+        webhook_data = {
+            "object": "whatsapp_business_account",
+            "entry": [
+                {
+                    "changes": [{
+                        "value": {
+                            "messages": [
+                                {"from": "51911111111", "id": "wamid.batch_1", "type": "text", "text": {"body": "Hola"}},
+                                {"from": "51911111111", "id": "wamid.batch_2", "type": "image", "image": {"caption": "Mi boleta"}}
+                            ],
+                            "contacts": [{"wa_id": "51911111111", "profile": {"name": "Ana"}}]
+                        }
+                    }]
+                },
+                {
+                    "changes": [{
+                        "value": {
+                            "messages": [
+                                {"from": "51922222222", "id": "wamid.batch_3", "type": "text", "text": {"body": "¿Vacaciones?"}},
+                                {"from": "51922222222", "type": "text", "text": {"body": "Sin id"}}
+                            ],
+                            "contacts": [{"wa_id": "51922222222", "profile": {"name": "Luis"}}]
+                        }
+                    }]
+                }
+            ]
+        }
+        
+        with patch('main.ingestion_queue') as mock_queue:
+            mock_queue.enqueue_async = AsyncMock(return_value=True)
+            response = client.post("/webhook", json=webhook_data)
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["received"] == 4
+        assert data["queued"] == 3
+        assert [r["status"] for r in data["results"]] == ["queued", "queued", "queued", "invalid"]
+        
+        items = [call[0][0] for call in mock_queue.enqueue_async.call_args_list]
+        assert [item["nombre"] for item in items] == ["Ana", "Ana", "Luis"]
+        assert items[1]["type"] == "image"
+        assert items[1]["text"] == "[Imagen] Mi boleta"
+    
+    def test_webhook_retry_after_failed_enqueue_is_accepted(self, client, mock_env_vars):
+        """La cola deduplica: el reintento de Meta entra si el primer INSERT falló, y solo una vez"""
+        from cola_mensajes import IngestionQueue, MemoryQueueBackend
+
+        class FlakyBackend(MemoryQueueBackend):
+            failures = 1
+
+            def push(self, item):
+                if self.failures:
+                    self.failures -= 1
+                    raise sqlite3.OperationalError("database is locked")
+                return super().push(item)
+
+        webhook_data = {
+            "object": "whatsapp_business_account",
+            "entry": [{"changes": [{"value": {
+                "messages": [{"from": "51911111111", "id": "wamid.retry", "type": "text", "text": {"body": "Hola"}}],
+                "contacts": [{"wa_id": "51911111111", "profile": {"name": "Ana"}}]
+            }}]}]
+        }
+
+        queue = IngestionQueue(backend=FlakyBackend())
+        with patch('main.ingestion_queue', queue):
+            assert client.post("/webhook", json=webhook_data).status_code == 500
+            assert client.post("/webhook", json=webhook_data).json()["queued"] == 1
+            assert client.post("/webhook", json=webhook_data).json()["results"][0]["status"] == "duplicate"
+        assert [item["message_id"] for _, item in queue.backend.pending()] == ["wamid.retry"]
+
+    @pytest.mark.asyncio
+    @patch('main.sync_whatsapp_message')
+    @patch('main.get_orchestrator_for_user_async', new_callable=AsyncMock)
+    async def test_worker_processes_whatsapp_message(self, mock_orchestrator, mock_sync):
+        """Los workers de la cola deben procesar y responder el mensaje"""
+        from main import process_incoming_message
+        
+        # Mock del orquestador
+        mock_orch_instance = MagicMock()
+        mock_orch_instance.process_query = AsyncMock(return_value={"response": "Test response"})
+        mock_orchestrator.return_value = mock_orch_instance
+        
+        # Mock de sync_whatsapp_message
+        mock_sync.return_value = "whatsapp_1234567890"
+        
+        with patch('main.send_whatsapp_message', new_callable=AsyncMock) as mock_send, \
+             patch('main.preprocessor') as mock_preprocessor:
+            mock_preprocessor.process_message = AsyncMock(return_value="Hola")
+            await process_incoming_message({
+                "message_id": "wamid.test_worker",
+                "phone_number": "1234567890",
+                "text": "Hola",
+                "nombre": "Test User"
+            })
+            
             mock_orchestrator.assert_called_once()
             mock_send.assert_called_once()
 
+    @pytest.mark.asyncio
+    @patch('main.sync_whatsapp_message')
+    @patch('main.get_orchestrator_for_user_async', new_callable=AsyncMock)
+    async def test_worker_replies_to_non_text_message(self, mock_orchestrator, mock_sync):
+        """Los mensajes multimedia reciben un aviso sin pasar por el orquestador"""
+        from main import process_incoming_message, UNSUPPORTED_MESSAGE_REPLY
+        
+        mock_sync.return_value = "whatsapp_1234567890"
+        
+        with patch('main.send_whatsapp_message', new_callable=AsyncMock) as mock_send:
+            await process_incoming_message({
+                "message_id": "wamid.test_image",
+                "phone_number": "1234567890",
+                "type": "image",
+                "text": "[Imagen]",
+                "nombre": "Test User"
+            })
+            
+            mock_orchestrator.assert_not_called()
+            mock_send.assert_called_once()
+            assert mock_send.call_args.args == ("1234567890", {"response": UNSUPPORTED_MESSAGE_REPLY})
+
 class TestMessagePreProcessor:
     """Tests para el preprocessor de mensajes"""
     
@@ -154,15 +284,57 @@ class TestMessagePreProcessor:
         with patch('main.ChatOpenAI') as mock_llm_class:
             # Mock del LLM
             mock_llm = MagicMock()
-            mock_response = MagicMock()
-            mock_response.content = "quiero información sobre cursos"
-            mock_llm.ainvoke.return_value = mock_response
+            mock_llm.ainvoke = AsyncMock()
             mock_llm_class.return_value = mock_llm
             
             preprocessor = MessagePreProcessor()
             result = await preprocessor.process_message("kiero informacion sobre cursos")
             
+            # Mensaje corto: se corrige localmente sin llamar al LLM
             assert result == "quiero información sobre cursos"
+            mock_llm.ainvoke.assert_not_called()
+            assert preprocessor.get_stats()["short_bypass"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_message_preprocessor_skips_llm_for_clean_messages(self):
+        """Los mensajes largos sin errores probables no pasan por el LLM"""
+        from main import MessagePreProcessor
+        
+        with patch('main.ChatOpenAI') as mock_llm_class:
+            mock_llm = MagicMock()
+            mock_llm.ainvoke = AsyncMock()
+            mock_llm_class.return_value = mock_llm
+            
+            preprocessor = MessagePreProcessor()
+            text = "hola, quisiera saber en qué cursos estoy inscrito y cuándo empieza la capacitación"
+            result = await preprocessor.process_message(text)
+            
+            assert result == text
+            mock_llm.ainvoke.assert_not_called()
+            assert preprocessor.get_stats()["clean_bypass"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_message_preprocessor_caches_llm_corrections(self):
+        """Un mensaje repetido con errores solo consulta al LLM una vez"""
+        from main import MessagePreProcessor
+        
+        with patch('main.ChatOpenAI') as mock_llm_class:
+            mock_llm = MagicMock()
+            mock_response = MagicMock()
+            mock_response.content = "quisiera saber cuántos feriados tiene la empresa este año según la ley laboral"
+            mock_llm.ainvoke = AsyncMock(return_value=mock_response)
+            mock_llm_class.return_value = mock_llm
+            
+            preprocessor = MessagePreProcessor()
+            text = "quisiera saber cuántos feriados tiene la empresa este año según la ley laborl"
+            first = await preprocessor.process_message(text)
+            second = await preprocessor.process_message(text.upper())
+            
+            assert first == second == mock_response.content
+            assert mock_llm.ainvoke.await_count == 1
+            stats = preprocessor.get_stats()
+            assert stats["llm_calls"] == 1
+            assert stats["cache_hits"] == 1
     
     @pytest.mark.asyncio
     async def test_message_preprocessor_handles_errors(self):
@@ -172,28 +344,32 @@ class TestMessagePreProcessor:
         with patch('main.ChatOpenAI') as mock_llm_class:
             # Mock del LLM que lanza excepción
             mock_llm = MagicMock()
-            mock_llm.ainvoke.side_effect = Exception("API Error")
+            mock_llm.ainvoke = AsyncMock(side_effect=Exception("API Error"))
             mock_llm_class.return_value = mock_llm
             
             preprocessor = MessagePreProcessor()
-            original_text = "texto de prueba"
+            original_text = "quisiera saber cuántos feriados tiene la empresa este año según la ley laborl"
             result = await preprocessor.process_message(original_text)
             
             assert result == original_text
+            assert preprocessor.get_stats()["llm_errors"] == 1
 
 @pytest.mark.integration
 class TestIntegrationFlow:
     """Tests de integración para el flujo completo"""
     
-    @patch('main.get_orchestrator_for_user')
-    @patch('main.send_whatsapp_message')
+    @patch('main.get_orchestrator_for_user_async', new_callable=AsyncMock)
+    @patch('main.send_whatsapp_message', new_callable=AsyncMock)
     def test_complete_whatsapp_flow(self, mock_send, mock_orchestrator, client, mock_env_vars):
         """Test del flujo completo desde webhook hasta respuesta"""
+        from cola_mensajes import IngestionQueue, MemoryQueueBackend
+        from main import process_incoming_message
+        
         # Setup mocks
         mock_orch_instance = MagicMock()
-        mock_orch_instance.process_query.return_value = {
+        mock_orch_instance.process_query = AsyncMock(return_value={
             "response": "Información sobre tus cursos disponibles"
-        }
+        })
         mock_orchestrator.return_value = mock_orch_instance
         
         # Datos del webhook
@@ -204,6 +380,7 @@ class TestIntegrationFlow:
                     "value": {
                         "messages": [{
                             "from": "51987654321",
+                            "id": "wamid.test_complete_flow",
                             "type": "text",
                             "text": {"body": "¿En qué cursos estoy inscrito?"}
                         }],
@@ -215,8 +392,20 @@ class TestIntegrationFlow:
             }]
         }
         
-        # Ejecutar request
-        response = client.post("/webhook", json=webhook_data)
+        queue = IngestionQueue(backend=MemoryQueueBackend(), workers=2)
+        
+        async def drain_queue():
+            await queue.start(process_incoming_message)
+            await queue.join()
+            await queue.stop()
+        
+        # Ejecutar request y luego drenar la cola con los workers
+        with patch('main.ingestion_queue', queue), \
+             patch('main.sync_whatsapp_message', return_value="whatsapp_51987654321"), \
+             patch('main.preprocessor') as mock_preprocessor:
+            mock_preprocessor.process_message = AsyncMock(side_effect=lambda text: text)
+            response = client.post("/webhook", json=webhook_data)
+            asyncio.run(drain_queue())
         
         # Verificaciones
         assert response.status_code == 200
@@ -227,4 +416,4 @@ class TestIntegrationFlow:
         # Verificar que se llamó con los datos correctos
         call_args = mock_send.call_args
         assert call_args[0][0] == "51987654321"  # phone_number
-        assert "response" in call_args[0][1]  # response_data 
\ No newline at end of file
+        assert "response" in call_args[0][1]  # response_data 
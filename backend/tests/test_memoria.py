@@ -0,0 +1,1163 @@
+import pytest
+import asyncio
+import sys
+import os
+import sqlite3
+import itertools
+import threading
+import time
+import random
+from types import SimpleNamespace
+import httpx
+import numpy as np
+from unittest.mock import AsyncMock, patch
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from langchain.schema import HumanMessage, AIMessage
+
+from memoria import (
+    LocalMemoryPersistence, MemoryWriteBuffer, EpisodicMemory, SemanticMemory, AdvancedMemorySystem, fts_query,
+    MessageEmbedder, EpisodicVectorIndex, SessionBackupScheduler, AdvancedMemoryManager,
+    get_local_persistence, get_sqlite_pool, session_id_for_user
+)
+from cliente_supabase import SupabaseClient, CircuitBreaker
+from postgrest_stub import PostgRESTStub
+
+
+class FakeSupabase:
+    """
+    Sustituto de make_supabase_request: registra los POST y responde con status configurable.
+    `reject(row)` simula un CHECK de Supabase: el lote entero falla con 400 si alguna fila no pasa.
+    """
+
+    def __init__(self, status_code: int = 201, delay: float = 0.0, reject=None):
+        self.status_code = status_code
+        self.delay = delay
+        self.reject = reject
+        self.calls = []
+
+    def __call__(self, method, endpoint, data=None, params=None, headers=None):
+        if self.delay:
+            time.sleep(self.delay)
+        self.calls.append((method, endpoint, data))
+        if self.reject and any(self.reject(row) for row in data):
+            return SimpleNamespace(status_code=400, text="violates check constraint")
+        return SimpleNamespace(status_code=self.status_code, text="")
+
+
+def wait_until(condition, timeout: float = 3.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def user_metadata(phone: str) -> dict:
+    """Metadata episódica como la guarda el orquestador"""
+    return {"context": {"user_context": {"phone_number": phone}, "tools_used": []}}
+
+
+class TestSessionIdentity:
+    """Tests para el session_id estable por usuario"""
+
+    def test_same_phone_same_session(self):
+        assert session_id_for_user("51987654321") == session_id_for_user("+51 987 654 321")
+
+    def test_different_phones_different_sessions(self):
+        assert session_id_for_user("51987654321") != session_id_for_user("51987654322")
+
+    def test_hashed_by_default(self):
+        session_id = session_id_for_user("51987654321")
+        assert session_id.startswith("session_")
+        assert "51987654321" not in session_id
+
+    def test_plain_session_id(self):
+        assert session_id_for_user("51987654321", hashed=False) == "session_51987654321"
+
+
+class TestLegacySessionMigration:
+    """Tests para la migración de sesiones session_<timestamp> de memory.db"""
+
+    @pytest.fixture
+    def persistence(self, tmp_path):
+        return LocalMemoryPersistence(base_path=str(tmp_path))
+
+    def test_rekeys_single_user_session(self, persistence):
+        old_id = "session_1717000000"
+        persistence.save_episodic_message(old_id, "human", "hola", user_metadata("51911111111"))
+        persistence.save_episodic_message(old_id, "ai", "¡Hola!", user_metadata("51911111111"))
+        persistence.save_semantic_knowledge(old_id, "user_nombre", "Ana", "user_profile")
+        persistence.save_procedural_knowledge(old_id, "consulta_vacaciones", ["buscar_documentos"])
+
+        report = persistence.rekey_legacy_sessions()
+
+        new_id = session_id_for_user("51911111111")
+        assert report["sessions_migrated"] == 1
+        assert report["mapping"] == {old_id: new_id}
+        assert len(persistence.get_episodic_messages(new_id)) == 2
+        assert persistence.get_semantic_knowledge(new_id)[0]["knowledge"] == "Ana"
+        assert len(persistence.get_procedural_knowledge(new_id)) == 1
+        assert persistence.get_episodic_messages(old_id) == []
+
+        with sqlite3.connect(persistence.db_path) as conn:
+            rows = dict(conn.execute("SELECT session_id, total_messages FROM session_metadata").fetchall())
+        assert rows == {new_id: 2}
+
+    def test_merges_into_existing_session(self, persistence):
+        new_id = session_id_for_user("51911111111")
+        persistence.save_episodic_message(new_id, "human", "nuevo", user_metadata("51911111111"))
+        persistence.save_episodic_message("session_1717000000", "human", "antiguo", user_metadata("51911111111"))
+
+        persistence.rekey_legacy_sessions()
+
+        with sqlite3.connect(persistence.db_path) as conn:
+            rows = dict(conn.execute("SELECT session_id, total_messages FROM session_metadata").fetchall())
+        assert rows == {new_id: 2}
+        assert len(persistence.get_episodic_messages(new_id)) == 2
+
+    def test_shared_session_splits_messages(self, persistence):
+        """Dos usuarios creados en el mismo segundo compartían sesión"""
+        old_id = "session_1717000000"
+        persistence.save_episodic_message(old_id, "human", "soy uno", user_metadata("51911111111"))
+        persistence.save_episodic_message(old_id, "human", "soy dos", user_metadata("51922222222"))
+        persistence.save_semantic_knowledge(old_id, "user_nombre", "¿?", "user_profile")
+
+        report = persistence.rekey_legacy_sessions()
+
+        assert report["ambiguous"] == [old_id]
+        assert report["rows_rekeyed"] == 2
+        first = persistence.get_episodic_messages(session_id_for_user("51911111111"))
+        second = persistence.get_episodic_messages(session_id_for_user("51922222222"))
+        assert [m["content"] for m in first] == ["soy uno"]
+        assert [m["content"] for m in second] == ["soy dos"]
+        # El conocimiento no atribuible queda en la sesión antigua
+        assert len(persistence.get_semantic_knowledge(old_id)) == 1
+
+    def test_sessions_without_phone_and_new_sessions_are_untouched(self, persistence):
+        persistence.save_episodic_message("session_1717000000", "human", "sin contexto")
+        persistence.save_episodic_message("session_51911111111", "human", "ya migrada", user_metadata("51911111111"))
+
+        report = persistence.rekey_legacy_sessions()
+
+        assert report["without_phone"] == ["session_1717000000"]
+        assert report["sessions_migrated"] == 0
+        assert len(persistence.get_episodic_messages("session_51911111111")) == 1
+
+    def test_migration_is_idempotent(self, persistence):
+        persistence.save_episodic_message("session_1717000000", "human", "hola", user_metadata("51911111111"))
+        persistence.rekey_legacy_sessions()
+        report = persistence.rekey_legacy_sessions()
+        assert report["sessions_migrated"] == 0
+        assert report["rows_rekeyed"] == 0
+
+
+class TestSQLiteConnectionPool:
+    """Tests para el pool de conexiones SQLite de la memoria local"""
+
+    def test_wal_and_synchronous_normal(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        conn = persistence.pool.connection()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+    def test_one_connection_per_thread(self, tmp_path):
+        pool = get_sqlite_pool(str(tmp_path / "pool.db"))
+        assert pool.connection() is pool.connection()
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(pool.connection()))
+        thread.start()
+        thread.join()
+        assert other[0] is not pool.connection()
+
+    def test_schema_is_created_once_per_file(self, tmp_path):
+        with patch.object(LocalMemoryPersistence, "_init_local_db", autospec=True,
+                          side_effect=LocalMemoryPersistence._init_local_db) as init_db:
+            first = LocalMemoryPersistence(base_path=str(tmp_path))
+            second = LocalMemoryPersistence(base_path=str(tmp_path))
+        assert init_db.call_count == 1
+        assert first.pool is second.pool
+
+    def test_memory_systems_share_persistence(self):
+        assert get_local_persistence() is get_local_persistence()
+
+    def test_writes_from_several_threads(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+
+        def write(worker):
+            for i in range(50):
+                persistence.save_episodic_message(f"session_{worker}", "human", f"mensaje {i}")
+
+        threads = [threading.Thread(target=write, args=(w,)) for w in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert all(len(persistence.get_episodic_messages(f"session_{w}")) == 50 for w in range(4))
+
+
+class TestSQLitePoolBenchmark:
+    """Benchmark: inserciones/s y latencia de lectura, pool vs conexión por llamada"""
+
+    MESSAGES = 1000
+    READS = 200
+
+    def _legacy_save(self, db_path, session_id, content):
+        """Comportamiento anterior: una conexión nueva por operación, journal por defecto"""
+        with sqlite3.connect(db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO episodic_memory (session_id, message_type, content, metadata) VALUES (?, ?, ?, ?)",
+                (session_id, "human", content, "{}")
+            )
+            cursor.execute("""
+                INSERT OR REPLACE INTO session_metadata (session_id, last_activity, total_messages)
+                VALUES (?, CURRENT_TIMESTAMP, COALESCE(
+                    (SELECT total_messages FROM session_metadata WHERE session_id = ?), 0) + 1)
+            """, (session_id, session_id))
+            conn.commit()
+
+    def _legacy_read(self, db_path, session_id):
+        with sqlite3.connect(db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM episodic_memory WHERE session_id = ? ORDER BY created_at ASC LIMIT 10",
+                           (session_id,))
+            return cursor.fetchall()
+
+    def test_pool_is_faster_than_connect_per_call(self, tmp_path):
+        # Base "antes": mismo esquema, sin WAL
+        legacy_dir = tmp_path / "legacy"
+        legacy = LocalMemoryPersistence(base_path=str(legacy_dir))
+        legacy.pool.close_all()
+        legacy_path = legacy.db_path
+        with sqlite3.connect(legacy_path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+
+        start = time.perf_counter()
+        for i in range(self.MESSAGES):
+            self._legacy_save(legacy_path, f"session_{i % 20}", f"mensaje {i}")
+        legacy_inserts = self.MESSAGES / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(self.READS):
+            self._legacy_read(legacy_path, f"session_{i % 20}")
+        legacy_read_ms = (time.perf_counter() - start) * 1000 / self.READS
+
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path / "pool"))
+        start = time.perf_counter()
+        for i in range(self.MESSAGES):
+            persistence.save_episodic_message(f"session_{i % 20}", "human", f"mensaje {i}")
+        pool_inserts = self.MESSAGES / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(self.READS):
+            persistence.get_episodic_messages(f"session_{i % 20}", limit=10)
+        pool_read_ms = (time.perf_counter() - start) * 1000 / self.READS
+
+        print(f"\n💾 Inserciones/s: {legacy_inserts:,.0f} → {pool_inserts:,.0f}")
+        print(f"📖 Latencia de lectura: {legacy_read_ms:.3f}ms → {pool_read_ms:.3f}ms")
+
+        assert pool_inserts > legacy_inserts
+        assert pool_read_ms < legacy_read_ms
+
+
+
+class TestMemoryWriteBuffer:
+    """Tests para las escrituras diferidas de memoria"""
+
+    @pytest.fixture
+    def persistence(self, tmp_path):
+        return LocalMemoryPersistence(base_path=str(tmp_path))
+
+    @pytest.fixture
+    def remote(self):
+        return FakeSupabase()
+
+    @pytest.fixture
+    def make_buffer(self, persistence, remote):
+        buffers = []
+
+        def factory(**kwargs):
+            options = {"batch_size": 100, "flush_interval": 60, "remote_request": remote}
+            options.update(kwargs)
+            buffer = MemoryWriteBuffer(persistence, **options)
+            buffers.append(buffer)
+            return buffer
+
+        yield factory
+        for buffer in buffers:
+            buffer.stop()
+
+    def test_writes_wait_in_ram_until_flush(self, make_buffer, persistence, remote):
+        buffer = make_buffer()
+        for i in range(10):
+            buffer.add_episodic("session_a", "human", f"mensaje {i}", {"timestamp": "2026-01-01T00:00:00"})
+        buffer.add_semantic("session_a", "user_nombre", "Ana", "user_profile", 0.8)
+
+        assert buffer.pending() == 11
+        assert persistence.get_episodic_messages("session_a") == []
+
+        assert buffer.flush() == 11
+        assert len(persistence.get_episodic_messages("session_a")) == 10
+        assert persistence.get_semantic_knowledge("session_a")[0]["knowledge"] == "Ana"
+
+    def test_remote_sync_is_one_bulk_insert_per_table(self, make_buffer, remote):
+        buffer = make_buffer()
+        for i in range(10):
+            buffer.add_episodic("session_a", "human", f"mensaje {i}", {"timestamp": "2026-01-01T00:00:00"})
+        buffer.add_semantic("session_a", "user_nombre", "Ana", "user_profile", 0.8)
+        buffer.flush()
+
+        assert [(method, endpoint, len(data)) for method, endpoint, data in remote.calls] == [
+            ("POST", "chat_history", 10), ("POST", "semantic_memory", 1)
+        ]
+        first = remote.calls[0][2][0]
+        assert first["content"] == {"content": "mensaje 0"}
+        assert first["created_at"] == "2026-01-01T00:00:00"
+
+    def test_flush_on_size(self, make_buffer, persistence):
+        buffer = make_buffer(batch_size=5)
+        for i in range(5):
+            buffer.add_episodic("session_a", "human", f"mensaje {i}")
+        assert wait_until(lambda: len(persistence.get_episodic_messages("session_a")) == 5)
+
+    def test_flush_on_time(self, make_buffer, persistence):
+        buffer = make_buffer(flush_interval=0.05)
+        buffer.add_episodic("session_a", "human", "hola")
+        assert wait_until(lambda: len(persistence.get_episodic_messages("session_a")) == 1)
+
+    def test_stop_flushes_pending_writes(self, make_buffer, persistence, remote):
+        buffer = make_buffer()
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.stop()
+        assert buffer.pending() == 0
+        assert len(persistence.get_episodic_messages("session_a")) == 1
+        assert len(remote.calls) == 1
+
+    def test_remote_failure_keeps_rows_for_retry(self, make_buffer, persistence, remote):
+        remote.status_code = 503
+        buffer = make_buffer(remote_retry_interval=0)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+
+        # Durable en SQLite aunque Supabase falle
+        assert len(persistence.get_episodic_messages("session_a")) == 1
+        assert len(persistence.get_unsynced("episodic_memory")) == 1
+        assert buffer.get_stats()["remote_failures"] == 1
+
+        remote.status_code = 201
+        buffer.flush()
+        assert persistence.get_unsynced("episodic_memory") == []
+        assert buffer.get_stats()["remote_rows"] == 1
+
+    def test_remote_failure_backs_off(self, make_buffer, remote):
+        remote.status_code = 503
+        buffer = make_buffer(remote_retry_interval=60)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+        buffer.add_episodic("session_a", "human", "otra vez")
+        buffer.flush()
+        assert len(remote.calls) == 1
+
+    def test_rejected_rows_do_not_block_later_ones(self, make_buffer, persistence, remote):
+        """Un 400 (p. ej. el CHECK de message_type) aparta solo la fila rechazada"""
+        remote.reject = lambda row: row["message_type"] == "unknown"
+        buffer = make_buffer(remote_retry_interval=60)
+        for i in range(8):
+            buffer.add_episodic("session_a", "unknown" if i == 5 else "human", f"mensaje {i}")
+        buffer.flush()
+
+        stats = buffer.get_stats()
+        assert stats["remote_rows"] == 7
+        assert stats["remote_rejected"] == 1
+        assert stats["remote_failures"] == 0
+        assert persistence.get_unsynced("episodic_memory") == []
+
+        # Los mensajes siguientes se sincronizan sin esperar al reintento
+        buffer.add_episodic("session_a", "human", "después")
+        buffer.flush()
+        assert remote.calls[-1][2][0]["content"] == {"content": "después"}
+        assert buffer.get_stats()["remote_rows"] == 8
+
+    def test_transient_failure_does_not_park_rows(self, make_buffer, persistence, remote):
+        remote.status_code = 429
+        buffer = make_buffer(remote_retry_interval=60)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.add_episodic("session_a", "human", "chau")
+        buffer.flush()
+        assert len(remote.calls) == 1  # sin partir el lote
+        assert len(persistence.get_unsynced("episodic_memory")) == 2
+        assert buffer.get_stats()["remote_rejected"] == 0
+
+    def test_resent_batch_is_not_duplicated(self, persistence):
+        """Timeout tras enviar el POST: el reenvío lleva las mismas sync_key y no duplica filas"""
+        stub = PostgRESTStub()
+        client = SupabaseClient(base_url="http://supabase.test", transport=stub.transport(), retry_backoff=0,
+                                max_retries=0, breaker=CircuitBreaker(failure_threshold=10 ** 6))
+        sent = []
+
+        def lost_response(**kwargs):
+            response = client.request_sync(**kwargs)
+            if not sent:
+                sent.append(kwargs)
+                raise httpx.ReadTimeout("respuesta perdida")
+            return response
+
+        buffer = MemoryWriteBuffer(persistence, batch_size=100, flush_interval=60,
+                                   remote_request=lost_response, remote_retry_interval=0)
+        try:
+            buffer.add_episodic("session_a", "human", "hola", {"message_id": "m1"})
+            buffer.add_semantic("session_a", "user_nombre", "Ana", "user_profile", 0.8)
+            buffer.flush()
+            assert len(persistence.get_unsynced("episodic_memory")) == 1
+
+            buffer.flush()
+            assert persistence.get_unsynced("episodic_memory") == []
+            assert persistence.get_unsynced("semantic_memory") == []
+            assert [row["sync_key"] for row in stub.rows("chat_history")] == ["m1"]
+            assert len(stub.rows("semantic_memory")) == 1
+        finally:
+            buffer.stop()
+
+    def test_idle_flush_does_not_query_sqlite(self, make_buffer, persistence, remote):
+        """En reposo el hilo de volcado no vuelve a leer la cola de sincronización ni la de embeddings"""
+        buffer = make_buffer(embedder=MessageEmbedder(embeddings=FakeEmbeddings(), model="fake", dimensions=8))
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+        assert len(remote.calls) == 1
+
+        with patch.object(persistence, "get_unsynced", side_effect=AssertionError("consulta en reposo")), \
+                patch.object(persistence, "get_unembedded", side_effect=AssertionError("consulta en reposo")):
+            for _ in range(5):
+                buffer.flush()
+
+        buffer.add_episodic("session_a", "human", "otra")
+        buffer.flush()
+        assert len(remote.calls) == 2
+        assert buffer.get_stats()["vectors"] == 2
+
+    def test_failed_sync_is_retried_without_new_writes(self, make_buffer, persistence, remote):
+        remote.status_code = 503
+        buffer = make_buffer(remote_retry_interval=0)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+        remote.status_code = 201
+        buffer.flush()
+        assert persistence.get_unsynced("episodic_memory") == []
+
+    def test_unsynced_queue_uses_partial_index(self, persistence):
+        with persistence.pool.connection() as conn:
+            for table, index in (("episodic_memory", "idx_episodic_unsynced"),
+                                 ("semantic_memory", "idx_semantic_unsynced")):
+                plan = " ".join(row[-1] for row in conn.execute(
+                    f"EXPLAIN QUERY PLAN SELECT * FROM {table} "
+                    "WHERE NOT synced_to_remote AND NOT sync_failed ORDER BY id LIMIT 100"))
+                assert index in plan
+
+    def test_existing_database_gets_sync_failed_column(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        with persistence.pool.connection() as conn:
+            conn.execute("ALTER TABLE episodic_memory DROP COLUMN sync_failed")
+            conn.execute("INSERT INTO episodic_memory (session_id, message_type, content) VALUES ('session_a', 'human', 'hola')")
+
+        persistence.pool.schema_ready = False
+        upgraded = LocalMemoryPersistence(base_path=str(tmp_path))
+        assert [row["content"] for row in upgraded.get_unsynced("episodic_memory")] == ["hola"]
+
+    def test_local_only_mode(self, make_buffer, persistence, remote):
+        buffer = make_buffer(remote_sync=False)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+        assert remote.calls == []
+        assert len(persistence.get_episodic_messages("session_a")) == 1
+
+    def test_knowledge_from_deferred_tasks_is_saved_in_the_same_flush(self, make_buffer, persistence):
+        buffer = make_buffer()
+        semantic = SemanticMemory("session_a", local_persistence=persistence, write_buffer=buffer)
+        buffer.add_task(semantic.extract_and_store_from_conversation,
+                        [HumanMessage(content="Mi nombre es Ana y trabajo en una empresa")])
+        buffer.flush()
+        concepts = {row["concept"] for row in persistence.get_semantic_knowledge("session_a")}
+        assert concepts == {"user_name", "user_profession", "discussed_topics"}
+        assert buffer.pending() == 0
+
+    def test_messages_reach_sqlite_before_deferred_tasks_run(self, make_buffer, persistence):
+        """Las tareas (GET/PATCH a Supabase) no retrasan la durabilidad local de los mensajes"""
+        buffer = make_buffer()
+        seen_by_task = []
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.add_semantic("session_a", "user_nombre", "Ana", "user_profile", 0.8)
+        buffer.add_task(lambda: seen_by_task.append((
+            len(persistence.get_episodic_messages("session_a")),
+            len(persistence.get_semantic_knowledge("session_a")),
+        )))
+        buffer.flush()
+        assert seen_by_task == [(1, 1)]
+
+    def test_task_errors_do_not_stop_the_flush(self, make_buffer, persistence):
+        buffer = make_buffer()
+        buffer.add_task(lambda: 1 / 0)
+        buffer.add_episodic("session_a", "human", "hola")
+        buffer.flush()
+        assert buffer.get_stats()["task_errors"] == 1
+        assert len(persistence.get_episodic_messages("session_a")) == 1
+
+    def test_add_message_does_not_touch_supabase(self, make_buffer, persistence):
+        buffer = make_buffer()
+        episodic = EpisodicMemory("session_a", local_persistence=persistence, write_buffer=buffer)
+        semantic = SemanticMemory("session_a", local_persistence=persistence, write_buffer=buffer)
+        with patch("memoria.make_supabase_request", side_effect=AssertionError("Supabase en el camino de la respuesta")):
+            episodic.add_message(HumanMessage(content="hola"), {"user_context": {}})
+            semantic.store_knowledge("user_nombre", "Ana", "user_profile")
+        assert buffer.pending() == 2
+
+    def test_restored_backup_is_not_synced_again(self, make_buffer, persistence, remote):
+        persistence.save_episodic_message("session_a", "human", "hola")
+        persistence.mark_synced("episodic_memory", [m["id"] for m in persistence.get_episodic_messages("session_a")])
+        persistence.create_compressed_backup("session_a")
+        with persistence.pool.connection() as conn:
+            conn.execute("DELETE FROM episodic_memory")
+
+        assert persistence.restore_from_backup("session_a")
+        assert persistence.get_unsynced("episodic_memory") == []
+
+
+class TestMemoryWriteBufferBenchmark:
+    """Benchmark: latencia de add_message con Supabase en línea vs escritura diferida"""
+
+    MESSAGES = 200
+    SUPABASE_LATENCY = 0.005
+
+    def test_reply_path_is_independent_of_supabase(self, tmp_path):
+        remote = FakeSupabase(delay=self.SUPABASE_LATENCY)
+
+        # Antes: insert local + POST a Supabase por mensaje, en el camino de la respuesta
+        legacy = LocalMemoryPersistence(base_path=str(tmp_path / "legacy"))
+        start = time.perf_counter()
+        for i in range(self.MESSAGES):
+            legacy.save_episodic_message("session_a", "human", f"mensaje {i}")
+            remote(method="POST", endpoint="chat_history", data={"content": {"content": f"mensaje {i}"}})
+        legacy_ms = (time.perf_counter() - start) * 1000 / self.MESSAGES
+        legacy_requests = len(remote.calls)
+
+        remote.calls.clear()
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path / "buffer"))
+        buffer = MemoryWriteBuffer(persistence, batch_size=50, flush_interval=60, remote_request=remote)
+        start = time.perf_counter()
+        for i in range(self.MESSAGES):
+            buffer.add_episodic("session_a", "human", f"mensaje {i}")
+        buffered_ms = (time.perf_counter() - start) * 1000 / self.MESSAGES
+        buffer.stop()
+
+        print(f"\n✍️ Latencia por mensaje: {legacy_ms:.3f}ms → {buffered_ms:.3f}ms")
+        print(f"☁️ Peticiones a Supabase: {legacy_requests} → {len(remote.calls)}")
+
+        assert len(persistence.get_episodic_messages("session_a")) == self.MESSAGES
+        assert persistence.get_unsynced("episodic_memory") == []
+        assert len(remote.calls) <= self.MESSAGES // 10
+        assert buffered_ms < legacy_ms / 10
+
+
+class TestIncrementalEpisodicLoading:
+    """Tests para la carga incremental de la memoria episódica"""
+
+    @pytest.fixture
+    def stub(self):
+        stub = PostgRESTStub()
+        client = SupabaseClient(base_url="http://supabase.test", transport=stub.transport(), retry_backoff=0,
+                                breaker=CircuitBreaker(failure_threshold=10 ** 6))
+        with patch("cliente_supabase.supabase_client", client):
+            yield stub
+
+    @pytest.fixture
+    def buffer(self, tmp_path):
+        buffer = MemoryWriteBuffer(LocalMemoryPersistence(base_path=str(tmp_path)), batch_size=1000, flush_interval=60)
+        yield buffer
+        buffer.stop()
+
+    def seed(self, stub, count, session_id="session_a", start=0):
+        for i in range(start, start + count):
+            stub.rows("chat_history").append({
+                "id": i, "session_id": session_id, "message_type": "human" if i % 2 == 0 else "ai",
+                "content": {"content": f"mensaje {i}"}, "metadata": {},
+                "created_at": f"2026-01-01T00:00:{i:06d}"
+            })
+
+    def gets(self, stub):
+        return [dict(request.url.params) for request in stub.requests if request.method == "GET"]
+
+    def test_loads_only_the_tail(self, stub, buffer):
+        self.seed(stub, 50)
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10)
+        assert [m.content for m in episodic.messages] == [f"mensaje {i}" for i in range(40, 50)]
+        assert self.gets(stub)[0]["order"] == "created_at.desc"
+        assert self.gets(stub)[0]["limit"] == "10"
+
+    def test_add_message_appends_without_refetch(self, stub, buffer):
+        self.seed(stub, 4)
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10)
+        episodic.messages
+        episodic.add_message(HumanMessage(content="nuevo"))
+        episodic.add_message(AIMessage(content="respuesta"))
+
+        assert [m.content for m in episodic.messages][-2:] == ["nuevo", "respuesta"]
+        assert len(self.gets(stub)) == 1
+
+    def test_refresh_fetches_only_newer_messages(self, stub, buffer):
+        self.seed(stub, 4)
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10, refresh_interval=0)
+        episodic.messages
+
+        self.seed(stub, 2, start=4)   # escritos por otro worker
+        contents = [m.content for m in episodic.messages]
+
+        assert contents == [f"mensaje {i}" for i in range(6)]
+        assert self.gets(stub)[-1]["id"] == "gt.3"
+
+    def test_late_rows_with_older_timestamps_are_not_missed(self, stub, buffer):
+        """El delta va por id: una fila que llega tarde con created_at antiguo igual se recibe"""
+        self.seed(stub, 4)
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10, refresh_interval=0)
+        episodic.messages
+
+        stub.rows("chat_history").append({
+            "id": 4, "session_id": "session_a", "message_type": "human",
+            "content": {"content": "escrito antes, sincronizado después"}, "metadata": {},
+            "created_at": "2026-01-01T00:00:000001"
+        })
+        assert [m.content for m in episodic.messages][-1] == "escrito antes, sincronizado después"
+
+    def test_own_messages_are_not_duplicated_by_delta(self, stub, buffer):
+        self.seed(stub, 2)
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10, refresh_interval=0)
+        episodic.messages
+        episodic.add_message(HumanMessage(content="mío"))
+        buffer.flush()   # ya está en Supabase
+
+        assert [m.content for m in episodic.messages] == ["mensaje 0", "mensaje 1", "mío"]
+        assert [m.content for m in episodic.messages] == ["mensaje 0", "mensaje 1", "mío"]
+
+    def test_pending_writes_are_visible_to_a_new_instance(self, stub, buffer):
+        EpisodicMemory("session_a", write_buffer=buffer).add_message(HumanMessage(content="aún en RAM"))
+        assert [m.content for m in EpisodicMemory("session_a", write_buffer=buffer).messages] == ["aún en RAM"]
+
+    def test_unsynced_local_rows_follow_the_remote_tail(self, stub, buffer):
+        """Filas ya en SQLite pero sin subir (Supabase en backoff) no desaparecen al rehidratar"""
+        self.seed(stub, 3)
+        buffer.remote_sync = False
+        buffer.add_episodic("session_a", "human", "en SQLite", {"message_id": "wamid.local"})
+        buffer.flush()
+        buffer.add_episodic("session_a", "ai", "aún en RAM")
+
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10)
+        assert [m.content for m in episodic.messages] == ["mensaje 0", "mensaje 1", "mensaje 2",
+                                                          "en SQLite", "aún en RAM"]
+
+    def test_synced_local_rows_are_not_duplicated(self, stub, buffer):
+        self.seed(stub, 2)
+        buffer.add_episodic("session_a", "human", "subido", {"message_id": "wamid.up"})
+        buffer.flush()
+
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=10)
+        assert [m.content for m in episodic.messages] == ["mensaje 0", "mensaje 1", "subido"]
+
+    def test_falls_back_to_local_tail(self, stub, buffer):
+        for i in range(5):
+            buffer.add_episodic("session_a", "human", f"local {i}")
+        stub.down = True
+        episodic = EpisodicMemory("session_a", local_persistence=buffer.persistence, write_buffer=buffer, window=3)
+        assert [m.content for m in episodic.messages] == ["local 2", "local 3", "local 4"]
+
+    def test_log_is_bounded_by_window(self, stub, buffer):
+        episodic = EpisodicMemory("session_a", write_buffer=buffer, window=5)
+        episodic.messages
+        for i in range(20):
+            episodic.add_message(HumanMessage(content=f"m{i}"))
+        assert [m.content for m in episodic.messages] == [f"m{i}" for i in range(15, 20)]
+        assert len(episodic._message_ids) <= 10
+
+
+class TestIncrementalEpisodicBenchmark:
+    """Benchmark: filas descargadas por turno, historial completo vs cola + deltas"""
+
+    HISTORY = 2000
+    TURNS = 20
+
+    def test_rows_downloaded_per_turn(self, tmp_path):
+        stub = PostgRESTStub()
+        client = SupabaseClient(base_url="http://supabase.test", transport=stub.transport())
+        for i in range(self.HISTORY):
+            stub.rows("chat_history").append({
+                "id": i + 1, "session_id": "session_a", "message_type": "human", "content": {"content": f"mensaje {i}"},
+                "metadata": {}, "created_at": f"2026-01-01T00:00:{i:06d}"
+            })
+
+        # Antes: add_message invalidaba la caché y cada turno bajaba todo el historial
+        legacy_rows = 0
+        for _ in range(self.TURNS):
+            response = client.request_sync("GET", "chat_history",
+                                           params={"session_id": "eq.session_a", "order": "created_at.asc"})
+            legacy_rows += len(response.json())
+
+        buffer = MemoryWriteBuffer(LocalMemoryPersistence(base_path=str(tmp_path)), flush_interval=60,
+                                   remote_request=lambda **kwargs: client.request_sync(**kwargs))
+        stub.requests.clear()
+        rows_seen = 0
+        with patch("cliente_supabase.supabase_client", client):
+            episodic = EpisodicMemory("session_a", write_buffer=buffer, refresh_interval=0)
+            for turn in range(self.TURNS):
+                episodic.add_message(HumanMessage(content=f"turno {turn}"))
+                buffer.flush()
+                episodic.messages
+        buffer.stop()
+        for request in [r for r in stub.requests if r.method == "GET"]:
+            rows_seen += len(client.request_sync("GET", "chat_history", params=dict(request.url.params)).json())
+
+        print(f"\n📉 Filas descargadas en {self.TURNS} turnos: {legacy_rows:,} → {rows_seen:,}")
+        assert rows_seen < legacy_rows / 20
+
+
+class TestEpisodicFullTextSearch:
+    """Tests para la búsqueda FTS5 en la memoria episódica"""
+
+    @pytest.fixture
+    def persistence(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        persistence.save_episodic_messages([
+            ("session_a", "human", "¿Cuántos días de vacaciones me corresponden este año?", {}),
+            ("session_a", "ai", "Te corresponden 30 días de vacación por año completo de servicio.", {}),
+            ("session_a", "human", "¿Y cómo se calcula la gratificación de julio?", {}),
+            ("session_a", "human", "Necesito un permiso por paternidad", {}),
+            ("session_b", "human", "Mis vacaciones empiezan el lunes", {}),
+        ])
+        return persistence
+
+    def search(self, persistence, query, limit=5, session_id="session_a"):
+        return [row["content"] for row in persistence.search_episodic(session_id, query, limit)]
+
+    def test_multiword_query_does_not_need_verbatim_match(self, persistence):
+        results = self.search(persistence, "vacaciones días")
+        assert results[0].startswith("¿Cuántos días de vacaciones")
+
+    def test_accents_are_folded(self, persistence):
+        assert self.search(persistence, "gratificacion") == ["¿Y cómo se calcula la gratificación de julio?"]
+        assert len(self.search(persistence, "vacacion")) == 1
+
+    def test_more_matching_terms_rank_higher(self, persistence):
+        results = self.search(persistence, "días vacaciones corresponden año")
+        assert results[0] == "¿Cuántos días de vacaciones me corresponden este año?"
+        assert len(results) == 2
+
+    def test_results_are_scoped_to_session_and_limited(self, persistence):
+        assert self.search(persistence, "vacaciones", session_id="session_b") == ["Mis vacaciones empiezan el lunes"]
+        assert len(self.search(persistence, "días vacaciones permiso gratificación", limit=2)) == 2
+
+    def test_stopwords_only_query_returns_nothing(self, persistence):
+        assert fts_query("¿de la que?") == ""
+        assert self.search(persistence, "¿de la que?") == []
+
+    def test_user_input_cannot_break_fts_syntax(self, persistence):
+        assert self.search(persistence, 'permiso" OR NEAR(* AND') == ["Necesito un permiso por paternidad"]
+
+    def test_triggers_keep_index_in_sync(self, persistence):
+        with persistence.pool.connection() as conn:
+            conn.execute("UPDATE episodic_memory SET content = 'Consulta sobre utilidades' WHERE content LIKE '%paternidad%'")
+            conn.execute("DELETE FROM episodic_memory WHERE content LIKE '%gratificación%'")
+        assert self.search(persistence, "paternidad") == []
+        assert self.search(persistence, "utilidades") == ["Consulta sobre utilidades"]
+        assert self.search(persistence, "gratificación") == []
+
+    def test_existing_messages_are_indexed_on_upgrade(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        with persistence.pool.connection() as conn:
+            for name in ("episodic_fts_insert", "episodic_fts_delete", "episodic_fts_update"):
+                conn.execute(f"DROP TRIGGER {name}")
+            conn.execute("DROP TABLE episodic_fts")
+            conn.execute("PRAGMA user_version = 1")
+            conn.execute("INSERT INTO episodic_memory (session_id, message_type, content) "
+                         "VALUES ('session_a', 'human', 'mensaje anterior a FTS')")
+
+        persistence.pool.schema_ready = False
+        upgraded = LocalMemoryPersistence(base_path=str(tmp_path))
+        assert upgraded.fts_enabled
+        assert [r["content"] for r in upgraded.search_episodic("session_a", "anterior")] == ["mensaje anterior a FTS"]
+
+    def test_session_filter_is_part_of_the_match(self, persistence):
+        """La sesión se filtra en el índice: ids que la contienen o términos del id no se cuelan"""
+        persistence.save_episodic_messages([
+            ("session_a_2", "human", "Mis vacaciones de otra sesión", {}),
+            ("session_c", "human", "Pregunta sobre session y vacaciones", {}),
+        ])
+        assert self.search(persistence, "vacaciones", session_id="session_a_2") == ["Mis vacaciones de otra sesión"]
+        assert len(self.search(persistence, "vacaciones")) == 1
+        assert self.search(persistence, "session") == []
+        assert self.search(persistence, "session", session_id="session_c") == ["Pregunta sobre session y vacaciones"]
+
+    def test_content_only_index_is_rebuilt_with_session_column(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        with persistence.pool.connection() as conn:
+            for name in ("episodic_fts_insert", "episodic_fts_delete", "episodic_fts_update"):
+                conn.execute(f"DROP TRIGGER {name}")
+            conn.execute("DROP TABLE episodic_fts")
+            conn.execute("CREATE VIRTUAL TABLE episodic_fts USING fts5(content, content='episodic_memory', "
+                         "content_rowid='id')")
+            conn.execute("PRAGMA user_version = 2")
+            conn.execute("INSERT INTO episodic_memory (session_id, message_type, content) "
+                         "VALUES ('session_a', 'human', 'mensaje de la versión 2')")
+
+        persistence.pool.schema_ready = False
+        upgraded = LocalMemoryPersistence(base_path=str(tmp_path))
+        with upgraded.pool.connection() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(episodic_fts)")]
+            assert columns == ["content", "session_id"]
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == 4
+        assert [r["content"] for r in upgraded.search_episodic("session_a", "versión")] == ["mensaje de la versión 2"]
+
+    def test_search_memory_returns_ranked_messages(self, persistence):
+        memory_system = SimpleNamespace(session_id="session_a", local_persistence=persistence)
+        results = AdvancedMemorySystem.search_memory(memory_system, "vacaciones días", limit=2)
+        assert isinstance(results[0], HumanMessage)
+        assert isinstance(results[1], AIMessage)
+
+
+class TestEpisodicSearchBenchmark:
+    """Benchmark: recorrido lineal vs FTS5/BM25 con 10k y 100k mensajes por sesión"""
+
+    VOCABULARY = ("vacaciones permiso sueldo horario contrato gratificación despido licencia "
+                  "utilidades boleta jornada descanso feriado renuncia liquidación seguro").split()
+    QUERIES = ["vacaciones pendientes", "cómo se calcula la gratificación", "liquidación por renuncia",
+               "horas extra en feriado", "licencia por paternidad"]
+
+    @pytest.mark.parametrize("messages", [10_000, 100_000])
+    def test_fts_vs_linear_scan(self, tmp_path, messages):
+        rng = random.Random(messages)
+        # Relleno con distribución de Zipf (como el lenguaje natural) + 1-2 términos laborales por mensaje
+        filler = [f"palabra{i}" for i in range(3000)]
+        cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(3000)))
+        contents = [
+            " ".join(rng.choices(filler, cum_weights=cum_weights, k=10) + rng.sample(self.VOCABULARY, rng.randint(1, 2)))
+            for _ in range(messages)
+        ]
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        persistence.save_episodic_messages([("session_a", "human", c, {}) for c in contents])
+
+        # Antes: substring de toda la consulta sobre todos los mensajes
+        start = time.perf_counter()
+        linear_found = 0
+        for query in self.QUERIES:
+            query_lower = query.lower()
+            linear_found += len([content for content in contents if query_lower in content.lower()][:5])
+        linear_ms = (time.perf_counter() - start) * 1000 / len(self.QUERIES)
+
+        start = time.perf_counter()
+        found = 0
+        for query in self.QUERIES:
+            found += len(persistence.search_episodic("session_a", query, limit=5))
+        fts_ms = (time.perf_counter() - start) * 1000 / len(self.QUERIES)
+
+        print(f"\n🔎 {messages:,} mensajes: recorrido lineal {linear_ms:.1f}ms → FTS5 {fts_ms:.1f}ms por consulta "
+              f"(resultados: {linear_found} → {found})")
+        assert found > linear_found
+        assert fts_ms < linear_ms * 2
+
+
+class FakeEmbeddings:
+    """Embeddings deterministas: palabras del mismo tema comparten dimensión"""
+
+    TOPICS = {
+        "vacaciones": 0, "vacacion": 0, "libres": 0, "descanso": 0, "feriado": 0,
+        "sueldo": 1, "pago": 1, "salario": 1, "remuneracion": 1, "gratificacion": 1,
+        "contrato": 2, "renuncia": 2, "despido": 2, "liquidacion": 2,
+    }
+
+    def __init__(self, dim: int = 32, fail: bool = False):
+        self.dim = dim
+        self.fail = fail
+        self.calls = []
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in fts_query(text).replace('"', "").split(" OR "):
+            folded = word.translate(str.maketrans("áéíóú", "aeiou"))
+            index = self.TOPICS.get(folded, 3 + hash(folded) % (self.dim - 3))
+            vector[index] += 3.0 if folded in self.TOPICS else 0.3
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        if self.fail:
+            raise RuntimeError("OpenAI no disponible")
+        self.calls.append(list(texts))
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text):
+        self.calls.append([text])
+        return self._vector(text)
+
+
+class TestVectorRecall:
+    """Tests para el recuerdo vectorial de preguntas pasadas"""
+
+    @pytest.fixture
+    def embeddings(self):
+        return FakeEmbeddings()
+
+    @pytest.fixture
+    def embedder(self, embeddings):
+        return MessageEmbedder(embeddings=embeddings, model="fake", dimensions=32, batch_size=2)
+
+    @pytest.fixture
+    def buffer(self, tmp_path, embedder):
+        buffer = MemoryWriteBuffer(LocalMemoryPersistence(base_path=str(tmp_path)), flush_interval=60,
+                                   remote_sync=False, embedder=embedder)
+        yield buffer
+        buffer.stop()
+
+    def write(self, buffer, *messages, session_id="session_a"):
+        for message_type, content in messages:
+            buffer.add_episodic(session_id, message_type, content)
+        buffer.flush()
+
+    def test_embed_many_batches_and_caches(self, embedder, embeddings):
+        texts = ["uno", "dos", "tres", "uno", "cuatro"]
+        matrix = embedder.embed_many(texts)
+        assert matrix.shape == (5, 32)
+        assert matrix.dtype == np.float32
+        assert [len(call) for call in embeddings.calls] == [2, 2]  # 4 textos distintos, lotes de 2
+        assert np.allclose(np.linalg.norm(matrix, axis=1), 1.0)
+
+        embedder.embed_many(["dos", "tres"])
+        assert len(embeddings.calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_query_embedding_is_reused_on_write(self, embedder, embeddings, buffer):
+        await embedder.aembed("¿Cuántos días de vacaciones tengo?")
+        self.write(buffer, ("human", "¿Cuántos días de vacaciones tengo?"))
+        assert len(embeddings.calls) == 1
+        assert embedder.get_stats()["cache"]["hits"] == 1
+
+    def test_only_user_messages_are_embedded(self, buffer):
+        self.write(buffer, ("human", "¿Me pagan el feriado?"), ("ai", "Sí, con sobretasa."))
+        persistence = buffer.persistence
+        vectors = persistence.get_vectors("session_a", "fake")
+        assert len(vectors) == 1
+        assert len(vectors[0][1]) == 32 * 4   # float32
+        assert persistence.get_unembedded("fake") == []
+
+    @pytest.mark.asyncio
+    async def test_recall_finds_related_question_without_shared_words(self, buffer, embedder):
+        self.write(buffer,
+                   ("human", "¿Cuántos días de vacaciones me quedan?"),
+                   ("human", "¿Cuándo depositan el sueldo?"),
+                   ("human", "Quiero presentar mi renuncia"))
+        index = EpisodicVectorIndex("session_a", buffer.persistence, embedder)
+
+        results = await index.recall("¿Me toca descanso pronto?", k=2)
+
+        assert [message.content for message, _ in results] == ["¿Cuántos días de vacaciones me quedan?"]
+        assert results[0][1] >= 0.45
+        # Sin términos en común, la búsqueda de texto no la encuentra
+        assert buffer.persistence.search_episodic("session_a", "¿Me toca descanso pronto?") == []
+
+    @pytest.mark.asyncio
+    async def test_index_loads_new_vectors_incrementally(self, buffer, embedder):
+        self.write(buffer, ("human", "¿Cuándo depositan el sueldo?"))
+        index = EpisodicVectorIndex("session_a", buffer.persistence, embedder)
+        await index.recall("pago")
+        assert len(index) == 1
+
+        self.write(buffer, ("human", "¿Y la gratificación?"))
+        results = await index.recall("salario", k=5)
+        assert len(index) == 2
+        assert len(results) == 2
+
+    @pytest.mark.asyncio
+    async def test_recall_is_scoped_to_session(self, buffer, embedder):
+        self.write(buffer, ("human", "Mis vacaciones"), session_id="session_b")
+        index = EpisodicVectorIndex("session_a", buffer.persistence, embedder)
+        assert await index.recall("vacaciones") == []
+
+    def test_deleting_messages_deletes_vectors(self, buffer):
+        self.write(buffer, ("human", "¿Me pagan el feriado?"))
+        with buffer.persistence.pool.connection() as conn:
+            conn.execute("DELETE FROM episodic_memory")
+        assert buffer.persistence.get_vectors("session_a", "fake") == []
+
+    def test_embedding_failure_keeps_messages_pending(self, tmp_path):
+        embedder = MessageEmbedder(embeddings=FakeEmbeddings(fail=True), model="fake")
+        buffer = MemoryWriteBuffer(LocalMemoryPersistence(base_path=str(tmp_path)), flush_interval=60,
+                                   remote_sync=False, embedder=embedder, remote_retry_interval=60)
+        self.write(buffer, ("human", "hola"))
+        buffer.flush()
+        assert buffer.get_stats()["embed_failures"] == 1
+        assert len(buffer.persistence.get_unembedded("fake")) == 1
+        buffer.stop()
+
+    @pytest.mark.asyncio
+    async def test_advanced_memory_recall_similar(self, buffer, embedder):
+        self.write(buffer, ("human", "¿Cuántos días de vacaciones me quedan?"))
+        memory_system = SimpleNamespace(vector_index=EpisodicVectorIndex("session_a", buffer.persistence, embedder))
+        results = await AdvancedMemorySystem.recall_similar(memory_system, "descanso")
+        assert [m.content for m in results] == ["¿Cuántos días de vacaciones me quedan?"]
+
+        failing = SimpleNamespace(vector_index=SimpleNamespace(recall=AsyncMock(side_effect=RuntimeError("x"))))
+        assert await AdvancedMemorySystem.recall_similar(failing, "descanso") == []
+
+
+class TestVectorRecallBenchmark:
+    """Benchmark: búsqueda coseno vectorizada sobre el historial de un usuario"""
+
+    DIMENSIONS = 256
+    SEARCHES = 200
+
+    @pytest.mark.parametrize("messages", [1_000, 10_000])
+    def test_search_latency(self, tmp_path, messages):
+        rng = np.random.default_rng(messages)
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        persistence.save_episodic_messages([("session_a", "human", f"pregunta {i}", {}) for i in range(messages)])
+        ids = [row[0] for row in persistence.get_unembedded("bench", limit=messages)]
+        vectors = rng.standard_normal((messages, self.DIMENSIONS)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        persistence.save_vectors([(i, "session_a", "bench", v) for i, v in zip(ids, vectors)])
+
+        embedder = SimpleNamespace(model="bench")
+        index = EpisodicVectorIndex("session_a", persistence, embedder)
+        start = time.perf_counter()
+        index.search(vectors[0], k=3, min_similarity=-1)
+        load_ms = (time.perf_counter() - start) * 1000
+
+        timings = []
+        for i in range(self.SEARCHES):
+            start = time.perf_counter()
+            top = index.search(vectors[i % messages], k=3, min_similarity=-1)
+            timings.append(time.perf_counter() - start)
+        median_ms = sorted(timings)[len(timings) // 2] * 1000
+
+        print(f"\n🧭 {messages:,} vectores ({index.nbytes / 1024:.0f} KB): carga {load_ms:.1f}ms, "
+              f"búsqueda top-3 {median_ms:.3f}ms (mediana)")
+        assert top[0][0] == ids[(self.SEARCHES - 1) % messages]
+        assert median_ms < 5
+
+
+class TestSessionBackupScheduler:
+    """Tests para los backups programados de sesiones"""
+
+    @pytest.fixture
+    def persistence(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        persistence.save_episodic_messages([(f"session_{i}", "human", f"hola {i}", {}) for i in range(5)])
+        return persistence
+
+    def backup_of(self, persistence, session_id):
+        with persistence.pool.connection() as conn:
+            return conn.execute("SELECT compressed_backup, last_activity, total_messages FROM session_metadata "
+                                "WHERE session_id = ?", (session_id,)).fetchone()
+
+    def test_only_dirty_sessions_are_backed_up(self, persistence):
+        backups = SessionBackupScheduler(persistence)
+        backups.mark_dirty("session_1")
+        backups.mark_dirty("session_3")
+        backups.mark_dirty("session_1")
+
+        assert asyncio.run(backups.run_pending()) == 2
+        assert self.backup_of(persistence, "session_1")[0] is not None
+        assert self.backup_of(persistence, "session_3")[0] is not None
+        assert self.backup_of(persistence, "session_0")[0] is None
+
+        # Sin cambios nuevos no se repite ningún backup
+        assert asyncio.run(backups.run_pending()) == 0
+        assert backups.get_stats()["backups"] == 2
+
+    def test_backup_keeps_session_metadata(self, persistence):
+        backups = SessionBackupScheduler(persistence)
+        backups.mark_dirty("session_2")
+        asyncio.run(backups.run_pending())
+
+        _, last_activity, total_messages = self.backup_of(persistence, "session_2")
+        assert last_activity is not None
+        assert total_messages == 1
+        with persistence.pool.connection() as conn:
+            conn.execute("DELETE FROM episodic_memory WHERE session_id = 'session_2'")
+        assert persistence.restore_from_backup("session_2")
+        assert persistence.get_episodic_messages("session_2")[0]["content"] == "hola 2"
+
+    def test_batches_respect_concurrency_limit(self, persistence):
+        running, peak, done = [0], [0], []
+        lock = threading.Lock()
+
+        def slow_backup(session_id):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+                done.append(session_id)
+
+        persistence.create_compressed_backup = slow_backup
+        backups = SessionBackupScheduler(persistence, batch_size=10, max_concurrency=3)
+        for i in range(25):
+            backups.mark_dirty(f"session_{i}")
+
+        assert asyncio.run(backups.run_pending()) == 25
+        assert sorted(done) == sorted(f"session_{i}" for i in range(25))
+        assert peak[0] <= 3
+
+    def test_failed_backup_stays_dirty(self, persistence):
+        backups = SessionBackupScheduler(persistence)
+        persistence.create_compressed_backup = lambda session_id: (_ for _ in ()).throw(sqlite3.OperationalError("locked"))
+        backups.mark_dirty("session_1")
+
+        assert asyncio.run(backups.run_pending()) == 0
+        assert backups.is_dirty("session_1")
+        assert backups.get_stats()["failures"] == 1
+
+    def test_cancel_drops_pending_backup(self, persistence):
+        backups = SessionBackupScheduler(persistence)
+        backups.mark_dirty("session_1")
+        assert backups.cancel("session_1")
+        assert not backups.cancel("session_1")
+        assert asyncio.run(backups.run_pending()) == 0
+
+
+class TestSessionBackupThreads:
+    """Benchmark: hilos vivos con muchas sesiones en RAM (antes un Timer por sesión)"""
+
+    SESSIONS = 10_000
+
+    def test_thread_count_stays_flat(self, tmp_path):
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        buffer = MemoryWriteBuffer(persistence, flush_interval=60, remote_sync=False)
+        backups = SessionBackupScheduler(persistence, batch_size=500, max_concurrency=4)
+        empty = SimpleNamespace(status_code=200, json=lambda: [])
+
+        with patch("memoria._local_persistence", persistence), \
+                patch("memoria.memory_write_buffer", buffer), \
+                patch("memoria.session_backups", backups), \
+                patch("memoria.make_supabase_request", lambda *args, **kwargs: empty), \
+                patch("memoria.MEMORY_VECTOR_RECALL", False), \
+                patch("builtins.print"):
+            manager = AdvancedMemoryManager()
+            manager.get_memory_for_session("session_warmup").add_message(HumanMessage(content="hola"))
+            before = threading.active_count()
+
+            start = time.perf_counter()
+            for i in range(self.SESSIONS):
+                manager.get_memory_for_session(f"session_{i}").add_message(HumanMessage(content=f"hola {i}"))
+            created_s = time.perf_counter() - start
+            during = threading.active_count()
+
+            buffer.flush(remote=False)
+            start = time.perf_counter()
+            backed_up = asyncio.run(backups.run_pending())
+            backup_s = time.perf_counter() - start
+            buffer.stop()
+
+        print(f"\n🧵 {self.SESSIONS:,} sesiones: hilos {before} → {during} "
+              f"(antes +{self.SESSIONS:,} Timers); alta {created_s:.1f}s, backup por lotes {backup_s:.1f}s")
+        assert during <= before
+        assert backed_up == self.SESSIONS + 1
+        assert threading.active_count() <= before
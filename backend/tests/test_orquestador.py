@@ -0,0 +1,484 @@
+import pytest
+import sys
+import os
+import gc
+import time
+import asyncio
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+import memoria
+import orquestador
+from orquestador import AgentTemplate, MainOrchestrator, OrchestratorPool
+from utilidades import ExpiryTracker
+from memoria import session_id_for_user, AdvancedMemoryManager, LocalMemoryPersistence, MemoryWriteBuffer
+from cliente_supabase import SupabaseClient, CircuitBreaker
+from postgrest_stub import PostgRESTStub
+
+TOOL_MARKER = "RESULTADO_HERRAMIENTA"
+LLM_DELAY = 0.05
+TOOL_DELAY = 0.2
+
+
+class SlowFakeChatModel(BaseChatModel):
+    """LLM falso solo asíncrono: primero pide buscar_documentos y luego responde"""
+
+    delay: float = LLM_DELAY
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow-fake"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise AssertionError("El agente no debe usar la ruta síncrona del LLM")
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        seen = " ".join(str(m.content) for m in messages)
+        if TOOL_MARKER in seen:
+            text = '```json\n{"action": "Final Answer", "action_input": "Tienes 30 días de vacaciones 😊"}\n```'
+        else:
+            text = '```json\n{"action": "buscar_documentos", "action_input": "vacaciones"}\n```'
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class FakeIndexerAgent:
+    """Búsqueda de documentos falsa: espera sin bloquear y registra dónde se ejecutó"""
+
+    calls = []
+
+    async def search_documents(self, query):
+        FakeIndexerAgent.calls.append((asyncio.get_running_loop(), threading.current_thread()))
+        await asyncio.sleep(TOOL_DELAY)
+        return [{"content": TOOL_MARKER, "metadata": {"file_name": "reglamento.pdf"}}]
+
+
+class FakeWebSearchAgent:
+    async def get_web_data(self, query):
+        await asyncio.sleep(TOOL_DELAY)
+        return {"web_results": []}
+
+
+def make_memory_system(llm, session_id, short_term_k=10):
+    """Memoria avanzada falsa con memoria corta real de LangChain"""
+    memory_system = MagicMock()
+    memory_system.short_term_memory = ConversationBufferWindowMemory(
+        memory_key="chat_history", input_key="input", output_key="output",
+        return_messages=True, k=short_term_k
+    )
+    memory_system.get_user_profile.return_value = {}
+    memory_system.procedural_memory.get_procedure.return_value = []
+    memory_system.search_memory.return_value = []
+    memory_system.recall_similar = AsyncMock(return_value=[])
+    memory_system.get_memory_summary.return_value = {}
+
+    def add_message(message, **kwargs):
+        if isinstance(message, HumanMessage):
+            memory_system.short_term_memory.chat_memory.add_user_message(message.content)
+        else:
+            memory_system.short_term_memory.chat_memory.add_ai_message(message.content)
+
+    memory_system.add_message.side_effect = add_message
+    return memory_system
+
+
+@pytest.fixture
+def fake_agent_env():
+    """Orquestadores con LLM, herramientas y memoria falsos"""
+    FakeIndexerAgent.calls = []
+    with patch.object(orquestador, "ChatOpenAI", lambda **kwargs: SlowFakeChatModel()), \
+         patch.object(orquestador, "IndexerAgent", FakeIndexerAgent), \
+         patch.object(orquestador, "WebSearchAgent", FakeWebSearchAgent), \
+         patch.object(orquestador, "get_memory", make_memory_system), \
+         patch.object(orquestador, "_agent_template", None):
+        yield
+
+
+class TestAsyncAgent:
+    """Tests para la ejecución asíncrona del agente"""
+
+    @pytest.mark.asyncio
+    async def test_tools_run_on_main_loop(self, fake_agent_env):
+        """Las herramientas se ejecutan en el event loop principal, sin threads nuevos"""
+        orchestrator = MainOrchestrator()
+        result = await orchestrator.process_query("¿Cuántos días de vacaciones me corresponden?")
+
+        assert result["success"] is True
+        assert result["tools_used"] == ["buscar_documentos"]
+        assert "30 días" in result["response"]
+        assert FakeIndexerAgent.calls == [(asyncio.get_running_loop(), threading.current_thread())]
+
+    @pytest.mark.asyncio
+    async def test_tool_errors_are_reported_to_agent(self, fake_agent_env):
+        """Un error en la herramienta se devuelve como texto y no rompe la consulta"""
+        orchestrator = MainOrchestrator()
+
+        async def failing(query):
+            raise RuntimeError("supabase caído")
+
+        output = await orchestrator.template._run_tool("buscar_documentos", failing, "vacaciones")
+        assert "supabase caído" in output
+
+    @pytest.mark.asyncio
+    async def test_tool_timeout(self, fake_agent_env):
+        orchestrator = MainOrchestrator()
+        with patch.object(orquestador, "TOOL_TIMEOUT", 0.01):
+            output = await orchestrator.template._run_tool("buscar_web", asyncio.sleep, 1)
+        assert "tiempo de espera agotado" in output
+
+
+class TestAgentTemplate:
+    """Tests para la plantilla compartida del agente"""
+
+    def test_users_share_template(self, fake_agent_env):
+        """LLM, herramientas y executor se construyen una sola vez"""
+        first, second = MainOrchestrator(), MainOrchestrator()
+        assert first.template is second.template
+        assert first.llm is second.llm
+        assert first.memory is not second.memory
+
+    @pytest.mark.asyncio
+    async def test_memory_is_bound_per_call(self, fake_agent_env):
+        """Cada usuario ve solo su historial y cada intercambio se guarda una vez"""
+        first, second = MainOrchestrator(), MainOrchestrator()
+        await first.process_query("¿Cuántos días de vacaciones me corresponden?")
+
+        assert len(first.memory.chat_memory.messages) == 2
+        assert second.memory.chat_memory.messages == []
+
+        seen = []
+        original_ainvoke = first.template.executor.ainvoke
+
+        async def spy(inputs, *args, **kwargs):
+            seen.append(inputs["chat_history"])
+            return await original_ainvoke(inputs, *args, **kwargs)
+
+        with patch.object(type(first.template.executor), "ainvoke", side_effect=spy, autospec=False):
+            await second.process_query("¿Cuándo me pagan la gratificación?")
+        assert seen == [[]]
+
+
+class TestAgentTemplateBenchmark:
+    """Benchmark: latencia del primer mensaje y memoria por usuario, antes y después"""
+
+    USERS = 20
+
+    def _measure(self, build):
+        tracemalloc.start()
+        start = time.perf_counter()
+        orchestrators = [build() for _ in range(self.USERS)]
+        elapsed = time.perf_counter() - start
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(orchestrators) == self.USERS
+        return elapsed / self.USERS, retained / self.USERS
+
+    def test_shared_template_is_cheaper_per_user(self, monkeypatch):
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        # Memoria mínima para medir solo lo que aporta el agente
+        light_memory = lambda llm, session_id, short_term_k=10: SimpleNamespace(
+            short_term_memory=ConversationBufferWindowMemory(memory_key="chat_history", return_messages=True)
+        )
+        with patch.object(orquestador, "get_memory", light_memory):
+            # Antes: cada usuario construía LLM, embeddings, herramientas y executor
+            before_latency, before_bytes = self._measure(lambda: MainOrchestrator(template=AgentTemplate()))
+            # Después: solo la memoria es por usuario
+            template = AgentTemplate()
+            after_latency, after_bytes = self._measure(lambda: MainOrchestrator(template=template))
+
+        print(f"\n⏱️ Orquestador nuevo: {before_latency * 1000:.2f}ms → {after_latency * 1000:.2f}ms por usuario")
+        print(f"💾 Memoria por usuario: {before_bytes / 1024:.0f}KB → {after_bytes / 1024:.0f}KB")
+
+        assert after_latency < before_latency / 5
+        assert after_bytes < before_bytes / 5
+
+
+class FakeOrchestrator:
+    """Orquestador falso con tamaño configurable que registra si fue persistido"""
+
+    persisted = set()
+
+    def __init__(self, user_id, size=1000):
+        self.session_id = f"session_{user_id}"
+        self.size = size
+        self.released = False
+        self.rehydrated = self.session_id in FakeOrchestrator.persisted
+
+    def approximate_size(self):
+        return self.size
+
+    def release(self):
+        self.released = True
+        FakeOrchestrator.persisted.add(self.session_id)
+
+
+class TestOrchestratorPool:
+    """Tests para el pool LRU de orquestadores"""
+
+    @pytest.fixture(autouse=True)
+    def reset_persisted(self):
+        FakeOrchestrator.persisted = set()
+
+    def test_reuses_orchestrator(self):
+        pool = OrchestratorPool(max_entries=10, max_bytes=10**6, factory=FakeOrchestrator)
+        first = pool.get("51911111111")
+        assert pool.get("51911111111") is first
+        stats = pool.get_stats()
+        assert stats["hits"] == 1
+        assert stats["creations"] == 1
+        assert "51911111111" in pool
+
+    def test_evicts_least_recently_used_by_entries(self):
+        pool = OrchestratorPool(max_entries=2, max_bytes=10**6, factory=FakeOrchestrator)
+        a = pool.get("a")
+        pool.get("b")
+        pool.get("a")  # "b" pasa a ser el menos usado
+        pool.get("c")
+
+        assert "b" not in pool
+        assert "a" in pool and "c" in pool
+        assert len(pool) == 2
+        assert pool.get_stats()["evictions"] == 1
+        assert a.released is False
+
+    def test_evicts_by_approximate_bytes(self):
+        pool = OrchestratorPool(max_entries=100, max_bytes=2500, factory=FakeOrchestrator)
+        first = pool.get("a")
+        pool.get("b")
+        pool.get("c")
+
+        assert "a" not in pool
+        assert first.released is True
+        assert pool.get_stats()["approx_bytes"] == 2000
+
+    def test_size_is_remeasured_on_access(self):
+        pool = OrchestratorPool(max_entries=100, max_bytes=10**6, factory=FakeOrchestrator)
+        orchestrator = pool.get("a")
+        orchestrator.size = 5000
+        pool.get("a")
+        assert pool.get_stats()["approx_bytes"] == 5000
+
+    def test_evicted_user_is_rehydrated_with_same_session(self):
+        pool = OrchestratorPool(max_entries=1, max_bytes=10**6, factory=FakeOrchestrator)
+        first = pool.get("a")
+        pool.get("b")
+        assert first.released is True
+
+        rehydrated = pool.get("a")
+        assert rehydrated is not first
+        assert rehydrated.session_id == first.session_id
+        stats = pool.get_stats()
+        assert stats["rehydrations"] == 1
+        assert stats["rehydration_avg_ms"] >= 0
+
+    def test_explicit_evict_and_discard(self):
+        pool = OrchestratorPool(max_entries=10, max_bytes=10**6, factory=FakeOrchestrator)
+        first = pool.get("a")
+        assert pool.evict("a") is True
+        assert first.released is True
+        assert pool.evict("a") is False
+
+        pool.get("a")
+        assert pool.get_stats()["rehydrations"] == 1
+
+        assert pool.discard("a") is not None
+        assert "a" not in pool
+
+    @pytest.mark.asyncio
+    async def test_evictions_are_persisted_off_the_loop_and_outside_the_lock(self):
+        """El desalojo saca la víctima bajo el lock y la persiste en un hilo, sin el lock"""
+        pool = OrchestratorPool(max_entries=1, max_bytes=10**6, factory=FakeOrchestrator)
+        seen = []
+
+        class SlowRelease(FakeOrchestrator):
+            def release(self):
+                seen.append((threading.get_ident(), pool.lock.locked()))
+                time.sleep(0.05)
+                super().release()
+
+        pool.factory = SlowRelease
+        first = await pool.get_async("a")
+        await pool.get_async("b")
+
+        assert first.released is True
+        assert seen == [(seen[0][0], False)]
+        assert seen[0][0] != threading.get_ident()
+
+    @pytest.mark.asyncio
+    async def test_rehydration_waits_for_pending_release(self):
+        """Si el usuario vuelve mientras se persiste su desalojo, se rehidrata con la memoria ya guardada"""
+        pool = OrchestratorPool(max_entries=1, max_bytes=10**6, factory=FakeOrchestrator)
+        release_started = threading.Event()
+
+        class SlowRelease(FakeOrchestrator):
+            def release(self):
+                release_started.set()
+                time.sleep(0.1)
+                super().release()
+
+        pool.factory = SlowRelease
+        await pool.get_async("a")
+        evicting = asyncio.create_task(pool.get_async("b"))
+        await asyncio.to_thread(release_started.wait)
+
+        pool.factory = FakeOrchestrator
+        again = await pool.get_async("a")
+        await evicting
+
+        assert again.rehydrated is True
+
+    def test_default_factory_uses_stable_session(self):
+        """El pool crea los orquestadores con el session_id derivado del número"""
+        pool = OrchestratorPool(max_entries=10, max_bytes=10**6)
+        with patch.object(orquestador, "MainOrchestrator") as orchestrator_class:
+            orchestrator_class.return_value = FakeOrchestrator("51911111111")
+            pool.get("51911111111")
+        orchestrator_class.assert_called_once_with(session_id=session_id_for_user("51911111111"))
+
+    def test_memory_is_released_from_manager(self, fake_agent_env):
+        """Al desalojar, la sesión se quita del gestor de memoria"""
+        with patch.object(orquestador.advanced_memory_manager, "release_session") as release:
+            orchestrator = MainOrchestrator()
+            pool = OrchestratorPool(max_entries=10, max_bytes=10**6, factory=lambda user_id: orchestrator)
+            pool.get("a")
+            pool.evict("a")
+        release.assert_called_once_with(orchestrator.session_id)
+
+
+class TestInactivityCleanup:
+    """Tests para la expiración de usuarios inactivos"""
+
+    def test_messages_do_not_trigger_cleanup(self):
+        pool = OrchestratorPool(max_entries=10, max_bytes=10**6, factory=FakeOrchestrator)
+        with patch.object(orquestador, "user_orchestrators", pool), \
+             patch.object(orquestador, "last_activity", ExpiryTracker(10)), \
+             patch.object(orquestador, "check_and_cleanup_inactive_users") as cleanup:
+            orquestador.get_orchestrator_for_user("a")
+        cleanup.assert_not_called()
+
+    def test_scheduler_job_expires_inactive_users(self):
+        pool = OrchestratorPool(max_entries=10, max_bytes=10**6, factory=FakeOrchestrator)
+        tracker = ExpiryTracker(0.05)
+        with patch.object(orquestador, "user_orchestrators", pool), \
+             patch.object(orquestador, "last_activity", tracker):
+            inactive = orquestador.get_orchestrator_for_user("inactivo")
+            time.sleep(0.1)
+            orquestador.get_orchestrator_for_user("activo")
+
+            orquestador.check_and_cleanup_inactive_users()
+
+        # Se persiste y libera, sin borrar su historial
+        assert inactive.released is True
+        assert "inactivo" not in pool and "inactivo" not in tracker
+        assert "activo" in pool
+
+
+class TestConcurrentUsersLoad:
+    """Prueba de carga: N usuarios concurrentes se atienden en paralelo"""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("users", [25])
+    async def test_concurrent_users_are_served_concurrently(self, fake_agent_env, users):
+        orchestrators = [MainOrchestrator() for _ in range(users)]
+
+        # Latido: si una consulta bloquea el loop, el intervalo entre latidos se dispara
+        max_gap = 0.0
+        running = True
+
+        async def heartbeat():
+            nonlocal max_gap
+            last = time.perf_counter()
+            while running:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                max_gap = max(max_gap, now - last)
+                last = now
+
+        # Sin pausas del GC durante la medición
+        gc.disable()
+        try:
+            beat = asyncio.create_task(heartbeat())
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                o.process_query("¿Cuántos días de vacaciones me corresponden?") for o in orchestrators
+            ])
+            elapsed = time.perf_counter() - start
+            running = False
+            await beat
+        finally:
+            gc.enable()
+
+        sequential = users * (2 * LLM_DELAY + TOOL_DELAY)
+        print(f"\n👥 {users} usuarios: {elapsed:.2f}s (secuencial ≈ {sequential:.2f}s), "
+              f"latido máximo {max_gap * 1000:.0f}ms")
+
+        assert all(r["success"] for r in results)
+        assert all(r["tools_used"] == ["buscar_documentos"] for r in results)
+        assert elapsed < sequential / 4
+        assert max_gap < 0.25
+
+
+class TestMemoryOffEventLoop:
+    """La memoria real lee Supabase con el cliente síncrono: nunca desde el event loop"""
+
+    SUPABASE_DELAY = 0.3
+
+    @pytest.fixture
+    def slow_supabase(self, tmp_path, fake_agent_env):
+        stub = PostgRESTStub()
+        stub.latency = self.SUPABASE_DELAY
+        client = SupabaseClient(base_url="http://supabase.test", transport=stub.transport(), retry_backoff=0,
+                                breaker=CircuitBreaker(failure_threshold=10 ** 6))
+        persistence = LocalMemoryPersistence(base_path=str(tmp_path))
+        buffer = MemoryWriteBuffer(persistence, flush_interval=60, remote_sync=False)
+        with patch("cliente_supabase.supabase_client", client), \
+             patch.object(memoria, "_local_persistence", persistence), \
+             patch.object(memoria, "memory_write_buffer", buffer), \
+             patch.object(memoria, "MEMORY_VECTOR_RECALL", False), \
+             patch.object(memoria, "advanced_memory_manager", AdvancedMemoryManager()), \
+             patch.object(orquestador, "get_memory", memoria.get_memory):
+            yield stub
+            buffer.stop()
+
+    @pytest.mark.asyncio
+    async def test_slow_supabase_does_not_block_the_loop(self, slow_supabase):
+        pool = OrchestratorPool()
+        max_gap = 0.0
+        running = True
+
+        async def heartbeat():
+            nonlocal max_gap
+            last = time.perf_counter()
+            while running:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                max_gap = max(max_gap, now - last)
+                last = now
+
+        beat = asyncio.create_task(heartbeat())
+        try:
+            # Usuario nuevo: la cola episódica se pide a Supabase al construir su orquestador
+            orchestrator = await pool.get_async("51999888777")
+            # Perfil semántico, procedimientos y resumen de memoria: GET en cada consulta
+            result = await orchestrator.process_query("¿Cuántos días de vacaciones me corresponden?")
+        finally:
+            running = False
+            await beat
+
+        paths = [request.url.path.rsplit("/", 1)[-1] for request in slow_supabase.requests]
+        print(f"\n🐢 {len(paths)} GET a Supabase de {self.SUPABASE_DELAY * 1000:.0f}ms, "
+              f"latido máximo {max_gap * 1000:.0f}ms")
+
+        assert result["success"] is True
+        assert {"chat_history", "semantic_memory", "procedural_memory"} <= set(paths)
+        assert max_gap < self.SUPABASE_DELAY / 2
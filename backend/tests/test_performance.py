@@ -31,6 +31,7 @@ pytestmark = [
 PERFORMANCE_THRESHOLDS = {
     "api_response_time": 0.5,    # 500ms max
     "webhook_processing": 1.0,    # 1s max
+    "webhook_batch_ack": 0.2,     # 200ms max to ACK a batched payload
     "database_query": 0.1,       # 100ms max
     "ai_processing": 3.0,        # 3s max
     "concurrent_requests": 10,    # 10 concurrent max
@@ -80,6 +81,71 @@ class TestAPIPerformance:
         assert result.status_code == 200
         assert benchmark.stats.mean < PERFORMANCE_THRESHOLDS["api_response_time"]
 
+# ================================================================
+# WEBHOOK BATCH PERFORMANCE
+# ================================================================
+
+def build_batched_webhook_payload(batch_id: int, entries: int = 5, messages_per_entry: int = 10) -> Dict[str, Any]:
+    """Build a Meta-style payload with several entries, each carrying several messages."""
+    payload_entries = []
+    for entry_index in range(entries):
+        phone = f"519{entry_index:08d}"
+        payload_entries.append({
+            "id": f"entry_{entry_index}",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "contacts": [{"wa_id": phone, "profile": {"name": f"User {entry_index}"}}],
+                    "messages": [
+                        {
+                            "from": phone,
+                            "id": f"wamid.batch{batch_id}.{entry_index}.{n}",
+                            "timestamp": str(int(time.time())),
+                            "type": "text" if n % 5 else "image",
+                            "text": {"body": f"Consulta {n} sobre vacaciones"},
+                            "image": {"caption": "adjunto"}
+                        }
+                        for n in range(messages_per_entry)
+                    ]
+                }
+            }]
+        })
+    return {"object": "whatsapp_business_account", "entry": payload_entries}
+
+
+class TestWebhookBatchPerformance:
+    """Benchmark webhook fan-out of multi-entry, multi-message payloads."""
+    
+    @pytest.fixture
+    def webhook_client(self):
+        """Client without lifespan and with an isolated, not-started ingestion queue."""
+        from fastapi.testclient import TestClient
+        from cola_mensajes import IngestionQueue, MemoryQueueBackend
+        from main import app
+        
+        queue = IngestionQueue(backend=MemoryQueueBackend())
+        with patch("main.ingestion_queue", queue):
+            yield TestClient(app), queue
+    
+    @pytest.mark.benchmark
+    def test_batched_webhook_enqueues_every_message(self, webhook_client, benchmark):
+        """Every message of every entry must be enqueued and ACKed quickly."""
+        client, queue = webhook_client
+        posted = []
+        
+        def post_batch():
+            posted.append(len(posted))
+            return client.post("/webhook", json=build_batched_webhook_payload(posted[-1]))
+        
+        result = benchmark(post_batch)
+        
+        assert result.status_code == 200
+        assert result.json()["queued"] == 50
+        assert queue.stats["enqueued"] == 50 * len(posted)
+        assert queue.stats["duplicates"] == 0
+        assert benchmark.stats.stats.mean < PERFORMANCE_THRESHOLDS["webhook_batch_ack"]
+
 # ================================================================
 # LOAD TESTING
 # ================================================================
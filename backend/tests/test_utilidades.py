@@ -0,0 +1,130 @@
+import pytest
+import sys
+import os
+import time
+
+# Agregar el directorio src al path para importar módulos
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../src'))
+
+from utilidades import ExpiryTracker, LRUTTLCache
+
+
+class TestLRUTTLCache:
+    """Tests para la caché LRU con expiración"""
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUTTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUTTLCache(maxsize=10, ttl=0.05)
+        cache.set("a", 1)
+        time.sleep(0.06)
+
+        assert cache.get("a") is None
+        stats = cache.get_stats()
+        assert stats["expirations"] == 1
+        assert stats["size"] == 0
+
+    def test_hit_rate(self):
+        cache = LRUTTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+
+        assert cache.get_stats()["hit_rate"] == 0.5
+
+
+class TestExpiryTracker:
+    """Tests para el registro de inactividad basado en heap"""
+
+    def test_expires_inactive_keys(self):
+        tracker = ExpiryTracker(timeout=10)
+        tracker.touch("a", now=0)
+        tracker.touch("b", now=5)
+
+        assert tracker.expired(now=9) == []
+        assert tracker.expired(now=11) == ["a"]
+        assert "a" not in tracker
+        assert tracker.expired(now=16) == ["b"]
+        assert len(tracker) == 0
+
+    def test_activity_postpones_expiry(self):
+        tracker = ExpiryTracker(timeout=10)
+        tracker.touch("a", now=0)
+        tracker.touch("a", now=8)
+
+        assert tracker.expired(now=11) == []
+        assert tracker.last_seen("a") == 8
+        assert tracker.expired(now=19) == ["a"]
+
+    def test_removed_keys_do_not_expire(self):
+        tracker = ExpiryTracker(timeout=10)
+        tracker.touch("a", now=0)
+        tracker.remove("a")
+        tracker.touch("a", now=5)
+
+        assert tracker.expired(now=11) == []
+        assert tracker.expired(now=16) == ["a"]
+        assert tracker.expired(now=100) == []
+
+    def test_is_expired_does_not_remove(self):
+        tracker = ExpiryTracker(timeout=10)
+        tracker.touch("a", now=0)
+        assert tracker.is_expired("a", now=11) is True
+        assert tracker.is_expired("a", now=5) is False
+        assert "a" in tracker
+        assert tracker.is_expired("desconocido") is True
+
+
+class TestExpiryTrackerBenchmark:
+    """Microbenchmark con 100k usuarios: costo por mensaje y de la expiración"""
+
+    USERS = 100_000
+
+    def test_touch_is_constant_time_at_100k_users(self):
+        tracker = ExpiryTracker(timeout=3600)
+        last_activity = {}
+        for i in range(self.USERS):
+            tracker.touch(f"user_{i}", now=i * 0.01)
+            last_activity[f"user_{i}"] = i * 0.01
+        now = self.USERS * 0.01
+
+        # Antes: cada mensaje recorría todo el diccionario buscando inactivos
+        start = time.perf_counter()
+        for i in range(20):
+            [u for u, t in last_activity.items() if now - t > 3600]
+            last_activity[f"user_{i}"] = now
+        scan_per_message = (time.perf_counter() - start) / 20
+
+        # Después: cada mensaje solo actualiza su marca de tiempo
+        start = time.perf_counter()
+        for i in range(self.USERS):
+            tracker.touch(f"user_{i}", now=now)
+        touch_per_message = (time.perf_counter() - start) / self.USERS
+
+        print(f"\n⏱️ Por mensaje con {self.USERS:,} usuarios: escaneo {scan_per_message * 1e6:.0f}µs "
+              f"→ touch {touch_per_message * 1e6:.2f}µs")
+        assert touch_per_message * 50 < scan_per_message
+
+    def test_expiry_only_visits_due_keys(self):
+        tracker = ExpiryTracker(timeout=3600)
+        for i in range(self.USERS):
+            tracker.touch(f"user_{i}", now=float(i % 1000))
+
+        start = time.perf_counter()
+        expired = tracker.expired(now=3600 + 10.5)
+        elapsed = time.perf_counter() - start
+
+        # Vencen los usuarios con última actividad en [0, 10]: 11 de cada 1000
+        assert len(expired) == 11 * (self.USERS // 1000)
+        assert len(tracker) == self.USERS - len(expired)
+        print(f"\n🧹 Expiración de {len(expired):,} de {self.USERS:,} usuarios: {elapsed * 1000:.2f}ms")
+